@@ -0,0 +1,10 @@
+#
+# This module is used to let pytest import the repository packages from the test folders.
+#
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# End of file: conftest.py
@@ -0,0 +1,245 @@
+#
+# This module is used to declare device drivers and poll them with compiled, shared read plans.
+#
+
+import asyncio
+import time
+from functools import lru_cache
+from typing import AsyncIterator, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from protocols.modbusTCP.modbus_tcp_pipeline import PipelinedModbusTcpClient
+from utils.config_loader import RegisterMap, load_register_map
+from utils.poll_scheduler import ONCE
+from utils.register_decoder import BatchDecoder, block_decoder
+from utils.register_planner import MAX_READ_REGISTERS, READ_HOLDING_REGISTERS, ReadBlock
+
+
+# One poll group of a device model: the registers read together every interval seconds
+# (ONCE: only on the first poll, e.g. serial numbers). function_code None uses the model's FUNCTION_CODE.
+class PollGroup(NamedTuple):
+    name: str
+    interval: float
+    registers: Tuple[str, ...]
+    function_code: Optional[int] = None
+
+
+# A poll group compiled into coalesced read blocks, each with its decoder built.
+class CompiledGroup(NamedTuple):
+    name: str
+    interval: float
+    blocks: Tuple[ReadBlock, ...]
+    decoders: Tuple[BatchDecoder, ...]
+
+    @property
+    def register_count(self) -> int:
+        return sum(block.count for block in self.blocks)
+
+
+# The compiled poll plan of a device model, shared by every instance of it.
+class PollPlan(NamedTuple):
+    register_map: RegisterMap
+    groups: Tuple[CompiledGroup, ...]
+
+    def group(self, name: str) -> CompiledGroup:
+        for group in self.groups:
+            if group.name == name:
+                return group
+        raise KeyError(f"No poll group {name}")
+
+    @property
+    def request_count(self) -> int:
+        return sum(len(group.blocks) for group in self.groups)
+
+
+# Values read for one poll group of one device.
+# errors maps the blocks that failed (by their register range) to the reason.
+class GroupResult(NamedTuple):
+    device: str
+    group: str
+    timestamp: float
+    elapsed: float
+    values: Dict[str, object]
+    errors: Dict[str, str]
+
+
+def compile_group(register_map: RegisterMap, name: str, interval: float, registers: Iterable[str], function_code: int,
+                  max_gap: int = 0, max_count: int = MAX_READ_REGISTERS, byteorder="big",
+                  wordorder="big") -> CompiledGroup:
+    missing = [register for register in registers if register not in register_map]
+    if missing:
+        raise KeyError(f"Poll group {name} names unknown registers: {', '.join(missing)}")
+    blocks = RegisterMap([register_map[register] for register in registers]).plan(max_gap, max_count, function_code)
+    return CompiledGroup(name, interval, blocks,
+                         tuple(block_decoder(block, byteorder, wordorder) for block in blocks))
+
+
+# Compiled plan of a model for a register map. Register maps loaded from a config
+# are replaced when the file changes, so an edited config compiles a new plan and
+# the old one ages out of the cache.
+@lru_cache(maxsize=64)
+def _compile_plan(model: type, register_map: RegisterMap) -> PollPlan:
+    groups = model.POLL_GROUPS or (PollGroup("all", model.POLL_INTERVAL, tuple(register_map.by_name)),)
+    return PollPlan(register_map, tuple(
+        compile_group(register_map, group.name, group.interval, group.registers,
+                      model.FUNCTION_CODE if group.function_code is None else group.function_code,
+                      model.MAX_GAP, model.MAX_COUNT, model.BYTEORDER, model.WORDORDER)
+        for group in groups))
+
+
+# Group BaseDevice.read() sends for names, compiled once per model and register map.
+@lru_cache(maxsize=256)
+def _compile_read(model: type, register_map: RegisterMap, names: Tuple[str, ...]) -> CompiledGroup:
+    return compile_group(register_map, "read", 0.0, names, model.FUNCTION_CODE, model.MAX_GAP, model.MAX_COUNT,
+                         model.BYTEORDER, model.WORDORDER)
+
+
+# This class is the base of every device driver.
+# A driver only declares its model: the register map (REGISTER_MAP, or
+# CONFIG_FILE and CONFIG_KEYS to load it from a JSON config), its POLL_GROUPS and
+# how to read them. The declaration is compiled once per model into a PollPlan of
+# coalesced blocks with prebuilt decoders, cached and reused by every instance;
+# an instance just sends the plan's requests over its client. Without
+# POLL_GROUPS the whole map is one group polled every POLL_INTERVAL seconds.
+# The client is anything with an async read_registers(unit, address, count,
+# function_code), by default a PipelinedModbusTcpClient to host and port, so the
+# blocks of a group are sent together and cost about one round trip.
+class BaseDevice:
+    MODEL = "device"
+    REGISTER_MAP: Iterable[Sequence] = ()
+    CONFIG_FILE: Optional[str] = None
+    CONFIG_KEYS: Tuple[str, ...] = ()
+    POLL_GROUPS: Sequence[PollGroup] = ()
+    POLL_INTERVAL = 1.0
+    FUNCTION_CODE = READ_HOLDING_REGISTERS
+    MAX_GAP = 0
+    MAX_COUNT = MAX_READ_REGISTERS
+    BYTEORDER = "big"
+    WORDORDER = "big"
+    PORT = 502
+
+    def __init__(self, host: Optional[str] = None, port: Optional[int] = None, unit_id: int = 1,
+                 name: Optional[str] = None, client=None, register_map: Optional[RegisterMap] = None):
+        if client is None:
+            if host is None:
+                raise ValueError(f"{type(self).__name__} needs a host or a client")
+            client = PipelinedModbusTcpClient(host, port or self.PORT)
+        self.client = client
+        self.unit_id = unit_id
+        self.name = name or f"{self.MODEL}/{unit_id}"
+        # Instances given their own map share the plan compiled for that map.
+        self._register_map = register_map
+        # Values of the ONCE groups, kept from their single read.
+        self.static_values: Dict[str, object] = {}
+        self._last_poll: Dict[str, float] = {}
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def connect(self):
+        if not self.client.connected:
+            await self.client.connect()
+
+    async def close(self):
+        await self.client.close()
+
+    # The model's register map.
+    @classmethod
+    def register_map(cls) -> RegisterMap:
+        if cls.CONFIG_FILE is not None:
+            return load_register_map(cls.CONFIG_FILE, *cls.CONFIG_KEYS)
+        if not isinstance(cls.REGISTER_MAP, RegisterMap):
+            cls.REGISTER_MAP = RegisterMap(cls.REGISTER_MAP)
+        return cls.REGISTER_MAP
+
+    # The compiled poll plan for register_map (the model's by default).
+    @classmethod
+    def compile(cls, register_map: Optional[RegisterMap] = None) -> PollPlan:
+        return _compile_plan(cls, cls.register_map() if register_map is None else register_map)
+
+    @property
+    def plan(self) -> PollPlan:
+        return self.compile(self._register_map)
+
+    async def _read_block(self, block: ReadBlock, decoder: BatchDecoder) -> Dict[str, object]:
+        registers = await self.client.read_registers(self.unit_id, block.address, block.count, block.function_code)
+        return decoder.decode(registers)
+
+    # Read every block of a compiled group at once and decode the values.
+    async def read_group(self, group: CompiledGroup) -> GroupResult:
+        await self.connect()
+        timestamp = time.time()
+        start = time.perf_counter()
+        results = await asyncio.gather(*(self._read_block(block, decoder)
+                                         for block, decoder in zip(group.blocks, group.decoders)),
+                                       return_exceptions=True)
+        values: Dict[str, object] = {}
+        errors: Dict[str, str] = {}
+        for block, result in zip(group.blocks, results):
+            if isinstance(result, BaseException):
+                errors[f"{block.address}-{block.address + block.count - 1}"] = str(result) or type(result).__name__
+            else:
+                values.update(result)
+        # A ONCE group none of whose blocks answered stays due, so it is tried again.
+        if group.interval > ONCE or not errors or len(errors) < len(group.blocks):
+            self._last_poll[group.name] = time.monotonic()
+        if group.interval == ONCE and group in self.plan.groups:
+            self.static_values.update(values)
+        return GroupResult(self.name, group.name, timestamp, time.perf_counter() - start, values, errors)
+
+    # Poll one group by name.
+    async def poll_group(self, name: str) -> GroupResult:
+        return await self.read_group(self.plan.group(name))
+
+    # Poll every group (or the named ones) at once; ONCE groups already read are left out
+    # unless named.
+    async def poll(self, groups: Optional[Iterable[str]] = None) -> List[GroupResult]:
+        plan = self.plan
+        if groups is None:
+            selected = [group for group in plan.groups if group.interval > ONCE or group.name not in self._last_poll]
+        else:
+            selected = [plan.group(name) for name in groups]
+        return list(await asyncio.gather(*(self.read_group(group) for group in selected)))
+
+    # Monotonic time a group is next due: now if never read, never again for ONCE groups.
+    def _due_at(self, group: CompiledGroup) -> float:
+        last = self._last_poll.get(group.name)
+        if last is None:
+            return float("-inf")
+        return last + group.interval if group.interval > ONCE else float("inf")
+
+    # Poll the groups whose interval has passed since they were last read, most overdue first.
+    async def poll_due(self) -> List[GroupResult]:
+        now = time.monotonic()
+        due = sorted((group for group in self.plan.groups if self._due_at(group) <= now), key=self._due_at)
+        return list(await asyncio.gather(*(self.read_group(group) for group in due)))
+
+    # Seconds until the next group is due.
+    def next_due(self) -> float:
+        due = [self._due_at(group) for group in self.plan.groups if group.interval > ONCE]
+        return max(0.0, min(due, default=time.monotonic() + self.POLL_INTERVAL) - time.monotonic())
+
+    # Yield group results as their intervals come due.
+    async def results(self) -> AsyncIterator[GroupResult]:
+        while True:
+            for result in await self.poll_due():
+                yield result
+            await asyncio.sleep(self.next_due())
+
+    # The group read() sends for names.
+    @classmethod
+    def compile_read(cls, register_map: RegisterMap, names: Tuple[str, ...]) -> CompiledGroup:
+        return _compile_read(cls, register_map, tuple(names))
+
+    # Read named registers once, outside the poll groups.
+    async def read(self, *names: str) -> Dict[str, object]:
+        group = self.compile_read(self.plan.register_map, names)
+        result = await self.read_group(group)
+        if result.errors:
+            raise ConnectionError(f"{self.name}: {'; '.join(result.errors.values())}")
+        return result.values
+
+# End of file: devices/base_device.py
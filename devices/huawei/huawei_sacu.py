@@ -6,9 +6,18 @@
 
 
 ## Importing required modules.
-from comm_protocols.modbus_tcp_test import ModbusTcpTest
-from tools.timer import Timer
-from tools.logger import Logger
+import asyncio
+import os
+import time
+from typing import AsyncIterator, Dict, Iterable, NamedTuple, Optional, Sequence
+
+from devices.base_device import BaseDevice, PollGroup
+from protocols.modbusTCP.modbus_tcp_pipeline import PipelinedModbusTcpClient
+from protocols.modbusTCP.modbus_tcp_test import ModbusTcpTest
+from utils.config_loader import RegisterMap
+from utils.poll_scheduler import ONCE
+from utils.timer import Timer
+from utils.logger import Logger
 
 # HuaweiSacu ip address.
 sacu_ip_address = "192.168.0.5"
@@ -36,6 +45,9 @@ for i in range(0, len(sacu_bms_id)):
 # HuaweiSacu registers list
 sacu_serial_num_reg = 40713 # string type, 10 registers
 
+# HuaweiSacu config file holding the SACU register map.
+sacu_config_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "config", "huawei", "sacu_config.json")
+
 # This class is used to test Huawei SACU device.
 class test_HuaweiSacu:
     def __init__(self):
@@ -61,34 +73,114 @@ class test_HuaweiSacu:
         serial_num = self.modbus.read_string(sacu_slave_id, sacu_serial_num_reg, 10)
         return serial_num
 
+
+# One consolidated poll of the SACU and its sub-devices.
+# values maps device names ('SACU', 'PCS1', 'BMS11'...) to their named values;
+# errors maps the devices that failed this cycle to the reason.
+class SacuSnapshot(NamedTuple):
+    timestamp: float
+    elapsed: float
+    values: Dict[str, Dict[str, object]]
+    errors: Dict[str, str]
+
+
+# Huawei SACU: the register map comes from the SACU config.
+# The serial number never changes, so it is read once instead of every cycle.
+class HuaweiSacu(BaseDevice):
+    MODEL = "huawei.sacu"
+    CONFIG_FILE = sacu_config_file
+    CONFIG_KEYS = ("huawei", "sacu")
+    POLL_GROUPS = (PollGroup("identity", ONCE, ("serial_number",)),)
+    PORT = port_number
+
+
+# PCS and BMS units behind the SACU; their register maps are given per site.
+class HuaweiPcs(BaseDevice):
+    MODEL = "huawei.pcs"
+    PORT = port_number
+
+
+class HuaweiBms(BaseDevice):
+    MODEL = "huawei.bms"
+    PORT = port_number
+
+
+# This class is used to poll the SACU and every sub-device behind it over one TCP connection.
+# Each unit is a BaseDevice sharing the connection, and units of one model share
+# one compiled poll plan. All coalesced reads of a cycle are sent together and
+# matched back by transaction id, so a cycle costs about one round trip plus the
+# SACU's own processing time instead of one round trip per request. Register maps
+# hold (address, count, decode, name) entries.
+class HuaweiSacuFleet:
+    def __init__(self, host=sacu_ip_address, port=port_number, pcs_map: Iterable[Sequence] = (),
+                 bms_map: Iterable[Sequence] = (), sacu_map: Optional[Iterable[Sequence]] = None,
+                 max_in_flight=len(sacu_pcs_id) + len(sacu_bms_id) + 1, timeout=3.0):
+        self.client = PipelinedModbusTcpClient(host, port, max_in_flight, timeout)
+        self.devices: Dict[str, BaseDevice] = {}
+        for model, slave_ids, register_map in ((HuaweiSacu, [sacu_slave_id], sacu_map),
+                                               (HuaweiPcs, sacu_pcs_id, pcs_map), (HuaweiBms, sacu_bms_id, bms_map)):
+            # One map object per model, so every unit of it reuses the same compiled plan.
+            register_map = None if register_map is None else RegisterMap(register_map)
+            if not (model.register_map() if register_map is None else register_map):
+                continue
+            for slave_id in slave_ids:
+                name = "SACU" if model is HuaweiSacu else model.MODEL.split(".")[-1].upper() + str(slave_id)
+                self.devices[name] = model(unit_id=slave_id, name=name, client=self.client, register_map=register_map)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def connect(self):
+        await self.client.connect()
+
+    async def close(self):
+        await self.client.close()
+
+    # Poll every device once and return the consolidated snapshot.
+    async def snapshot(self) -> SacuSnapshot:
+        if not self.client.connected:
+            await self.client.connect()
+        timestamp = time.time()
+        start = time.perf_counter()
+        results = await asyncio.gather(*(device.poll() for device in self.devices.values()))
+        values: Dict[str, Dict[str, object]] = {name: dict(device.static_values)
+                                                 for name, device in self.devices.items()}
+        errors: Dict[str, str] = {}
+        for name, device_results in zip(self.devices, results):
+            for result in device_results:
+                values[name].update(result.values)
+                if result.errors:
+                    errors.setdefault(name, next(iter(result.errors.values())))
+        return SacuSnapshot(timestamp, time.perf_counter() - start, values, errors)
+
+    # Yield a snapshot every period seconds (back to back when period is 0).
+    async def snapshots(self, period: float = 0.0) -> AsyncIterator[SacuSnapshot]:
+        while True:
+            snapshot = await self.snapshot()
+            yield snapshot
+            if period > snapshot.elapsed:
+                await asyncio.sleep(period - snapshot.elapsed)
+
+
+# Poll the SACU and its sub-devices a few times and print how long each snapshot took.
+async def print_snapshots(host=sacu_ip_address, port=port_number, count: int = 5, period: float = 1.0):
+    async with HuaweiSacuFleet(host, port) as fleet:
+        snapshots = fleet.snapshots(period)
+        for _ in range(count):
+            snapshot = await snapshots.__anext__()
+            print(f"Snapshot of {len(snapshot.values)} devices in {1000 * snapshot.elapsed:.1f} ms, "
+                  f"{len(snapshot.errors)} failed")
+            for name, error in snapshot.errors.items():
+                print(f"  {name}: {error}")
+        if "SACU" in fleet.devices:
+            print("SACU serial number:", fleet.devices["SACU"].static_values.get("serial_number"))
+
+
 if __name__ == "__main__":
-    # Create a test_HuaweiSacu object.
-    test_sacu = test_HuaweiSacu()
-    # Connect to the HuaweiSacu device.
-    
-    test_sacu.connect()
-    
-    if test_sacu.modbus.is_connected() == True:
-        Logger.info("Connection to HuaweiSacu device is successful.")
-        # Read the serial number of HuaweiSacu device.
-        Logger.info("Reading the serial number of HuaweiSacu device...")
-        # Reset the timer.
-        test_sacu.timer.reset()
-        # Start the timer.
-        test_sacu.timer.start()
-        # Read the serial number of HuaweiSacu device.
-        serial_num = test_sacu.read_serial_num()
-        # Stop the timer.
-        test_sacu.timer.stop()
-        # Display the serial number of HuaweiSacu device.
-        Logger.info("Serial number of HuaweiSacu device: " + serial_num)
-        # Display the time taken to read the serial number.
-        Logger.info("Time taken to read the serial number: " + str(test_sacu.timer.elapsed_time()) + " seconds.")
-        
-    else:
-        Logger.error("Connection to HuaweiSacu device is unsuccessful.")
-    
-    # Close the connection to the HuaweiSacu device.
-    test_sacu.disconnect()
+    asyncio.run(print_snapshots())
 
-# End of script.
\ No newline at end of file
+# End of script.
@@ -1,12 +1,17 @@
 #
 # This module is used to test the Siemens S7-1200 PLC device.
+#
+
+# The PLC is read through its MB_SERVER block (Modbus TCP), which maps a data
+# block onto holding registers from 40001 up.
+
+from devices.base_device import BaseDevice
 
-from comm_protocols import ModbusTcpTest
-from tools import Timer
 
-class test_SiemensS7_1200_PLC:
-    def __init__(self):
-        pass
+# Siemens S7-1200 PLC. The holding register layout depends on the PLC program,
+# so the register map (and any poll groups) is given per site; every PLC with
+# the same map shares one compiled poll plan.
+class SiemensS71200Plc(BaseDevice):
+    MODEL = "siemens.s7_1200"
 
-    def test(self):
-        print("SiemensS7_1200_PLC.test() called")
\ No newline at end of file
+# End of file: devices/siemens/siemens_s7_1200_plc.py
@@ -0,0 +1,180 @@
+#
+# This module is used to run the protocol and device tests from one command line.
+#
+# Run from the repository root:
+#   python main.py --list
+#   python main.py modbus* huawei* --jobs 4 --timeout 60
+#
+# Tests are found by reading the sources under protocols/ and devices/ (nothing is
+# imported to find them) and each selected test runs as its own Python process,
+# so only the stacks that test needs are ever loaded. Keep this module on the
+# standard library: the watchdog restarts it often on slow gateways.
+#
+
+import argparse
+import fnmatch
+import os
+import re
+import subprocess
+import sys
+import time
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Directories searched for tests, one level of protocol or vendor folders below each.
+TEST_DIRS = ("protocols", "devices")
+
+# A module is a runnable test when it has a top-level main guard.
+_MAIN_GUARD = re.compile(rb"^if __name__ == ['\"]__main__['\"]\s*:", re.MULTILINE)
+
+
+# One runnable test script, named by its path below the repository root without .py.
+class TestTarget(NamedTuple):
+    name: str
+    path: str
+
+    @property
+    def stem(self) -> str:
+        return self.name.rsplit("/", 1)[-1]
+
+
+# Outcome of one test run; returncode is None when it timed out.
+class TestResult(NamedTuple):
+    target: TestTarget
+    returncode: Optional[int]
+    elapsed: float
+    output: str
+
+    @property
+    def status(self) -> str:
+        if self.returncode is None:
+            return "timeout"
+        return "ok" if self.returncode == 0 else f"failed ({self.returncode})"
+
+
+# Runnable test scripts under root's TEST_DIRS, sorted by name.
+def discover(root: str = ROOT) -> List[TestTarget]:
+    targets = []
+    for directory in TEST_DIRS:
+        top = os.path.join(root, directory)
+        if not os.path.isdir(top):
+            continue
+        for folder in sorted(os.scandir(top), key=lambda entry: entry.name):
+            if not folder.is_dir() or folder.name.startswith(("_", ".")):
+                continue
+            for entry in sorted(os.scandir(folder.path), key=lambda entry: entry.name):
+                if not entry.name.endswith(".py") or not entry.is_file():
+                    continue
+                with open(entry.path, "rb") as file:
+                    if not _MAIN_GUARD.search(file.read()):
+                        continue
+                targets.append(TestTarget(f"{directory}/{folder.name}/{entry.name[:-3]}", entry.path))
+    return targets
+
+
+# Targets matching any pattern, on their full name or module name (every target without patterns).
+def select(targets: Sequence[TestTarget], patterns: Sequence[str]) -> List[TestTarget]:
+    if not patterns:
+        return list(targets)
+    unmatched = [pattern for pattern in patterns
+                 if not any(fnmatch.fnmatch(target.name, pattern) or fnmatch.fnmatch(target.stem, pattern)
+                            for target in targets)]
+    if unmatched:
+        raise ValueError(f"No tests match {', '.join(unmatched)}")
+    return [target for target in targets
+            if any(fnmatch.fnmatch(target.name, pattern) or fnmatch.fnmatch(target.stem, pattern)
+                   for pattern in patterns)]
+
+
+# Environment of a test process: the repository root goes first on its import path.
+def test_environment(root: str = ROOT) -> Dict[str, str]:
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, (root, env.get("PYTHONPATH"))))
+    return env
+
+
+# Run one test script to completion (or timeout seconds) and collect its output.
+def run_target(target: TestTarget, timeout: Optional[float] = None, env: Optional[Dict[str, str]] = None,
+               root: str = ROOT) -> TestResult:
+    start = time.perf_counter()
+    try:
+        completed = subprocess.run([sys.executable, target.path], cwd=root, env=env or test_environment(root),
+                                   stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   timeout=timeout)
+    except subprocess.TimeoutExpired as e:
+        output = e.stdout or b""
+        return TestResult(target, None, time.perf_counter() - start, output.decode("utf-8", "replace"))
+    return TestResult(target, completed.returncode, time.perf_counter() - start,
+                      completed.stdout.decode("utf-8", "replace"))
+
+
+# Run targets on up to jobs processes at once; report() is called with each result as it finishes.
+def run_tests(targets: Sequence[TestTarget], jobs: int = 1, timeout: Optional[float] = None,
+              report=None) -> List[TestResult]:
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    env = test_environment()
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, jobs), thread_name_prefix="test") as executor:
+        futures = [executor.submit(run_target, target, timeout, env) for target in targets]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if report is not None:
+                report(result)
+    results.sort(key=lambda result: result.target.name)
+    return results
+
+
+# Combined timing table of a run.
+def format_summary(results: Sequence[TestResult], elapsed: float) -> str:
+    width = max((len(result.target.name) for result in results), default=4)
+    lines = [f"{'test':<{width}}  {'status':<12}  {'seconds':>8}"]
+    for result in results:
+        lines.append(f"{result.target.name:<{width}}  {result.status:<12}  {result.elapsed:>8.3f}")
+    passed = sum(result.returncode == 0 for result in results)
+    total = sum(result.elapsed for result in results)
+    lines.append(f"{passed} of {len(results)} passed in {elapsed:.3f}s wall time "
+                 f"({total:.3f}s of test time, {total / elapsed if elapsed else 0.0:.1f}x parallel)")
+    return "\n".join(lines)
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run the protocol and device tests.")
+    parser.add_argument("tests", nargs="*", help="tests to run, by name or glob (default: all)")
+    parser.add_argument("--list", action="store_true", help="list the tests found and exit")
+    parser.add_argument("--jobs", "-j", type=int, default=min(4, os.cpu_count() or 1),
+                        help="tests run at once")
+    parser.add_argument("--timeout", type=float, default=0, help="seconds a test may run (0: no limit)")
+    parser.add_argument("--quiet", "-q", action="store_true", help="print the output of failed tests only")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    args = parse_args(argv)
+    try:
+        targets = select(discover(), args.tests)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    if args.list:
+        for target in targets:
+            print(target.name)
+        return 0
+
+    def report(result: TestResult):
+        print(f"== {result.target.name}: {result.status} in {result.elapsed:.3f}s", flush=True)
+        if result.output and (result.returncode != 0 or not args.quiet):
+            print(result.output.rstrip(), flush=True)
+
+    start = time.perf_counter()
+    results = run_tests(targets, args.jobs, args.timeout or None, report)
+    print(format_summary(results, time.perf_counter() - start))
+    return 0 if all(result.returncode == 0 for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# End of file: main.py
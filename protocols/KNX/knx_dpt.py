@@ -0,0 +1,141 @@
+#
+# This module is used to encode and decode KNX datapoint types (DPTs).
+#
+
+import struct
+from datetime import date, time as time_of_day
+from typing import Callable, Dict, NamedTuple, Union
+
+Value = Union[bool, int, float, str, date, time_of_day]
+
+
+# One datapoint type. length is the payload size in bytes after the APCI;
+# 0 means the value fits in the 6 low bits of the APCI byte (DPT 1, 2, 3).
+class DPT(NamedTuple):
+    id: str
+    name: str
+    unit: str
+    length: int
+    encode: Callable[[Value], bytes]
+    decode: Callable[[bytes], Value]
+
+
+# DPT 9: 2-byte float, 0.01 * mantissa * 2^exponent with an 11-bit signed mantissa.
+def encode_float16(value: float) -> bytes:
+    mantissa = round(value * 100)
+    exponent = 0
+    while not -2048 <= mantissa <= 2047:
+        mantissa = round(mantissa / 2) if mantissa > 0 else -round(-mantissa / 2)
+        exponent += 1
+        if exponent > 15:
+            raise ValueError(f"{value} is out of range for a 2-byte KNX float")
+    raw = (mantissa & 0x7FF) | (exponent << 11) | (0x8000 if mantissa < 0 else 0)
+    return struct.pack(">H", raw)
+
+
+def decode_float16(data: bytes) -> float:
+    raw = struct.unpack(">H", data[:2])[0]
+    mantissa = raw & 0x7FF
+    if raw & 0x8000:
+        mantissa -= 2048
+    return round(0.01 * mantissa * (1 << (raw >> 11 & 0x0F)), 2)
+
+
+def _scaled(maximum: float) -> Dict[str, Callable]:
+    return dict(encode=lambda value: bytes((round(max(0.0, min(maximum, value)) * 255 / maximum),)),
+                decode=lambda data: round(data[0] * maximum / 255, 1))
+
+
+def _packed(fmt: str) -> Dict[str, Callable]:
+    packer = struct.Struct(fmt)
+    return dict(encode=lambda value: packer.pack(value), decode=lambda data: packer.unpack(data[:packer.size])[0])
+
+
+def _encode_time(value: time_of_day) -> bytes:
+    return bytes((value.hour, value.minute, value.second))
+
+
+def _decode_time(data: bytes) -> time_of_day:
+    return time_of_day(data[0] & 0x1F, data[1] & 0x3F, data[2] & 0x3F)
+
+
+def _encode_date(value: date) -> bytes:
+    return bytes((value.day, value.month, value.year % 100))
+
+
+def _decode_date(data: bytes) -> date:
+    year = data[2] & 0x7F
+    return date(2000 + year if year < 90 else 1900 + year, data[1] & 0x0F, data[0] & 0x1F)
+
+
+def _encode_string(value: str) -> bytes:
+    return value.encode("latin-1", errors="replace")[:14].ljust(14, b"\x00")
+
+
+def _decode_string(data: bytes) -> str:
+    return data[:14].rstrip(b"\x00").decode("latin-1")
+
+
+_BOOLEAN = dict(encode=lambda value: bytes((1 if value else 0,)), decode=lambda data: bool(data[0] & 1))
+_FLOAT16 = dict(encode=encode_float16, decode=decode_float16)
+
+# Main types and the subtypes used on site: id: (name, unit, length, codec).
+_TYPES = {
+    "1.001": ("switch", "", 0, _BOOLEAN),
+    "1.002": ("boolean", "", 0, _BOOLEAN),
+    "1.008": ("up/down", "", 0, _BOOLEAN),
+    "1.009": ("open/close", "", 0, _BOOLEAN),
+    "5.001": ("percentage", "%", 1, _scaled(100.0)),
+    "5.003": ("angle", "deg", 1, _scaled(360.0)),
+    "5.010": ("counter pulses", "", 1, _packed(">B")),
+    "6.010": ("counter pulses", "", 1, _packed(">b")),
+    "7.001": ("pulses", "", 2, _packed(">H")),
+    "7.013": ("brightness", "lx", 2, _packed(">H")),
+    "8.001": ("pulses difference", "", 2, _packed(">h")),
+    "9.001": ("temperature", "C", 2, _FLOAT16),
+    "9.004": ("illuminance", "lx", 2, _FLOAT16),
+    "9.005": ("wind speed", "m/s", 2, _FLOAT16),
+    "9.007": ("humidity", "%", 2, _FLOAT16),
+    "9.024": ("power", "kW", 2, _FLOAT16),
+    "10.001": ("time of day", "", 3, dict(encode=_encode_time, decode=_decode_time)),
+    "11.001": ("date", "", 3, dict(encode=_encode_date, decode=_decode_date)),
+    "12.001": ("counter pulses", "", 4, _packed(">I")),
+    "13.001": ("counter pulses", "", 4, _packed(">i")),
+    "13.010": ("active energy", "Wh", 4, _packed(">i")),
+    "13.013": ("active energy", "kWh", 4, _packed(">i")),
+    "14.019": ("electric current", "A", 4, _packed(">f")),
+    "14.027": ("electric potential", "V", 4, _packed(">f")),
+    "14.056": ("power", "W", 4, _packed(">f")),
+    "16.000": ("string", "", 14, dict(encode=_encode_string, decode=_decode_string)),
+    "17.001": ("scene number", "", 1, dict(encode=lambda value: bytes((value & 0x3F,)),
+                                           decode=lambda data: data[0] & 0x3F)),
+}
+
+DPTS: Dict[str, DPT] = {dpt_id: DPT(dpt_id, name, unit, length, **codec)
+                        for dpt_id, (name, unit, length, codec) in _TYPES.items()}
+
+# Subtype whose encoding every other subtype of a main type shares, for ids not listed above.
+_MAIN_DEFAULTS = {main: DPTS[dpt_id] for main, dpt_id in (
+    ("1", "1.002"), ("5", "5.010"), ("6", "6.010"), ("7", "7.001"), ("8", "8.001"), ("9", "9.001"), ("10", "10.001"),
+    ("11", "11.001"), ("12", "12.001"), ("13", "13.001"), ("14", "14.056"), ("16", "16.000"), ("17", "17.001"))}
+
+
+# The DPT for an id such as '9.001', 'DPST-9-1' or just '9'.
+def get_dpt(dpt_id: str) -> DPT:
+    text = str(dpt_id).upper()
+    if text.startswith("DPST-"):
+        main, sub = text[5:].split("-")
+        text = f"{int(main)}.{int(sub):03d}"
+    elif text.startswith("DPT-"):
+        text = str(int(text[4:]))
+    dpt = DPTS.get(text)
+    if dpt is None and "." in text:
+        main, sub = text.split(".")
+        dpt = DPTS.get(f"{int(main)}.{int(sub):03d}")
+    if dpt is None:
+        dpt = _MAIN_DEFAULTS.get(text.split(".")[0])
+    if dpt is None:
+        raise ValueError(f"Unknown KNX datapoint type {dpt_id}")
+    return dpt
+
+# End of file: protocols/KNX/knx_dpt.py
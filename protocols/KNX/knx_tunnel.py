@@ -0,0 +1,407 @@
+#
+# This module is used to read and write KNX group addresses through a KNXnet/IP tunnel.
+#
+
+import asyncio
+import logging
+import struct
+from typing import Callable, Dict, Iterable, Mapping, NamedTuple, Optional, Tuple
+
+from protocols.KNX.knx_dpt import DPT, Value, get_dpt
+from utils.register_cache import CachePolicy, ChangeEvent, RegisterCache
+
+log = logging.getLogger(__name__)
+
+KNX_PORT = 3671
+
+# KNXnet/IP header: header length, protocol version, service type, total length.
+HEADER = struct.Struct(">BBHH")
+HEADER_LENGTH = 6
+PROTOCOL_VERSION = 0x10
+
+# KNXnet/IP services.
+CONNECT_REQUEST = 0x0205
+CONNECT_RESPONSE = 0x0206
+CONNECTIONSTATE_REQUEST = 0x0207
+CONNECTIONSTATE_RESPONSE = 0x0208
+DISCONNECT_REQUEST = 0x0209
+DISCONNECT_RESPONSE = 0x020A
+TUNNELLING_REQUEST = 0x0420
+TUNNELLING_ACK = 0x0421
+
+# UDP endpoint 0.0.0.0:0: the gateway answers to where the request came from (NAT mode).
+HPAI_ROUTE_BACK = bytes((8, 1, 0, 0, 0, 0, 0, 0))
+# Connection request information: tunnel connection on the link layer.
+CRI_TUNNEL = bytes((4, 4, 2, 0))
+
+# cEMI message codes.
+L_DATA_REQ = 0x11
+L_DATA_CON = 0x2E
+L_DATA_IND = 0x29
+
+# Application layer services.
+GROUP_VALUE_READ = 0x000
+GROUP_VALUE_RESPONSE = 0x040
+GROUP_VALUE_WRITE = 0x080
+
+# Standard frame, no repeat, broadcast, low priority; group destination, hop count 6.
+CONTROL_1 = 0xBC
+CONTROL_2 = 0xE0
+
+# Seconds between connection state requests (the gateway drops the tunnel after 120 s of silence).
+HEARTBEAT_INTERVAL = 60.0
+
+
+def knx_frame(service: int, body: bytes) -> bytes:
+    return HEADER.pack(HEADER_LENGTH, PROTOCOL_VERSION, service, HEADER_LENGTH + len(body)) + body
+
+
+# '1/2/3' (three level), '1/2' (two level) or a plain number to a 16-bit group address.
+def parse_group_address(address) -> int:
+    if isinstance(address, int):
+        return address
+    parts = [int(part) for part in str(address).split("/")]
+    if len(parts) == 3:
+        return parts[0] << 11 | parts[1] << 8 | parts[2]
+    if len(parts) == 2:
+        return parts[0] << 11 | parts[1]
+    return parts[0]
+
+
+def format_group_address(address: int) -> str:
+    return f"{address >> 11 & 0x1F}/{address >> 8 & 0x07}/{address & 0xFF}"
+
+
+# A group telegram carried in a cEMI L_Data frame. payload holds the value bytes;
+# values of up to 6 bits (DPT 1, 2, 3) come as one byte.
+class GroupTelegram(NamedTuple):
+    code: int
+    source: int
+    destination: int
+    apci: int
+    payload: bytes
+
+
+def encode_cemi(code: int, source: int, destination: int, apci: int, payload: bytes = b"", small: bool = False) -> bytes:
+    if small:
+        apdu = bytes((apci >> 8 & 0x03, apci & 0xC0 | payload[0] & 0x3F))
+    else:
+        apdu = bytes((apci >> 8 & 0x03, apci & 0xC0)) + payload
+    return bytes((code, 0, CONTROL_1, CONTROL_2)) + struct.pack(">HH", source, destination) \
+        + bytes((len(apdu) - 1,)) + apdu
+
+
+# Decode a cEMI L_Data frame sent to a group address; None for anything else.
+def decode_cemi(data: bytes) -> Optional[GroupTelegram]:
+    if len(data) < 2:
+        return None
+    offset = 2 + data[1]
+    if len(data) < offset + 9:
+        return None
+    control_2 = data[offset + 1]
+    if not control_2 & 0x80:
+        return None
+    source, destination = struct.unpack_from(">HH", data, offset + 2)
+    apdu = data[offset + 7:offset + 8 + data[offset + 6]]
+    if len(apdu) < 2:
+        return None
+    apci = (apdu[0] & 0x03) << 8 | apdu[1] & 0xC0
+    payload = bytes(apdu[2:]) if len(apdu) > 2 else bytes((apdu[1] & 0x3F,))
+    return GroupTelegram(data[0], source, destination, apci, payload)
+
+
+# Time one group telegram with payload_length value bytes holds a KNX TP1 line:
+# 50 bit times of idle, the frame at 13 bit times per octet (start, 8 data,
+# parity, stop and 2 idle bits), then 15 bit times and the acknowledgement.
+def tp1_frame_time(payload_length: int, baudrate: int = 9600) -> float:
+    octets = 9 + payload_length
+    return (50 + 13 * octets + 15 + 13) / baudrate
+
+
+# This class is a rate limiter that spaces telegrams by their TP1 line time.
+# load is the share of the line this client may use; up to burst seconds of
+# unused line time may be spent at once.
+class LineRateLimiter:
+    def __init__(self, load: float = 0.5, burst: float = 0.1):
+        self.load = load
+        self.burst = burst
+        self._due = 0.0
+
+    async def wait(self, line_time: float):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self._due = max(self._due, now)
+        delay = self._due - now - self.burst
+        self._due += line_time / self.load
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+# Result of future within timeout seconds, else asyncio.TimeoutError. Unlike
+# asyncio.wait_for() on Python < 3.12 this never swallows a cancellation that
+# arrives as the future completes, which would leave close() waiting on the sender.
+async def _wait(future: asyncio.Future, timeout: float):
+    done, _ = await asyncio.wait((future,), timeout=timeout)
+    if not done:
+        raise asyncio.TimeoutError
+    return future.result()
+
+
+# This class is an asyncio KNXnet/IP tunneling client with a live group value cache.
+# Every group write and response seen on the tunnel is decoded with the
+# address's DPT (raw bytes when it has none) and stored in a RegisterCache, so
+# read() is usually answered from memory; only values older than max_age send a
+# GroupValueRead, and concurrent reads of one address share a single request.
+# Outgoing telegrams go through one queue, paced to line_load of the TP1 line
+# by tp1_frame_time(), and each waits for the gateway's tunnelling ACK; one that
+# is not acknowledged with status 0 is sent once more, then counted in .failed.
+class KnxTunnel(asyncio.DatagramProtocol):
+    def __init__(self, host: str, port: int = KNX_PORT, group_addresses: Optional[Mapping[str, str]] = None,
+                 max_age: float = 300.0, line_load: float = 0.5, baudrate: int = 9600, read_timeout: float = 2.0,
+                 ack_timeout: float = 1.0, queue_size: int = 1000, cache: Optional[RegisterCache] = None):
+        self.host = host
+        self.port = port
+        self.device = f"knx:{host}:{port}"
+        self.dpts: Dict[int, DPT] = {parse_group_address(address): get_dpt(dpt)
+                                     for address, dpt in (group_addresses or {}).items()}
+        self.baudrate = baudrate
+        self.read_timeout = read_timeout
+        self.ack_timeout = ack_timeout
+        self.cache = cache if cache is not None else RegisterCache(default_policy=CachePolicy(max_age=max_age))
+        self.limiter = LineRateLimiter(line_load)
+        self.individual_address = 0
+        self.sent = 0
+        self.received = 0
+        self.resent = 0
+        self.failed = 0
+        self._queue: "asyncio.Queue[bytes]" = asyncio.Queue(queue_size)
+        self._transport: Optional[asyncio.DatagramTransport] = None
+        self._channel = 0
+        self._send_sequence = 0
+        self._receive_sequence = 0
+        self._control: Dict[int, asyncio.Future] = {}
+        self._ack: Optional[Tuple[int, asyncio.Future]] = None
+        self._reads: Dict[int, asyncio.Future] = {}
+        self._tasks = []
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    # asyncio protocol callbacks
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        if len(data) < HEADER_LENGTH:
+            return
+        _, _, service, _ = HEADER.unpack_from(data)
+        body = data[HEADER_LENGTH:]
+        if service == TUNNELLING_REQUEST:
+            self._tunnelling_request(body)
+        elif service == TUNNELLING_ACK:
+            if self._ack is not None and len(body) >= 4 and body[2] == self._ack[0] and not self._ack[1].done():
+                self._ack[1].set_result(body[3])
+        elif service == DISCONNECT_REQUEST:
+            self._send(knx_frame(DISCONNECT_RESPONSE, bytes((self._channel, 0))))
+            log.warning("KNX gateway %s closed the tunnel", self.host)
+            self._channel = 0
+        else:
+            future = self._control.pop(service, None)
+            if future is not None and not future.done():
+                future.set_result(body)
+
+    def _send(self, data: bytes):
+        if self._transport is not None:
+            self._transport.sendto(data, (self.host, self.port))
+
+    def _tunnelling_request(self, body: bytes):
+        if len(body) < 4 or body[1] != self._channel:
+            return
+        sequence = body[2]
+        self._send(knx_frame(TUNNELLING_ACK, bytes((4, self._channel, sequence, 0))))
+        if sequence != self._receive_sequence:
+            # A repeat of the last frame (our ACK was lost) or out of order: acknowledged, not processed.
+            return
+        self._receive_sequence = (sequence + 1) & 0xFF
+        telegram = decode_cemi(body[4:])
+        if telegram is None or telegram.code not in (L_DATA_IND, L_DATA_CON):
+            return
+        self.received += 1
+        if telegram.apci in (GROUP_VALUE_WRITE, GROUP_VALUE_RESPONSE):
+            self._store(telegram.destination, telegram.payload)
+
+    def _store(self, address: int, payload: bytes):
+        dpt = self.dpts.get(address)
+        value = payload
+        if dpt is not None:
+            try:
+                value = dpt.decode(payload)
+            except (ValueError, struct.error, IndexError):
+                log.warning("Could not decode %s from %s as DPT %s", payload.hex(), format_group_address(address), dpt.id)
+        self.cache.put(self.device, format_group_address(address), value)
+        future = self._reads.pop(address, None)
+        if future is not None and not future.done():
+            future.set_result(value)
+
+    # connection
+
+    async def _request(self, request: int, response: int, body: bytes, timeout: float = 5.0) -> bytes:
+        future = asyncio.get_running_loop().create_future()
+        self._control[response] = future
+        self._send(knx_frame(request, body))
+        try:
+            return await _wait(future, timeout)
+        finally:
+            self._control.pop(response, None)
+
+    async def _open_tunnel(self):
+        body = await self._request(CONNECT_REQUEST, CONNECT_RESPONSE, HPAI_ROUTE_BACK + HPAI_ROUTE_BACK + CRI_TUNNEL)
+        if len(body) < 2 or body[1] != 0:
+            raise ConnectionError(f"KNX gateway {self.host} refused the tunnel (status {body[1] if len(body) > 1 else '?'})")
+        self._channel = body[0]
+        self._send_sequence = self._receive_sequence = 0
+        if len(body) >= 14:
+            self.individual_address = struct.unpack_from(">H", body, 12)[0]
+        log.info("Opened KNX tunnel %s on %s", self._channel, self.host)
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, remote_addr=(self.host, self.port))
+        await self._open_tunnel()
+        self._tasks = [asyncio.ensure_future(self._sender()), asyncio.ensure_future(self._heartbeat())]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._channel:
+            try:
+                await self._request(DISCONNECT_REQUEST, DISCONNECT_RESPONSE, bytes((self._channel, 0)) + HPAI_ROUTE_BACK,
+                                    timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
+            self._channel = 0
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                if not self._channel:
+                    await self._open_tunnel()
+                    continue
+                body = await self._request(CONNECTIONSTATE_REQUEST, CONNECTIONSTATE_RESPONSE,
+                                           bytes((self._channel, 0)) + HPAI_ROUTE_BACK)
+                if len(body) < 2 or body[1] != 0:
+                    log.warning("KNX tunnel %s on %s is gone, reconnecting", self._channel, self.host)
+                    await self._open_tunnel()
+            except (asyncio.TimeoutError, ConnectionError) as e:
+                log.warning("KNX gateway %s did not answer: %s", self.host, e)
+                self._channel = 0
+
+    # outgoing telegrams
+
+    async def _sender(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            cemi = await self._queue.get()
+            # Value bytes after the 2-byte TPCI/APCI.
+            await self.limiter.wait(tp1_frame_time(max(0, cemi[8] - 1), self.baudrate))
+            sequence = self._send_sequence
+            frame = knx_frame(TUNNELLING_REQUEST, bytes((4, self._channel, sequence, 0)) + cemi)
+            status = None
+            for attempt in range(2):
+                future = loop.create_future()
+                self._ack = (sequence, future)
+                self._send(frame)
+                try:
+                    status = await _wait(future, self.ack_timeout)
+                except asyncio.TimeoutError:
+                    status = None
+                if status == 0:
+                    break
+                self.resent += 1
+            else:
+                self._failed(cemi, sequence, status)
+            self._ack = None
+            self._send_sequence = (sequence + 1) & 0xFF
+            self.sent += 1
+
+    # A telegram the gateway did not accept (status None: never acknowledged) is
+    # dropped; a read waiting on it gets None now instead of at its timeout.
+    def _failed(self, cemi: bytes, sequence: int, status: Optional[int]):
+        self.failed += 1
+        if status is None:
+            log.warning("KNX gateway %s did not acknowledge telegram %s", self.host, sequence)
+        else:
+            log.warning("KNX gateway %s rejected telegram %s with status 0x%02X", self.host, sequence, status)
+        telegram = decode_cemi(cemi)
+        if telegram is not None and telegram.apci == GROUP_VALUE_READ:
+            future = self._reads.pop(telegram.destination, None)
+            if future is not None and not future.done():
+                future.set_result(None)
+
+    def _telegram(self, address: int, apci: int, payload: bytes = b"", small: bool = False) -> bytes:
+        return encode_cemi(L_DATA_REQ, 0, address, apci, payload, small)
+
+    # public API
+
+    # Cached value of a group address (None if never seen), without touching the bus.
+    def value(self, address):
+        return self.cache.get(self.device, format_group_address(parse_group_address(address)), max_age=float("inf"))
+
+    # Value of a group address: from the cache when younger than max_age (the cache
+    # policy's by default), else from a GroupValueRead; None if nothing answered.
+    async def read(self, address, max_age: Optional[float] = None):
+        address = parse_group_address(address)
+        cached = self.cache.get(self.device, format_group_address(address), max_age)
+        if cached is not None:
+            return cached
+        future = self._reads.get(address)
+        if future is None:
+            future = self._reads[address] = asyncio.get_running_loop().create_future()
+            await self._queue.put(self._telegram(address, GROUP_VALUE_READ))
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.read_timeout)
+        except asyncio.TimeoutError:
+            if self._reads.get(address) is future:
+                del self._reads[address]
+            log.warning("No response from group address %s", format_group_address(address))
+            return None
+
+    # Read several group addresses at once; addresses missing from the cache are read concurrently.
+    async def read_many(self, addresses: Iterable, max_age: Optional[float] = None) -> Dict[str, object]:
+        addresses = list(addresses)
+        values = await asyncio.gather(*(self.read(address, max_age) for address in addresses))
+        return {format_group_address(parse_group_address(address)): value for address, value in zip(addresses, values)}
+
+    # Queue a GroupValueWrite; the value is encoded with dpt or the address's DPT.
+    # Raw bytes are sent as they are.
+    async def write(self, address, value: Value, dpt: Optional[str] = None):
+        address = parse_group_address(address)
+        codec = get_dpt(dpt) if dpt else self.dpts.get(address)
+        if isinstance(value, (bytes, bytearray)):
+            payload, small = bytes(value), False
+        elif codec is None:
+            raise ValueError(f"Group address {format_group_address(address)} has no DPT to encode {value!r} with")
+        else:
+            payload, small = codec.encode(value), codec.length == 0
+        await self._queue.put(self._telegram(address, GROUP_VALUE_WRITE, payload, small))
+
+    # Call callback with a ChangeEvent whenever a group value changes.
+    def subscribe(self, callback: Callable[[ChangeEvent], None]):
+        self.cache.subscribe(callback)
+
+    @property
+    def queued(self) -> int:
+        return self._queue.qsize()
+
+# End of file: protocols/KNX/knx_tunnel.py
@@ -0,0 +1,288 @@
+#
+# This module is used to ingest CAN frames at bus rate and decode their signals in batches.
+#
+
+import logging
+import re
+import socket
+import struct
+import threading
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# Flags and masks of the can_id field (linux/can.h).
+CAN_EFF_FLAG = 0x80000000
+CAN_RTR_FLAG = 0x40000000
+CAN_ERR_FLAG = 0x20000000
+CAN_EFF_MASK = 0x1FFFFFFF
+CAN_SFF_MASK = 0x7FF
+
+# One classic CAN frame laid out as the kernel's struct can_frame, so SocketCAN
+# reads land in the ring as they come off the socket.
+FRAME_DTYPE = np.dtype([("can_id", "<u4"), ("dlc", "u1"), ("pad", "u1", (3,)), ("data", "u1", (8,))])
+FRAME = struct.Struct("<IB3x8s")
+
+
+# Frames copied out of the ring; data is one row of 8 bytes per frame.
+class FrameBatch(NamedTuple):
+    timestamp: np.ndarray
+    arbitration_id: np.ndarray
+    dlc: np.ndarray
+    data: np.ndarray
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    # Frame indices per arbitration id, each in arrival order.
+    def by_id(self) -> Dict[int, np.ndarray]:
+        if not len(self.timestamp):
+            return {}
+        order = np.argsort(self.arbitration_id, kind="stable")
+        ids, starts = np.unique(self.arbitration_id[order], return_index=True)
+        return dict(zip(ids.tolist(), np.split(order, starts[1:])))
+
+
+# This class is a preallocated ring of CAN frames.
+# The frame and timestamp arrays are allocated once; writers fill the next
+# slot in place (recv_into() straight from a SocketCAN socket, or append()) and
+# readers copy out everything written since their last position with since().
+# One writer thread and any number of readers may use a ring; a reader that
+# falls more than capacity frames behind loses the oldest ones.
+class FrameRing:
+    def __init__(self, capacity: int = 1 << 16):
+        self.capacity = capacity
+        self.frames = np.zeros(capacity, dtype=FRAME_DTYPE)
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.written = 0
+        raw = memoryview(self.frames.view(np.uint8))
+        # One writable view per slot, made up front so the receive path allocates nothing.
+        self._slots = [raw[i * FRAME.size:(i + 1) * FRAME.size] for i in range(capacity)]
+
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    def append(self, timestamp: float, can_id: int, dlc: int, data: bytes):
+        slot = self.written % self.capacity
+        FRAME.pack_into(self._slots[slot], 0, can_id, dlc, data)
+        self.timestamps[slot] = timestamp
+        self.written += 1
+
+    # Read one frame from a raw CAN socket into the next slot; returns False on timeout.
+    def recv_into(self, sock: socket.socket, clock=time.time) -> bool:
+        slot = self.written % self.capacity
+        try:
+            sock.recv_into(self._slots[slot])
+        except socket.timeout:
+            return False
+        self.timestamps[slot] = clock()
+        self.written += 1
+        return True
+
+    # Copy the frames written after position; returns the batch, the new position and
+    # the number of frames that were overwritten before they could be read.
+    def since(self, position: int) -> Tuple[FrameBatch, int, int]:
+        end = self.written
+        start = max(position, end - self.capacity)
+        lost = start - position
+        slots = np.arange(start, end) % self.capacity
+        frames = self.frames[slots]
+        can_id = frames["can_id"]
+        arbitration_id = np.where(can_id & CAN_EFF_FLAG, can_id & CAN_EFF_MASK, can_id & CAN_SFF_MASK)
+        return FrameBatch(self.timestamps[slots], arbitration_id, frames["dlc"], frames["data"]), end, lost
+
+
+# One signal of a CAN message, as defined in a DBC file.
+# start is the DBC start bit: the least significant bit for little-endian (Intel)
+# signals and the most significant bit for big-endian (Motorola) ones.
+class Signal(NamedTuple):
+    name: str
+    start: int
+    length: int
+    little_endian: bool = True
+    signed: bool = False
+    scale: float = 1.0
+    offset: float = 0.0
+    unit: str = ""
+
+
+# One CAN message and its signals.
+class CanMessage(NamedTuple):
+    arbitration_id: int
+    name: str
+    dlc: int
+    signals: Tuple[Signal, ...]
+
+
+_MESSAGE = re.compile(r"^BO_\s+(\d+)\s+(\w+)\s*:\s*(\d+)")
+_SIGNAL = re.compile(r"^SG_\s+(\w+)\s*(?:\w+\s*)?:\s*(\d+)\|(\d+)@([01])([+-])\s*"
+                     r"\(([^,]+),([^)]+)\)\s*\[[^]]*\]\s*\"([^\"]*)\"")
+
+
+# Parse the messages and signals (BO_ and SG_ lines) of a DBC file's text.
+# Other sections are ignored; multiplexed signals are read as plain signals.
+def parse_dbc(text: str) -> List[CanMessage]:
+    messages: List[CanMessage] = []
+    current: Optional[Tuple[int, str, int]] = None
+    signals: List[Signal] = []
+    for line in text.splitlines():
+        line = line.strip()
+        match = _MESSAGE.match(line)
+        if match:
+            if current is not None:
+                messages.append(CanMessage(*current, tuple(signals)))
+            frame_id = int(match.group(1))
+            # DBC marks extended ids with bit 31.
+            current = (frame_id & CAN_EFF_MASK if frame_id & CAN_EFF_FLAG else frame_id, match.group(2), int(match.group(3)))
+            signals = []
+            continue
+        match = _SIGNAL.match(line)
+        if match and current is not None:
+            name, start, length, order, sign, scale, offset, unit = match.groups()
+            signals.append(Signal(name, int(start), int(length), order == "1", sign == "-", float(scale), float(offset), unit))
+    if current is not None:
+        messages.append(CanMessage(*current, tuple(signals)))
+    return messages
+
+
+def load_dbc(path: str) -> List[CanMessage]:
+    with open(path, "r", encoding="utf-8", errors="replace") as file:
+        return parse_dbc(file.read())
+
+
+# Shift that brings a signal's least significant bit to bit 0 of its 64-bit payload view.
+def _shift(signal: Signal) -> int:
+    if signal.little_endian:
+        return signal.start
+    # Motorola: the start bit is the MSB in sawtooth numbering; count from the MSB of a big-endian word.
+    msb = (signal.start // 8) * 8 + (7 - signal.start % 8)
+    return 63 - (msb + signal.length - 1)
+
+
+# This class is used to decode whole batches of frames into signal arrays.
+# Each message's frames are viewed as 64-bit words (little- and big-endian)
+# once and every signal is a shift and mask over that column, so a batch of
+# thousands of frames costs a few NumPy operations per signal.
+class SignalDecoder:
+    def __init__(self, messages: Iterable[CanMessage]):
+        self.messages: Dict[int, CanMessage] = {message.arbitration_id: message for message in messages}
+        self._layout = {
+            message.arbitration_id: [(signal, np.uint64(_shift(signal)), np.uint64((1 << signal.length) - 1))
+                                     for signal in message.signals]
+            for message in self.messages.values()
+        }
+
+    # Decode the frames of a batch; returns {message name: (timestamps, {signal name: values})}.
+    # Frames of ids without a definition are skipped.
+    def decode(self, batch: FrameBatch) -> Dict[str, Tuple[np.ndarray, Dict[str, np.ndarray]]]:
+        decoded = {}
+        for arbitration_id, indices in batch.by_id().items():
+            layout = self._layout.get(arbitration_id)
+            if layout is None:
+                continue
+            data = np.ascontiguousarray(batch.data[indices])
+            words = {True: data.view("<u8")[:, 0], False: data.view(">u8")[:, 0]}
+            signals = {}
+            for signal, shift, mask in layout:
+                raw = (words[signal.little_endian] >> shift) & mask
+                if signal.signed:
+                    values = raw.astype(np.int64)
+                    values[values >= 1 << (signal.length - 1)] -= 1 << signal.length
+                else:
+                    values = raw
+                signals[signal.name] = values * signal.scale + signal.offset
+            decoded[self.messages[arbitration_id].name] = (batch.timestamp[indices], signals)
+        return decoded
+
+
+# Open a raw SocketCAN socket on a channel such as 'can0' or 'vcan0'.
+def open_socketcan(channel: str, timeout: float = 0.1) -> socket.socket:
+    sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+    sock.bind((channel,))
+    sock.settimeout(timeout)
+    return sock
+
+
+# This class is used to receive CAN frames into a FrameRing from a background thread.
+# On Linux with interface='socketcan' frames are read straight off a raw socket
+# into the ring; otherwise a python-can bus (pass one in, or it is opened from
+# channel and interface, e.g. 'virtual') is read with recv(). No per-frame
+# callbacks run: consumers call read() to decode everything new in one batch.
+class CanIngest:
+    def __init__(self, channel: Optional[str] = None, interface: str = "socketcan", bus=None,
+                 capacity: int = 1 << 16, messages: Iterable[CanMessage] = (), **bus_options):
+        self.channel = channel
+        self.interface = interface
+        self.ring = FrameRing(capacity)
+        self.decoder = SignalDecoder(messages)
+        self.lost = 0
+        self._bus = bus
+        self._owns_bus = bus is None
+        self._bus_options = bus_options
+        self._socket: Optional[socket.socket] = None
+        self._position = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        if self._bus is None:
+            if self.interface == "socketcan" and hasattr(socket, "AF_CAN"):
+                self._socket = open_socketcan(self.channel)
+            else:
+                import can
+
+                self._bus = can.Bus(channel=self.channel, interface=self.interface, **self._bus_options)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._receive, name=f"can-{self.channel}", daemon=True)
+        self._thread.start()
+
+    def _receive(self):
+        ring, stop = self.ring, self._stop
+        if self._socket is not None:
+            sock = self._socket
+            while not stop.is_set():
+                ring.recv_into(sock)
+            return
+        recv, append = self._bus.recv, ring.append
+        while not stop.is_set():
+            message = recv(0.1)
+            if message is None:
+                continue
+            can_id = message.arbitration_id | CAN_EFF_FLAG if message.is_extended_id else message.arbitration_id
+            append(message.timestamp, can_id, message.dlc, bytes(message.data))
+
+    # Frames received since the last call.
+    def frames(self) -> FrameBatch:
+        batch, self._position, lost = self.ring.since(self._position)
+        if lost:
+            self.lost += lost
+            log.warning("%s CAN frames on %s were overwritten before they were read", lost, self.channel)
+        return batch
+
+    # Decode every frame received since the last call.
+    def read(self) -> Dict[str, Tuple[np.ndarray, Dict[str, np.ndarray]]]:
+        return self.decoder.decode(self.frames())
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        if self._bus is not None and self._owns_bus:
+            self._bus.shutdown()
+            self._bus = None
+
+# End of file: protocols/can/can_ingest.py
@@ -0,0 +1,218 @@
+#
+# This module is used to talk to M-Bus meters through a serial level converter.
+#
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+from typing import Dict, List, Optional, Union
+
+from protocols.mbus.mbus_parser import (ACK_FRAME, ADDRESS_SECONDARY, FCB, REQ_UD2, SND_NKE, Ack, Frame,
+                                        SecondaryAddress, Telegram, TelegramParser, encode_manufacturer, select_frame,
+                                        short_frame)
+
+log = logging.getLogger(__name__)
+
+# Where found secondary addresses are kept between runs.
+MBUS_ADDRESS_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "logs",
+                                 "mbus_addresses.json")
+
+# Outcomes of a selection probe.
+NONE = "none"
+SINGLE = "single"
+COLLISION = "collision"
+
+
+# This class is used to keep the secondary addresses found on each M-Bus segment.
+# Saved to path as {bus: {address string: {"id", "manufacturer", "version", "medium"}}}.
+class SecondaryAddressBook:
+    def __init__(self, path: str = MBUS_ADDRESS_FILE):
+        self.path = path
+        self.buses: Dict[str, Dict[str, Dict[str, object]]] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                self.buses = json.load(file)
+
+    def addresses(self, bus: str) -> List[SecondaryAddress]:
+        return [SecondaryAddress(entry["id"], entry["manufacturer"], entry["version"], entry["medium"])
+                for entry in self.buses.get(bus, {}).values()]
+
+    def replace(self, bus: str, addresses: List[SecondaryAddress]):
+        with self._lock:
+            self.buses[bus] = {str(address): address._asdict() for address in addresses}
+        self.save()
+
+    def save(self):
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temporary = self.path + ".tmp"
+            with open(temporary, "w", encoding="utf-8") as file:
+                json.dump(self.buses, file, indent=2, sort_keys=True)
+            os.replace(temporary, self.path)
+
+
+# This class is an M-Bus master on a serial port (2400 baud, 8E1 by default).
+# Responses are read through a TelegramParser as bytes arrive. search() finds
+# every meter's secondary address with a wildcard tree search: a selection mask
+# that several meters answer (a collision) is narrowed one digit at a time, so
+# the probes grow with the number of meters instead of the 10^8 id space.
+class MbusMaster:
+    def __init__(self, port: str, baudrate: int = 2400, timeout: float = 0.5, collision_retries: int = 1,
+                 serial_port=None, seed: Optional[int] = None):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.collision_retries = collision_retries
+        # Start bit, 8 data bits, parity and stop bit.
+        self.char_time = 11 / baudrate
+        self.probes = 0
+        self._serial = serial_port
+        self._parser = TelegramParser()
+        self._fcb: Dict[int, bool] = {}
+        self._random = random.Random(seed)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self):
+        if self._serial is None:
+            import serial
+
+            self._serial = serial.Serial(self.port, self.baudrate, parity=serial.PARITY_EVEN, timeout=0)
+
+    def close(self):
+        if self._serial is not None:
+            self._serial.close()
+            self._serial = None
+
+    def _send(self, frame: bytes):
+        self._serial.reset_input_buffer()
+        self._parser.reset()
+        self._serial.write(frame)
+        self._serial.flush()
+
+    # Collect frames until one arrives (or timeout), then for settle seconds more so
+    # replies from other meters talking at the same time are seen too.
+    def _receive(self, settle: float) -> List[Frame]:
+        frames: List[Frame] = []
+        deadline = time.monotonic() + self.timeout
+        while True:
+            data = self._serial.read(max(1, self._serial.in_waiting))
+            if data:
+                frames.extend(self._parser.feed(data))
+                if frames:
+                    deadline = min(deadline, time.monotonic() + settle)
+            elif time.monotonic() >= deadline:
+                break
+            else:
+                time.sleep(self.char_time)
+        return frames
+
+    def _clean(self, frames: List[Frame]) -> bool:
+        return len(frames) == 1 and not len(self._parser) and not self._parser.errors
+
+    # Reset a meter (SND_NKE); on the secondary address this deselects every meter.
+    def reset(self, address: int = ADDRESS_SECONDARY) -> bool:
+        self._fcb.pop(address, None)
+        self._send(short_frame(SND_NKE, address))
+        return self._receive(3 * self.char_time) == [ACK_FRAME]
+
+    # Read a meter's data (REQ_UD2), toggling the frame count bit per request.
+    def request_data(self, address: int = ADDRESS_SECONDARY) -> Optional[Telegram]:
+        fcb = self._fcb.get(address, True)
+        self._fcb[address] = not fcb
+        self._parser.errors = 0
+        self._send(short_frame(REQ_UD2 | (FCB if fcb else 0), address))
+        frames = self._receive(3 * self.char_time)
+        if not self._clean(frames) or not isinstance(frames[0], Telegram):
+            return None
+        return frames[0]
+
+    # Send a selection for mask and classify what answered: NONE, SINGLE or COLLISION.
+    # A garbled answer is probed again after a random back-off before it counts as
+    # a collision, so line noise does not send the search down a needless branch;
+    # several clean acknowledgements are a collision straight away.
+    def probe(self, mask: str, manufacturer: int = 0xFFFF, version: int = 0xFF, medium: int = 0xFF) -> str:
+        for attempt in range(self.collision_retries + 1):
+            if attempt:
+                time.sleep(self._random.uniform(1, 2) * 2 ** attempt * 10 * self.char_time)
+            self.probes += 1
+            self._parser.errors = 0
+            self._send(select_frame(mask, manufacturer, version, medium))
+            frames = self._receive(4 * self.char_time)
+            if not frames and not self._parser.errors and not len(self._parser):
+                return NONE
+            if self._clean(frames) and isinstance(frames[0], Ack):
+                return SINGLE
+            if len(frames) > 1 and not self._parser.errors:
+                # Several clean acknowledgements: certainly more than one meter.
+                return COLLISION
+        return COLLISION
+
+    # Select a meter by its full secondary address.
+    def select(self, address: SecondaryAddress) -> bool:
+        return self.probe(address.id, encode_manufacturer(address.manufacturer), address.version,
+                          address.medium) == SINGLE
+
+    # Select a meter by secondary address and read its data.
+    def read_secondary(self, address: Union[SecondaryAddress, str]) -> Optional[Telegram]:
+        selected = self.select(address) if isinstance(address, SecondaryAddress) else self.probe(address) == SINGLE
+        return self.request_data(ADDRESS_SECONDARY) if selected else None
+
+    # Find the secondary address of every meter whose id matches mask.
+    # Each mask that exactly one meter acknowledges is read with REQ_UD2 for the
+    # full address; collisions are split on the next wildcard digit.
+    def search(self, mask: str = "FFFFFFFF") -> List[SecondaryAddress]:
+        found: List[SecondaryAddress] = []
+        result = self.probe(mask)
+        if result == SINGLE:
+            self._read_selected(mask, found)
+        elif result == COLLISION:
+            self._split(mask, found)
+        return found
+
+    def _read_selected(self, mask: str, found: List[SecondaryAddress]):
+        telegram = self.request_data(ADDRESS_SECONDARY)
+        if telegram is not None and telegram.header is not None:
+            found.append(telegram.header)
+        else:
+            log.warning("Meter selected by %s did not send its data", mask)
+
+    def _split(self, mask: str, found: List[SecondaryAddress]):
+        position = mask.upper().find("F")
+        if position < 0:
+            log.warning("Several meters share the id %s; select them by manufacturer, version or medium", mask)
+            return
+        for digit in "0123456789":
+            narrowed = mask[:position] + digit + mask[position + 1:]
+            result = self.probe(narrowed)
+            if result == SINGLE:
+                self._read_selected(narrowed, found)
+            elif result == COLLISION:
+                self._split(narrowed, found)
+
+    # Search a segment and save the addresses found under bus in book.
+    # With refresh=False, known addresses that still answer are kept and no search runs
+    # unless one of them is gone.
+    def discover(self, book: SecondaryAddressBook, bus: str, refresh: bool = False) -> List[SecondaryAddress]:
+        if not refresh:
+            known = book.addresses(bus)
+            if known and all(self.select(address) for address in known):
+                self.reset()
+                return known
+        found = self.search()
+        self.reset()
+        book.replace(bus, found)
+        return found
+
+# End of file: protocols/mbus/mbus_master.py
@@ -0,0 +1,413 @@
+#
+# This module is used to parse M-Bus (EN 13757-3) telegrams from a byte stream.
+#
+
+import struct
+from datetime import datetime
+from typing import List, NamedTuple, Optional, Tuple, Union
+
+# Frame delimiters.
+ACK = 0xE5
+SHORT_START = 0x10
+LONG_START = 0x68
+STOP = 0x16
+
+# Control fields (master to slave with FCB clear; 0x20 sets the frame count bit).
+SND_NKE = 0x40
+SND_UD = 0x53
+REQ_UD2 = 0x5B
+FCB = 0x20
+
+# Control information fields.
+CI_SELECT = 0x52
+CI_RESPONSE_LONG = 0x72
+CI_RESPONSE_SHORT = 0x7A
+
+# Addresses.
+ADDRESS_SECONDARY = 0xFD
+ADDRESS_BROADCAST = 0xFE
+
+# Data field coding (low nibble of the DIF): value length in bytes.
+DATA_LENGTHS = {0x0: 0, 0x1: 1, 0x2: 2, 0x3: 3, 0x4: 4, 0x5: 4, 0x6: 6, 0x7: 8,
+                0x8: 0, 0x9: 1, 0xA: 2, 0xB: 3, 0xC: 4, 0xE: 6}
+BCD_CODINGS = (0x9, 0xA, 0xB, 0xC, 0xE)
+VARIABLE_LENGTH = 0xD
+
+# DIF function field.
+FUNCTIONS = ("instantaneous", "maximum", "minimum", "error")
+
+# Medium codes of the fixed header.
+MEDIUMS = {0x00: "other", 0x01: "oil", 0x02: "electricity", 0x03: "gas", 0x04: "heat (outlet)", 0x05: "steam",
+           0x06: "warm water", 0x07: "water", 0x08: "heat cost allocator", 0x0A: "cooling (outlet)",
+           0x0B: "cooling (inlet)", 0x0C: "heat (inlet)", 0x0D: "heat / cooling", 0x0E: "bus / system",
+           0x15: "hot water", 0x16: "cold water", 0x17: "dual water", 0x18: "pressure", 0x19: "A/D converter"}
+
+_FLOAT = struct.Struct("<f")
+
+
+# The acknowledgement (single character 0xE5).
+class Ack(NamedTuple):
+    pass
+
+
+ACK_FRAME = Ack()
+
+
+class ShortFrame(NamedTuple):
+    control: int
+    address: int
+
+
+# Identification of a meter used for secondary addressing.
+# id is the 8-digit identification number; manufacturer the three-letter code.
+class SecondaryAddress(NamedTuple):
+    id: str
+    manufacturer: str
+    version: int
+    medium: int
+
+    def __str__(self):
+        return f"{self.id}{self.manufacturer}{self.version:02X}{self.medium:02X}"
+
+    # The 8 bytes of a selection telegram addressing exactly this meter.
+    def to_bytes(self) -> bytes:
+        return bytes.fromhex(self.id)[::-1] + struct.pack("<H", encode_manufacturer(self.manufacturer)) \
+            + bytes((self.version, self.medium))
+
+
+# One data record of a variable data response.
+# value is scaled to unit (int, float, str, datetime or raw bytes); storage,
+# tariff and subunit come from the DIF/DIFEs and vife holds the raw VIF extensions.
+class DataRecord(NamedTuple):
+    dif: int
+    vif: int
+    function: str
+    storage: int
+    tariff: int
+    subunit: int
+    quantity: str
+    unit: str
+    value: object
+    vife: Tuple[int, ...] = ()
+
+
+# A long or control frame. header is set for variable data responses; data holds
+# the application data of other frames (such as a selection) as bytes.
+class Telegram(NamedTuple):
+    control: int
+    address: int
+    ci: int
+    header: Optional[SecondaryAddress] = None
+    access_number: int = 0
+    status: int = 0
+    records: Tuple[DataRecord, ...] = ()
+    more: bool = False
+    manufacturer_data: bytes = b""
+    data: bytes = b""
+
+
+Frame = Union[Ack, ShortFrame, Telegram]
+
+
+def encode_manufacturer(code: str) -> int:
+    code = code.upper()
+    return (ord(code[0]) - 64) << 10 | (ord(code[1]) - 64) << 5 | (ord(code[2]) - 64)
+
+
+def decode_manufacturer(value: int) -> str:
+    return "".join(chr(((value >> shift) & 0x1F) + 64) for shift in (10, 5, 0))
+
+
+def _checksum(data) -> int:
+    return sum(data) & 0xFF
+
+
+def short_frame(control: int, address: int) -> bytes:
+    return bytes((SHORT_START, control, address, (control + address) & 0xFF, STOP))
+
+
+def long_frame(control: int, address: int, ci: int, data: bytes = b"") -> bytes:
+    body = bytes((control, address, ci)) + data
+    return bytes((LONG_START, len(body), len(body), LONG_START)) + body + bytes((_checksum(body), STOP))
+
+
+# Selection telegram for a secondary address mask such as '1234FFFF'.
+# F digits of the id and 0xFFFF / 0xFF for manufacturer, version and medium are wildcards.
+def select_frame(mask: str, manufacturer: int = 0xFFFF, version: int = 0xFF, medium: int = 0xFF) -> bytes:
+    data = bytes.fromhex(mask)[::-1] + struct.pack("<H", manufacturer) + bytes((version, medium))
+    return long_frame(SND_UD, ADDRESS_SECONDARY, CI_SELECT, data)
+
+
+# Digits of a little-endian BCD field; None if it holds a non-decimal digit.
+def _bcd(data) -> Optional[int]:
+    digits = bytes(reversed(data)).hex()
+    negative = digits[0] == "f"
+    if negative:
+        digits = digits[1:]
+    if not digits.isdigit():
+        return None
+    return -int(digits) if negative else int(digits)
+
+
+# Type F (date and time) or type G (date) as a datetime; None if invalid.
+def _date(value: int, with_time: bool) -> Optional[datetime]:
+    try:
+        if with_time:
+            minute, hour = value & 0x3F, value >> 8 & 0x1F
+            day, month = value >> 16 & 0x1F, value >> 24 & 0x0F
+            year = (value >> 21 & 0x07) | (value >> 25 & 0x78)
+            return datetime(2000 + year, month, day, hour, minute)
+        day, month = value & 0x1F, value >> 8 & 0x0F
+        year = (value >> 5 & 0x07) | (value >> 9 & 0x78)
+        return datetime(2000 + year, month, day)
+    except ValueError:
+        return None
+
+
+_DURATION_UNITS = ("s", "min", "h", "d")
+
+# Primary VIF ranges: (start, end, quantity, unit, exponent bias). A code's decimal
+# exponent is its offset in the range plus the bias; a unit of None marks a duration
+# whose offset picks the unit from _DURATION_UNITS instead.
+_VIF_RANGES = (
+    (0x00, 0x08, "energy", "Wh", -3),
+    (0x08, 0x10, "energy", "J", 0),
+    (0x10, 0x18, "volume", "m3", -6),
+    (0x18, 0x20, "mass", "kg", -3),
+    (0x20, 0x24, "on time", None, 0),
+    (0x24, 0x28, "operating time", None, 0),
+    (0x28, 0x30, "power", "W", -3),
+    (0x30, 0x38, "power", "J/h", 0),
+    (0x38, 0x40, "volume flow", "m3/h", -6),
+    (0x40, 0x48, "volume flow", "m3/min", -7),
+    (0x48, 0x50, "volume flow", "m3/s", -9),
+    (0x50, 0x58, "mass flow", "kg/h", -3),
+    (0x58, 0x5C, "flow temperature", "C", -3),
+    (0x5C, 0x60, "return temperature", "C", -3),
+    (0x60, 0x64, "temperature difference", "K", -3),
+    (0x64, 0x68, "external temperature", "C", -3),
+    (0x68, 0x6C, "pressure", "bar", -3),
+    (0x6C, 0x6D, "date", "", 0),
+    (0x6D, 0x6E, "date time", "", 0),
+    (0x6E, 0x6F, "units for HCA", "", 0),
+    (0x70, 0x74, "averaging duration", None, 0),
+    (0x74, 0x78, "actuality duration", None, 0),
+    (0x78, 0x79, "fabrication number", "", 0),
+    (0x79, 0x7A, "enhanced identification", "", 0),
+    (0x7A, 0x7B, "bus address", "", 0),
+    (0x7C, 0x7D, "plain text", "", 0),
+    (0x7E, 0x7F, "any", "", 0),
+    (0x7F, 0x80, "manufacturer specific", "", 0),
+)
+
+
+def _vif_table() -> Tuple[Tuple[str, str, int], ...]:
+    table = [("unknown", "", 0)] * 0x80
+    for start, end, quantity, unit, bias in _VIF_RANGES:
+        for vif in range(start, end):
+            table[vif] = (quantity, _DURATION_UNITS[vif - start], 0) if unit is None \
+                else (quantity, unit, vif - start + bias)
+    return tuple(table)
+
+
+# Quantity, unit and exponent of every primary VIF, built from _VIF_RANGES.
+_VIFS = _vif_table()
+
+
+# Quantity, unit and decimal exponent of a primary VIF (extension bit cleared).
+def describe_vif(vif: int) -> Tuple[str, str, int]:
+    return _VIFS[vif] if 0 <= vif < len(_VIFS) else ("unknown", "", 0)
+
+
+# Storage number, tariff and subunit of a DIF and its DIFEs starting at i.
+# Returns them with the index of the byte after the last DIFE.
+def _decode_dif(data: memoryview, i: int, dif: int) -> Tuple[int, int, int, int]:
+    storage = dif >> 6 & 1
+    tariff = subunit = 0
+    extension = dif & 0x80
+    k = 0
+    while extension and i < len(data):
+        dife = data[i]
+        i += 1
+        storage |= (dife & 0x0F) << (1 + 4 * k)
+        tariff |= (dife >> 4 & 0x03) << (2 * k)
+        subunit |= (dife >> 6 & 0x01) << k
+        extension = dife & 0x80
+        k += 1
+    return storage, tariff, subunit, i
+
+
+# VIF and VIFEs starting at i, with the quantity, unit and exponent they describe.
+# A plain text VIF (0x7C) takes its unit from the text that follows it.
+def _decode_vif(data: memoryview, i: int) -> Tuple[int, Tuple[int, ...], str, str, int, int]:
+    if i >= len(data):
+        raise ValueError("Data record ends before its VIF")
+    vif = data[i]
+    i += 1
+    vife = []
+    extension = vif & 0x80
+    while extension and i < len(data):
+        vife.append(data[i])
+        extension = data[i] & 0x80
+        i += 1
+    quantity, unit, exponent = describe_vif(vif & 0x7F) if vif not in (0xFB, 0xFD) else ("extension", "", 0)
+    if vif & 0x7F == 0x7C:
+        length = data[i]
+        unit = bytes(data[i + 1:i + 1 + length])[::-1].decode("ascii", errors="replace")
+        i += 1 + length
+    return vif, tuple(vife), quantity, unit, exponent, i
+
+
+# Variable length value (LVAR) at i: text, positive or negative BCD, or a binary number.
+def _decode_variable(data: memoryview, i: int) -> Tuple[object, int]:
+    length = data[i]
+    i += 1
+    field = data[i:i + (length if length < 0xC0 else length & 0x0F)]
+    i += len(field)
+    if length < 0xC0:
+        return bytes(field)[::-1].decode("latin-1"), i
+    if length < 0xE0:
+        value = _bcd(field)
+        return (-value if value is not None and length >= 0xD0 else value), i
+    return int.from_bytes(field, "little", signed=True), i
+
+
+# Raw value at i in the data field coding of a DIF; returns it with the index after it.
+def _decode_value(data: memoryview, i: int, coding: int) -> Tuple[object, int]:
+    if coding == VARIABLE_LENGTH:
+        return _decode_variable(data, i)
+    length = DATA_LENGTHS[coding]
+    field = data[i:i + length]
+    if len(field) < length:
+        raise ValueError("Data record ends before its value")
+    i += length
+    if not length:
+        return None, i
+    if coding in BCD_CODINGS:
+        return _bcd(field), i
+    if coding == 0x5:
+        return _FLOAT.unpack(field)[0], i
+    return int.from_bytes(field, "little", signed=True), i
+
+
+# A raw value in its quantity's form: dates as datetimes, numbers scaled by 10**exponent.
+def _scale(value: object, quantity: str, exponent: int) -> object:
+    if quantity == "date time" and isinstance(value, int):
+        return _date(value & 0xFFFFFFFF, True)
+    if quantity == "date" and isinstance(value, int):
+        return _date(value & 0xFFFF, False)
+    if isinstance(value, (int, float)) and exponent:
+        return value * 10 ** exponent if exponent > 0 else value / 10 ** -exponent
+    return value
+
+
+# Decode the data records of a variable data response.
+# Returns the records, whether more records follow in the next telegram and
+# any manufacturer specific data after a 0x0F / 0x1F DIF.
+def decode_records(data: memoryview) -> Tuple[List[DataRecord], bool, bytes]:
+    records: List[DataRecord] = []
+    i = 0
+    while i < len(data):
+        dif = data[i]
+        i += 1
+        if dif == 0x2F:
+            # Idle filler.
+            continue
+        if dif & 0x0F == 0x0F:
+            return records, dif == 0x1F, bytes(data[i:])
+        storage, tariff, subunit, i = _decode_dif(data, i, dif)
+        vif, vife, quantity, unit, exponent, i = _decode_vif(data, i)
+        value, i = _decode_value(data, i, dif & 0x0F)
+        records.append(DataRecord(dif, vif, FUNCTIONS[dif >> 4 & 3], storage, tariff, subunit, quantity, unit,
+                                  _scale(value, quantity, exponent), vife))
+    return records, False, b""
+
+
+# Decode the body (C field to the last data byte) of a long or control frame.
+def decode_long_frame(body: memoryview) -> Telegram:
+    control, address, ci = body[0], body[1], body[2]
+    data = body[3:]
+    if ci == CI_RESPONSE_LONG and len(data) >= 12:
+        header = SecondaryAddress(f"{int.from_bytes(data[0:4], 'little'):08X}",
+                                  decode_manufacturer(data[4] | data[5] << 8), data[6], data[7])
+        records, more, manufacturer_data = decode_records(data[12:])
+        return Telegram(control, address, ci, header, data[8], data[9], tuple(records), more, manufacturer_data)
+    if ci == CI_RESPONSE_SHORT and len(data) >= 4:
+        records, more, manufacturer_data = decode_records(data[4:])
+        return Telegram(control, address, ci, None, data[0], data[1], tuple(records), more, manufacturer_data)
+    return Telegram(control, address, ci, data=bytes(data))
+
+
+# This class is an incremental M-Bus frame parser.
+# feed() takes whatever bytes arrived and returns the frames completed by them;
+# partial frames stay buffered for the next call. Frames are checked and decoded
+# in place through memoryviews of the receive buffer, and bytes that do not
+# start a valid frame are skipped so the parser resynchronises after noise.
+class TelegramParser:
+    def __init__(self):
+        self._buffer = bytearray()
+        self.errors = 0
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def reset(self):
+        self._buffer.clear()
+
+    # Short frame at offset: the offset after it (or after its bad start byte), None if incomplete.
+    def _short_frame(self, view: memoryview, offset: int, frames: List[Frame]) -> Optional[int]:
+        if len(view) - offset < 5:
+            return None
+        control, address, checksum, stop = view[offset + 1:offset + 5]
+        if stop != STOP or (control + address) & 0xFF != checksum:
+            self.errors += 1
+            return offset + 1
+        frames.append(ShortFrame(control, address))
+        return offset + 5
+
+    # Long or control frame at offset: the offset after it (or after its bad start byte), None if incomplete.
+    def _long_frame(self, view: memoryview, offset: int, frames: List[Frame]) -> Optional[int]:
+        if len(view) - offset < 4:
+            return None
+        length = view[offset + 1]
+        if length < 3 or view[offset + 2] != length or view[offset + 3] != LONG_START:
+            self.errors += 1
+            return offset + 1
+        end = offset + length + 6
+        if len(view) < end:
+            return None
+        with view[offset + 4:end - 2] as body:
+            if view[end - 1] != STOP or _checksum(body) != view[end - 2]:
+                self.errors += 1
+                return offset + 1
+            try:
+                frames.append(decode_long_frame(body))
+            except (ValueError, IndexError, KeyError):
+                self.errors += 1
+        return end
+
+    def feed(self, data: bytes) -> List[Frame]:
+        self._buffer += data
+        frames: List[Frame] = []
+        offset = 0
+        with memoryview(self._buffer) as view:
+            while offset < len(view):
+                start = view[offset]
+                if start == ACK:
+                    frames.append(ACK_FRAME)
+                    following = offset + 1
+                elif start == SHORT_START:
+                    following = self._short_frame(view, offset, frames)
+                elif start == LONG_START:
+                    following = self._long_frame(view, offset, frames)
+                else:
+                    self.skipped += 1
+                    following = offset + 1
+                if following is None:
+                    break
+                offset = following
+        del self._buffer[:offset]
+        return frames
+
+# End of file: protocols/mbus/mbus_parser.py
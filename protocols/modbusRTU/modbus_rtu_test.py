@@ -1,27 +1,67 @@
 import os
+from functools import partial
 from pymodbus.client import ModbusSerialClient as ModbusClient
 from pymodbus.constants import Endian
-from pymodbus.payload import BinaryPayloadDecoder, BinaryPayloadBuilder
-from time import sleep
+from pymodbus.exceptions import ModbusIOException
 import logging
-from typing import Callable, List, Optional, Union
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Union
+from utils.logger import configure_logging, log_sample
+from utils.config_loader import RegisterMap, load_cache_policies, load_poll_intervals, load_register_map
+from utils.register_cache import CachePolicy, RegisterCache
+from utils.register_codec import compile_register_map, get_codec
+from utils.register_planner import READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS, ReadBlock
+from utils.register_writer import WriteResult, encode_setpoints, execute_writes, plan_writes
+from utils.unit_discovery import DISCOVERY_FILE, UnitDiscovery
+from utils.register_types import byte_order
+from utils.poll_scheduler import ONCE, DeadlineScheduler, PollTask
+from utils.timer import ERROR_RESPONSE, METRICS, RETRY, TIMEOUT as TIMEOUT_EVENT, block_label
+from protocols.modbusRTU.rtu_bus_scheduler import RtuBusScheduler, inter_frame_gap
+
+# The sample store (numpy), process image (shared memory), MQTT bridge (paho),
+# bus supervisor (multiprocessing) and frame capture are imported by the code
+# that enables them, so importing this module for process_unit() stays light.
+if TYPE_CHECKING:
+  from protocols.mqtt.mqtt_bridge import MqttBridge
+  from utils.bus_supervisor import PollBatch
+  from utils.frame_capture import CaptureWriter
+  from utils.process_image import ProcessImage
+  from utils.sample_store import SampleWriter
 
-# Configure the client logging
-logging.basicConfig(
-  format='[%(asctime)s] [%(filename)s: %(lineno)s - %(funcName)s] => %(levelname)s: %(message)s',
-  level=logging.DEBUG
-)
 log = logging.getLogger()
 
 # Constants
 PORT = os.getenv("MODBUS_PORT", "COM6") # "COM7" for Windows or "/dev/ttyUSB2" for Linux
+PORTS = [port for port in os.getenv("MODBUS_PORTS", "").split(",") if port] # several ports: one worker process each
+POLL_PERIOD = float(os.getenv("MODBUS_POLL_PERIOD", 1)) # seconds between sweeps of a supervised port
+SCHEDULED = os.getenv("MODBUS_SCHEDULED", "0") != "0" # poll each register group at its own interval, earliest deadline first
+RUN_TIME = float(os.getenv("MODBUS_RUN_TIME", 0)) # seconds a scheduled poll runs (0: until interrupted)
+MAX_BUS_LOAD = float(os.getenv("MODBUS_MAX_BUS_LOAD", 0.9)) # bus share above which the slowest groups are shed
 STOPBITS = int(os.getenv("MODBUS_STOPBITS", 1))
 BYTESIZE = int(os.getenv("MODBUS_BYTESIZE", 8))
 PARITY = os.getenv("MODBUS_PARITY", 'N')
 BAUDRATE = int(os.getenv("MODBUS_BAUDRATE", 11500))
 TIMEOUT = int(os.getenv("MODBUS_TIMEOUT", 2))
-UNIT_IDS = range(1, 37)
+UNIT_IDS = range(1, 37) # polled until a discovery scan has found the live units of a port
+DISCOVER = os.getenv("MODBUS_DISCOVER", "0") != "0" # probe unit ids 1-247 before polling
+DISCOVERY_PATH = os.getenv("MODBUS_DISCOVERY_FILE", DISCOVERY_FILE) # live units and latencies per port
+PROBE_TIMEOUT = float(os.getenv("MODBUS_PROBE_TIMEOUT", 0.1)) # first probe timeout, adapted to the units found
+REPROBE_COUNT = int(os.getenv("MODBUS_REPROBE_COUNT", 2)) # missing units re-probed after each sweep
+REPROBE_INTERVAL = float(os.getenv("MODBUS_REPROBE_INTERVAL", 30)) # seconds between re-probes in scheduled mode
 MAX_RETRIES = 1
+READ_MAX_GAP = int(os.getenv("MODBUS_READ_MAX_GAP", 0)) # unmapped registers a coalesced read may span
+REGISTER_CONFIG = os.getenv("MODBUS_REGISTER_CONFIG") # JSON device config to read the register map from
+REGISTER_SECTION = os.getenv("MODBUS_REGISTER_SECTION", "") # dotted section of the config, e.g. "huawei.sacu"
+CACHE_MAX_AGE = float(os.getenv("MODBUS_CACHE_MAX_AGE", 0)) # seconds a value is served from memory (0: always read)
+CACHE_DEADBAND = float(os.getenv("MODBUS_CACHE_DEADBAND", 0)) # absolute change a value must exceed to be reported
+CACHE_MAX_ENTRIES = int(os.getenv("MODBUS_CACHE_MAX_ENTRIES", 10000))
+VERIFY_WRITES = os.getenv("MODBUS_VERIFY_WRITES", "0") != "0" # read setpoints back after writing them
+MQTT_HOST = os.getenv("MODBUS_MQTT_HOST") # broker to publish every unit's poll cycle to (unset: no MQTT)
+MQTT_PORT = int(os.getenv("MODBUS_MQTT_PORT", 1883))
+MQTT_FORMAT = os.getenv("MODBUS_MQTT_FORMAT", "json") # "json" or "packed"
+MQTT_ON_CHANGE = os.getenv("MODBUS_MQTT_ON_CHANGE", "0") != "0" # publish only values that moved past their deadband
+SAMPLE_STORE_DIR = os.getenv("MODBUS_SAMPLE_STORE", "") # binary sample store directory, e.g. logs/samples (unset: none)
+PROCESS_IMAGE_NAME = os.getenv("MODBUS_PROCESS_IMAGE") # shared memory name to publish every unit's latest values under (unset: none)
+CAPTURE_PATH = os.getenv("MODBUS_CAPTURE") # file to record the raw bus frames into for offline replay (unset: none)
 
 # register_address, register_count, decode, register_name
 REGISTER_ADDRESSES_READ = [
@@ -33,124 +73,440 @@ REGISTER_ADDRESSES_WRITE = [
   (40100, 1, 'build_16bit_uint', 'dcdc_command', 14),
 ]
 
-DECODERS = {
-  'decode_8bit_uint': lambda registers: BinaryPayloadDecoder.fromRegisters(registers, byteorder=Endian.BIG, wordorder=Endian.LITTLE).decode_8bit_uint(),
-  'decode_8bit_int': lambda registers: BinaryPayloadDecoder.fromRegisters(registers, byteorder=Endian.BIG, wordorder=Endian.LITTLE).decode_8bit_int(),
-  'decode_16bit_uint': lambda registers: BinaryPayloadDecoder.fromRegisters(registers, byteorder=Endian.BIG, wordorder=Endian.LITTLE).decode_16bit_uint(),
-  'decode_16bit_int': lambda registers: BinaryPayloadDecoder.fromRegisters(registers, byteorder=Endian.BIG, wordorder=Endian.LITTLE).decode_16bit_int(),
-  'decode_32bit_uint': lambda registers: BinaryPayloadDecoder.fromRegisters(registers, byteorder=Endian.BIG, wordorder=Endian.LITTLE).decode_32bit_uint(),
-  'decode_32bit_int': lambda registers: BinaryPayloadDecoder.fromRegisters(registers, byteorder=Endian.BIG, wordorder=Endian.LITTLE).decode_32bit_int(),
-  'decode_64bit_uint': lambda registers: BinaryPayloadDecoder.fromRegisters(registers, byteorder=Endian.BIG, wordorder=Endian.LITTLE).decode_64bit_uint(),
-  'decode_64bit_int': lambda registers: BinaryPayloadDecoder.fromRegisters(registers, byteorder=Endian.BIG, wordorder=Endian.LITTLE).decode_64bit_int(),
-  'decode_16bit_float': lambda registers: BinaryPayloadDecoder.fromRegisters(registers, byteorder=Endian.BIG, wordorder=Endian.LITTLE).decode_16bit_float(),
-  'decode_32bit_float': lambda registers: BinaryPayloadDecoder.fromRegisters(registers, byteorder=Endian.BIG, wordorder=Endian.LITTLE).decode_32bit_float(),
-  'decode_64bit_float': lambda registers: BinaryPayloadDecoder.fromRegisters(registers, byteorder=Endian.BIG, wordorder=Endian.LITTLE).decode_64bit_float(),
-  'decode_string': lambda registers, length: BinaryPayloadDecoder.fromRegisters(registers, byteorder=Endian.BIG, wordorder=Endian.LITTLE).decode_string(length).decode('utf-8').strip('\x00'),
-  'decode_string_list': lambda registers, length: [BinaryPayloadDecoder.fromRegisters(registers, byteorder=Endian.BIG, wordorder=Endian.LITTLE).decode_string(length).decode('utf-8').strip('\x00')] * 2,
-  'decode_bits': lambda registers: BinaryPayloadDecoder.fromRegisters(registers, byteorder=Endian.BIG, wordorder=Endian.LITTLE).decode_bits(),
-}
-
-BUILDERS = {
-  'build_8bit_uint': lambda value: BinaryPayloadBuilder(byteorder=Endian.BIG, wordorder=Endian.LITTLE).add_8bit_uint(value),
-  'build_8bit_int': lambda value: BinaryPayloadBuilder(byteorder=Endian.BIG, wordorder=Endian.LITTLE).add_8bit_int(value),
-  'build_16bit_uint': lambda value: BinaryPayloadBuilder(byteorder=Endian.BIG, wordorder=Endian.LITTLE).add_16bit_uint(value),
-  'build_16bit_int': lambda value: BinaryPayloadBuilder(byteorder=Endian.BIG, wordorder=Endian.LITTLE).add_16bit_int(value),
-  'build_32bit_uint': lambda value: BinaryPayloadBuilder(byteorder=Endian.BIG, wordorder=Endian.LITTLE).add_32bit_uint(value),
-  'build_32bit_int': lambda value: BinaryPayloadBuilder(byteorder=Endian.BIG, wordorder=Endian.LITTLE).add_32bit_int(value),
-  'build_64bit_uint': lambda value: BinaryPayloadBuilder(byteorder=Endian.BIG, wordorder=Endian.LITTLE).add_64bit_uint(value),
-  'build_64bit_int': lambda value: BinaryPayloadBuilder(byteorder=Endian.BIG, wordorder=Endian.LITTLE).add_64bit_int(value),
-  'build_32bit_float': lambda value: BinaryPayloadBuilder(byteorder=Endian.BIG, wordorder=Endian.LITTLE).add_32bit_float(value),
-  'build_64bit_float': lambda value: BinaryPayloadBuilder(byteorder=Endian.BIG, wordorder=Endian.LITTLE).add_64bit_float(value),
-  'build_string': lambda value, length: BinaryPayloadBuilder(byteorder=Endian.BIG, wordorder=Endian.LITTLE).add_string(value, length),
-  'build_bits': lambda value: BinaryPayloadBuilder(byteorder=Endian.BIG, wordorder=Endian.LITTLE).add_bits(value),
-}
-
-def read_register(client: ModbusClient, unit_id: int, register_address: int, register_count: int, decode: Optional[str]) -> Union[int, float, str, None]:
-  for _ in range(MAX_RETRIES):
+# Register maps indexed by name and address; the read map comes from REGISTER_CONFIG when set
+READ_MAP = (load_register_map(REGISTER_CONFIG, *filter(None, REGISTER_SECTION.split('.'))) if REGISTER_CONFIG
+            else RegisterMap(REGISTER_ADDRESSES_READ))
+WRITE_MAP = RegisterMap(REGISTER_ADDRESSES_WRITE)
+
+# register_name: value pushed to every unit after its reads
+SETPOINTS = {register_name: value for _, _, _, register_name, value in REGISTER_ADDRESSES_WRITE}
+
+# Coalesced read requests covering READ_MAP
+READ_PLAN = list(READ_MAP.plan(max_gap=READ_MAX_GAP))
+
+# Seconds between reads of each register (0: once at startup); registers in REGISTER_CONFIG
+# may set their own "poll_interval", the rest are read every POLL_PERIOD
+POLL_INTERVALS = load_poll_intervals(REGISTER_CONFIG, *filter(None, REGISTER_SECTION.split('.'))) if REGISTER_CONFIG else {}
+
+# interval: coalesced read requests for the registers polled at that rate
+def poll_groups(register_map: RegisterMap, intervals: Dict[str, float], default: float) -> Dict[float, List[ReadBlock]]:
+  groups: Dict[float, list] = {}
+  for entry in register_map:
+    groups.setdefault(intervals.get(entry.name, default), []).append(entry)
+  return {interval: list(RegisterMap(entries).plan(max_gap=READ_MAX_GAP)) for interval, entries in sorted(groups.items())}
+
+POLL_GROUPS = poll_groups(READ_MAP, POLL_INTERVALS, POLL_PERIOD)
+
+# Values shared by every unit; registers in REGISTER_CONFIG may set their own max_age and deadband
+REGISTER_CACHE = RegisterCache(
+  max_entries=CACHE_MAX_ENTRIES,
+  default_policy=CachePolicy(max_age=CACHE_MAX_AGE, deadband=CACHE_DEADBAND),
+  policies=load_cache_policies(REGISTER_CONFIG, *filter(None, REGISTER_SECTION.split('.'))) if REGISTER_CONFIG else None
+)
+
+# Sample store the sweep records every polled value into; opened by main()
+SAMPLE_STORE: Optional["SampleWriter"] = None
+
+# MQTT publisher fed one message per unit and sweep; started by main() when MQTT_HOST is set
+MQTT_BRIDGE: Optional["MqttBridge"] = None
+
+# Shared memory image of every unit's latest READ_MAP values; opened by main() when PROCESS_IMAGE_NAME is set
+PROCESS_IMAGE: Optional["ProcessImage"] = None
+
+# Raw frame capture of the bus; opened by connect_to_modbus_client() when CAPTURE_PATH is set
+CAPTURE: Optional["CaptureWriter"] = None
+
+# Codecs compiled once per map (register_name: codec, None for raw registers).
+# Units sharing a map share the cached codecs, so the 36 DC/DC units compile them once.
+BYTE_ORDER = Endian.BIG
+WORD_ORDER = Endian.LITTLE
+READ_CODECS = compile_register_map(READ_MAP, byteorder=BYTE_ORDER, wordorder=WORD_ORDER)
+WRITE_CODECS = compile_register_map(WRITE_MAP, byteorder=BYTE_ORDER, wordorder=WORD_ORDER)
+
+# Metrics label of one unit on the bus.
+def device_label(unit_id: int) -> str:
+  return f"{PORT}/{unit_id}"
+
+# Count a failed response: pymodbus reports timeouts as a ModbusIOException response.
+def record_error(unit_id: int, response):
+  METRICS.count(device_label(unit_id), TIMEOUT_EVENT if isinstance(response, ModbusIOException) else ERROR_RESPONSE)
+
+def read_register(client: ModbusClient, unit_id: int, register_address: int, register_count: int, decode: Optional[str],
+                  function_code: int = READ_INPUT_REGISTERS) -> Union[int, float, str, None]:
+  read = client.read_holding_registers if function_code == READ_HOLDING_REGISTERS else client.read_input_registers
+  for attempt in range(MAX_RETRIES):
+    if attempt:
+      METRICS.count(device_label(unit_id), RETRY)
     try:
-      rr = client.read_input_registers(address=register_address, count=register_count, slave=unit_id)
+      with METRICS.time(device_label(unit_id), function_code, block_label(register_address, register_count)):
+        rr = read(address=register_address, count=register_count, slave=unit_id)
       if not rr.isError():
         if decode:
-          return DECODERS[decode](rr.registers)
+          return get_codec(decode, register_count, BYTE_ORDER, WORD_ORDER).decode(rr.registers)
         return rr.registers
-      log.error(f"Error reading register {register_address} from unit {unit_id}")
+      record_error(unit_id, rr)
+      log.error("Error reading register %s from unit %s", register_address, unit_id)
     except Exception as e:
-      log.error(f"Exception reading register {register_address} from unit {unit_id}: {e}")
-    sleep(1)
+      log.error("Exception reading register %s from unit %s: %s", register_address, unit_id, e)
   return None
 
+def read_block(client: ModbusClient, unit_id: int, block: ReadBlock) -> Dict[str, Union[int, float, str, List[int]]]:
+  read = client.read_holding_registers if block.function_code == READ_HOLDING_REGISTERS else client.read_input_registers
+  for attempt in range(MAX_RETRIES):
+    if attempt:
+      METRICS.count(device_label(unit_id), RETRY)
+    try:
+      with METRICS.time(device_label(unit_id), block.function_code, block_label(block.address, block.count)):
+        rr = read(address=block.address, count=block.count, slave=unit_id)
+      if not rr.isError():
+        values = {}
+        for entry in block.entries:
+          codec = READ_CODECS.get(entry.name)
+          offset = block.offset(entry)
+          values[entry.name] = codec.decode(rr.registers, offset) if codec else rr.registers[offset:offset + entry.count]
+        return values
+      record_error(unit_id, rr)
+      log.error("Error reading registers %s-%s from unit %s", block.address, block.address + block.count - 1, unit_id)
+    except Exception as e:
+      log.error("Exception reading registers %s-%s from unit %s: %s", block.address, block.address + block.count - 1,
+                unit_id, e)
+  return {}
+
+# Read a unit's register map, skipping blocks whose values are all still fresh in REGISTER_CACHE.
+# Values that moved past their deadband are also added to changes when it is given.
+def read_planned(client: ModbusClient, unit_id: int, plan: List[ReadBlock] = READ_PLAN,
+                 changes: Optional[Dict[str, object]] = None) -> Dict[str, Union[int, float, str, List[int]]]:
+  device = device_label(unit_id)
+  values = {}
+  for block in plan:
+    names = [entry.name for entry in block.entries]
+    if REGISTER_CACHE.fresh(device, names):
+      values.update((name, REGISTER_CACHE.get(device, name)) for name in names)
+      continue
+    block_values = read_block(client, unit_id, block)
+    for name, value in block_values.items():
+      if REGISTER_CACHE.put(device, name, value) is not None and changes is not None:
+        changes[name] = value
+    values.update(block_values)
+  return values
+
 def get_register_address_by_name(register_name: str, read: bool = True) -> Optional[int]:
-  registers = REGISTER_ADDRESSES_READ if read else REGISTER_ADDRESSES_WRITE
-  for address, _, _, name in registers:
-    if name == register_name:
-      return address
-  return None
+  entry = (READ_MAP if read else WRITE_MAP).get(register_name)
+  return entry.address if entry else None
 
 def read_register_by_name(client: ModbusClient, unit_id: int, register_name: str) -> Union[int, float, str, None]:
-  register_address = get_register_address_by_name(register_name)
-  if register_address is not None:
-    for address, count, decode, name in REGISTER_ADDRESSES_READ:
-      if name == register_name:
-        return read_register(client, unit_id, address, count, decode)
-  log.error(f"Register name {register_name} not found")
+  entry = READ_MAP.get(register_name)
+  if entry is not None:
+    return REGISTER_CACHE.read_through(device_label(unit_id), register_name,
+                                       lambda: read_register(client, unit_id, entry.address, entry.count, entry.decode))
+  log.error("Register name %s not found", register_name)
   return None
 
-def write_register(client: ModbusClient, unit_id: int, register_address: int, value: Union[int, float]) -> bool:
-  for _ in range(MAX_RETRIES):
+# Drop cached reads of registers a write just changed.
+def invalidate_written(unit_id: int, register_address: int, register_count: int):
+  for address in range(register_address, register_address + register_count):
+    entry = READ_MAP.covering(address)
+    if entry is not None:
+      REGISTER_CACHE.invalidate(device_label(unit_id), entry.name)
+
+def write_registers(client: ModbusClient, unit_id: int, register_address: int, registers: List[int]) -> bool:
+  for attempt in range(MAX_RETRIES):
+    if attempt:
+      METRICS.count(device_label(unit_id), RETRY)
     try:
-      builder = BinaryPayloadBuilder(byteorder=Endian.BIG, wordorder=Endian.LITTLE)
-      if isinstance(value, int):
-        builder.add_16bit_int(value)
-      elif isinstance(value, float):
-        builder.add_32bit_float(value)
-      else:
-        log.error(f"Invalid value type for register {register_address}")
-        return False
-      wb = client.write_registers(register_address, builder.to_registers(), slave=unit_id)
+      with METRICS.time(device_label(unit_id), 16, block_label(register_address, len(registers))):
+        wb = client.write_registers(register_address, registers, slave=unit_id)
       if not wb.isError():
-        log.info(f"Successfully wrote value {value} to register {register_address} for unit {unit_id}")
+        log.debug("Successfully wrote %s to register %s for unit %s", registers, register_address, unit_id)
+        invalidate_written(unit_id, register_address, len(registers))
         return True
-      log.error(f"Error writing value {value} to register {register_address} for unit {unit_id}")
+      record_error(unit_id, wb)
+      log.error("Error writing %s to register %s for unit %s", registers, register_address, unit_id)
     except Exception as e:
-      log.error(f"Exception writing value {value} to register {register_address} for unit {unit_id}: {e}")
-    sleep(1)
+      log.error("Exception writing %s to register %s for unit %s: %s", registers, register_address, unit_id, e)
   return False
 
-def write_register_by_name(client: ModbusClient, unit_id: int, register_name: str, value: Union[int, float]) -> bool:
-  register_address = get_register_address_by_name(register_name, read=False)
-  if register_address is not None:
-    for address, _, builder_key, name, _ in REGISTER_ADDRESSES_WRITE:
-      if name == register_name:
-        builder = BUILDERS[builder_key](value)
-        return write_register(client, unit_id, address, builder.to_registers())
-  log.error(f"Register name {register_name} not found")
-  return False
+def write_register(client: ModbusClient, unit_id: int, register_address: int, value: Union[int, float, Sequence[int]]) -> bool:
+  # Plain ints go out as int16 and floats as float32; a register list is written as is.
+  if isinstance(value, int):
+    registers = get_codec('int16', 1, BYTE_ORDER, WORD_ORDER).encode(value)
+  elif isinstance(value, float):
+    registers = get_codec('float32', 2, BYTE_ORDER, WORD_ORDER).encode(value)
+  elif isinstance(value, (list, tuple)):
+    registers = list(value)
+  else:
+    log.error("Invalid value type for register %s", register_address)
+    return False
+  return write_registers(client, unit_id, register_address, registers)
+
+# Write named setpoints with the fewest FC16 requests, encoded with the WRITE_MAP types.
+# verify=True reads the written registers back (FC3, coalesced) and compares them.
+def write_setpoints(client: ModbusClient, unit_id: int, setpoints: Dict[str, object],
+                    verify: bool = False) -> Dict[str, WriteResult]:
+  try:
+    blocks = plan_writes(encode_setpoints(WRITE_MAP, setpoints, BYTE_ORDER, WORD_ORDER))
+  except (KeyError, ValueError) as e:
+    log.error("Invalid setpoints for unit %s: %s", unit_id, e)
+    return {}
+  write = lambda address, registers: write_registers(client, unit_id, address, registers)
+  read = lambda address, count: read_register(client, unit_id, address, count, None, READ_HOLDING_REGISTERS)
+  results = execute_writes(blocks, write, read if verify else None)
+  for result in results.values():
+    if result.verified is False:
+      log.error("Read back %s from %s on unit %s, wrote %s", result.read_back, result.name, unit_id, result.value)
+  return results
+
+def write_register_by_name(client: ModbusClient, unit_id: int, register_name: str,
+                           value: Union[int, float, Sequence[int]]) -> bool:
+  if register_name not in WRITE_MAP:
+    log.error("Register name %s not found", register_name)
+    return False
+  result = write_setpoints(client, unit_id, {register_name: value}).get(register_name)
+  return result is not None and result.ok
 
 def connect_to_modbus_client() -> ModbusClient:
-  return ModbusClient(port=PORT, stopbits=STOPBITS, bytesize=BYTESIZE, parity=PARITY, baudrate=BAUDRATE, timeout=TIMEOUT)
+  global CAPTURE
+  client = ModbusClient(port=PORT, stopbits=STOPBITS, bytesize=BYTESIZE, parity=PARITY, baudrate=BAUDRATE, timeout=TIMEOUT)
+  if CAPTURE_PATH:
+    from utils.frame_capture import RTU, CaptureWriter, capture_client
+    if CAPTURE is None:
+      CAPTURE = CaptureWriter(CAPTURE_PATH, RTU)
+      log.info("Capturing the frames on %s to %s", PORT, CAPTURE_PATH)
+    capture_client(client, CAPTURE)
+  return client
+
+def close_capture():
+  global CAPTURE
+  if CAPTURE is not None:
+    CAPTURE.close()
+    log.info("Captured %s frames to %s", CAPTURE.frames, CAPTURE.path)
+    CAPTURE = None
+
+# Read one group of a unit's registers and hand the values to the sample store, MQTT and the log.
+def poll_group(client: ModbusClient, unit_id: int, plan: List[ReadBlock] = READ_PLAN):
+  # One structured record per unit holding only the values that really moved.
+  changes = {}
+  values = read_planned(client, unit_id, plan, changes=changes)
+  if SAMPLE_STORE is not None:
+    SAMPLE_STORE.append_values(device_label(unit_id), values)
+  if MQTT_BRIDGE is not None:
+    MQTT_BRIDGE.submit(device_label(unit_id), values)
+  if PROCESS_IMAGE is not None:
+    PROCESS_IMAGE.publish(device_label(unit_id), values)
+  if changes:
+    log_sample(log, device_label(unit_id), changes)
+
+def write_unit_setpoints(client: ModbusClient, unit_id: int):
+  for result in write_setpoints(client, unit_id, SETPOINTS, verify=VERIFY_WRITES).values():
+    if result.ok:
+      log.info("Wrote %s to %s", result.value, result.name)
 
 def process_unit(client: ModbusClient, unit_id: int):
-  log.info(f"Connected to unit {unit_id}")
-  for register_address, register_count, decode, register_name in REGISTER_ADDRESSES_READ:
-    result = read_register(client, unit_id, register_address, register_count, decode)
-    if result is not None:
-      log.info(f"{register_name}: {result}")
-  for register_address, _, builder_key, register_name, value in REGISTER_ADDRESSES_WRITE:
-    if write_register(client, unit_id, register_address, value):
-      log.info(f"Wrote {value} to {register_name}")
-  log.info(f"Disconnected from unit {unit_id}")
+  log.debug("Connected to unit %s", unit_id)
+  poll_group(client, unit_id)
+  write_unit_setpoints(client, unit_id)
+  log.debug("Disconnected from unit %s", unit_id)
+
+# One task per unit and poll group, plus one for the unit's setpoints.
+# Faster groups get a higher priority, so the slowest ones are shed first when the
+# bus is overloaded; setpoint writes rank above every read and run-once groups never shed.
+def poll_tasks(scheduler: RtuBusScheduler, unit_ids: Sequence[int]) -> List[PollTask]:
+  rates = sorted((interval for interval in POLL_GROUPS if interval > ONCE), reverse=True)
+  tasks = []
+  for unit_id in unit_ids:
+    for interval, plan in POLL_GROUPS.items():
+      label = f"{interval:g}s" if interval > ONCE else "once"
+      priority = rates.index(interval) + 1 if interval > ONCE else 0
+      tasks.append(PollTask(f"{device_label(unit_id)}@{label}", interval,
+                            partial(scheduler.transaction, unit_id, partial(poll_group, plan=plan)), priority))
+    if SETPOINTS:
+      tasks.append(PollTask(f"{device_label(unit_id)}@setpoints", POLL_PERIOD,
+                            partial(scheduler.transaction, unit_id, write_unit_setpoints), len(rates) + 1))
+  return tasks
+
+# Re-probe a few missing units of the port and log the ones that answered.
+def reprobe_units(discovery: UnitDiscovery, client: ModbusClient):
+  for unit_id in discovery.reprobe(PORT, client, REPROBE_COUNT):
+    log.info("Unit %s answered on %s", unit_id, PORT)
+
+# Poll the units' register groups at their own intervals until RUN_TIME passes or the run is interrupted.
+# With a discovery, missing units are re-probed as the lowest priority task, so
+# probes only take bus time the poll groups leave idle and are shed first.
+def run_scheduled(scheduler: RtuBusScheduler, unit_ids: Sequence[int], discovery: Optional[UnitDiscovery] = None):
+  tasks = poll_tasks(scheduler, unit_ids)
+  if discovery is not None and discovery.known(PORT):
+    tasks.append(PollTask(f"{PORT}@reprobe", REPROBE_INTERVAL, partial(reprobe_units, discovery, scheduler.client), -1))
+  bus = DeadlineScheduler(tasks, PORT, MAX_BUS_LOAD)
+  try:
+    bus.run(RUN_TIME or None)
+  except KeyboardInterrupt:
+    pass
+  for name, stats in bus.report().items():
+    log.info("%s: %s runs, %s deadline misses, %s skipped, jitter p95 %.1f ms, interval x%.2f", name, stats["runs"],
+             stats["misses"], stats["skipped"], 1000 * stats["jitter"]["p95"], stats["stretch"])
+  log.info("Scheduled bus load on %s: %.0f%%", PORT, 100 * bus.utilisation())
+
+def unit_discovery() -> UnitDiscovery:
+  return UnitDiscovery(DISCOVERY_PATH, initial_timeout=PROBE_TIMEOUT, max_timeout=TIMEOUT)
+
+# Units to poll on a port: the live ones from the last discovery scan, else UNIT_IDS.
+def poll_units(discovery: UnitDiscovery, port: str) -> Sequence[int]:
+  return discovery.known(port) or UNIT_IDS
+
+def start_mqtt_bridge() -> Optional["MqttBridge"]:
+  if not MQTT_HOST:
+    return None
+  from protocols.mqtt.mqtt_bridge import MqttBridge
+  bridge = MqttBridge(MQTT_HOST, MQTT_PORT, payload_format=MQTT_FORMAT, publish_on_change=MQTT_ON_CHANGE,
+                      policy=CachePolicy(deadband=CACHE_DEADBAND))
+  bridge.start()
+  return bridge
+
+def stop_mqtt_bridge():
+  global MQTT_BRIDGE
+  if MQTT_BRIDGE is not None:
+    MQTT_BRIDGE.stop()
+    log.info("MQTT: %s", MQTT_BRIDGE.stats())
+    MQTT_BRIDGE = None
+
+# Open the process image for devices, unless PROCESS_IMAGE_NAME is unset.
+def open_process_image(devices: Sequence[str]) -> Optional["ProcessImage"]:
+  if not PROCESS_IMAGE_NAME:
+    return None
+  from utils.process_image import ProcessImage
+  image = ProcessImage(PROCESS_IMAGE_NAME, devices, READ_MAP)
+  log.info("Publishing %s devices to shared memory %s", len(devices), image.name)
+  return image
+
+def close_process_image():
+  global PROCESS_IMAGE
+  if PROCESS_IMAGE is not None:
+    PROCESS_IMAGE.close()
+    PROCESS_IMAGE = None
+
+# Configure the client logging; handlers run on a background queue listener so
+# console and file writes stay out of the bus timing (MODBUS_LOG_QUEUED=0 logs inline).
+def setup_logging():
+  configure_logging(
+    level=os.getenv("MODBUS_LOG_LEVEL", "DEBUG").upper(),
+    fmt='[%(asctime)s] [%(filename)s: %(lineno)s - %(funcName)s] => %(levelname)s: %(message)s',
+    log_file=os.getenv("MODBUS_LOG_FILE"),
+    queued=os.getenv("MODBUS_LOG_QUEUED", "1") != "0"
+  )
+
+def open_sample_store() -> Optional["SampleWriter"]:
+  if not SAMPLE_STORE_DIR:
+    return None
+  from utils.sample_store import SampleWriter
+  return SampleWriter(SAMPLE_STORE_DIR)
 
 def main():
-  for unit_id in UNIT_IDS:
-    try:
-      with connect_to_modbus_client() as client:
-        if client.connect():
-          process_unit(client, unit_id)
-        else:
-          log.error(f"Failed to connect to unit {unit_id}")
-    except Exception as e:
-      log.error(f"Exception occurred while communicating with unit {unit_id}: {e}")
-    sleep(1)
+  global SAMPLE_STORE, MQTT_BRIDGE, PROCESS_IMAGE
+  setup_logging()
+  discovery = unit_discovery()
+  SAMPLE_STORE = open_sample_store()
+  MQTT_BRIDGE = start_mqtt_bridge()
+  try:
+    # One open port for the whole sweep; units are polled back to back with only the inter-frame gap between frames.
+    with RtuBusScheduler(connect_to_modbus_client(), inter_frame_gap(BAUDRATE, BYTESIZE, PARITY, STOPBITS)) as scheduler:
+      if not scheduler.open():
+        log.error("Failed to open serial port %s", PORT)
+        return
+      if DISCOVER:
+        found = discovery.scan(PORT, scheduler.client)
+        log.info("Discovered %s units on %s: %s", len(found), PORT, sorted(found))
+      PROCESS_IMAGE = open_process_image([device_label(unit_id) for unit_id in poll_units(discovery, PORT)])
+      if SCHEDULED:
+        run_scheduled(scheduler, poll_units(discovery, PORT), discovery)
+        return
+      stats = scheduler.sweep(poll_units(discovery, PORT), process_unit)
+      # Pick up units that were missing a few at a time instead of rescanning the bus.
+      # A single sweep has no idle bus time to hide the probes in and the port is
+      # half duplex, so they run once the sweep is done.
+      if discovery.known(PORT):
+        reprobe_units(discovery, scheduler.client)
+  finally:
+    stop_mqtt_bridge()
+    close_process_image()
+    close_capture()
+    if SAMPLE_STORE is not None:
+      SAMPLE_STORE.close()
+      SAMPLE_STORE = None
+  log.info("Swept %s units (%s failed) in %.3fs, bus utilisation %.0f%%", stats.units, stats.failed, stats.elapsed,
+           100 * stats.utilisation)
+
+# SETPOINTS as a write plan for the bus workers, or () when they cannot be encoded.
+def setpoint_plan() -> tuple:
+  try:
+    return tuple(plan_writes(encode_setpoints(WRITE_MAP, SETPOINTS, BYTE_ORDER, WORD_ORDER)))
+  except (KeyError, ValueError) as e:
+    log.error("Invalid setpoints, supervised workers will only read: %s", e)
+    return ()
+
+# Probe every port at once for live units; probes on one port stay sequential.
+def discover_ports(discovery: UnitDiscovery, options: Dict[str, dict]):
+  clients = {port: ModbusClient(**port_options) for port, port_options in options.items()}
+  try:
+    opened = {port: client for port, client in clients.items() if client.connect()}
+    for port, found in discovery.scan_all(opened).items():
+      log.info("Discovered %s units on %s: %s", len(found), port, sorted(found))
+  finally:
+    for client in clients.values():
+      client.close()
+
+# Hand one worker batch to the sinks, as process_unit() does for a single port.
+def handle_batch(batch: "PollBatch"):
+  for error in batch.errors:
+    log.error("Polling %s failed: %s", batch.bus, error)
+  if MQTT_BRIDGE is not None:
+    MQTT_BRIDGE.submit_batch(batch)
+  for unit_id, timestamp, values in batch.samples:
+    device = f"{batch.bus}/{unit_id}"
+    if SAMPLE_STORE is not None:
+      SAMPLE_STORE.append_values(device, values, timestamp)
+    if PROCESS_IMAGE is not None:
+      PROCESS_IMAGE.publish(device, values, timestamp)
+    changes = REGISTER_CACHE.update(device, values)
+    if changes:
+      log_sample(log, device, changes)
+
+# Sweep every port in PORTS from its own worker process, restarting workers that crash.
+# Each worker writes SETPOINTS to a unit after reading it, as process_unit() does.
+def main_supervised(ports: Sequence[str]):
+  global SAMPLE_STORE, MQTT_BRIDGE, PROCESS_IMAGE
+  from utils.bus_supervisor import BusSpec, BusSupervisor
+  setup_logging()
+  options = {port: dict(port=port, stopbits=STOPBITS, bytesize=BYTESIZE, parity=PARITY, baudrate=BAUDRATE, timeout=TIMEOUT)
+             for port in ports}
+  discovery = unit_discovery()
+  if DISCOVER:
+    discover_ports(discovery, options)
+  writes = setpoint_plan()
+  buses = [BusSpec(port, "utils.bus_supervisor:rtu_bus", options[port],
+                   tuple(poll_units(discovery, port)), READ_MAP.entries, period=POLL_PERIOD, max_gap=READ_MAX_GAP,
+                   byteorder=byte_order(BYTE_ORDER), wordorder=byte_order(WORD_ORDER), writes=writes,
+                   verify=VERIFY_WRITES)
+           for port in ports]
+  SAMPLE_STORE = open_sample_store()
+  MQTT_BRIDGE = start_mqtt_bridge()
+  PROCESS_IMAGE = open_process_image([f"{bus.name}/{unit_id}" for bus in buses for unit_id in bus.units])
+  supervisor = BusSupervisor(buses)
+  supervisor.start()
+  try:
+    for batch in supervisor.batches():
+      handle_batch(batch)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    supervisor.stop()
+    stop_mqtt_bridge()
+    close_process_image()
+    if SAMPLE_STORE is not None:
+      SAMPLE_STORE.close()
+      SAMPLE_STORE = None
 
 if __name__ == "__main__":
-  main()
\ No newline at end of file
+  if len(PORTS) > 1:
+    main_supervised(PORTS)
+  else:
+    main()
\ No newline at end of file
@@ -0,0 +1,90 @@
+#
+# This module is used to run back to back Modbus RTU transactions on one serial bus.
+#
+
+import logging
+import time
+from typing import Any, Callable, Dict, Iterable, NamedTuple
+
+log = logging.getLogger(__name__)
+
+# Above 19200 baud the Modbus serial line spec fixes the inter-frame gap at 1.75 ms.
+FIXED_GAP_BAUDRATE = 19200
+FIXED_FRAME_GAP = 0.00175
+
+# Seconds needed to transmit one character: start bit, data bits, parity bit and stop bits.
+def character_time(baudrate: int, bytesize: int, parity: str, stopbits: int) -> float:
+  bits = 1 + bytesize + (0 if parity.upper() == 'N' else 1) + stopbits
+  return bits / baudrate
+
+# The 3.5 character silent interval that must separate two RTU frames.
+def inter_frame_gap(baudrate: int, bytesize: int, parity: str, stopbits: int) -> float:
+  if baudrate > FIXED_GAP_BAUDRATE:
+    return FIXED_FRAME_GAP
+  return 3.5 * character_time(baudrate, bytesize, parity, stopbits)
+
+class SweepStats(NamedTuple):
+  units: int
+  failed: int
+  elapsed: float
+  busy: float
+
+  # Share of the sweep spent inside unit transactions.
+  @property
+  def utilisation(self) -> float:
+    return self.busy / self.elapsed if self.elapsed else 0.0
+
+# Keeps one serial port open and runs per-unit transactions back to back.
+# The only pause between frames is the inter-frame gap, which is handed to the
+# pymodbus RTU framer (it already waits out client.silent_interval before each
+# send) so nothing else sleeps on the bus.
+class RtuBusScheduler:
+  def __init__(self, client, gap: float):
+    self.client = client
+    self.gap = gap
+    self.client.silent_interval = round(gap, 6)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def open(self) -> bool:
+    return self.client.connect()
+
+  def close(self):
+    self.client.close()
+
+  # Run transaction(client, unit_id) for one unit, returning its result and duration.
+  def transaction(self, unit_id: int, transaction: Callable[[Any, int], Any]):
+    start = time.perf_counter()
+    result = transaction(self.client, unit_id)
+    return result, time.perf_counter() - start
+
+  # Run transaction(client, unit_id) for every unit on the already open port.
+  def sweep(self, unit_ids: Iterable[int], transaction: Callable[[Any, int], Any]) -> SweepStats:
+    units = failed = 0
+    busy = 0.0
+    start = time.perf_counter()
+    for unit_id in unit_ids:
+      units += 1
+      try:
+        _, duration = self.transaction(unit_id, transaction)
+        busy += duration
+      except Exception as e:
+        failed += 1
+        log.error("Exception occurred while communicating with unit %s: %s", unit_id, e)
+    return SweepStats(units, failed, time.perf_counter() - start, busy)
+
+  # Run transaction(client, unit_id) for every unit and collect the results by unit ID.
+  def collect(self, unit_ids: Iterable[int], transaction: Callable[[Any, int], Any]) -> Dict[int, Any]:
+    results = {}
+    for unit_id in unit_ids:
+      try:
+        results[unit_id], _ = self.transaction(unit_id, transaction)
+      except Exception as e:
+        log.error("Exception occurred while communicating with unit %s: %s", unit_id, e)
+    return results
+
+# End of file: protocols/modbusRTU/rtu_bus_scheduler.py
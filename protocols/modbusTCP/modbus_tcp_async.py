@@ -0,0 +1,214 @@
+#
+# This module is used to poll many Modbus TCP devices concurrently.
+#
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from pymodbus.client import AsyncModbusTcpClient
+from utils.register_decoder import block_decoder, decode_array, registers_to_bytes
+from utils.register_planner import READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS, plan_reads
+from utils.timer import ERROR_RESPONSE, METRICS, block_label
+
+# Registers taken by one value of each typed read helper.
+VALUE_WIDTHS = {
+    "int16": 1,
+    "float16": 1,
+    "int32": 2,
+    "float32": 2,
+    "int64": 4,
+    "float64": 4,
+}
+
+
+# One device to poll: a slave behind a host:port and the register map to read from it.
+# register_map holds (address, count, decode, name) entries as used by plan_reads().
+class PollTarget(NamedTuple):
+    host: str
+    port: int
+    slave: int
+    register_map: Sequence[Sequence]
+    name: Optional[str] = None
+
+
+# The outcome of polling one target.
+class PollResult(NamedTuple):
+    target: PollTarget
+    values: Dict[str, object]
+    error: Optional[str]
+    elapsed: float
+
+
+# Typed read helpers for one slave, sharing the poller's pooled connection.
+class AsyncModbusDevice:
+    def __init__(self, poller, host, port=502, slave=1):
+        self.poller = poller
+        self.host = host
+        self.port = port
+        self.slave = slave
+
+    # Read raw registers, returning None if the device answers with an error.
+    async def read_registers(self, address, count, function_code=READ_INPUT_REGISTERS):
+        return await self.poller.read_registers(self.host, self.port, self.slave, address, count, function_code)
+
+    # Read count values of the given type and decode them.
+    async def _read_values(self, kind, address, count):
+        registers = await self.read_registers(address, count * VALUE_WIDTHS[kind])
+        if registers is None:
+            return None
+        return decode_array(registers, kind, count=count).tolist()
+
+    # Read 16-bit integer values from the device.
+    async def read_int16(self, address, count):
+        return await self._read_values("int16", address, count)
+
+    # Read 16-bit float values from the device.
+    async def read_float16(self, address, count):
+        return await self._read_values("float16", address, count)
+
+    # Read 32-bit integer values from the device.
+    async def read_int32(self, address, count):
+        return await self._read_values("int32", address, count)
+
+    # Read 32-bit float values from the device.
+    async def read_float32(self, address, count):
+        return await self._read_values("float32", address, count)
+
+    # Read 64-bit integer values from the device.
+    async def read_int64(self, address, count):
+        return await self._read_values("int64", address, count)
+
+    # Read 64-bit float values from the device.
+    async def read_float64(self, address, count):
+        return await self._read_values("float64", address, count)
+
+    # Read boolean values (coils) from the device.
+    async def read_bool(self, address, count):
+        client = await self.poller.client(self.host, self.port)
+        async with self.poller.request_slot(self.host, self.port):
+            result = await client.read_coils(address, count, slave=self.slave)
+        if result.isError():
+            return None
+        return result.bits[:count]
+
+    # Read a string stored in count registers from the device.
+    async def read_string(self, address, count):
+        registers = await self.read_registers(address, count)
+        if registers is None:
+            return None
+        return registers_to_bytes(registers).decode("utf-8", errors="replace").strip("\x00")
+
+
+# This class is used to poll many Modbus TCP devices concurrently.
+# One connection is kept per host:port and shared by every slave behind it;
+# per_host_limit bounds the requests queued against one host so a slow
+# gateway only stalls its own devices, and max_concurrency bounds the total.
+class AsyncModbusTcpPoller:
+    def __init__(self, per_host_limit=1, max_concurrency=256, timeout=3, retries=1):
+        self.per_host_limit = per_host_limit
+        self.timeout = timeout
+        self.retries = retries
+        self._clients: Dict[Tuple[str, int], AsyncModbusTcpClient] = {}
+        self._connect_locks: Dict[Tuple[str, int], asyncio.Lock] = {}
+        self._host_slots: Dict[Tuple[str, int], asyncio.Semaphore] = {}
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    # Return typed read helpers for one slave.
+    def device(self, host, port=502, slave=1):
+        return AsyncModbusDevice(self, host, port, slave)
+
+    # Semaphore bounding the requests in flight against one host:port.
+    def host_slot(self, host, port):
+        key = (host, port)
+        if key not in self._host_slots:
+            self._host_slots[key] = asyncio.Semaphore(self.per_host_limit)
+        return self._host_slots[key]
+
+    # Hold a request slot for host:port: the host's own slot first, then one of the
+    # global slots, so requests queued behind a slow host never hold global slots.
+    @asynccontextmanager
+    async def request_slot(self, host, port):
+        async with self.host_slot(host, port):
+            async with self._slots:
+                yield
+
+    # Return the pooled connection for host:port, connecting it if needed.
+    async def client(self, host, port=502):
+        key = (host, port)
+        client = self._clients.get(key)
+        if client is not None and client.connected:
+            return client
+        lock = self._connect_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = AsyncModbusTcpClient(host, port=port, timeout=self.timeout, retries=self.retries)
+                self._clients[key] = client
+            if not client.connected:
+                await client.connect()
+            if not client.connected:
+                raise ConnectionError(f"Failed to connect to the Modbus TCP server at {host}:{port}")
+        return client
+
+    # Read raw registers with FC3 or FC4, returning None if the device answers with an error.
+    async def read_registers(self, host, port, slave, address, count, function_code=READ_INPUT_REGISTERS):
+        client = await self.client(host, port)
+        device = f"{host}:{port}/{slave}"
+        async with self.request_slot(host, port):
+            with METRICS.time(device, function_code, block_label(address, count)):
+                if function_code == READ_HOLDING_REGISTERS:
+                    result = await client.read_holding_registers(address, count, slave=slave)
+                else:
+                    result = await client.read_input_registers(address, count, slave=slave)
+        if result.isError():
+            METRICS.count(device, ERROR_RESPONSE)
+            return None
+        return result.registers
+
+    # Poll one target's whole register map through a coalesced read plan.
+    async def poll_target(self, target, max_gap=0, function_code=READ_INPUT_REGISTERS):
+        start = time.perf_counter()
+        values = {}
+        try:
+            for block in plan_reads(target.register_map, max_gap=max_gap, function_code=function_code):
+                registers = await self.read_registers(target.host, target.port, target.slave,
+                                                      block.address, block.count, block.function_code)
+                if registers is None:
+                    return PollResult(target, values, f"Error reading registers {block.address}-"
+                                      f"{block.address + block.count - 1}", time.perf_counter() - start)
+                values.update(block_decoder(block).decode(registers))
+        except Exception as e:
+            return PollResult(target, values, str(e) or type(e).__name__, time.perf_counter() - start)
+        return PollResult(target, values, None, time.perf_counter() - start)
+
+    # Poll all targets concurrently and yield each result as soon as it arrives.
+    async def poll(self, targets: Iterable[PollTarget], max_gap=0,
+                   function_code=READ_INPUT_REGISTERS) -> AsyncIterator[PollResult]:
+        tasks = [asyncio.ensure_future(self.poll_target(target, max_gap, function_code)) for target in targets]
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                yield await next_result
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    # Poll all targets and return the results once every target has answered.
+    async def poll_all(self, targets: Iterable[PollTarget], max_gap=0,
+                       function_code=READ_INPUT_REGISTERS) -> List[PollResult]:
+        return [result async for result in self.poll(targets, max_gap, function_code)]
+
+    # Close every pooled connection.
+    async def close(self):
+        for client in self._clients.values():
+            client.close()
+        self._clients.clear()
+
+# End of file: protocols/modbusTCP/modbus_tcp_async.py
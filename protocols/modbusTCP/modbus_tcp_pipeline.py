@@ -0,0 +1,142 @@
+#
+# This module is used to pipeline Modbus TCP requests over one connection.
+#
+
+import asyncio
+import struct
+from typing import Dict, List, Optional
+
+from utils.register_planner import READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS
+from utils.timer import ERROR_RESPONSE, METRICS, block_label
+
+# MBAP header: transaction id, protocol id (0), length of unit id + PDU, unit id.
+MBAP = struct.Struct(">HHHB")
+
+
+# Raised when a device answers with a Modbus exception response.
+class ModbusExceptionResponse(Exception):
+    def __init__(self, function_code: int, exception_code: int):
+        super().__init__(f"Function {function_code} failed with exception code {exception_code}")
+        self.function_code = function_code
+        self.exception_code = exception_code
+
+
+# This class is used to keep several Modbus TCP transactions in flight on one connection.
+# Each request gets its own transaction id and a reader task hands every response
+# to the request with the same id, so a gateway fronting many units (such as a
+# Huawei SACU) is kept busy instead of idling one round trip per request.
+# max_in_flight bounds the outstanding requests; gateways that do not queue
+# requests need it set to 1.
+class PipelinedModbusTcpClient:
+    def __init__(self, host, port=502, max_in_flight=8, timeout=3.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._next_id = 0
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    # Open the connection and start dispatching responses.
+    async def connect(self):
+        if self.connected:
+            return
+        self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                                            self.timeout)
+        self._reader_task = asyncio.ensure_future(self._dispatch())
+
+    # Close the connection, failing every request still in flight.
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._fail_pending(ConnectionError("Connection closed"))
+
+    def _fail_pending(self, error: Exception):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+
+    # Read responses and resolve the request with the matching transaction id.
+    # Any failure, including a malformed frame, drops the connection and fails every
+    # request in flight; the next connect() opens a new one.
+    async def _dispatch(self):
+        try:
+            while True:
+                transaction, _, length, _ = MBAP.unpack(await self._reader.readexactly(MBAP.size))
+                pdu = await self._reader.readexactly(length - 1)
+                future = self._pending.pop(transaction, None)
+                # Late answers to timed-out requests have no future left and are dropped.
+                if future is not None and not future.done():
+                    future.set_result(pdu)
+        except Exception as e:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            self._fail_pending(ConnectionError(f"Connection to {self.host}:{self.port} lost: {e!r}"))
+
+    def _transaction_id(self) -> int:
+        while True:
+            self._next_id = (self._next_id + 1) & 0xFFFF
+            if self._next_id not in self._pending:
+                return self._next_id
+
+    # Send a request PDU to a unit and return the response PDU.
+    # block labels the request in the latency metrics, e.g. '40101-40110'.
+    async def execute(self, unit: int, pdu: bytes, block: str = "") -> bytes:
+        device = f"{self.host}:{self.port}/{unit}"
+        async with self._slots:
+            if not self.connected:
+                raise ConnectionError(f"Not connected to {self.host}:{self.port}")
+            transaction = self._transaction_id()
+            future = asyncio.get_running_loop().create_future()
+            self._pending[transaction] = future
+            self._writer.write(MBAP.pack(transaction, 0, len(pdu) + 1, unit) + pdu)
+            try:
+                with METRICS.time(device, pdu[0], block):
+                    response = await asyncio.wait_for(future, self.timeout)
+            finally:
+                self._pending.pop(transaction, None)
+        if response[0] & 0x80:
+            METRICS.count(device, ERROR_RESPONSE)
+            raise ModbusExceptionResponse(response[0] & 0x7F, response[1])
+        return response
+
+    # Read registers with FC3 or FC4.
+    async def read_registers(self, unit: int, address: int, count: int,
+                             function_code=READ_INPUT_REGISTERS) -> List[int]:
+        function_code = READ_HOLDING_REGISTERS if function_code == READ_HOLDING_REGISTERS else READ_INPUT_REGISTERS
+        response = await self.execute(unit, struct.pack(">BHH", function_code, address, count),
+                                      block_label(address, count))
+        if len(response) < 2 + 2 * count or response[1] != 2 * count:
+            raise ValueError(f"Unit {unit} returned {response[1] // 2} registers for a read of {count}")
+        return list(struct.unpack_from(f">{count}H", response, 2))
+
+    # Write registers with FC16.
+    async def write_registers(self, unit: int, address: int, registers: List[int]):
+        count = len(registers)
+        await self.execute(unit, struct.pack(f">BHHB{count}H", 16, address, count, 2 * count, *registers),
+                           block_label(address, count))
+
+# End of file: protocols/modbusTCP/modbus_tcp_pipeline.py
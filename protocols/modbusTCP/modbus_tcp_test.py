@@ -2,38 +2,55 @@
 # This module is used to test the Modbus TCP protocol.
 #
 
+import logging
+
 from pymodbus.client import ModbusTcpClient as ModbusClient
-from pymodbus.payload import BinaryPayloadDecoder
 from pymodbus.constants import Endian
 from pymodbus.payload import BinaryPayloadBuilder
-from utils import Logger
+from utils.frame_capture import TCP, CaptureWriter, capture_client
+from utils.register_decoder import block_decoder, decode_array, registers_to_bytes
+from utils.register_planner import READ_HOLDING_REGISTERS, plan_reads
+from utils.timer import ERROR_RESPONSE, METRICS, block_label
+
+log = logging.getLogger(__name__)
 
 
 # This class is used to test the Modbus TCP protocol.
+# With a capture path, every frame sent and received while connected is recorded
+# for offline replay (see utils.frame_capture).
 class ModbusTcpTest:
-    def __init__(self):
+    def __init__(self, capture=None):
         self.client = None
+        self.capture_path = capture
+        self.capture = None
 
     # Connect to the Modbus TCP server.
     def connect(self, host, port):
         self.client = ModbusClient(host, port)
+        if self.capture_path and self.capture is None:
+            self.capture = CaptureWriter(self.capture_path, TCP)
+        if self.capture is not None:
+            capture_client(self.client, self.capture)
         self.client.connect()
         # Check if the connection is successful.
         if self.client.is_socket_open():
-            Logger.log("Connected to the Modbus TCP server.")
+            log.info("Connected to the Modbus TCP server.")
         else:
-            Logger.log("Failed to connect to the Modbus TCP server.")
+            log.error("Failed to connect to the Modbus TCP server.")
         # Return the connection status.
         return self.client.is_socket_open()
 
     # Disconnect from the Modbus TCP server.
     def disconnect(self):
         self.client.close()
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
         # Check if the disconnection is successful.
         if not self.client.is_socket_open():
-            Logger.log("Disconnected from the Modbus TCP server.")
+            log.info("Disconnected from the Modbus TCP server.")
         else:
-            Logger.log("Failed to disconnect from the Modbus TCP server.")
+            log.error("Failed to disconnect from the Modbus TCP server.")
         # Return the disconnection status.
         return not self.client.is_socket_open()
 
@@ -43,13 +60,10 @@ class ModbusTcpTest:
         result = self.client.read_input_registers(address, count, unit=1)
         # Check if the reading is successful.
         if result.isError():
-            Logger.log("Failed to read 16-bit integer values from the Modbus TCP server.")
+            log.error("Failed to read 16-bit integer values from the Modbus TCP server.")
             return None
-        # Decode the 16-bit integer values.
-        decoder = BinaryPayloadDecoder.fromRegisters(result.registers, byteorder=Endian.Big)
-        values = []
-        for _ in range(count):
-            values.append(decoder.decode_16bit_int())
+        # Decode the 16-bit integer values in one vectorised step.
+        values = decode_array(result.registers, "int16", count=count).tolist()
         # Return the 16-bit integer values.
         return values
 
@@ -64,7 +78,7 @@ class ModbusTcpTest:
         result = self.client.write_registers(address, payload, unit=1)
         # Check if the writing is successful.
         if result.isError():
-            Logger.log("Failed to write 16-bit integer values to the Modbus TCP server.")
+            log.error("Failed to write 16-bit integer values to the Modbus TCP server.")
             return False
         # Return the writing status.
         return True
@@ -75,13 +89,10 @@ class ModbusTcpTest:
         result = self.client.read_input_registers(address, count, unit=1)
         # Check if the reading is successful.
         if result.isError():
-            Logger.log("Failed to read 16-bit float values from the Modbus TCP server.")
+            log.error("Failed to read 16-bit float values from the Modbus TCP server.")
             return None
-        # Decode the 16-bit float values.
-        decoder = BinaryPayloadDecoder.fromRegisters(result.registers, byteorder=Endian.Big)
-        values = []
-        for _ in range(count):
-            values.append(decoder.decode_16bit_float())
+        # Decode the 16-bit float values in one vectorised step.
+        values = decode_array(result.registers, "float16", count=count).tolist()
         # Return the 16-bit float values.
         return values
 
@@ -96,7 +107,7 @@ class ModbusTcpTest:
         result = self.client.write_registers(address, payload, unit=1)
         # Check if the writing is successful.
         if result.isError():
-            Logger.log("Failed to write 16-bit float values to the Modbus TCP server.")
+            log.error("Failed to write 16-bit float values to the Modbus TCP server.")
             return False
         # Return the writing status.
         return True
@@ -104,16 +115,13 @@ class ModbusTcpTest:
     # Read 32-bit integer values from the Modbus TCP server.
     def read_int32(self, address, count):
         # Read 32-bit integer values from the Modbus TCP server.
-        result = self.client.read_input_registers(address, count, unit=1)
+        result = self.client.read_input_registers(address, count * 2, unit=1)
         # Check if the reading is successful.
         if result.isError():
-            Logger.log("Failed to read 32-bit integer values from the Modbus TCP server.")
+            log.error("Failed to read 32-bit integer values from the Modbus TCP server.")
             return None
-        # Decode the 32-bit integer values.
-        decoder = BinaryPayloadDecoder.fromRegisters(result.registers, byteorder=Endian.Big)
-        values = []
-        for _ in range(count):
-            values.append(decoder.decode_32bit_int())
+        # Decode the 32-bit integer values in one vectorised step.
+        values = decode_array(result.registers, "int32", count=count).tolist()
         # Return the 32-bit integer values.
         return values
 
@@ -128,7 +136,7 @@ class ModbusTcpTest:
         result = self.client.write_registers(address, payload, unit=1)
         # Check if the writing is successful.
         if result.isError():
-            Logger.log("Failed to write 32-bit integer values to the Modbus TCP server.")
+            log.error("Failed to write 32-bit integer values to the Modbus TCP server.")
             return False
         # Return the writing status.
         return True
@@ -139,13 +147,10 @@ class ModbusTcpTest:
         result = self.client.read_input_registers(address, count * 2, unit=1)
         # Check if the reading is successful.
         if result.isError():
-            Logger.log("Failed to read 32-bit float values from the Modbus TCP server.")
+            log.error("Failed to read 32-bit float values from the Modbus TCP server.")
             return None
-        # Decode the 32-bit float values.
-        decoder = BinaryPayloadDecoder.fromRegisters(result.registers, byteorder=Endian.Big)
-        values = []
-        for _ in range(count):
-            values.append(decoder.decode_32bit_float())
+        # Decode the 32-bit float values in one vectorised step.
+        values = decode_array(result.registers, "float32", count=count).tolist()
         # Return the 32-bit float values.
         return values
 
@@ -160,7 +165,7 @@ class ModbusTcpTest:
         result = self.client.write_registers(address, payload, unit=1)
         # Check if the writing is successful.
         if result.isError():
-            Logger.log("Failed to write 32-bit float values to the Modbus TCP server.")
+            log.error("Failed to write 32-bit float values to the Modbus TCP server.")
             return False
         # Return the writing status.
         return True
@@ -168,16 +173,13 @@ class ModbusTcpTest:
     # Read 64-bit integer values from the Modbus TCP server.
     def read_int64(self, address, count):
         # Read 64-bit integer values from the Modbus TCP server.
-        result = self.client.read_input_registers(address, count * 2, unit=1)
+        result = self.client.read_input_registers(address, count * 4, unit=1)
         # Check if the reading is successful.
         if result.isError():
-            Logger.log("Failed to read 64-bit integer values from the Modbus TCP server.")
+            log.error("Failed to read 64-bit integer values from the Modbus TCP server.")
             return None
-        # Decode the 64-bit integer values.
-        decoder = BinaryPayloadDecoder.fromRegisters(result.registers, byteorder=Endian.Big)
-        values = []
-        for _ in range(count):
-            values.append(decoder.decode_64bit_int())
+        # Decode the 64-bit integer values in one vectorised step.
+        values = decode_array(result.registers, "int64", count=count).tolist()
         # Return the 64-bit integer values.
         return values
 
@@ -192,7 +194,7 @@ class ModbusTcpTest:
         result = self.client.write_registers(address, payload, unit=1)
         # Check if the writing is successful.
         if result.isError():
-            Logger.log("Failed to write 64-bit integer values to the Modbus TCP server.")
+            log.error("Failed to write 64-bit integer values to the Modbus TCP server.")
             return False
         # Return the writing status.
         return True
@@ -203,13 +205,10 @@ class ModbusTcpTest:
         result = self.client.read_input_registers(address, count * 4, unit=1)
         # Check if the reading is successful.
         if result.isError():
-            Logger.log("Failed to read 64-bit float values from the Modbus TCP server.")
+            log.error("Failed to read 64-bit float values from the Modbus TCP server.")
             return None
-        # Decode the 64-bit float values.
-        decoder = BinaryPayloadDecoder.fromRegisters(result.registers, byteorder=Endian.Big)
-        values = []
-        for _ in range(count):
-            values.append(decoder.decode_64bit_float())
+        # Decode the 64-bit float values in one vectorised step.
+        values = decode_array(result.registers, "float64", count=count).tolist()
         # Return the 64-bit float values.
         return values
 
@@ -224,7 +223,7 @@ class ModbusTcpTest:
         result = self.client.write_registers(address, payload, unit=1)
         # Check if the writing is successful.
         if result.isError():
-            Logger.log("Failed to write 64-bit float values to the Modbus TCP server.")
+            log.error("Failed to write 64-bit float values to the Modbus TCP server.")
             return False
         # Return the writing status.
         return True
@@ -235,7 +234,7 @@ class ModbusTcpTest:
         result = self.client.read_coils(address, count, unit=1)
         # Check if the reading is successful.
         if result.isError():
-            Logger.log("Failed to read boolean values from the Modbus TCP server.")
+            log.error("Failed to read boolean values from the Modbus TCP server.")
             return None
         # Return the boolean values.
         return result.bits
@@ -246,7 +245,7 @@ class ModbusTcpTest:
         result = self.client.write_coils(address, values, unit=1)
         # Check if the writing is successful.
         if result.isError():
-            Logger.log("Failed to write boolean values to the Modbus TCP server.")
+            log.error("Failed to write boolean values to the Modbus TCP server.")
             return False
         # Return the writing status.
         return True
@@ -257,13 +256,11 @@ class ModbusTcpTest:
         result = self.client.read_input_registers(address, count * 2, unit=1)
         # Check if the reading is successful.
         if result.isError():
-            Logger.log("Failed to read string values from the Modbus TCP server.")
+            log.error("Failed to read string values from the Modbus TCP server.")
             return None
-        # Decode the string values.
-        decoder = BinaryPayloadDecoder.fromRegisters(result.registers, byteorder=Endian.Big)
-        values = []
-        for _ in range(count):
-            values.append(decoder.decode_string(2))
+        # Split the string values out of the raw register bytes.
+        data = registers_to_bytes(result.registers)
+        values = [data[2 * i:2 * i + 2] for i in range(count)]
         # Return the string values.
         return values
 
@@ -278,11 +275,40 @@ class ModbusTcpTest:
         result = self.client.write_registers(address, payload, unit=1)
         # Check if the writing is successful.
         if result.isError():
-            Logger.log("Failed to write string values to the Modbus TCP server.")
+            log.error("Failed to write string values to the Modbus TCP server.")
             return False
         # Return the writing status.
         return True
 
+    # Metrics label of a slave behind this client's gateway: host:port/slave.
+    def device_label(self, slave):
+        params = self.client.comm_params
+        return f"{params.host}:{params.port}/{slave}"
+
+    # Read a whole register map with as few requests as possible.
+    # register_map holds (address, count, decode, name) entries, decode being a
+    # BinaryPayloadDecoder method name such as 'decode_32bit_float' or None for raw registers.
+    def read_register_map(self, register_map, max_gap=0, function_code=4, slave=1):
+        values = {}
+        device = self.device_label(slave)
+        for block in plan_reads(register_map, max_gap=max_gap, function_code=function_code):
+            # Read the coalesced block from the Modbus TCP server, recording its latency.
+            with METRICS.time(device, block.function_code, block_label(block.address, block.count)):
+                if block.function_code == READ_HOLDING_REGISTERS:
+                    result = self.client.read_holding_registers(block.address, block.count, slave=slave)
+                else:
+                    result = self.client.read_input_registers(block.address, block.count, slave=slave)
+            # Check if the reading is successful.
+            if result.isError():
+                METRICS.count(device, ERROR_RESPONSE)
+                log.error("Failed to read registers %s to %s from %s.", block.address,
+                          block.address + block.count - 1, device)
+                continue
+            # Split the block back into named values and decode them in one pass.
+            values.update(block_decoder(block).decode(result.registers))
+        # Return the named values.
+        return values
+
     if __name__ == "__main__":
         pass
 
@@ -0,0 +1,406 @@
+#
+# This module is used to publish poll results to an MQTT broker in batches.
+#
+
+import json
+import logging
+import os
+import struct
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Mapping, NamedTuple, Optional, Tuple
+
+from utils.register_cache import CachePolicy, RegisterCache
+
+log = logging.getLogger(__name__)
+
+# Payload formats.
+JSON = "json"
+PACKED = "packed"
+
+# What submit() does when the queue is full.
+BLOCK = "block"              # wait for room (backpressure on the poll loop)
+DROP_OLDEST = "drop_oldest"  # discard the oldest queued message
+SPILL = "spill"              # append to a file on disk and publish it once the queue drains
+
+# Default spill location, under the repository's logs directory.
+SPILL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "logs", "mqtt_spill")
+SPILL_FILE = "spill.bin"
+
+# Packed payload: timestamp and value count, then per value its name, a type code and the value.
+PACKED_HEADER = struct.Struct("<dH")
+_FLOAT = struct.Struct("<d")
+_INT = struct.Struct("<q")
+_INT_RANGE = range(-2 ** 63, 2 ** 63)
+_LENGTH = struct.Struct("<H")
+
+# Spill record: qos, topic length, payload length.
+SPILL_RECORD = struct.Struct("<BHI")
+
+
+# One payload waiting to be published.
+class OutgoingMessage(NamedTuple):
+    topic: str
+    payload: bytes
+    qos: int
+
+
+def _json_value(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode("utf-8", errors="replace").strip("\x00")
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return str(value)
+
+
+# One poll cycle of a device as compact JSON: {"t": unix time, "d": device, "v": {name: value}}.
+def encode_json(device: str, timestamp: float, values: Mapping[str, object]) -> bytes:
+    return json.dumps({"t": round(timestamp, 3), "d": device, "v": values}, separators=(",", ":"),
+                      default=_json_value).encode("utf-8")
+
+
+def _encode_name(text: str) -> bytes:
+    data = text.encode("utf-8")
+    if len(data) > 255:
+        raise ValueError(f"Value name {text[:32]!r}... is longer than 255 bytes")
+    return bytes((len(data),)) + data
+
+
+# One poll cycle of a device as a packed binary payload (the device is the topic).
+# Type codes: b'd' float64, b'q' int64, b'?' bool, b's' UTF-8 string, b'n' no value.
+# Integers outside the int64 range are sent as their decimal text; names longer
+# than 255 bytes raise ValueError.
+def encode_packed(timestamp: float, values: Mapping[str, object]) -> bytes:
+    parts = [PACKED_HEADER.pack(timestamp, len(values))]
+    for name, value in values.items():
+        parts.append(_encode_name(name))
+        if value is None:
+            parts.append(b"n")
+        elif isinstance(value, bool):
+            parts.append(b"?" + bytes((value,)))
+        elif isinstance(value, int) and value in _INT_RANGE:
+            parts.append(b"q" + _INT.pack(value))
+        elif isinstance(value, float):
+            parts.append(b"d" + _FLOAT.pack(value))
+        else:
+            data = (value if isinstance(value, str) else json.dumps(value, default=_json_value)).encode("utf-8")
+            parts.append(b"s" + _LENGTH.pack(len(data)) + data)
+    return b"".join(parts)
+
+
+# Decode a packed payload back into (timestamp, values).
+def decode_packed(payload: bytes) -> Tuple[float, Dict[str, object]]:
+    timestamp, count = PACKED_HEADER.unpack_from(payload)
+    offset = PACKED_HEADER.size
+    values: Dict[str, object] = {}
+    for _ in range(count):
+        length = payload[offset]
+        name = payload[offset + 1:offset + 1 + length].decode("utf-8")
+        offset += 1 + length
+        code = payload[offset:offset + 1]
+        offset += 1
+        if code == b"n":
+            values[name] = None
+        elif code == b"?":
+            values[name] = bool(payload[offset])
+            offset += 1
+        elif code == b"q":
+            values[name] = _INT.unpack_from(payload, offset)[0]
+            offset += _INT.size
+        elif code == b"d":
+            values[name] = _FLOAT.unpack_from(payload, offset)[0]
+            offset += _FLOAT.size
+        elif code == b"s":
+            length = _LENGTH.unpack_from(payload, offset)[0]
+            offset += _LENGTH.size
+            values[name] = payload[offset:offset + length].decode("utf-8")
+            offset += length
+        else:
+            raise ValueError(f"Unknown value type {code!r} in packed payload")
+    return timestamp, values
+
+
+# This class is a bounded FIFO of outgoing messages with an overflow policy.
+# With SPILL, messages that do not fit are appended to a file and read back in
+# order once the queue has room, so a broker outage costs disk space instead of
+# memory or data. A spill file left by an earlier run is picked up again.
+class SpillQueue:
+    def __init__(self, max_items: int = 10000, overflow: str = SPILL, spill_dir: str = SPILL_DIR):
+        if overflow not in (BLOCK, DROP_OLDEST, SPILL):
+            raise ValueError(f"Unknown overflow policy {overflow}")
+        self.max_items = max_items
+        self.overflow = overflow
+        self.spill_path = os.path.join(spill_dir, SPILL_FILE)
+        self.dropped = 0
+        self.spilled = 0
+        self._items: Deque[OutgoingMessage] = deque()
+        self._condition = threading.Condition()
+        self._spill_file = None
+        self._spill_offset = 0
+        self._spill_count = 0
+        if overflow == SPILL:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._spill_file = open(self.spill_path, "a+b")
+            self._spill_count = self._count_spilled()
+
+    def __len__(self):
+        return len(self._items) + self._spill_count
+
+    def _count_spilled(self) -> int:
+        self._spill_file.seek(0)
+        count = 0
+        while True:
+            header = self._spill_file.read(SPILL_RECORD.size)
+            if len(header) < SPILL_RECORD.size:
+                return count
+            _, topic_length, payload_length = SPILL_RECORD.unpack(header)
+            self._spill_file.seek(topic_length + payload_length, os.SEEK_CUR)
+            count += 1
+
+    @staticmethod
+    def _record(message: OutgoingMessage) -> bytes:
+        topic = message.topic.encode("utf-8")
+        return SPILL_RECORD.pack(message.qos, len(topic), len(message.payload)) + topic + message.payload
+
+    def _spill(self, message: OutgoingMessage):
+        self._spill_file.seek(0, os.SEEK_END)
+        self._spill_file.write(self._record(message))
+        self._spill_count += 1
+        self.spilled += 1
+
+    # Move spilled messages back into memory while there is room.
+    def _unspill(self):
+        self._spill_file.flush()
+        self._spill_file.seek(self._spill_offset)
+        while self._spill_count and len(self._items) < self.max_items:
+            qos, topic_length, payload_length = SPILL_RECORD.unpack(self._spill_file.read(SPILL_RECORD.size))
+            topic = self._spill_file.read(topic_length).decode("utf-8")
+            self._items.append(OutgoingMessage(topic, self._spill_file.read(payload_length), qos))
+            self._spill_count -= 1
+        self._spill_offset = self._spill_file.tell()
+        if not self._spill_count:
+            self._spill_file.truncate(0)
+            self._spill_offset = 0
+
+    # Queue a message; returns False when it was dropped (BLOCK timed out).
+    def put(self, message: OutgoingMessage, timeout: Optional[float] = None) -> bool:
+        with self._condition:
+            if self.overflow == SPILL and (self._spill_count or len(self._items) >= self.max_items):
+                # Once spilling, newer messages go to disk too so order is kept.
+                self._spill(message)
+            elif len(self._items) >= self.max_items:
+                if self.overflow == DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                elif not self._condition.wait_for(lambda: len(self._items) < self.max_items, timeout):
+                    self.dropped += 1
+                    return False
+                self._items.append(message)
+            else:
+                self._items.append(message)
+            self._condition.notify_all()
+        return True
+
+    # Next message, or None if nothing arrived within timeout.
+    def get(self, timeout: Optional[float] = None) -> Optional[OutgoingMessage]:
+        with self._condition:
+            if not self._items and self._spill_count:
+                self._unspill()
+            if not self._condition.wait_for(lambda: self._items or self._spill_count, timeout):
+                return None
+            if not self._items:
+                self._unspill()
+            message = self._items.popleft()
+            self._condition.notify_all()
+            return message
+
+    # Put a message that could not be published back at the front.
+    def requeue(self, message: OutgoingMessage):
+        with self._condition:
+            self._items.appendleft(message)
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            if self._spill_file is None:
+                return
+            # Keep whatever is still queued for the next run, oldest first.
+            self._spill_file.flush()
+            self._spill_file.seek(self._spill_offset)
+            remaining = self._spill_file.read()
+            self._spill_file.close()
+            self._spill_file = None
+            temporary = self.spill_path + ".tmp"
+            with open(temporary, "wb") as file:
+                for message in self._items:
+                    file.write(self._record(message))
+                file.write(remaining)
+            os.replace(temporary, self.spill_path)
+            self._items.clear()
+
+
+# This class is used to publish poll results through a background MQTT client.
+# submit() turns one poll cycle of a device into a single message on
+# '<topic_prefix>/<device>' (JSON or packed, see encode_json/encode_packed) and
+# queues it; a publisher thread sends queued messages while keeping at most
+# max_in_flight QoS 1/2 messages unacknowledged. With publish_on_change only the
+# values that moved past their deadband (as in RegisterCache) are sent.
+# Needs paho-mqtt.
+class MqttBridge:
+    def __init__(self, host: str = "localhost", port: int = 1883, topic_prefix: str = "uiot", qos: int = 1,
+                 payload_format: str = JSON, max_queue: int = 10000, overflow: str = SPILL, spill_dir: str = SPILL_DIR,
+                 max_in_flight: int = 20, publish_on_change: bool = False, policy: CachePolicy = CachePolicy(),
+                 client_id: str = "", keepalive: int = 60, username: Optional[str] = None,
+                 password: Optional[str] = None):
+        if payload_format not in (JSON, PACKED):
+            raise ValueError(f"Unknown payload format {payload_format}")
+        self.host = host
+        self.port = port
+        self.topic_prefix = topic_prefix.rstrip("/")
+        self.qos = qos
+        self.payload_format = payload_format
+        self.max_in_flight = max_in_flight
+        self.client_id = client_id
+        self.keepalive = keepalive
+        self.username = username
+        self.password = password
+        self.queue = SpillQueue(max_queue, overflow, spill_dir)
+        self.cache = RegisterCache(default_policy=policy) if publish_on_change else None
+        self.submitted = 0
+        self.published = 0
+        self.acknowledged = 0
+        self.unchanged = 0
+        self.in_flight = 0
+        self._counter_lock = threading.Lock()
+        self._window = threading.BoundedSemaphore(max_in_flight)
+        self._connected = threading.Event()
+        self._stop = threading.Event()
+        self._client = None
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        import paho.mqtt.client as mqtt
+
+        self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=self.client_id)
+        self._client.max_inflight_messages_set(self.max_in_flight)
+        if self.username:
+            self._client.username_pw_set(self.username, self.password)
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_publish = self._on_publish
+        self._client.connect_async(self.host, self.port, self.keepalive)
+        self._client.loop_start()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._publish_loop, name="mqtt-bridge", daemon=True)
+        self._thread.start()
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            log.error("MQTT broker %s:%s refused the connection: %s", self.host, self.port, reason_code)
+            return
+        log.info("Connected to MQTT broker %s:%s", self.host, self.port)
+        self._connected.set()
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+        self._connected.clear()
+        if not self._stop.is_set():
+            log.warning("Disconnected from MQTT broker %s:%s: %s", self.host, self.port, reason_code)
+
+    def _on_publish(self, client, userdata, mid, reason_code, properties):
+        with self._counter_lock:
+            self.acknowledged += 1
+            self.in_flight -= 1
+        self._window.release()
+
+    def _encode(self, device: str, timestamp: float, values: Mapping[str, object]) -> bytes:
+        if self.payload_format == PACKED:
+            try:
+                return encode_packed(timestamp, values)
+            except ValueError as error:
+                log.warning("Publishing %s as JSON: %s", device, error)
+        return encode_json(device, timestamp, values)
+
+    # Queue one poll cycle of a device; returns False if it was dropped.
+    # timeout bounds the wait for room with the BLOCK overflow policy. With
+    # publish_on_change the cache only takes the values once they are queued,
+    # so a dropped cycle is sent again on the next submit.
+    def submit(self, device, values: Mapping[str, object], timestamp: Optional[float] = None,
+               timeout: Optional[float] = None) -> bool:
+        device = str(device)
+        changes = values if self.cache is None else self.cache.changes(device, values)
+        if not changes:
+            self.unchanged += 1
+            return True
+        timestamp = time.time() if timestamp is None else timestamp
+        payload = self._encode(device, timestamp, changes)
+        self.submitted += 1
+        if not self.queue.put(OutgoingMessage(f"{self.topic_prefix}/{device}", payload, self.qos), timeout):
+            return False
+        if self.cache is not None:
+            self.cache.update(device, values)
+        return True
+
+    # Queue every sample of a bus supervisor PollBatch.
+    def submit_batch(self, batch) -> int:
+        return sum(self.submit(f"{batch.bus}/{unit}", values, timestamp) for unit, timestamp, values in batch.samples)
+
+    def _publish_loop(self):
+        from paho.mqtt.client import MQTT_ERR_QUEUE_SIZE
+
+        while not self._stop.is_set() or len(self.queue):
+            if not self._connected.wait(0.1):
+                if self._stop.is_set():
+                    return
+                continue
+            message = self.queue.get(timeout=0.1)
+            if message is None:
+                continue
+            while not self._window.acquire(timeout=0.1):
+                if self._stop.is_set() and not self._connected.is_set():
+                    self.queue.requeue(message)
+                    return
+            with self._counter_lock:
+                self.in_flight += 1
+            info = self._client.publish(message.topic, message.payload, message.qos)
+            if info.rc != 0 and (message.qos == 0 or info.rc == MQTT_ERR_QUEUE_SIZE):
+                # Not kept by the client; try again after reconnecting. A QoS 1/2 message
+                # refused for a lost connection is still held by paho, which sends it
+                # after reconnecting and acknowledges it then, so it stays in flight.
+                with self._counter_lock:
+                    self.in_flight -= 1
+                self._window.release()
+                self.queue.requeue(message)
+                continue
+            self.published += 1
+
+    # Publish what is queued (up to timeout seconds), then disconnect.
+    # Messages still queued are kept in the spill file when spilling is enabled.
+    def stop(self, timeout: float = 5.0):
+        end = time.monotonic() + timeout
+        while (len(self.queue) or self.in_flight) and self._connected.is_set() and time.monotonic() < end:
+            time.sleep(0.01)
+        self._stop.set()
+        self._connected.clear()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._client is not None:
+            self._client.disconnect()
+            self._client.loop_stop()
+            self._client = None
+        self.queue.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"submitted": self.submitted, "published": self.published, "acknowledged": self.acknowledged,
+                "unchanged": self.unchanged, "queued": len(self.queue), "in_flight": self.in_flight,
+                "dropped": self.queue.dropped, "spilled": self.queue.spilled}
+
+# End of file: protocols/mqtt/mqtt_bridge.py
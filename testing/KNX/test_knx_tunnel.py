@@ -0,0 +1,156 @@
+#
+# This module is used to test the KNX tunnel client and DPT codecs against the UDP gateway stand-in.
+#
+
+import asyncio
+import time
+from datetime import date, time as time_of_day
+
+import pytest
+
+from protocols.KNX.knx_dpt import decode_float16, encode_float16, get_dpt
+from protocols.KNX.knx_tunnel import GROUP_VALUE_READ, GROUP_VALUE_WRITE, KnxTunnel, tp1_frame_time
+from testing.benchmark.knx_gateway import KnxGatewayStandIn
+
+GROUP_ADDRESSES = {"1/0/1": "1.001", "1/0/2": "9.001", "1/0/3": "5.001"}
+
+
+@pytest.fixture
+def gateway():
+    with KnxGatewayStandIn(group_values={"1/0/1": 1, "1/0/2": encode_float16(21.5)}) as gateway:
+        yield gateway
+
+
+def run(gateway, test, **options):
+    async def main():
+        async with KnxTunnel(gateway.host, gateway.port, GROUP_ADDRESSES, ack_timeout=0.2, **options) as tunnel:
+            return await test(tunnel)
+    return asyncio.run(main())
+
+
+def sent(gateway, apci):
+    return [received.telegram for received in gateway.telegrams if received.telegram.apci == apci]
+
+
+@pytest.mark.parametrize("dpt_id, value", [
+    ("1.001", True), ("1.001", False), ("5.001", 40.0), ("5.010", 200), ("6.010", -5), ("7.001", 65000),
+    ("8.001", -1200), ("9.001", 21.5), ("9.001", -30.0), ("9.004", 670760.96), ("12.001", 4000000000),
+    ("13.010", -123456), ("14.056", 1.5), ("10.001", time_of_day(13, 45, 7)), ("11.001", date(2024, 2, 29)),
+    ("16.000", "KNX is OK"), ("17.001", 12),
+])
+def test_dpt_round_trip(dpt_id, value):
+    dpt = get_dpt(dpt_id)
+    data = dpt.encode(value)
+    assert len(data) == max(dpt.length, 1)
+    assert dpt.decode(data) == value
+
+
+def test_float16_keeps_two_decimals_and_rejects_out_of_range():
+    assert decode_float16(encode_float16(0.01)) == 0.01
+    assert decode_float16(encode_float16(-0.5)) == -0.5
+    with pytest.raises(ValueError):
+        encode_float16(1e9)
+
+
+def test_dpt_ids_resolve_in_every_notation():
+    assert get_dpt("DPST-9-1") is get_dpt("9.001") is get_dpt("9.1")
+    assert get_dpt("9.999") is get_dpt("9") is get_dpt("9.001")
+    with pytest.raises(ValueError):
+        get_dpt("99.001")
+
+
+def test_read_decodes_with_the_group_dpt(gateway):
+    async def test(tunnel):
+        return await tunnel.read_many(["1/0/1", "1/0/2"])
+
+    assert run(gateway, test) == {"1/0/1": True, "1/0/2": 21.5}
+
+
+def test_concurrent_reads_share_one_request_and_then_use_the_cache(gateway):
+    gateway.response_delay = 0.05
+
+    async def test(tunnel):
+        values = await asyncio.gather(*(tunnel.read("1/0/2") for _ in range(5)))
+        return values, await tunnel.read("1/0/2")
+
+    values, cached = run(gateway, test)
+    assert values == [21.5] * 5 and cached == 21.5
+    assert len(sent(gateway, GROUP_VALUE_READ)) == 1
+
+
+def test_stale_values_are_read_again(gateway):
+    async def test(tunnel):
+        await tunnel.read("1/0/2")
+        await asyncio.sleep(0.05)
+        return await tunnel.read("1/0/2", max_age=0.01)
+
+    assert run(gateway, test) == 21.5
+    assert len(sent(gateway, GROUP_VALUE_READ)) == 2
+
+
+def test_write_reaches_the_gateway_and_the_cache(gateway):
+    async def test(tunnel):
+        await tunnel.write("1/0/1", False)
+        await tunnel.write("1/0/3", 40.0)
+        await tunnel.write("1/0/4", b"\x01\x02")
+        for _ in range(100):
+            if tunnel.value("1/0/4") is not None:
+                break
+            await asyncio.sleep(0.01)
+        return tunnel.value("1/0/1"), tunnel.value("1/0/3"), tunnel.value("1/0/4")
+
+    assert run(gateway, test) == (False, 40.0, b"\x01\x02")
+    assert len(sent(gateway, GROUP_VALUE_WRITE)) == 3
+    assert gateway.values[0x0801] == 0
+    assert gateway.values[0x0803] == get_dpt("5.001").encode(40.0)
+    with pytest.raises(ValueError):
+        run(gateway, lambda tunnel: tunnel.write("1/0/9", 1.0))
+
+
+def test_bus_writes_update_the_cache_and_subscribers(gateway):
+    async def test(tunnel):
+        events = []
+        tunnel.subscribe(events.append)
+        gateway.inject("1/0/2", encode_float16(19.0))
+        for _ in range(100):
+            if tunnel.value("1/0/2") is not None:
+                break
+            await asyncio.sleep(0.01)
+        return tunnel.value("1/0/2"), events, await tunnel.read("1/0/2")
+
+    value, events, read = run(gateway, test)
+    assert value == read == 19.0
+    assert [event.value for event in events] == [19.0]
+    assert not sent(gateway, GROUP_VALUE_READ)
+
+
+def test_telegrams_are_spaced_by_line_time(gateway):
+    count, load = 8, 0.25
+
+    async def test(tunnel):
+        for i in range(count):
+            await tunnel.write("1/0/2", float(i))
+        return await asyncio.to_thread(gateway.wait_for, count)
+
+    assert run(gateway, test, line_load=load)
+    times = [received.timestamp for received in gateway.telegrams]
+    spacing = tp1_frame_time(2) / load
+    # The limiter lets its burst allowance (0.1 s) through at once, then spaces the rest.
+    assert times[-1] - times[0] >= (count - 1) * spacing - 0.1 - 0.01
+
+
+def test_rejected_telegrams_fail_instead_of_waiting(gateway):
+    gateway.ack_status = 0x29
+
+    async def test(tunnel):
+        start = time.monotonic()
+        value = await tunnel.read("1/0/2")
+        return value, time.monotonic() - start, tunnel.failed, tunnel.resent
+
+    value, elapsed, failed, resent = run(gateway, test, read_timeout=2.0)
+    assert value is None
+    assert elapsed < 1.0
+    assert failed == 1 and resent == 2
+    assert not gateway.telegrams
+
+# End of file: testing/KNX/test_knx_tunnel.py
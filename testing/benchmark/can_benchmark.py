@@ -0,0 +1,175 @@
+#
+# This module is used to benchmark CAN frame ingest and signal decoding.
+#
+# Run from the repository root:
+#   python -m testing.benchmark.can_benchmark --rate 2000 --duration 5
+#   python -m testing.benchmark.can_benchmark --interface socketcan --channel vcan0
+#
+
+import argparse
+import os
+import platform
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from protocols.can.can_ingest import CanIngest, CanMessage, FrameRing, Signal, SignalDecoder
+from testing.benchmark.modbus_benchmark import RESULTS_DIR, code_version, save_results
+
+# Synthetic battery rack messages: 16 modules each sending cell voltages and temperatures,
+# plus a rack summary with big-endian signals.
+RACK_MESSAGES = (
+    [CanMessage(0x100 + module, f"cells_{module}", 8, tuple(
+        Signal(f"cell_{module}_{cell}", 16 * cell, 16, scale=0.001, unit="V") for cell in range(4)))
+     for module in range(16)]
+    + [CanMessage(0x200 + module, f"temperatures_{module}", 8, tuple(
+        Signal(f"temperature_{module}_{sensor}", 8 * sensor, 8, signed=True, offset=-40.0, unit="degC")
+        for sensor in range(8)))
+       for module in range(16)]
+    + [CanMessage(0x300, "rack", 8, (
+        Signal("voltage", 7, 16, little_endian=False, scale=0.1, unit="V"),
+        Signal("current", 23, 16, little_endian=False, signed=True, scale=0.1, unit="A"),
+        Signal("soc", 39, 8, little_endian=False, unit="%"),
+    ))]
+)
+RACK_IDS = [message.arbitration_id for message in RACK_MESSAGES]
+
+
+def _random_frames(count: int, seed: int = 0):
+    generator = np.random.default_rng(seed)
+    ids = generator.choice(RACK_IDS, count)
+    data = generator.integers(0, 256, (count, 8), dtype=np.uint8)
+    return ids.tolist(), [row.tobytes() for row in data]
+
+
+# Frames per second FrameRing.append() sustains from one thread.
+def ring_scenario(args) -> Dict[str, object]:
+    ids, payloads = _random_frames(args.frames)
+    ring = FrameRing(args.capacity)
+    start = time.perf_counter()
+    now = time.time()
+    for can_id, data in zip(ids, payloads):
+        ring.append(now, can_id, 8, data)
+    elapsed = time.perf_counter() - start
+    return {"name": "ring_append", "frames": args.frames, "frames_per_s": args.frames / elapsed}
+
+
+# Frames per second SignalDecoder decodes in batches of args.batch frames.
+def decode_scenario(args) -> Dict[str, object]:
+    ids, payloads = _random_frames(args.frames)
+    ring = FrameRing(max(args.capacity, args.frames))
+    for can_id, data in zip(ids, payloads):
+        ring.append(0.0, can_id, 8, data)
+    batch, _, _ = ring.since(0)
+    decoder = SignalDecoder(RACK_MESSAGES)
+    signals = sum(len(message.signals) for message in RACK_MESSAGES)
+    start = time.perf_counter()
+    for offset in range(0, args.frames, args.batch):
+        decoder.decode(type(batch)(*(column[offset:offset + args.batch] for column in batch)))
+    elapsed = time.perf_counter() - start
+    return {"name": "batch_decode", "frames": args.frames, "batch": args.batch, "signals": signals,
+            "frames_per_s": args.frames / elapsed}
+
+
+# Send frames at args.rate on a bus for args.duration seconds while CanIngest receives
+# and decodes them every args.read_interval seconds.
+def bus_scenario(args) -> Dict[str, object]:
+    import can
+
+    ids, payloads = _random_frames(int(args.rate * args.duration))
+    with CanIngest(args.channel, args.interface, capacity=args.capacity, messages=RACK_MESSAGES) as ingest:
+        sender = can.Bus(channel=args.channel, interface=args.interface, receive_own_messages=False)
+        done = threading.Event()
+
+        def send():
+            period = 1.0 / args.rate
+            start = time.perf_counter()
+            for i, (can_id, data) in enumerate(zip(ids, payloads)):
+                delay = start + i * period - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                sender.send(can.Message(arbitration_id=can_id, data=data, is_extended_id=False))
+            done.set()
+
+        thread = threading.Thread(target=send, daemon=True)
+        start = time.perf_counter()
+        thread.start()
+        received = decoded = 0
+        decode_time = 0.0
+        while not done.is_set() or ingest.ring.written > received:
+            time.sleep(args.read_interval)
+            batch = ingest.frames()
+            received += len(batch)
+            began = time.perf_counter()
+            decoded += sum(len(timestamps) for timestamps, _ in ingest.decoder.decode(batch).values())
+            decode_time += time.perf_counter() - began
+            if done.is_set() and not len(batch):
+                break
+        elapsed = time.perf_counter() - start
+        thread.join()
+        sender.shutdown()
+    return {"name": f"bus_{args.interface}", "frames": len(ids), "received": received, "decoded": decoded,
+            "lost": ingest.lost, "frames_per_s": received / elapsed,
+            "decode_us_per_frame": 1e6 * decode_time / max(decoded, 1)}
+
+
+def format_report(run: Dict[str, object]) -> str:
+    lines = [f"CAN benchmark {run['version']} ({run['timestamp']})"]
+    for scenario in run["scenarios"]:
+        details = ", ".join(f"{key} {value:.1f}" if isinstance(value, float) else f"{key} {value}"
+                            for key, value in scenario.items() if key != "name")
+        lines.append(f"{scenario['name']}: {details}")
+    return "\n".join(lines)
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark CAN frame ingest and signal decoding.")
+    parser.add_argument("--scenarios", default="ring,decode,bus", help="comma separated: ring, decode, bus")
+    parser.add_argument("--frames", type=int, default=200000, help="frames for the ring and decode scenarios")
+    parser.add_argument("--batch", type=int, default=2000, help="frames decoded per batch")
+    parser.add_argument("--capacity", type=int, default=1 << 16, help="ring capacity in frames")
+    parser.add_argument("--interface", default="virtual", help="python-can interface for the bus scenario")
+    parser.add_argument("--channel", default="benchmark", help="bus channel, e.g. vcan0 with socketcan")
+    parser.add_argument("--rate", type=float, default=2000, help="frames per second sent in the bus scenario")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds the bus scenario sends for")
+    parser.add_argument("--read-interval", type=float, default=0.1, help="seconds between batch reads")
+    parser.add_argument("--output", default=os.path.join(RESULTS_DIR, "can"), help="directory results are saved to")
+    parser.add_argument("--no-save", action="store_true", help="do not save this run")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> Dict[str, object]:
+    args = parse_args(argv)
+    scenarios: List[Dict[str, object]] = []
+    for name in args.scenarios.split(","):
+        name = name.strip()
+        if name == "ring":
+            scenarios.append(ring_scenario(args))
+        elif name == "decode":
+            scenarios.append(decode_scenario(args))
+        elif name == "bus":
+            scenarios.append(bus_scenario(args))
+        elif name:
+            raise SystemExit(f"Unknown scenario {name}")
+    run = {
+        "version": code_version(),
+        "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "no_save")},
+        "scenarios": scenarios,
+    }
+    print(format_report(run))
+    if not args.no_save:
+        print(f"Saved {save_results(run, args.output)}")
+    return run
+
+
+if __name__ == "__main__":
+    main()
+
+# End of file: testing/benchmark/can_benchmark.py
@@ -0,0 +1,165 @@
+#
+# This module is used to stand in for a KNXnet/IP tunneling gateway in tests and benchmarks.
+#
+
+import asyncio
+import struct
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+from protocols.KNX.knx_tunnel import (CONNECT_REQUEST, CONNECT_RESPONSE, CONNECTIONSTATE_REQUEST,
+                                      CONNECTIONSTATE_RESPONSE, DISCONNECT_REQUEST, DISCONNECT_RESPONSE,
+                                      GROUP_VALUE_READ, GROUP_VALUE_RESPONSE, GROUP_VALUE_WRITE, HEADER,
+                                      HEADER_LENGTH, HPAI_ROUTE_BACK, L_DATA_CON, L_DATA_IND, TUNNELLING_ACK,
+                                      TUNNELLING_REQUEST, GroupTelegram, decode_cemi, encode_cemi, knx_frame,
+                                      parse_group_address)
+
+# Individual address handed to the tunnel client (1.1.250) and used by the simulated bus devices (1.1.1).
+CLIENT_ADDRESS = 0x11FA
+DEVICE_ADDRESS = 0x1101
+
+
+# One telegram received from the client.
+class ReceivedTelegram(NamedTuple):
+    telegram: GroupTelegram
+    timestamp: float
+
+
+# This class is a KNXnet/IP gateway with one tunnel and a simulated bus behind it.
+# It acknowledges every tunnelling request and confirms it with L_Data.con, stores
+# group writes, answers GroupValueRead from the stored values (after
+# response_delay seconds) and records what the client sent, with timestamps, in
+# .telegrams. inject() puts a group write on the simulated bus for the client to
+# see. Values are bytes, or an int for values of up to 6 bits carried in the APCI.
+# Set ack_status to a non-zero status to reject tunnelling requests as a busy or
+# faulty gateway would: they are acknowledged with it and not forwarded.
+# Runs its event loop in a thread on a free UDP port.
+class KnxGatewayStandIn:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 group_values: Optional[Dict[str, Union[bytes, int]]] = None, response_delay: float = 0.0):
+        self.host = host
+        self.port = port
+        self.response_delay = response_delay
+        self.ack_status = 0
+        self.values: Dict[int, Union[bytes, int]] = {parse_group_address(address): value
+                                                     for address, value in (group_values or {}).items()}
+        self.telegrams: List[ReceivedTelegram] = []
+        self.connections = 0
+        self._client: Optional[Tuple[str, int]] = None
+        self._channel = 0
+        self._sequence = 0
+        self._received = threading.Condition()
+        self._transport: Optional[asyncio.DatagramTransport] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="knx-gateway", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    # Wait until count telegrams have arrived; returns whether they did within timeout.
+    def wait_for(self, count: int, timeout: float = 5.0) -> bool:
+        with self._received:
+            return self._received.wait_for(lambda: len(self.telegrams) >= count, timeout)
+
+    # A bus device writes value to a group address.
+    def inject(self, address, value: Union[bytes, int]):
+        address = parse_group_address(address)
+        self._loop.call_soon_threadsafe(self._indicate, address, GROUP_VALUE_WRITE, value)
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        self._transport, _ = self._loop.run_until_complete(
+            self._loop.create_datagram_endpoint(lambda: _GatewayProtocol(self), local_addr=(self.host, self.port)))
+        self.port = self._transport.get_extra_info("sockname")[1]
+        self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._transport.close()
+            self._loop.close()
+
+    def _send(self, data: bytes, address=None):
+        target = address or self._client
+        if target is not None:
+            self._transport.sendto(data, target)
+
+    def _tunnel(self, cemi: bytes):
+        self._send(knx_frame(TUNNELLING_REQUEST, bytes((4, self._channel, self._sequence, 0)) + cemi))
+        self._sequence = (self._sequence + 1) & 0xFF
+
+    def _indicate(self, address: int, apci: int, value: Union[bytes, int]):
+        self.values[address] = value
+        small = isinstance(value, int)
+        payload = bytes((value,)) if small else value
+        self._tunnel(encode_cemi(L_DATA_IND, DEVICE_ADDRESS, address, apci, payload, small))
+
+    def _respond(self, address: int):
+        value = self.values.get(address)
+        if value is not None:
+            self._indicate(address, GROUP_VALUE_RESPONSE, value)
+
+    def received(self, data: bytes, address):
+        if len(data) < HEADER_LENGTH:
+            return
+        _, _, service, _ = HEADER.unpack_from(data)
+        body = data[HEADER_LENGTH:]
+        if service == CONNECT_REQUEST:
+            self.connections += 1
+            self._client = address
+            self._channel = self._channel % 255 + 1
+            self._sequence = 0
+            # Channel, status, data endpoint, then the connection response data block with the client's address.
+            self._send(knx_frame(CONNECT_RESPONSE, bytes((self._channel, 0)) + HPAI_ROUTE_BACK
+                                 + bytes((4, 4)) + struct.pack(">H", CLIENT_ADDRESS)))
+        elif service == CONNECTIONSTATE_REQUEST:
+            self._send(knx_frame(CONNECTIONSTATE_RESPONSE, bytes((body[0], 0 if body[0] == self._channel else 0x21))),
+                       address)
+        elif service == DISCONNECT_REQUEST:
+            self._send(knx_frame(DISCONNECT_RESPONSE, bytes((body[0], 0))), address)
+            if body[0] == self._channel:
+                self._client = None
+        elif service == TUNNELLING_REQUEST and len(body) > 4:
+            self._send(knx_frame(TUNNELLING_ACK, bytes((4, body[1], body[2], self.ack_status))), address)
+            if self.ack_status:
+                return
+            cemi = bytearray(body[4:])
+            telegram = decode_cemi(bytes(cemi))
+            if telegram is None:
+                return
+            with self._received:
+                self.telegrams.append(ReceivedTelegram(telegram, time.monotonic()))
+                self._received.notify_all()
+            cemi[0] = L_DATA_CON
+            self._tunnel(bytes(cemi))
+            if telegram.apci == GROUP_VALUE_WRITE:
+                # An NPDU of one byte (the TPCI/APCI pair only) carries the value in the APCI.
+                self.values[telegram.destination] = telegram.payload[0] if cemi[8] == 1 else telegram.payload
+            elif telegram.apci == GROUP_VALUE_READ:
+                self._loop.call_later(self.response_delay, self._respond, telegram.destination)
+
+
+class _GatewayProtocol(asyncio.DatagramProtocol):
+    def __init__(self, gateway: KnxGatewayStandIn):
+        self.gateway = gateway
+
+    def datagram_received(self, data: bytes, addr):
+        self.gateway.received(data, addr)
+
+# End of file: testing/benchmark/knx_gateway.py
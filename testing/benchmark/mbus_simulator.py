@@ -0,0 +1,160 @@
+#
+# This module is used to simulate an M-Bus segment of meters on a pseudo-terminal.
+#
+
+import os
+import random
+import select
+import struct
+import threading
+import time
+import tty
+from typing import Iterable, List, Optional
+
+from protocols.mbus.mbus_parser import (ACK, ADDRESS_BROADCAST, ADDRESS_SECONDARY, CI_RESPONSE_LONG, CI_SELECT,
+                                        REQ_UD2, SND_NKE, SND_UD, FCB, SecondaryAddress, ShortFrame, Telegram,
+                                        TelegramParser, encode_manufacturer, long_frame)
+
+# RSP_UD control field.
+RSP_UD = 0x08
+
+
+# One simulated meter: its secondary address, primary address and the values it reports.
+class SimulatedMeter:
+    def __init__(self, address: SecondaryAddress, primary: int = 0, energy_wh: int = 0, volume_l: int = 0,
+                 flow_temperature: float = 70.0, return_temperature: float = 40.0):
+        self.address = address
+        self.primary = primary
+        self.energy_wh = energy_wh
+        self.volume_l = volume_l
+        self.flow_temperature = flow_temperature
+        self.return_temperature = return_temperature
+        self.access_number = 0
+
+    # Whether a selection (8 bytes: id with F wildcards, manufacturer, version, medium) matches.
+    def matches(self, selection: bytes) -> bool:
+        if len(selection) < 8:
+            return False
+        mask = selection[:4][::-1].hex()
+        if any(digit != "f" and digit != own for digit, own in zip(mask, self.address.id.lower())):
+            return False
+        manufacturer = struct.unpack_from("<H", selection, 4)[0]
+        if manufacturer != 0xFFFF and manufacturer != encode_manufacturer(self.address.manufacturer):
+            return False
+        return selection[6] in (0xFF, self.address.version) and selection[7] in (0xFF, self.address.medium)
+
+    # RSP_UD variable data response.
+    def response(self) -> bytes:
+        self.access_number = (self.access_number + 1) & 0xFF
+        now = time.localtime()
+        date_time = (now.tm_min | now.tm_hour << 8 | now.tm_mday << 16 | (now.tm_year - 2000 & 0x07) << 21
+                     | now.tm_mon << 24 | (now.tm_year - 2000 & 0x78) << 25)
+        header = self.address.to_bytes() + bytes((self.access_number, 0)) + b"\x00\x00"
+        records = (
+            b"\x04\x03" + struct.pack("<i", self.energy_wh)                                # energy, Wh
+            + b"\x04\x13" + struct.pack("<i", self.volume_l)                             # volume, l
+            + b"\x02\x5A" + struct.pack("<h", round(self.flow_temperature * 10))         # flow temperature, 0.1 C
+            + b"\x02\x5E" + struct.pack("<h", round(self.return_temperature * 10))       # return temperature, 0.1 C
+            + b"\x04\x6D" + struct.pack("<I", date_time)                                 # date and time
+            + b"\x0C\x78" + bytes.fromhex(self.address.id)[::-1]                         # fabrication number, BCD
+        )
+        return long_frame(RSP_UD, self.primary, CI_RESPONSE_LONG, header + records)
+
+
+# This class is used to serve simulated meters on a pseudo-terminal like an M-Bus master port.
+# Clients open .port (e.g. /dev/pts/5). Meters answer SND_NKE, REQ_UD2 and
+# secondary address selection; when several meters answer at once their
+# replies are written back to back, as a collision looks to the master.
+# When baudrate is set, the time the reply would spend on the wire is added.
+class MbusSimulator:
+    def __init__(self, meters: Iterable[SimulatedMeter], baudrate: Optional[int] = None, bits_per_char: int = 11):
+        if not hasattr(os, "openpty"):
+            raise OSError("The M-Bus simulator needs pseudo-terminal support")
+        self.meters: List[SimulatedMeter] = list(meters)
+        self.char_time = bits_per_char / baudrate if baudrate else 0.0
+        self.port: Optional[str] = None
+        self.requests = 0
+        self.selected: Optional[SimulatedMeter] = None
+        self._parser = TelegramParser()
+        self._master: Optional[int] = None
+        self._slave: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # n meters with random 8-digit ids, primary addresses 1..n (up to 250).
+    @classmethod
+    def random_meters(cls, count: int, seed: Optional[int] = None, manufacturer: str = "SIM") -> List[SimulatedMeter]:
+        generator = random.Random(seed)
+        ids = generator.sample(range(10 ** 8), count)
+        return [SimulatedMeter(SecondaryAddress(f"{meter_id:08d}", manufacturer, 1, 0x04), i % 250 + 1,
+                               energy_wh=generator.randrange(10 ** 7), volume_l=generator.randrange(10 ** 6))
+                for i, meter_id in enumerate(ids)]
+
+    def start(self):
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="mbus-simulator", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            os.close(self._master)
+            os.close(self._slave)
+
+    def _run(self):
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self._master], [], [], 0.05)
+            if not readable:
+                # A silent interval ends any partial frame.
+                self._parser.reset()
+                continue
+            for frame in self._parser.feed(os.read(self._master, 1024)):
+                self.requests += 1
+                self._answer(frame)
+
+    def _write(self, replies: List[bytes]):
+        if not replies:
+            return
+        data = b"".join(replies)
+        if self.char_time:
+            time.sleep(len(data) * self.char_time)
+        os.write(self._master, data)
+
+    def _addressed(self, address: int) -> List[SimulatedMeter]:
+        if address == ADDRESS_SECONDARY:
+            return [self.selected] if self.selected is not None else []
+        if address == ADDRESS_BROADCAST:
+            return list(self.meters)
+        return [meter for meter in self.meters if meter.primary == address]
+
+    def _answer(self, frame):
+        if isinstance(frame, ShortFrame):
+            control = frame.control & ~FCB
+            meters = self._addressed(frame.address)
+            if control == SND_NKE:
+                if frame.address == ADDRESS_SECONDARY:
+                    self.selected = None
+                self._write([bytes((ACK,)) for _ in meters])
+            elif control == REQ_UD2:
+                self._write([meter.response() for meter in meters])
+        elif isinstance(frame, Telegram) and frame.control & ~FCB == SND_UD and frame.address == ADDRESS_SECONDARY \
+                and frame.ci == CI_SELECT:
+            matching = [meter for meter in self.meters if meter.matches(frame.data)]
+            # A selection deselects every meter that does not match it.
+            self.selected = matching[0] if len(matching) == 1 else None
+            self._write([bytes((ACK,)) for _ in matching])
+
+# End of file: testing/benchmark/mbus_simulator.py
@@ -0,0 +1,262 @@
+#
+# This module is used to benchmark Modbus TCP and RTU polling against simulated devices.
+#
+# Run from the repository root:
+#   python -m testing.benchmark.modbus_benchmark --operations 2000 --latency 0.002 --jitter 0.001
+#
+
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Sequence
+
+from testing.benchmark.modbus_simulator import (DataBank, DeviceBehaviour, ModbusRtuSimulator, ModbusTcpSimulator,
+                                                SimulatedDevices)
+
+# Where results are saved by default, one JSON file per run.
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# Synthetic register map read by the TCP register-map scenario:
+# 32 float32 values, 16 int16 values and a 10-register string.
+BENCH_MAP = (
+    [(100 + 2 * i, 2, "decode_32bit_float", f"float_{i}") for i in range(32)]
+    + [(200 + i, 1, "decode_16bit_int", f"int_{i}") for i in range(16)]
+    + [(300, 10, "decode_string", "serial_number")]
+)
+BENCH_VALUES = dict(
+    [(f"float_{i}", i * 1.5) for i in range(32)]
+    + [(f"int_{i}", i - 8) for i in range(16)]
+    + [("serial_number", "SIM-000001")]
+)
+
+# Thread CPU time, so the simulator threads are not charged to the client.
+_cpu_time = getattr(time, "thread_time", time.process_time)
+
+
+# Value at percentile p of sorted samples (nearest rank).
+def percentile(samples: Sequence[float], p: float) -> float:
+    if not samples:
+        return 0.0
+    index = max(0, min(len(samples) - 1, int(round(p / 100 * len(samples))) - 1))
+    return samples[index]
+
+
+# Run one operation; False when it reported or raised a failure.
+def _attempt(operation: Callable[[int], object], i: int) -> object:
+    try:
+        return operation(i)
+    except Exception:
+        logging.getLogger(__name__).debug("Operation %s failed", i, exc_info=True)
+        return False
+
+
+# Time operation count times against devices and summarise the run.
+# operation returns False when the poll failed; an exception counts as a failure too,
+# so injected errors and drops are measured instead of ending the run.
+def run_scenario(name: str, operation: Callable[[int], object], devices: SimulatedDevices, operations: int,
+                 warmup: int = 0) -> Dict[str, object]:
+    for i in range(warmup):
+        _attempt(operation, i)
+    devices.reset_counters()
+    latencies: List[float] = []
+    failures = 0
+    cpu_start = _cpu_time()
+    start = time.perf_counter()
+    for i in range(operations):
+        op_start = time.perf_counter()
+        result = _attempt(operation, i)
+        latencies.append(time.perf_counter() - op_start)
+        if result is False:
+            failures += 1
+    elapsed = time.perf_counter() - start
+    cpu = _cpu_time() - cpu_start
+    counters = devices.counters()
+    requests = counters["requests"] or operations
+    latencies.sort()
+    return {
+        "name": name,
+        "operations": operations,
+        "requests": counters["requests"],
+        "failures": failures,
+        "device_errors": counters["errors"],
+        "dropped": counters["dropped"],
+        "elapsed_s": elapsed,
+        "requests_per_s": counters["requests"] / elapsed if elapsed else 0.0,
+        "operations_per_s": operations / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "mean": 1000 * sum(latencies) / len(latencies) if latencies else 0.0,
+            "p50": 1000 * percentile(latencies, 50),
+            "p95": 1000 * percentile(latencies, 95),
+            "p99": 1000 * percentile(latencies, 99),
+            "max": 1000 * latencies[-1] if latencies else 0.0,
+        },
+        "cpu_us_per_request": 1e6 * cpu / requests,
+    }
+
+
+# Benchmark ModbusTcpTest against an in-process TCP simulator.
+def tcp_scenarios(args, behaviour: DeviceBehaviour) -> List[Dict[str, object]]:
+    from pymodbus.client import ModbusTcpClient
+    from protocols.modbusTCP.modbus_tcp_test import ModbusTcpTest
+
+    bank = DataBank()
+    bank.load_map(BENCH_MAP, BENCH_VALUES)
+    results = []
+    with ModbusTcpSimulator(bank, behaviour) as simulator:
+        test = ModbusTcpTest()
+        test.client = ModbusTcpClient(simulator.host, port=simulator.port, timeout=args.timeout, retries=0)
+        if not test.client.connect():
+            raise ConnectionError(f"Failed to connect to the simulator at {simulator.host}:{simulator.port}")
+        try:
+            def read_int16(_):
+                return test.read_int16(200, 16) is not None
+
+            def read_register_map(_):
+                values = test.read_register_map(BENCH_MAP, function_code=3)
+                return len(values) == len(BENCH_MAP)
+
+            results.append(run_scenario("tcp_read_int16", read_int16, simulator, args.operations, args.warmup))
+            results.append(run_scenario("tcp_read_register_map", read_register_map, simulator, args.operations,
+                                        args.warmup))
+        finally:
+            test.client.close()
+    return results
+
+
+# Benchmark the RTU process_unit path against a pty-backed RTU simulator.
+def rtu_scenarios(args, behaviour: DeviceBehaviour) -> List[Dict[str, object]]:
+    from pymodbus.client import ModbusSerialClient
+    from protocols.modbusRTU import modbus_rtu_test
+
+    # process_unit logs every value; keep the benchmark measuring Modbus, not logging.
+    logging.getLogger().setLevel(logging.WARNING)
+    units = list(range(1, args.units + 1))
+    with ModbusRtuSimulator(DataBank(), behaviour, baudrate=args.baudrate or None, units=units) as simulator:
+        client = ModbusSerialClient(port=simulator.port, baudrate=args.baudrate or 115200, timeout=args.timeout,
+                                    retries=0)
+        if not client.connect():
+            raise ConnectionError(f"Failed to open the simulator port {simulator.port}")
+        try:
+            # process_unit logs failed blocks instead of reporting them, so a poll
+            # failed when the simulator injected an error or a drop while it ran.
+            def process(i):
+                injected = simulator.errors + simulator.dropped
+                modbus_rtu_test.process_unit(client, units[i % len(units)])
+                return simulator.errors + simulator.dropped == injected
+
+            return [run_scenario("rtu_process_unit", process, simulator, args.operations, args.warmup)]
+        finally:
+            client.close()
+
+
+# Short version of the code being measured, e.g. '8d6bb70-dirty'.
+def code_version() -> str:
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=root, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+# Save a run and return the file it was written to.
+def save_results(run: Dict[str, object], directory: str = RESULTS_DIR) -> str:
+    os.makedirs(directory, exist_ok=True)
+    stamp = run["timestamp"].replace(":", "").replace("-", "")
+    path = os.path.join(directory, f"{stamp}_{run['version']}.json")
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(run, file, indent=2)
+    return path
+
+
+# Most recent saved run in directory, or None.
+def load_previous(directory: str = RESULTS_DIR) -> Optional[Dict[str, object]]:
+    if not os.path.isdir(directory):
+        return None
+    files = sorted(name for name in os.listdir(directory) if name.endswith(".json"))
+    if not files:
+        return None
+    with open(os.path.join(directory, files[-1]), "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def _change(current: float, previous: float) -> str:
+    if not previous:
+        return ""
+    return f" ({100 * (current - previous) / previous:+.1f}%)"
+
+
+# Text report of a run, with changes against a previous run when given.
+def format_report(run: Dict[str, object], previous: Optional[Dict[str, object]] = None) -> str:
+    before = {scenario["name"]: scenario for scenario in (previous or {}).get("scenarios", [])}
+    lines = [f"Modbus benchmark {run['version']} ({run['timestamp']})"]
+    if previous:
+        lines.append(f"compared with {previous['version']} ({previous['timestamp']})")
+    for scenario in run["scenarios"]:
+        old = before.get(scenario["name"], {})
+        latency, old_latency = scenario["latency_ms"], old.get("latency_ms", {})
+        lines.append(f"{scenario['name']}: {scenario['operations']} operations, {scenario['requests']} requests, "
+                     f"{scenario['failures']} failed")
+        lines.append(f"  requests/s {scenario['requests_per_s']:.1f}"
+                     f"{_change(scenario['requests_per_s'], old.get('requests_per_s', 0))}")
+        lines.append("  latency ms " + ", ".join(
+            f"{key} {latency[key]:.3f}{_change(latency[key], old_latency.get(key, 0))}" for key in ("p50", "p95", "p99")))
+        lines.append(f"  cpu us/request {scenario['cpu_us_per_request']:.1f}"
+                     f"{_change(scenario['cpu_us_per_request'], old.get('cpu_us_per_request', 0))}")
+    return "\n".join(lines)
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark Modbus polling against simulated devices.")
+    parser.add_argument("--scenarios", default="tcp,rtu", help="comma separated: tcp, rtu")
+    parser.add_argument("--operations", type=int, default=1000, help="timed polls per scenario")
+    parser.add_argument("--warmup", type=int, default=20, help="untimed polls before each scenario")
+    parser.add_argument("--latency", type=float, default=0.0, help="device response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="uniform latency jitter in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with an exception")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="share of requests left unanswered")
+    parser.add_argument("--seed", type=int, default=None, help="seed for jitter and error injection")
+    parser.add_argument("--timeout", type=float, default=1.0, help="client timeout in seconds")
+    parser.add_argument("--baudrate", type=int, default=0, help="RTU baud rate to simulate on the wire (0: none)")
+    parser.add_argument("--units", type=int, default=36, help="RTU unit ids 1..N answered by the simulator")
+    parser.add_argument("--output", default=RESULTS_DIR, help="directory results are saved to and compared with")
+    parser.add_argument("--no-save", action="store_true", help="do not save this run")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> Dict[str, object]:
+    args = parse_args(argv)
+    behaviour = DeviceBehaviour(args.latency, args.jitter, args.error_rate, args.drop_rate, seed=args.seed)
+    scenarios = []
+    for name in args.scenarios.split(","):
+        name = name.strip()
+        if name == "tcp":
+            scenarios.extend(tcp_scenarios(args, behaviour))
+        elif name == "rtu":
+            scenarios.extend(rtu_scenarios(args, behaviour))
+        elif name:
+            raise SystemExit(f"Unknown scenario {name}")
+    run = {
+        "version": code_version(),
+        "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "no_save")},
+        "scenarios": scenarios,
+    }
+    print(format_report(run, load_previous(args.output)))
+    if not args.no_save:
+        print(f"Saved {save_results(run, args.output)}")
+    return run
+
+
+if __name__ == "__main__":
+    main()
+
+# End of file: testing/benchmark/modbus_benchmark.py
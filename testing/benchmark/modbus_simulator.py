@@ -0,0 +1,361 @@
+#
+# This module is used to simulate Modbus TCP and RTU devices for benchmarks.
+#
+
+import asyncio
+import os
+import random
+import select
+import struct
+import threading
+import time
+import tty
+from array import array
+from typing import Dict, Iterable, Mapping, NamedTuple, Optional, Sequence, Set, Tuple
+
+from utils.register_codec import get_codec
+
+# Modbus exception codes.
+ILLEGAL_FUNCTION = 1
+ILLEGAL_DATA_ADDRESS = 2
+ILLEGAL_DATA_VALUE = 3
+SLAVE_DEVICE_FAILURE = 4
+
+# Requests with a fixed RTU frame length: function code: bytes including the CRC.
+FIXED_REQUEST_LENGTHS = {1: 8, 2: 8, 3: 8, 4: 8, 5: 8, 6: 8}
+
+# Counts allowed per read request.
+MAX_READ_BITS = 2000
+MAX_READ_REGISTERS = 125
+
+
+# How a simulated device answers: a fixed response latency plus uniform jitter
+# (seconds), the share of requests answered with an exception and the share
+# left unanswered so the client times out.
+class DeviceBehaviour(NamedTuple):
+    latency: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    drop_rate: float = 0.0
+    exception_code: int = SLAVE_DEVICE_FAILURE
+    seed: Optional[int] = None
+
+
+# Registers and coils of one simulated device. Every address 0-65535 exists;
+# unset registers read as zero.
+class DataBank:
+    def __init__(self, holding: Optional[Mapping[int, int]] = None, inputs: Optional[Mapping[int, int]] = None,
+                 coils: Optional[Iterable[int]] = None):
+        self.holding = array("H", bytes(2 * 65536))
+        self.inputs = array("H", bytes(2 * 65536))
+        self.coils = bytearray(65536)
+        self.discrete = bytearray(65536)
+        for address, value in (holding or {}).items():
+            self.holding[address] = value
+        for address, value in (inputs or {}).items():
+            self.inputs[address] = value
+        for address in coils or ():
+            self.coils[address] = 1
+
+    # Store registers in both the holding and input tables.
+    def set_registers(self, address: int, registers: Sequence[int]):
+        self.holding[address:address + len(registers)] = array("H", registers)
+        self.inputs[address:address + len(registers)] = array("H", registers)
+
+    # Store register map values, encoding each with its type.
+    # register_map holds (address, count, decode, name) entries; values maps names to values.
+    def load_map(self, register_map: Iterable[Sequence], values: Mapping[str, object], byteorder="big", wordorder="big"):
+        for address, count, key, name, *_ in register_map:
+            if name not in values:
+                continue
+            value = values[name]
+            registers = get_codec(key, count, byteorder, wordorder).encode(value) if key else list(value)
+            self.set_registers(address, registers)
+
+
+# Bit values packed least significant first, as on the wire.
+def _pack_bits(bits: Sequence[int]) -> bytes:
+    data = bytearray((len(bits) + 7) // 8)
+    for i, bit in enumerate(bits):
+        if bit:
+            data[i // 8] |= 1 << (i % 8)
+    return bytes(data)
+
+
+def _exception(function_code: int, code: int) -> bytes:
+    return bytes((function_code | 0x80, code))
+
+
+# Answer one request PDU from a data bank.
+def handle_pdu(bank: DataBank, pdu: bytes) -> bytes:
+    function_code = pdu[0]
+    try:
+        if function_code in (1, 2):
+            address, count = struct.unpack_from(">HH", pdu, 1)
+            if not 1 <= count <= MAX_READ_BITS or address + count > 65536:
+                return _exception(function_code, ILLEGAL_DATA_VALUE)
+            table = bank.coils if function_code == 1 else bank.discrete
+            data = _pack_bits(table[address:address + count])
+            return bytes((function_code, len(data))) + data
+        if function_code in (3, 4):
+            address, count = struct.unpack_from(">HH", pdu, 1)
+            if not 1 <= count <= MAX_READ_REGISTERS or address + count > 65536:
+                return _exception(function_code, ILLEGAL_DATA_VALUE)
+            table = bank.holding if function_code == 3 else bank.inputs
+            registers = table[address:address + count]
+            return struct.pack(f">BB{count}H", function_code, 2 * count, *registers)
+        if function_code == 5:
+            address, value = struct.unpack_from(">HH", pdu, 1)
+            if value not in (0x0000, 0xFF00):
+                return _exception(function_code, ILLEGAL_DATA_VALUE)
+            bank.coils[address] = 1 if value else 0
+            return pdu[:5]
+        if function_code == 6:
+            address, value = struct.unpack_from(">HH", pdu, 1)
+            bank.holding[address] = value
+            return pdu[:5]
+        if function_code == 15:
+            address, count, size = struct.unpack_from(">HHB", pdu, 1)
+            if address + count > 65536 or size != (count + 7) // 8:
+                return _exception(function_code, ILLEGAL_DATA_VALUE)
+            data = pdu[6:6 + size]
+            for i in range(count):
+                bank.coils[address + i] = data[i // 8] >> (i % 8) & 1
+            return pdu[:5]
+        if function_code == 16:
+            address, count, size = struct.unpack_from(">HHB", pdu, 1)
+            if not 1 <= count <= 123 or size != 2 * count or address + count > 65536:
+                return _exception(function_code, ILLEGAL_DATA_VALUE)
+            bank.holding[address:address + count] = array("H", struct.unpack_from(f">{count}H", pdu, 6))
+            return pdu[:5]
+    except struct.error:
+        return _exception(function_code, ILLEGAL_DATA_VALUE)
+    return _exception(function_code, ILLEGAL_FUNCTION)
+
+
+# This class is the device side shared by the TCP and RTU simulators:
+# unit ids, data banks, injected latency/errors and request counters.
+class SimulatedDevices:
+    def __init__(self, bank: Optional[DataBank] = None, behaviour: DeviceBehaviour = DeviceBehaviour(),
+                 units: Optional[Iterable[int]] = None, banks: Optional[Mapping[int, DataBank]] = None):
+        self.bank = bank or DataBank()
+        self.banks: Dict[int, DataBank] = dict(banks or {})
+        self.units: Optional[Set[int]] = set(units) if units is not None else None
+        self.behaviour = behaviour
+        self.random = random.Random(behaviour.seed)
+        self.requests = 0
+        self.errors = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    # Whether a unit id answers at all.
+    def answers(self, unit: int) -> bool:
+        return self.units is None or unit in self.units
+
+    # Response delay for the next request, in seconds.
+    def delay(self) -> float:
+        behaviour = self.behaviour
+        if not behaviour.jitter:
+            return behaviour.latency
+        return max(0.0, behaviour.latency + self.random.uniform(-behaviour.jitter, behaviour.jitter))
+
+    # Answer a request PDU for a unit; None means no response is sent.
+    def respond(self, unit: int, pdu: bytes) -> Optional[bytes]:
+        behaviour = self.behaviour
+        with self._lock:
+            self.requests += 1
+            if behaviour.drop_rate and self.random.random() < behaviour.drop_rate:
+                self.dropped += 1
+                return None
+            if behaviour.error_rate and self.random.random() < behaviour.error_rate:
+                self.errors += 1
+                return _exception(pdu[0], behaviour.exception_code)
+            return handle_pdu(self.banks.get(unit, self.bank), pdu)
+
+    # Delay and response for a request; the servers answer through this.
+    def respond_timed(self, unit: int, pdu: bytes) -> Tuple[float, Optional[bytes]]:
+        return self.delay(), self.respond(unit, pdu)
+
+    # Request counters since the last reset.
+    def counters(self) -> Dict[str, int]:
+        return {"requests": self.requests, "errors": self.errors, "dropped": self.dropped}
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = self.errors = self.dropped = 0
+
+
+# This class is used to serve simulated devices over Modbus TCP from a background thread.
+# port=0 picks a free port; the bound address is in .host and .port after start().
+class ModbusTcpSimulator(SimulatedDevices):
+    def __init__(self, bank: Optional[DataBank] = None, behaviour: DeviceBehaviour = DeviceBehaviour(),
+                 host: str = "127.0.0.1", port: int = 0, **kwargs):
+        super().__init__(bank, behaviour, **kwargs)
+        self.host = host
+        self.port = port
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server = None
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="modbus-tcp-simulator", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._serve, self.host, self.port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+    # Answer the requests of one connection in order, as a single-threaded device would.
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                header = await reader.readexactly(7)
+                transaction, protocol, length, unit = struct.unpack(">HHHB", header)
+                pdu = await reader.readexactly(length - 1)
+                if not self.answers(unit):
+                    continue
+                delay, response = self.respond_timed(unit, pdu)
+                if delay:
+                    await asyncio.sleep(delay)
+                if response is not None:
+                    writer.write(struct.pack(">HHHB", transaction, protocol, len(response) + 1, unit) + response)
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+# Modbus RTU CRC-16 table (polynomial 0xA001).
+def _crc_table() -> Sequence[int]:
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+
+_CRC_TABLE = _crc_table()
+
+
+# CRC of an RTU frame body, in wire (little-endian) byte order.
+def crc16(data: bytes) -> bytes:
+    crc = 0xFFFF
+    for byte in data:
+        crc = (crc >> 8) ^ _CRC_TABLE[(crc ^ byte) & 0xFF]
+    return struct.pack("<H", crc)
+
+
+# Length of the RTU request frame at the start of buffer, or None until enough bytes arrived.
+def _request_length(buffer: bytes) -> Optional[int]:
+    if len(buffer) < 2:
+        return None
+    length = FIXED_REQUEST_LENGTHS.get(buffer[1])
+    if length is not None:
+        return length
+    if buffer[1] in (15, 16):
+        return 9 + buffer[6] if len(buffer) >= 7 else None
+    # Unknown function: take whatever has arrived as one frame.
+    return len(buffer)
+
+
+# This class is used to serve simulated devices over Modbus RTU on a pseudo-terminal.
+# Clients open .port (e.g. /dev/pts/5) like a serial port. When baudrate is set,
+# the time the request and response would spend on the wire is added to each answer.
+# Needs a POSIX system with pty support.
+class ModbusRtuSimulator(SimulatedDevices):
+    def __init__(self, bank: Optional[DataBank] = None, behaviour: DeviceBehaviour = DeviceBehaviour(),
+                 baudrate: Optional[int] = None, bits_per_char: int = 10, **kwargs):
+        super().__init__(bank, behaviour, **kwargs)
+        if not hasattr(os, "openpty"):
+            raise OSError("The RTU simulator needs pseudo-terminal support")
+        self.char_time = bits_per_char / baudrate if baudrate else 0.0
+        self.port: Optional[str] = None
+        self._master: Optional[int] = None
+        self._slave: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="modbus-rtu-simulator", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            os.close(self._master)
+            os.close(self._slave)
+
+    def _run(self):
+        buffer = b""
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self._master], [], [], 0.05)
+            if not readable:
+                # A silent interval ends any partial frame.
+                buffer = b""
+                continue
+            buffer += os.read(self._master, 1024)
+            while True:
+                length = _request_length(buffer)
+                if length is None or len(buffer) < length:
+                    break
+                frame, buffer = buffer[:length], buffer[length:]
+                self._answer(frame)
+
+    def _answer(self, frame: bytes):
+        if len(frame) < 4 or crc16(frame[:-2]) != frame[-2:]:
+            return
+        unit, pdu = frame[0], frame[1:-2]
+        # Unit 0 is a broadcast: act on it but never answer.
+        if unit != 0 and not self.answers(unit):
+            return
+        delay, response = self.respond_timed(unit, pdu)
+        if unit == 0 or response is None:
+            return
+        response = bytes((unit,)) + response
+        response += crc16(response)
+        delay += (len(frame) + len(response)) * self.char_time
+        if delay:
+            time.sleep(delay)
+        os.write(self._master, response)
+
+# End of file: testing/benchmark/modbus_simulator.py
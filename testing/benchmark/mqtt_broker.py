@@ -0,0 +1,156 @@
+#
+# This module is used to stand in for an MQTT broker in tests and benchmarks.
+#
+
+import asyncio
+import struct
+import threading
+import time
+from typing import List, NamedTuple, Optional
+
+# MQTT 3.1.1 control packet types.
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+# One message received from a client.
+class ReceivedMessage(NamedTuple):
+    topic: str
+    payload: bytes
+    qos: int
+    timestamp: float
+
+
+def _packet(packet_type: int, body: bytes, flags: int = 0) -> bytes:
+    length = len(body)
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            break
+    return bytes((packet_type << 4 | flags,)) + bytes(encoded) + body
+
+
+async def _read_packet(reader: asyncio.StreamReader):
+    first = (await reader.readexactly(1))[0]
+    length = shift = 0
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    return first >> 4, first & 0x0F, await reader.readexactly(length)
+
+
+# This class is a minimal MQTT 3.1.1 broker that records what clients publish.
+# It accepts every CONNECT, acknowledges QoS 1 and 2 publishes (after ack_delay
+# seconds, to emulate a slow broker) and answers pings and subscribes; nothing is
+# forwarded to subscribers. stop() drops every client connection, as a broker
+# going down would. Runs its event loop in a thread on a free port.
+class MqttBrokerStandIn:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, ack_delay: float = 0.0):
+        self.host = host
+        self.port = port
+        self.ack_delay = ack_delay
+        self.messages: List[ReceivedMessage] = []
+        self.connections = 0
+        self._received = threading.Condition()
+        self._writers = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="mqtt-broker", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    # Wait until count messages have arrived; returns whether they did within timeout.
+    def wait_for(self, count: int, timeout: float = 5.0) -> bool:
+        with self._received:
+            return self._received.wait_for(lambda: len(self.messages) >= count, timeout)
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        server = self._loop.run_until_complete(asyncio.start_server(self._serve, self.host, self.port))
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            for writer in list(self._writers):
+                writer.close()
+            server.close()
+            self._loop.run_until_complete(server.wait_closed())
+            self._loop.close()
+
+    def _store(self, topic: str, payload: bytes, qos: int):
+        with self._received:
+            self.messages.append(ReceivedMessage(topic, payload, qos, time.time()))
+            self._received.notify_all()
+
+    async def _ack(self, writer: asyncio.StreamWriter, packet: bytes):
+        if self.ack_delay:
+            await asyncio.sleep(self.ack_delay)
+        writer.write(packet)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        self._writers.add(writer)
+        try:
+            while True:
+                packet_type, flags, body = await _read_packet(reader)
+                if packet_type == CONNECT:
+                    writer.write(_packet(CONNACK, b"\x00\x00"))
+                elif packet_type == PUBLISH:
+                    qos = flags >> 1 & 3
+                    topic_length = struct.unpack_from(">H", body)[0]
+                    topic = body[2:2 + topic_length].decode("utf-8")
+                    offset = 2 + topic_length
+                    if qos:
+                        packet_id = body[offset:offset + 2]
+                        offset += 2
+                        asyncio.ensure_future(self._ack(writer, _packet(PUBACK if qos == 1 else PUBREC, packet_id)))
+                    self._store(topic, body[offset:], qos)
+                elif packet_type == PUBREL:
+                    writer.write(_packet(PUBCOMP, body[:2]))
+                elif packet_type == SUBSCRIBE:
+                    writer.write(_packet(SUBACK, body[:2] + b"\x00"))
+                elif packet_type == PINGREQ:
+                    writer.write(_packet(PINGRESP, b""))
+                elif packet_type == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+# End of file: testing/benchmark/mqtt_broker.py
@@ -0,0 +1,183 @@
+#
+# This module is used to benchmark decoding and serving captured Modbus traffic offline.
+#
+# Run from the repository root:
+#   python -m testing.benchmark.replay_benchmark --operations 500 --latency 0.002 --speeds 100,0
+#   python -m testing.benchmark.replay_benchmark --capture logs/site.cap --map config.json --section huawei.sacu
+#
+
+import argparse
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Sequence
+
+from testing.benchmark.modbus_benchmark import (BENCH_MAP, BENCH_VALUES, RESULTS_DIR, code_version, percentile,
+                                                save_results)
+from testing.benchmark.modbus_simulator import DataBank, DeviceBehaviour, ModbusTcpSimulator
+from testing.benchmark.replay_server import ReplayTcpServer
+from utils.config_loader import RegisterMap, load_register_map
+from utils.frame_capture import TCP, CaptureReader, CaptureWriter, ReplayDecoder, Transaction, capture_client
+
+
+# Capture args.operations register map reads of ModbusTcpTest against the TCP simulator.
+def capture_scenario(args, path: str) -> Dict[str, object]:
+    from pymodbus.client import ModbusTcpClient
+    from protocols.modbusTCP.modbus_tcp_test import ModbusTcpTest
+
+    bank = DataBank()
+    bank.load_map(BENCH_MAP, BENCH_VALUES)
+    behaviour = DeviceBehaviour(args.latency, args.jitter, seed=args.seed)
+    with ModbusTcpSimulator(bank, behaviour) as simulator:
+        test = ModbusTcpTest()
+        test.client = ModbusTcpClient(simulator.host, port=simulator.port, timeout=args.timeout, retries=0)
+        test.capture = capture_client(test.client, CaptureWriter(path, TCP)).capture
+        if not test.client.connect():
+            raise ConnectionError(f"Failed to connect to the simulator at {simulator.host}:{simulator.port}")
+        try:
+            start = time.perf_counter()
+            for _ in range(args.operations):
+                test.read_register_map(BENCH_MAP, function_code=3)
+            elapsed = time.perf_counter() - start
+        finally:
+            test.client.close()
+            test.capture.close()
+    frames = test.capture.frames
+    return {"name": "capture_tcp", "operations": args.operations, "frames": frames, "elapsed_s": elapsed,
+            "bytes": os.path.getsize(path), "frames_per_s": frames / elapsed}
+
+
+# Decode every captured transaction at speed times the captured rate (0: as fast as possible).
+def decode_scenario(transactions: Sequence[Transaction], register_map: RegisterMap, speed: float,
+                    byteorder: str, wordorder: str) -> Dict[str, object]:
+    decoder = ReplayDecoder(register_map, byteorder, wordorder)
+    values = 0
+    start = time.perf_counter()
+    for _, _, decoded in decoder.decode(transactions, speed=speed):
+        values += len(decoded)
+    elapsed = time.perf_counter() - start
+    span = transactions[-1].t - transactions[0].t if transactions else 0.0
+    result = {"name": f"decode_{speed:g}x" if speed > 0 else "decode_max", "transactions": len(transactions),
+              "decoded": decoder.decoded, "skipped": decoder.skipped, "values": values, "elapsed_s": elapsed,
+              "transactions_per_s": len(transactions) / elapsed if elapsed else 0.0,
+              "values_per_s": values / elapsed if elapsed else 0.0}
+    if speed > 0:
+        # How far behind the captured timing the replay finished, in seconds.
+        result["lag_s"] = max(0.0, elapsed - span / speed)
+    return result
+
+
+# Serve the capture from ReplayTcpServer at speed and send its requests again, in order.
+def serve_scenario(transactions: Sequence[Transaction], speed: float, timeout: float) -> Dict[str, object]:
+    import struct
+    from pymodbus.client import ModbusTcpClient
+
+    answered = [transaction for transaction in transactions if transaction.response is not None]
+    latencies: List[float] = []
+    mismatches = 0
+    with ReplayTcpServer(answered, speed) as server:
+        client = ModbusTcpClient(server.host, port=server.port, timeout=timeout, retries=0)
+        if not client.connect():
+            raise ConnectionError(f"Failed to connect to the replay server at {server.host}:{server.port}")
+        try:
+            start = time.perf_counter()
+            for transaction in answered:
+                request = transaction.request
+                address, count = struct.unpack_from(">HH", request, 1)
+                began = time.perf_counter()
+                if request[0] == 3:
+                    result = client.read_holding_registers(address, count, slave=transaction.unit)
+                else:
+                    result = client.read_input_registers(address, count, slave=transaction.unit)
+                latencies.append(time.perf_counter() - began)
+                if result.isError():
+                    mismatches += 1
+            elapsed = time.perf_counter() - start
+        finally:
+            client.close()
+        counters = server.counters()
+    latencies.sort()
+    captured = sorted(transaction.latency for transaction in answered)
+    return {"name": f"serve_tcp_{speed:g}x" if speed > 0 else "serve_tcp_max", "requests": len(answered),
+            "misses": counters["misses"], "errors": mismatches, "elapsed_s": elapsed,
+            "requests_per_s": len(answered) / elapsed if elapsed else 0.0,
+            "captured_latency_ms": {"p50": 1000 * percentile(captured, 50), "p95": 1000 * percentile(captured, 95)},
+            "latency_ms": {"p50": 1000 * percentile(latencies, 50), "p95": 1000 * percentile(latencies, 95)}}
+
+
+def format_report(run: Dict[str, object]) -> str:
+    lines = [f"Replay benchmark {run['version']} ({run['timestamp']})"]
+    for scenario in run["scenarios"]:
+        details = ", ".join(f"{key} {value:.3f}" if isinstance(value, float) else f"{key} {value}"
+                            for key, value in scenario.items() if key != "name")
+        lines.append(f"{scenario['name']}: {details}")
+    return "\n".join(lines)
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark offline decoding and serving of captured Modbus traffic.")
+    parser.add_argument("--scenarios", default="decode,serve", help="comma separated: decode, serve")
+    parser.add_argument("--capture", help="Modbus TCP capture to replay (default: capture one from the simulator)")
+    parser.add_argument("--map", help="JSON config the capture's register map is read from (default: the bench map)")
+    parser.add_argument("--section", default="", help="dotted section of --map, e.g. huawei.sacu")
+    parser.add_argument("--byteorder", default="big", help="byte order of the captured device")
+    parser.add_argument("--wordorder", default="big", help="word order of the captured device")
+    parser.add_argument("--speeds", default="100,0", help="comma separated replay speeds (0: as fast as possible)")
+    parser.add_argument("--operations", type=int, default=500, help="register map reads to capture")
+    parser.add_argument("--latency", type=float, default=0.002, help="simulated device latency while capturing")
+    parser.add_argument("--jitter", type=float, default=0.001, help="uniform latency jitter in seconds")
+    parser.add_argument("--seed", type=int, default=None, help="seed for the jitter")
+    parser.add_argument("--timeout", type=float, default=1.0, help="client timeout in seconds")
+    parser.add_argument("--output", default=os.path.join(RESULTS_DIR, "replay"), help="directory results are saved to")
+    parser.add_argument("--no-save", action="store_true", help="do not save this run")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> Dict[str, object]:
+    args = parse_args(argv)
+    speeds = [float(speed) for speed in args.speeds.split(",") if speed.strip()]
+    scenarios: List[Dict[str, object]] = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.capture
+        if path is None:
+            path = os.path.join(directory, "bench.cap")
+            scenarios.append(capture_scenario(args, path))
+        with CaptureReader(path) as reader:
+            transactions = reader.transactions()
+            link = reader.link
+    if args.map:
+        register_map = load_register_map(args.map, *filter(None, args.section.split(".")))
+    else:
+        register_map = RegisterMap(BENCH_MAP)
+    for name in args.scenarios.split(","):
+        name = name.strip()
+        for speed in speeds:
+            if name == "decode":
+                scenarios.append(decode_scenario(transactions, register_map, speed, args.byteorder, args.wordorder))
+            elif name == "serve":
+                if link != TCP:
+                    raise SystemExit("The serve scenario replays Modbus TCP captures only")
+                scenarios.append(serve_scenario(transactions, speed, args.timeout))
+            elif name:
+                raise SystemExit(f"Unknown scenario {name}")
+    run = {
+        "version": code_version(),
+        "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "no_save")},
+        "scenarios": scenarios,
+    }
+    print(format_report(run))
+    if not args.no_save:
+        print(f"Saved {save_results(run, args.output)}")
+    return run
+
+
+if __name__ == "__main__":
+    main()
+
+# End of file: testing/benchmark/replay_benchmark.py
@@ -0,0 +1,71 @@
+#
+# This module is used to serve captured Modbus responses back to a client, at the captured timing.
+#
+
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from testing.benchmark.modbus_simulator import (ILLEGAL_DATA_ADDRESS, DeviceBehaviour, ModbusRtuSimulator,
+                                                ModbusTcpSimulator, _exception)
+from utils.frame_capture import Transaction
+
+
+# This class is used to answer requests from the transactions of a capture.
+# Each (unit, request PDU) seen in the capture is answered with the responses
+# captured for it, in turn, after the captured latency divided by speed (0:
+# answer at once); requests never captured get an illegal data address
+# exception and are counted in .misses, requests that went unanswered in the
+# capture get no answer here either.
+class _Replay:
+    def _load(self, transactions: Iterable[Transaction], speed: float):
+        self.speed = speed
+        self.misses = 0
+        self._answers: Dict[Tuple[int, bytes], List[Tuple[float, Optional[bytes]]]] = defaultdict(list)
+        self._turn: Dict[Tuple[int, bytes], int] = defaultdict(int)
+        self._replay_lock = threading.Lock()
+        for transaction in transactions:
+            latency = transaction.latency or 0.0
+            self._answers[(transaction.unit, transaction.request)].append(
+                (latency / speed if speed > 0 else 0.0, transaction.response))
+
+    def respond_timed(self, unit: int, pdu: bytes) -> Tuple[float, Optional[bytes]]:
+        key = (unit, bytes(pdu))
+        with self._replay_lock:
+            self.requests += 1
+            answers = self._answers.get(key)
+            if not answers:
+                self.misses += 1
+                return 0.0, _exception(pdu[0], ILLEGAL_DATA_ADDRESS)
+            turn = self._turn[key]
+            self._turn[key] = turn + 1
+            delay, response = answers[turn % len(answers)]
+            if response is None:
+                self.dropped += 1
+        return delay, response
+
+    def counters(self) -> Dict[str, int]:
+        return dict(super().counters(), misses=self.misses)
+
+    def reset_counters(self):
+        super().reset_counters()
+        with self._replay_lock:
+            self.misses = 0
+
+
+# This class is used to replay a capture over Modbus TCP on a free port.
+class ReplayTcpServer(_Replay, ModbusTcpSimulator):
+    def __init__(self, transactions: Iterable[Transaction], speed: float = 1.0, host: str = "127.0.0.1",
+                 port: int = 0):
+        super().__init__(None, DeviceBehaviour(), host, port)
+        self._load(transactions, speed)
+
+
+# This class is used to replay a capture over Modbus RTU on a pseudo-terminal.
+# The captured latency already includes the time on the wire, so none is added.
+class ReplayRtuServer(_Replay, ModbusRtuSimulator):
+    def __init__(self, transactions: Iterable[Transaction], speed: float = 1.0):
+        super().__init__(None, DeviceBehaviour())
+        self._load(transactions, speed)
+
+# End of file: testing/benchmark/replay_server.py
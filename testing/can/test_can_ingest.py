@@ -0,0 +1,148 @@
+#
+# This module is used to test the CAN frame ring and batch signal decoder on a python-can virtual bus.
+#
+
+import time
+
+import numpy as np
+import pytest
+
+from protocols.can.can_ingest import CAN_EFF_FLAG, CanIngest, CanMessage, FrameRing, Signal, SignalDecoder, parse_dbc
+
+DBC = """
+BO_ 256 Intel: 8 BMS
+ SG_ counter : 0|8@1+ (1,0) [0|255] "" Vector__XXX
+ SG_ temperature : 8|12@1- (0.5,-10) [-100|100] "degC" Vector__XXX
+ SG_ current : 20|16@1- (0.01,0) [-300|300] "A" Vector__XXX
+
+BO_ 2147488000 Motorola: 8 BMS
+ SG_ voltage : 7|16@0+ (0.1,0) [0|6553.5] "V" Vector__XXX
+ SG_ power : 21|14@0- (2,100) [0|0] "W" Vector__XXX
+ SG_ soc : 39|8@0+ (1,0) [0|100] "%" Vector__XXX
+"""
+
+MESSAGES = parse_dbc(DBC)
+
+
+# Reference encoder: set a signal's raw value bit by bit, as the DBC numbering describes it.
+def put(data: bytearray, signal: Signal, value: float):
+    raw = round((value - signal.offset) / signal.scale) & ((1 << signal.length) - 1)
+    bit = signal.start
+    for i in range(signal.length):
+        if signal.little_endian:
+            position, value_bit = signal.start + i, i
+        else:
+            position, value_bit = bit, signal.length - 1 - i
+            bit = bit + 15 if bit % 8 == 0 else bit - 1
+        if raw >> value_bit & 1:
+            data[position // 8] |= 1 << position % 8
+
+
+def encode(message: CanMessage, values) -> bytes:
+    data = bytearray(8)
+    for signal in message.signals:
+        put(data, signal, values[signal.name])
+    return bytes(data)
+
+
+ROWS = {
+    "Intel": [dict(counter=i, temperature=-10 + 7.5 * i - 60, current=-250.0 + 123.45 * i) for i in range(5)],
+    "Motorola": [dict(voltage=400.0 + 12.3 * i, power=100 + 2 * (i * 1000 - 2000), soc=20 * i) for i in range(5)],
+}
+
+
+def test_dbc_is_parsed_with_extended_ids():
+    intel, motorola = MESSAGES
+    assert (intel.arbitration_id, intel.name, intel.dlc) == (256, "Intel", 8)
+    assert motorola.arbitration_id == 2147488000 & ~CAN_EFF_FLAG
+    assert intel.signals[1] == Signal("temperature", 8, 12, True, True, 0.5, -10.0, "degC")
+    assert motorola.signals[0] == Signal("voltage", 7, 16, False, False, 0.1, 0.0, "V")
+
+
+def test_decoder_matches_the_reference_encoding():
+    ring = FrameRing(64)
+    for i in range(5):
+        for message in MESSAGES:
+            can_id = message.arbitration_id | (CAN_EFF_FLAG if message.arbitration_id > 0x7FF else 0)
+            ring.append(float(i), can_id, 8, encode(message, ROWS[message.name][i]))
+    batch, position, lost = ring.since(0)
+    assert (len(batch), position, lost) == (10, 10, 0)
+    decoded = SignalDecoder(MESSAGES).decode(batch)
+    for name, rows in ROWS.items():
+        timestamps, signals = decoded[name]
+        assert timestamps.tolist() == [0.0, 1.0, 2.0, 3.0, 4.0]
+        for signal, values in signals.items():
+            assert values == pytest.approx([row[signal] for row in rows]), signal
+
+
+def test_unknown_ids_are_skipped():
+    ring = FrameRing(4)
+    ring.append(0.0, 0x123, 8, bytes(8))
+    assert SignalDecoder(MESSAGES).decode(ring.since(0)[0]) == {}
+
+
+def test_ring_counts_frames_overwritten_before_they_were_read():
+    ring = FrameRing(8)
+    for i in range(5):
+        ring.append(float(i), 1, 1, bytes((i,)))
+    batch, position, lost = ring.since(0)
+    assert (len(batch), position, lost) == (5, 5, 0)
+    for i in range(5, 20):
+        ring.append(float(i), 1, 1, bytes((i,)))
+    batch, position, lost = ring.since(position)
+    # 15 frames were written since the last read; only the newest 8 are left.
+    assert (len(batch), position, lost) == (8, 20, 7)
+    assert batch.data[:, 0].tolist() == list(range(12, 20))
+    assert len(ring.since(position)[0]) == 0
+
+
+@pytest.fixture
+def bus():
+    can = pytest.importorskip("can")
+    channel = f"test-{time.monotonic_ns()}"
+    sender = can.Bus(channel=channel, interface="virtual")
+    yield can, sender, channel
+    sender.shutdown()
+
+
+def wait_for(ingest: CanIngest, count: int, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while ingest.ring.written < count:
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_ingest_decodes_frames_from_a_virtual_bus(bus):
+    can, sender, channel = bus
+    intel, motorola = MESSAGES
+    with CanIngest(channel, interface="virtual", messages=MESSAGES) as ingest:
+        for i in range(5):
+            sender.send(can.Message(arbitration_id=intel.arbitration_id, is_extended_id=False,
+                                    data=encode(intel, ROWS["Intel"][i])))
+            sender.send(can.Message(arbitration_id=motorola.arbitration_id, is_extended_id=True,
+                                    data=encode(motorola, ROWS["Motorola"][i])))
+        assert wait_for(ingest, 10)
+        decoded = ingest.read()
+    assert set(decoded) == {"Intel", "Motorola"}
+    assert decoded["Motorola"][1]["voltage"] == pytest.approx([row["voltage"] for row in ROWS["Motorola"]])
+    assert np.all(np.diff(decoded["Intel"][0]) >= 0)
+    assert ingest.lost == 0
+
+
+def test_ingest_accumulates_lost_frames(bus):
+    can, sender, channel = bus
+    with CanIngest(channel, interface="virtual", capacity=8) as ingest:
+        for i in range(20):
+            sender.send(can.Message(arbitration_id=0x100, is_extended_id=False, data=[i]))
+        assert wait_for(ingest, 20)
+        batch = ingest.frames()
+        sender.send(can.Message(arbitration_id=0x100, is_extended_id=False, data=[20]))
+        assert wait_for(ingest, 21)
+        last = ingest.frames()
+    assert batch.data[:, 0].tolist() == list(range(12, 20))
+    assert last.data[:, 0].tolist() == [20]
+    assert ingest.lost == 12
+
+# End of file: testing/can/test_can_ingest.py
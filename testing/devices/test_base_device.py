@@ -0,0 +1,94 @@
+#
+# This module is used to test the compiled poll plans and group polling of BaseDevice.
+#
+
+import asyncio
+
+import pytest
+
+from devices.base_device import BaseDevice, PollGroup
+from utils.poll_scheduler import ONCE
+
+
+# Async client answering register reads from a dict; addresses in failing raise.
+class FakeClient:
+    def __init__(self, registers, failing=()):
+        self.registers = registers
+        self.failing = set(failing)
+        self.connected = True
+        self.requests = []
+
+    async def connect(self):
+        self.connected = True
+
+    async def close(self):
+        self.connected = False
+
+    async def read_registers(self, unit, address, count, function_code):
+        self.requests.append((unit, address, count, function_code))
+        if address in self.failing:
+            raise ConnectionError(f"no response at {address}")
+        return [self.registers.get(address + i, 0) for i in range(count)]
+
+
+class Meter(BaseDevice):
+    MODEL = "meter"
+    REGISTER_MAP = [(0, 10, "string", "serial_number"), (100, 2, "uint32", "energy"), (102, 1, "int16", "power"),
+                    (200, 1, "uint16", "status")]
+    POLL_GROUPS = (PollGroup("identity", ONCE, ("serial_number",)), PollGroup("fast", 1.0, ("energy", "power")),
+                   PollGroup("slow", 60.0, ("status",)))
+
+
+REGISTERS = {0: 0x4142, 1: 0x4300, 100: 1, 101: 2, 102: 0xFFFE, 200: 7}
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_plan_is_compiled_once_per_model():
+    plan = Meter.compile()
+    assert Meter.compile() is plan
+    assert [group.name for group in plan.groups] == ["identity", "fast", "slow"]
+    # energy and power are back to back: one request.
+    assert len(plan.group("fast").blocks) == 1
+    assert plan.request_count == 3
+
+
+def test_poll_decodes_every_group_and_keeps_once_values():
+    device = Meter(client=FakeClient(REGISTERS))
+    results = {result.group: result for result in run(device.poll())}
+    assert results["fast"].values == {"energy": 0x10002, "power": -2}
+    assert results["identity"].values["serial_number"] == "ABC"
+    assert device.static_values == {"serial_number": "ABC"}
+    # The ONCE group is not read again.
+    assert {result.group for result in run(device.poll())} == {"fast", "slow"}
+
+
+def test_failed_once_group_is_read_again():
+    client = FakeClient(REGISTERS, failing={0})
+    device = Meter(client=client)
+    results = {result.group: result for result in run(device.poll())}
+    assert results["identity"].errors and not results["identity"].values
+    assert "identity" in {result.group for result in run(device.poll_due())}
+    client.failing.clear()
+    assert "identity" in {result.group for result in run(device.poll())}
+    assert device.static_values == {"serial_number": "ABC"}
+    assert "identity" not in {result.group for result in run(device.poll())}
+
+
+def test_read_reuses_the_compiled_group():
+    device = Meter(client=FakeClient(REGISTERS))
+    assert run(device.read("power", "status")) == {"power": -2, "status": 7}
+    register_map = Meter.register_map()
+    assert Meter.compile_read(register_map, ("power", "status")) is Meter.compile_read(register_map, ("power", "status"))
+    with pytest.raises(KeyError):
+        run(device.read("missing"))
+
+
+def test_read_raises_when_a_block_fails():
+    device = Meter(client=FakeClient(REGISTERS, failing={200}))
+    with pytest.raises(ConnectionError):
+        run(device.read("status"))
+
+# End of file: testing/devices/test_base_device.py
@@ -0,0 +1,38 @@
+#
+# This module is used to test the Huawei SACU fleet snapshot against the Modbus TCP simulator.
+#
+
+import asyncio
+
+from devices.huawei.huawei_sacu import HuaweiSacu, HuaweiSacuFleet, print_snapshots
+from testing.benchmark.modbus_simulator import DataBank, ModbusTcpSimulator
+
+
+def sacu_bank():
+    bank = DataBank()
+    bank.load_map(HuaweiSacu.register_map(), {"serial_number": "SACU-42"})
+    return bank
+
+
+def test_snapshot_reads_the_sacu_once():
+    async def snapshots(fleet):
+        async with fleet:
+            return [await fleet.snapshot() for _ in range(2)]
+
+    with ModbusTcpSimulator(sacu_bank()) as simulator:
+        first, second = asyncio.run(snapshots(HuaweiSacuFleet(simulator.host, simulator.port)))
+        requests = simulator.counters()["requests"]
+    assert first.values["SACU"]["serial_number"] == second.values["SACU"]["serial_number"] == "SACU-42"
+    assert not first.errors and not second.errors
+    assert requests == len(HuaweiSacu.compile().group("identity").blocks)
+
+
+def test_main_prints_snapshot_timing(capsys):
+    with ModbusTcpSimulator(sacu_bank()) as simulator:
+        asyncio.run(print_snapshots(simulator.host, simulator.port, count=2, period=0.0))
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split(" in ")[0] for line in lines[:2]] == ["Snapshot of 1 devices"] * 2
+    assert lines[-1] == "SACU serial number: SACU-42"
+
+
+# End of file: testing/devices/test_huawei_sacu.py
@@ -0,0 +1,158 @@
+#
+# This module is used to test the M-Bus parser and master against the pty meter simulator.
+#
+
+import os
+
+import pytest
+
+from protocols.mbus.mbus_parser import (ACK_FRAME, SND_NKE, SecondaryAddress, ShortFrame, Telegram, TelegramParser,
+                                        decode_records, describe_vif, short_frame)
+from testing.benchmark.mbus_simulator import MbusSimulator, SimulatedMeter
+
+METER = SimulatedMeter(SecondaryAddress("12345678", "SIM", 1, 0x04), 5, energy_wh=1234, volume_l=99,
+                       flow_temperature=70.5)
+
+
+def values(telegram: Telegram):
+    return {record.quantity: record.value for record in telegram.records}
+
+
+def test_parser_decodes_a_variable_data_response():
+    frames = TelegramParser().feed(METER.response())
+    assert len(frames) == 1
+    telegram = frames[0]
+    assert telegram.header == METER.address
+    assert telegram.address == 5
+    decoded = values(telegram)
+    assert decoded["energy"] == 1234
+    assert decoded["volume"] == pytest.approx(0.099)
+    assert decoded["flow temperature"] == pytest.approx(70.5)
+    assert decoded["fabrication number"] == 12345678
+
+
+def test_parser_joins_frames_split_across_reads():
+    parser = TelegramParser()
+    data = short_frame(SND_NKE, 7) + METER.response() + b"\xE5"
+    frames = []
+    for i in range(len(data)):
+        frames.extend(parser.feed(data[i:i + 1]))
+    assert frames[0] == ShortFrame(SND_NKE, 7)
+    assert values(frames[1])["energy"] == 1234
+    assert frames[2] == ACK_FRAME
+    assert len(frames) == 3
+    assert not len(parser)
+    assert not parser.errors
+
+
+def test_parser_resynchronises_after_noise():
+    parser = TelegramParser()
+    corrupted = bytearray(METER.response())
+    corrupted[-2] ^= 0xFF  # checksum
+    frames = parser.feed(b"\x00\x42" + bytes(corrupted) + b"\x33" + METER.response())
+    telegrams = [frame for frame in frames if isinstance(frame, Telegram)]
+    assert len(telegrams) == 1
+    assert telegrams[0].header == METER.address
+    assert parser.errors >= 1
+    assert parser.skipped >= 3
+
+
+def test_parser_keeps_a_truncated_frame_until_the_rest_arrives():
+    parser = TelegramParser()
+    response = METER.response()
+    assert parser.feed(response[:-3]) == []
+    assert len(parser) == len(response) - 3
+    frames = parser.feed(response[-3:])
+    assert len(frames) == 1 and frames[0].header == METER.address
+    assert not len(parser)
+
+
+@pytest.mark.parametrize("vif, expected", [
+    (0x03, ("energy", "Wh", 0)),
+    (0x0E, ("energy", "J", 6)),
+    (0x13, ("volume", "m3", -3)),
+    (0x22, ("on time", "h", 0)),
+    (0x2B, ("power", "W", 0)),
+    (0x4F, ("volume flow", "m3/s", -2)),
+    (0x5B, ("flow temperature", "C", 0)),
+    (0x67, ("external temperature", "C", 0)),
+    (0x6D, ("date time", "", 0)),
+    (0x75, ("actuality duration", "min", 0)),
+    (0x6F, ("unknown", "", 0)),
+    (0x7B, ("unknown", "", 0)),
+    (0x80, ("unknown", "", 0)),
+])
+def test_vif_table(vif, expected):
+    assert describe_vif(vif) == expected
+
+
+def test_records_with_dife_bcd_and_variable_length_values():
+    data = memoryview(bytes([
+        0x84, 0x12, 0x03, 0x10, 0x27, 0x00, 0x00,   # 32-bit energy, storage 4 tariff 1, 10000 Wh
+        0x0A, 0x5A, 0x34, 0x12,                     # 4 digit BCD flow temperature, 123.4 C
+        0x0D, 0x78, 0x03, 0x43, 0x42, 0x41,         # text fabrication number
+        0x2F, 0x1F, 0xAA]))
+    records, more, manufacturer = decode_records(data)
+    assert [(r.quantity, r.storage, r.tariff, r.value) for r in records] == [
+        ("energy", 4, 1, 10000), ("flow temperature", 0, 0, pytest.approx(123.4)), ("fabrication number", 0, 0, "ABC")]
+    assert more and manufacturer == b"\xaa"
+    with pytest.raises(ValueError):
+        decode_records(memoryview(bytes([0x04, 0x03, 0x10])))
+
+
+needs_pty = pytest.mark.skipif(not hasattr(os, "openpty"), reason="needs pseudo-terminal support")
+
+
+@pytest.fixture
+def segment():
+    pytest.importorskip("serial")
+    from protocols.mbus.mbus_master import MbusMaster
+
+    meters = MbusSimulator.random_meters(12, seed=3)
+    # Two meters whose ids differ only in the last digit collide down to the final wildcard.
+    meters.append(SimulatedMeter(SecondaryAddress(meters[0].address.id[:7] + str((int(meters[0].address.id[7]) + 1) % 10),
+                                                  "SIM", 1, 0x04), 200))
+    with MbusSimulator(meters) as simulator:
+        with MbusMaster(simulator.port, timeout=0.05, seed=1) as master:
+            yield simulator, master
+
+
+@needs_pty
+def test_search_finds_every_meter(segment):
+    simulator, master = segment
+    found = master.search()
+    assert sorted(map(str, found)) == sorted(str(meter.address) for meter in simulator.meters)
+    # The tree search probes far fewer masks than a scan of the id space.
+    assert master.probes < 10 * 10 * len(simulator.meters)
+
+
+@needs_pty
+def test_discover_saves_and_reuses_the_addresses(segment, tmp_path):
+    from protocols.mbus.mbus_master import SecondaryAddressBook
+
+    simulator, master = segment
+    path = str(tmp_path / "addresses.json")
+    found = master.discover(SecondaryAddressBook(path), "bus1")
+    assert len(found) == len(simulator.meters)
+
+    # Known addresses that all still answer are kept without another search.
+    probes = master.probes
+    book = SecondaryAddressBook(path)
+    assert sorted(map(str, master.discover(book, "bus1"))) == sorted(map(str, found))
+    assert master.probes - probes == len(found)
+
+    # A meter that is gone triggers a fresh search.
+    simulator.meters.pop()
+    assert len(master.discover(book, "bus1")) == len(simulator.meters)
+    assert len(SecondaryAddressBook(path).addresses("bus1")) == len(simulator.meters)
+
+
+@needs_pty
+def test_selected_meter_is_read_by_secondary_address(segment):
+    simulator, master = segment
+    meter = simulator.meters[3]
+    telegram = master.read_secondary(meter.address)
+    assert telegram is not None and telegram.header == meter.address
+    assert values(telegram)["energy"] == meter.energy_wh
+
+# End of file: testing/mbus/test_mbus.py
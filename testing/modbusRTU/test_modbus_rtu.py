@@ -0,0 +1,38 @@
+#
+# This module is used to test the Modbus RTU poll script against the RTU simulator.
+#
+
+import subprocess
+import sys
+
+from testing.benchmark.modbus_simulator import DataBank, ModbusRtuSimulator
+
+# Imported by the code that enables them, never by importing the script.
+OPTIONAL = ("numpy", "paho", "multiprocessing", "utils.sample_store", "utils.process_image", "utils.frame_capture",
+            "utils.bus_supervisor", "protocols.mqtt.mqtt_bridge")
+
+
+def test_import_leaves_logging_and_optional_subsystems_alone():
+    code = ("import logging, sys; import protocols.modbusRTU.modbus_rtu_test; "
+            f"print(logging.getLogger().handlers, [name for name in {OPTIONAL!r} if name in sys.modules])")
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "[] []"
+
+
+def test_process_unit_reads_and_writes_a_simulated_unit():
+    from pymodbus.client import ModbusSerialClient
+    from protocols.modbusRTU import modbus_rtu_test
+
+    bank = DataBank()
+    bank.set_registers(40101, [7])
+    with ModbusRtuSimulator(bank, units=[3]) as simulator:
+        client = ModbusSerialClient(port=simulator.port, baudrate=115200, timeout=1, retries=0)
+        assert client.connect()
+        try:
+            modbus_rtu_test.process_unit(client, 3)
+        finally:
+            client.close()
+    assert modbus_rtu_test.REGISTER_CACHE.get("COM6/3", "status", max_age=60) == [7]
+    assert bank.holding[40100] == 14
+
+# End of file: testing/modbusRTU/test_modbus_rtu.py
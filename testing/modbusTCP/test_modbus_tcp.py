@@ -1,2 +1,84 @@
 #
-# 
\ No newline at end of file
+# This module is used to test ModbusTcpTest and the Modbus benchmark against the TCP simulator.
+#
+
+from contextlib import contextmanager
+
+import pytest
+
+from protocols.modbusTCP.modbus_tcp_test import ModbusTcpTest
+from testing.benchmark import modbus_benchmark
+from testing.benchmark.modbus_benchmark import BENCH_MAP, BENCH_VALUES, run_scenario
+from testing.benchmark.modbus_simulator import DataBank, DeviceBehaviour, ModbusTcpSimulator, SimulatedDevices
+from utils.timer import ERROR_RESPONSE, METRICS
+
+
+# A ModbusTcpTest connected to a simulator holding the benchmark register map.
+@contextmanager
+def connected(behaviour=DeviceBehaviour()):
+    bank = DataBank()
+    bank.load_map(BENCH_MAP, BENCH_VALUES)
+    with ModbusTcpSimulator(bank, behaviour) as simulator:
+        test = ModbusTcpTest()
+        assert test.connect(simulator.host, simulator.port)
+        try:
+            yield test, simulator
+        finally:
+            assert test.disconnect()
+
+
+def error_responses(device):
+    return sum(entry["count"] for entry in METRICS.snapshot()["counters"]
+               if entry["device"] == device and entry["event"] == ERROR_RESPONSE)
+
+
+def test_typed_reads_decode_the_simulated_registers():
+    with connected() as (test, _):
+        assert test.read_int16(200, 16) == list(range(-8, 8))
+        assert test.read_float32(100, 4) == [0.0, 1.5, 3.0, 4.5]
+        assert test.read_string(300, 2) == [b"SI", b"M-"]
+
+
+def test_register_map_is_read_in_one_request_per_block():
+    with connected() as (test, simulator):
+        simulator.reset_counters()
+        values = test.read_register_map(BENCH_MAP, function_code=3)
+        assert values == pytest.approx(BENCH_VALUES)
+        # float_*, int_* and serial_number sit in three separate ranges.
+        assert simulator.counters()["requests"] == 3
+
+
+def test_failed_blocks_are_skipped_and_counted_per_slave():
+    with connected(DeviceBehaviour(error_rate=1.0)) as (test, simulator):
+        device = test.device_label(7)
+        assert device == f"{simulator.host}:{simulator.port}/7"
+        before = error_responses(device)
+        assert test.read_register_map(BENCH_MAP, function_code=3, slave=7) == {}
+        assert test.read_int16(200, 1) is None
+        assert error_responses(device) - before == 3
+
+
+def test_raised_operations_count_as_failures():
+    def operation(i):
+        if i % 2:
+            raise ConnectionError("no response")
+        return i % 4 != 0
+
+    result = run_scenario("raises", operation, SimulatedDevices(), 8, warmup=2)
+    assert result["operations"] == 8
+    assert result["failures"] == 6
+
+
+# Regression: injected errors and drops used to end the TCP scenarios with an exception.
+def test_benchmark_runs_with_injected_errors_and_drops(tmp_path):
+    run = modbus_benchmark.main(["--scenarios", "tcp", "--operations", "40", "--warmup", "2", "--error-rate", "0.3",
+                                 "--drop-rate", "0.1", "--timeout", "0.05", "--seed", "7", "--output", str(tmp_path)])
+    scenarios = {scenario["name"]: scenario for scenario in run["scenarios"]}
+    assert set(scenarios) == {"tcp_read_int16", "tcp_read_register_map"}
+    for scenario in scenarios.values():
+        assert scenario["operations"] == 40
+        assert scenario["device_errors"] + scenario["dropped"] > 0
+        assert 0 < scenario["failures"] < 40
+    assert len(list(tmp_path.iterdir())) == 1
+
+# End of file: testing/modbusTCP/test_modbus_tcp.py
@@ -0,0 +1,73 @@
+#
+# This module is used to test the pipelined Modbus TCP client against the TCP simulator.
+#
+
+import asyncio
+
+import pytest
+
+from protocols.modbusTCP.modbus_tcp_pipeline import MBAP, ModbusExceptionResponse, PipelinedModbusTcpClient
+from testing.benchmark.modbus_simulator import DataBank, DeviceBehaviour, ModbusTcpSimulator
+
+
+def test_pipelined_reads_are_matched_by_transaction_id():
+    async def read(host, port):
+        async with PipelinedModbusTcpClient(host, port, max_in_flight=4) as client:
+            return await asyncio.gather(*(client.read_registers(1, address, 2, 3) for address in range(0, 20, 2)))
+
+    with ModbusTcpSimulator(DataBank(holding={i: 100 + i for i in range(20)}), DeviceBehaviour(0.005, 0.004, seed=1)) \
+            as simulator:
+        blocks = asyncio.run(read(simulator.host, simulator.port))
+    assert blocks == [[100 + address, 101 + address] for address in range(0, 20, 2)]
+
+
+def test_exception_responses_raise():
+    async def read(host, port):
+        async with PipelinedModbusTcpClient(host, port) as client:
+            await client.read_registers(1, 0, 1)
+
+    with ModbusTcpSimulator(behaviour=DeviceBehaviour(error_rate=1.0)) as simulator:
+        with pytest.raises(ModbusExceptionResponse):
+            asyncio.run(read(simulator.host, simulator.port))
+
+
+# A server whose first answer has an MBAP length of 0, then answers every read normally.
+async def malformed_server():
+    connections = []
+
+    async def serve(reader, writer):
+        connections.append(writer)
+        while True:
+            try:
+                transaction, _, length, unit = MBAP.unpack(await reader.readexactly(MBAP.size))
+                await reader.readexactly(length - 1)
+            except asyncio.IncompleteReadError:
+                return
+            if len(connections) == 1:
+                writer.write(MBAP.pack(transaction, 0, 0, unit))
+            else:
+                writer.write(MBAP.pack(transaction, 0, 5, unit) + bytes((3, 2, 0, 42)))
+
+    server = await asyncio.start_server(serve, "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1], connections
+
+
+def test_malformed_frame_drops_the_connection_and_fails_in_flight_requests():
+    async def test():
+        server, port, connections = await malformed_server()
+        async with server:
+            client = PipelinedModbusTcpClient("127.0.0.1", port, timeout=5.0)
+            await client.connect()
+            with pytest.raises(ConnectionError):
+                await asyncio.wait_for(client.read_registers(1, 0, 1, 3), 1.0)
+            assert not client.connected
+            with pytest.raises(ConnectionError):
+                await client.read_registers(1, 0, 1, 3)
+            await client.connect()
+            values = await client.read_registers(1, 0, 1, 3)
+            await client.close()
+        return values, len(connections)
+
+    assert asyncio.run(test()) == ([42], 2)
+
+# End of file: testing/modbusTCP/test_modbus_tcp_pipeline.py
@@ -0,0 +1,138 @@
+#
+# This module is used to test the MQTT bridge against the local broker stand-in.
+#
+
+import json
+import time
+
+import pytest
+
+pytest.importorskip("paho.mqtt.client")
+
+from protocols.mqtt.mqtt_bridge import BLOCK, PACKED, SPILL, MqttBridge, SpillQueue, decode_packed, encode_packed
+from testing.benchmark.mqtt_broker import MqttBrokerStandIn
+
+
+def wait_until(condition, timeout: float = 10.0) -> bool:
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+# A port nothing listens on, free to start a broker on later.
+def free_port() -> int:
+    with MqttBrokerStandIn() as broker:
+        return broker.port
+
+
+def start_bridge(port: int, **kwargs) -> MqttBridge:
+    bridge = MqttBridge("127.0.0.1", port, **kwargs)
+    bridge.start()
+    bridge._client.reconnect_delay_set(1, 1)
+    return bridge
+
+
+def test_window_limits_unacknowledged_messages(tmp_path):
+    with MqttBrokerStandIn(ack_delay=0.3) as broker:
+        bridge = start_bridge(broker.port, max_in_flight=2, spill_dir=str(tmp_path))
+        try:
+            for i in range(6):
+                assert bridge.submit(f"unit{i}", {"value": i})
+            assert broker.wait_for(2)
+            time.sleep(0.15)
+            # The first two are still waiting for their acknowledgement.
+            assert len(broker.messages) == 2
+            assert bridge.in_flight == 2
+            assert broker.wait_for(6)
+            assert wait_until(lambda: bridge.acknowledged == 6)
+        finally:
+            bridge.stop()
+        assert bridge.in_flight == 0
+        assert [message.topic for message in broker.messages] == [f"uiot/unit{i}" for i in range(6)]
+
+
+def test_message_refused_while_disconnected_is_sent_once_after_reconnect(tmp_path):
+    broker = MqttBrokerStandIn()
+    broker.start()
+    port = broker.port
+    bridge = start_bridge(port, spill_dir=str(tmp_path))
+    try:
+        assert wait_until(bridge._connected.is_set)
+        broker.stop()
+        assert wait_until(lambda: not bridge._connected.is_set())
+        # Let the publisher hand a QoS 1 message to paho while the connection is down.
+        bridge._connected.set()
+        assert bridge.submit("unit1", {"value": 1})
+        assert wait_until(lambda: bridge.published == 1)
+        assert bridge.in_flight == 1
+        with MqttBrokerStandIn(port=port) as restarted:
+            assert restarted.wait_for(1)
+            assert wait_until(lambda: bridge.acknowledged == 1)
+            time.sleep(0.2)
+            assert len(restarted.messages) == 1
+            assert bridge.in_flight == 0
+            assert len(bridge.queue) == 0
+    finally:
+        bridge.stop()
+
+
+def test_outage_spills_to_disk_and_is_published_in_order(tmp_path):
+    port = free_port()
+    bridge = start_bridge(port, max_queue=2, overflow=SPILL, spill_dir=str(tmp_path), payload_format=PACKED)
+    for i in range(5):
+        assert bridge.submit("unit1", {"value": i}, timestamp=float(i))
+    assert bridge.queue.spilled == 3
+    assert len(bridge.queue) == 5
+    bridge.stop(timeout=0.1)
+
+    # Everything still queued is kept on disk for the next run, oldest first.
+    queue = SpillQueue(10, SPILL, str(tmp_path))
+    try:
+        assert len(queue) == 5
+        messages = [queue.get(timeout=0.1) for _ in range(5)]
+        assert [decode_packed(message.payload)[1]["value"] for message in messages] == list(range(5))
+        for message in reversed(messages):
+            queue.requeue(message)
+    finally:
+        queue.close()
+
+    with MqttBrokerStandIn(port=port) as broker:
+        bridge = start_bridge(port, overflow=SPILL, spill_dir=str(tmp_path), payload_format=PACKED)
+        try:
+            assert broker.wait_for(5)
+        finally:
+            bridge.stop()
+        assert [decode_packed(message.payload)[1]["value"] for message in broker.messages] == list(range(5))
+
+
+def test_packed_payload_sends_out_of_range_ints_as_text():
+    values = {"small": -5, "big": 2 ** 64, "flag": True}
+    assert decode_packed(encode_packed(1.0, values)) == (1.0, {"small": -5, "big": str(2 ** 64), "flag": True})
+    with pytest.raises(ValueError):
+        encode_packed(1.0, {"x" * 256: 1})
+
+
+def test_long_names_fall_back_to_json(tmp_path):
+    bridge = MqttBridge(payload_format=PACKED, overflow=SPILL, spill_dir=str(tmp_path))
+    try:
+        assert bridge.submit("unit1", {"x" * 256: 1}, timestamp=2.0)
+        assert json.loads(bridge.queue.get(timeout=0)[1]) == {"t": 2.0, "d": "unit1", "v": {"x" * 256: 1}}
+    finally:
+        bridge.queue.close()
+
+
+# A change dropped by a full queue is not marked as reported, so the next cycle sends it.
+def test_dropped_changes_are_submitted_again():
+    bridge = MqttBridge(max_queue=1, overflow=BLOCK, publish_on_change=True)
+    assert bridge.submit("unit1", {"a": 1}, timestamp=1.0)
+    assert not bridge.submit("unit1", {"a": 1, "b": 2}, timestamp=2.0, timeout=0)
+    bridge.queue.get(timeout=0)
+    assert bridge.submit("unit1", {"a": 1, "b": 2}, timestamp=3.0)
+    assert json.loads(bridge.queue.get(timeout=0)[1])["v"] == {"b": 2}
+    assert bridge.submit("unit1", {"a": 1, "b": 2}, timestamp=4.0)
+    assert bridge.unchanged == 1 and not len(bridge.queue)
+
+# End of file: testing/mqtt/test_mqtt_bridge.py
@@ -0,0 +1,56 @@
+#
+# This module is used to test the command line test runner in main.py.
+#
+
+import pytest
+
+import main
+
+SCRIPTS = {
+    "protocols/modbusTCP/fast_test.py": "if __name__ == '__main__':\n    print('fast')\n",
+    "protocols/modbusTCP/helpers.py": "VALUE = 1\n",
+    "protocols/mqtt/broken_test.py": "import sys\n\nif __name__ == \"__main__\":\n    sys.exit(3)\n",
+    "devices/huawei/slow_test.py": "import time\n\nif __name__ == '__main__':\n    time.sleep(30)\n",
+    "devices/_private/hidden_test.py": "if __name__ == '__main__':\n    pass\n",
+}
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for name, source in SCRIPTS.items():
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(source)
+    return tmp_path
+
+
+def test_scripts_with_a_main_guard_are_discovered_without_importing(tree):
+    targets = main.discover(str(tree))
+    assert [target.name for target in targets] == [
+        "protocols/modbusTCP/fast_test", "protocols/mqtt/broken_test", "devices/huawei/slow_test"]
+    assert [target.name for target in main.select(targets, ["*fast*", "broken_test"])] == [
+        "protocols/modbusTCP/fast_test", "protocols/mqtt/broken_test"]
+    with pytest.raises(ValueError):
+        main.select(targets, ["missing*"])
+
+
+def test_targets_run_in_parallel_processes_with_timeouts(tree):
+    targets = main.discover(str(tree))
+    reported = []
+    start = main.time.perf_counter()
+    results = main.run_tests(targets, jobs=3, timeout=2.0, report=reported.append)
+    elapsed = main.time.perf_counter() - start
+    assert [result.status for result in results] == ["timeout", "ok", "failed (3)"]
+    assert results[1].output.strip() == "fast"
+    assert len(reported) == 3 and elapsed < 10
+    summary = main.format_summary(results, elapsed)
+    assert "1 of 3 passed" in summary
+
+
+def test_list_prints_the_repository_tests(capsys):
+    assert main.main(["--list", "modbus*"]) == 0
+    assert capsys.readouterr().out.split() == ["protocols/modbusRTU/modbus_rtu_test"]
+    assert main.main(["no_such_test"]) == 2
+    assert main.test_environment()["PYTHONPATH"].split(main.os.pathsep)[0] == main.ROOT
+
+# End of file: testing/runner/test_main.py
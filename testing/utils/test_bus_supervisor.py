@@ -0,0 +1,73 @@
+#
+# This module is used to test the bus worker poll loop and the supervisor against the TCP simulator.
+#
+
+import time
+
+from pymodbus.constants import Endian
+
+from testing.benchmark.modbus_simulator import DataBank, ModbusTcpSimulator
+from utils.bus_supervisor import BusSpec, BusSupervisor, _poll_plan
+from utils.register_planner import READ_HOLDING_REGISTERS
+from utils.register_writer import encode_setpoints, plan_writes
+
+REGISTER_MAP = [(0, 1, "uint16", "status"), (1, 2, "float32", "power")]
+WRITE_MAP = [(100, 1, "uint16", "command"), (101, 1, "uint16", "limit")]
+
+
+def writes(setpoints):
+    return tuple(plan_writes(encode_setpoints(WRITE_MAP, setpoints, Endian.BIG, Endian.BIG)))
+
+
+def test_units_are_read_then_written():
+    calls = []
+    memory = {0: 1, 1: 0x3FC0, 2: 0}
+
+    def read(unit, block):
+        calls.append(("read", unit, block.address))
+        return None if unit == 2 else [memory.get(block.address + i, 0) for i in range(block.count)]
+
+    def write(unit, address, registers):
+        calls.append(("write", unit, address, registers))
+        memory.update((address + i, register) for i, register in enumerate(registers))
+        return unit != 2
+
+    spec = BusSpec("bus", "", {}, (1, 2), REGISTER_MAP, function_code=READ_HOLDING_REGISTERS,
+                   writes=writes({"command": 14, "limit": 3}), verify=True)
+    results = list(_poll_plan(spec, read, write)())
+    assert results[0] == (1, {"status": 1, "power": 1.5}, [])
+    assert results[1][1] == {}
+    assert results[1][2] == ["unit 2: reading 3 registers at 0 failed", "unit 2: writing command failed",
+                             "unit 2: writing limit failed"]
+    # One FC16 for both setpoints, read back with one FC3.
+    assert calls[:3] == [("read", 1, 0), ("write", 1, 100, [14, 3]), ("read", 1, 100)]
+
+
+def test_supervised_worker_polls_and_writes_setpoints():
+    bank = DataBank()
+    bank.load_map(REGISTER_MAP, {"status": 7, "power": 2.5})
+    with ModbusTcpSimulator(bank) as simulator:
+        spec = BusSpec("gateway", "utils.bus_supervisor:tcp_bus", dict(host=simulator.host, port=simulator.port),
+                       (1,), REGISTER_MAP, period=0.05, writes=writes({"command": 14, "limit": 3}))
+        with BusSupervisor([spec], batch_interval=0.05) as supervisor:
+            samples = []
+            for batch in supervisor.batches(timeout=20):
+                assert batch.bus == "gateway" and not batch.errors
+                samples.extend(batch.samples)
+                if samples:
+                    break
+        assert samples[0][0] == 1 and samples[0][2] == {"status": 7, "power": 2.5}
+        assert list(bank.holding[100:102]) == [14, 3]
+
+
+def test_crashed_workers_are_restarted():
+    spec = BusSpec("missing", "utils.bus_supervisor:tcp_bus", dict(host="127.0.0.1", port=1, timeout=0.1), (1,),
+                   REGISTER_MAP)
+    with BusSupervisor([spec], restart_delay=0.05) as supervisor:
+        end = time.monotonic() + 20
+        # A worker that cannot connect sends nothing; batches() restarts it while waiting.
+        while supervisor.restarts["missing"] < 2 and time.monotonic() < end:
+            list(supervisor.batches(timeout=0.2))
+        assert supervisor.restarts["missing"] >= 2
+
+# End of file: testing/utils/test_bus_supervisor.py
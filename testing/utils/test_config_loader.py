@@ -0,0 +1,73 @@
+#
+# This module is used to test loading register maps, cache policies and poll intervals from JSON configs.
+#
+
+import json
+import os
+
+import pytest
+
+from utils.config_loader import RegisterMap, load_cache_policies, load_poll_intervals, load_register_map
+from utils.register_cache import CachePolicy
+
+CONFIG = {"site": {"meter": {"registers": {
+    "r1": {"name": "energy", "type": "uint32", "address": 100, "length": 2, "poll_interval": 60},
+    "r2": {"name": "power", "type": "float32", "address": 102, "length": 2, "deadband": 0.5},
+    "status": {"type": "", "address": 200},
+}}}}
+
+
+@pytest.fixture
+def config(tmp_path):
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps(CONFIG))
+    return str(path)
+
+
+def test_register_map_is_loaded_from_a_section(config):
+    register_map = load_register_map(config, "site", "meter")
+    assert [(entry.address, entry.count, entry.decode, entry.name) for entry in register_map] == \
+        [(100, 2, "uint32", "energy"), (102, 2, "float32", "power"), (200, 1, None, "status")]
+    assert load_register_map(config, "site", "meter") is register_map
+    with pytest.raises(KeyError):
+        load_register_map(config, "site", "inverter")
+
+
+def test_changed_files_are_parsed_again(config):
+    first = load_register_map(config, "site", "meter")
+    changed = json.loads(json.dumps(CONFIG))
+    changed["site"]["meter"]["registers"]["extra"] = {"type": "int16", "address": 300, "length": 1}
+    with open(config, "w") as file:
+        json.dump(changed, file)
+    os.utime(config, ns=(0, os.stat(config).st_mtime_ns + 1))
+    assert "extra" in load_register_map(config, "site", "meter") and "extra" not in first
+
+
+def test_invalid_registers_are_rejected(tmp_path):
+    path = tmp_path / "bad.json"
+    path.write_text(json.dumps({"registers": {"x": {"type": "uint16"}}}))
+    with pytest.raises(ValueError):
+        load_register_map(str(path))
+    with pytest.raises(ValueError):
+        RegisterMap([(0, 1, "uint16", "a"), (1, 1, "uint16", "a")])
+
+
+def test_cache_policies_and_poll_intervals(config):
+    assert load_cache_policies(config, "site", "meter") == {"power": CachePolicy(deadband=0.5)}
+    assert load_poll_intervals(config, "site", "meter") == {"energy": 60.0}
+
+
+def test_register_map_lookups():
+    register_map = RegisterMap([(110, 4, None, "serial"), (100, 2, "uint32", "energy"), (102, 1, "int16", "power")])
+    assert [entry.name for entry in register_map] == ["energy", "power", "serial"]
+    assert register_map["power"].address == 102 and register_map.get("missing") is None
+    assert register_map.at(110).name == "serial" and register_map.at(111) is None
+    assert register_map.covering(101).name == "energy" and register_map.covering(113).name == "serial"
+    assert register_map.covering(105) is None
+    assert [entry.name for entry in register_map.between(100, 110)] == ["energy", "power"]
+    plan = register_map.plan(max_gap=8)
+    assert register_map.plan(max_gap=8) is plan
+    assert [(block.address, block.count) for block in plan] == [(100, 14)]
+    assert [(block.address, block.count) for block in register_map.plan()] == [(100, 3), (110, 4)]
+
+# End of file: testing/utils/test_config_loader.py
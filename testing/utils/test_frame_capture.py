@@ -0,0 +1,73 @@
+#
+# This module is used to test raw frame capture and its replay through the decode pipeline.
+#
+
+import pytest
+
+from protocols.modbusTCP.modbus_tcp_test import ModbusTcpTest
+from testing.benchmark.modbus_benchmark import BENCH_MAP, BENCH_VALUES
+from testing.benchmark.modbus_simulator import DataBank, ModbusTcpSimulator
+from utils.frame_capture import (REQUEST, RESPONSE, RTU, TCP, CaptureReader, CaptureWriter, ReplayDecoder, paced)
+
+
+def test_captured_session_replays_to_the_same_values(tmp_path):
+    path = str(tmp_path / "session.cap")
+    bank = DataBank()
+    bank.load_map(BENCH_MAP, BENCH_VALUES)
+    with ModbusTcpSimulator(bank) as simulator:
+        test = ModbusTcpTest(capture=path)
+        assert test.connect(simulator.host, simulator.port)
+        live = test.read_register_map(BENCH_MAP, function_code=3)
+        assert test.disconnect()
+    with CaptureReader(path) as reader:
+        assert reader.link == TCP and reader.start_time > 0
+        transactions = reader.transactions()
+    assert len(transactions) == 3
+    assert all(transaction.response is not None and transaction.latency >= 0 for transaction in transactions)
+    decoder = ReplayDecoder(BENCH_MAP)
+    replayed = {}
+    for timestamp, unit, values in decoder.decode(transactions, start_time=1000.0):
+        assert unit == 1 and timestamp >= 1000.0
+        replayed.update(values)
+    assert replayed == live == pytest.approx(BENCH_VALUES)
+    assert (decoder.decoded, decoder.skipped) == (3, 0)
+
+
+def test_rtu_frames_pair_requests_with_their_responses(tmp_path):
+    path = str(tmp_path / "bus.cap")
+    with CaptureWriter(path, RTU) as writer:
+        writer.record(REQUEST, b"\x01\x03\x00\x00\x00\x01\xaa\xbb")
+        # A response read in pieces is stored as one frame.
+        writer.record(RESPONSE, b"\x01\x03\x02")
+        writer.record(RESPONSE, b"\x00\x07\xcc\xdd")
+        writer.record(REQUEST, b"\x02\x03\x00\x00\x00\x01\xaa\xbb")
+    assert writer.frames == 3
+    with CaptureReader(path) as reader:
+        transactions = reader.transactions()
+    assert [(transaction.unit, transaction.response) for transaction in transactions] == \
+        [(1, b"\x03\x02\x00\x07"), (2, None)]
+    decoder = ReplayDecoder([(0, 1, "decode_16bit_uint", "status")])
+    assert [values for _, _, values in decoder.decode(transactions)] == [{"status": 7}]
+    assert decoder.skipped == 1
+
+
+def test_truncated_captures_keep_their_complete_frames(tmp_path):
+    path = tmp_path / "cut.cap"
+    with CaptureWriter(str(path), TCP) as writer:
+        writer.record(REQUEST, b"\x00\x01\x00\x00\x00\x06\x01\x03\x00\x00\x00\x01")
+        writer.record(RESPONSE, b"\x00\x01\x00\x00\x00\x05\x01\x03\x02\x00\x07")
+    path.write_bytes(path.read_bytes()[:-4])
+    with CaptureReader(str(path)) as reader:
+        assert [frame.direction for frame in reader] == [REQUEST]
+    (tmp_path / "other.bin").write_bytes(b"not a capture")
+    with pytest.raises(ValueError):
+        CaptureReader(str(tmp_path / "other.bin"))
+
+
+def test_paced_items_wait_for_their_time():
+    waits = []
+    items = list(paced([0.0, 1.0, 3.0], speed=2.0, time_of=lambda item: item, sleep=waits.append))
+    assert items == [0.0, 1.0, 3.0]
+    assert [round(wait, 1) for wait in waits] == [0.5, 1.5]
+
+# End of file: testing/utils/test_frame_capture.py
@@ -0,0 +1,92 @@
+#
+# This module is used to test the batched background logging.
+#
+
+import io
+import json
+import logging
+import queue
+import time
+
+import numpy as np
+
+from utils.logger import (BatchingFileHandler, FlushingQueueListener, LazyQueueHandler, Logger, SampleFormatter,
+                          log_sample, start_queue_logging, stop_queue_logging)
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_samples_are_formatted_as_json_lines():
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(SampleFormatter("%(levelname)s %(message)s"))
+    logger = logging.getLogger("test_logger.samples")
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        logger.setLevel(logging.INFO)
+        log_sample(logger, 7, {"power": 1.5, "name": b"SIM\x00", "raw": np.array([1, 2])})
+        logger.info("plain")
+        logger.setLevel(logging.WARNING)
+        log_sample(logger, 7, {"power": 2.0})
+    finally:
+        logger.removeHandler(handler)
+    sample, plain = stream.getvalue().splitlines()
+    assert json.loads(sample)["d"] == "7"
+    assert json.loads(sample)["v"] == {"power": 1.5, "name": "SIM", "raw": [1, 2]}
+    assert plain == "INFO plain"
+
+
+def test_full_queue_drops_records_instead_of_blocking():
+    handler = LazyQueueHandler(queue.Queue(2))
+    logger = logging.getLogger("test_logger.full")
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        for i in range(5):
+            logger.warning("record %d", i)
+    finally:
+        logger.removeHandler(handler)
+    assert handler.dropped == 3
+    # Records are queued unformatted.
+    assert handler.queue.get_nowait().args == (0,)
+
+
+def test_batched_records_reach_the_file_once_logging_goes_quiet(tmp_path):
+    path = tmp_path / "poll.log"
+    handler = BatchingFileHandler(str(path), batch_size=100, flush_interval=0.1)
+    logger = logging.getLogger("test_logger.batches")
+    logger.propagate = False
+    listener = start_queue_logging(logger, [handler])
+    try:
+        assert isinstance(listener, FlushingQueueListener) and listener.idle_timeout == 0.1
+        for i in range(3):
+            logger.warning("record %d", i)
+        assert wait_for(lambda: path.read_text().count("record") == 3)
+    finally:
+        stop_queue_logging(listener)
+        stop_queue_logging(listener)
+        logger.handlers.clear()
+        handler.close()
+
+
+def test_queued_logger_writes_everything_on_close(tmp_path):
+    logger = Logger("queued", str(tmp_path), logging.INFO, queued=True)
+    try:
+        for i in range(10):
+            logger.log(f"message {i}")
+        logger.log_sample("unit 1", {"power": 3})
+        logger.close()
+        text = (tmp_path / "queued.log").read_text()
+    finally:
+        logger.logger.handlers.clear()
+        logger.file_handler.close()
+    assert text.count("message") == 10
+    assert '"v":{"power":3}' in text
+
+# End of file: testing/utils/test_logger.py
@@ -0,0 +1,77 @@
+#
+# This module is used to test the earliest-deadline-first poll scheduler with a manual clock.
+#
+
+from utils.poll_scheduler import ONCE, DeadlineScheduler, PollTask
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+# A task run that records its name and takes duration seconds of the clock.
+def busy(clock, runs, name, duration):
+    def run():
+        runs.append(name)
+        clock.now += duration
+    return run
+
+
+def test_earliest_deadline_runs_first_and_priority_breaks_ties():
+    clock, runs = Clock(), []
+    scheduler = DeadlineScheduler([PollTask("slow", 4.0, busy(clock, runs, "slow", 0.1)),
+                                   PollTask("fast", 1.0, busy(clock, runs, "fast", 0.1)),
+                                   PollTask("fast_low", 1.0, busy(clock, runs, "fast_low", 0.1), priority=-1),
+                                   PollTask("fast_high", 1.0, busy(clock, runs, "fast_high", 0.1), priority=1)],
+                                  clock=clock)
+    while len(runs) < 4:
+        assert scheduler.step() == 0.0
+    assert runs == ["fast_high", "fast", "fast_low", "slow"]
+    # Nothing is due until the fast tasks are released again at t=1.
+    assert scheduler.step() == 1.0 - clock.now
+
+
+def test_overdue_releases_are_skipped_not_run_late():
+    clock, runs = Clock(), []
+    scheduler = DeadlineScheduler([PollTask("hog", 1.0, busy(clock, runs, "hog", 3.5), priority=1),
+                                   PollTask("fast", 1.0, busy(clock, runs, "fast", 0.1))], clock=clock)
+    scheduler.step()
+    # fast's deadline (t=1) passed while hog held the bus until t=3.5: its releases
+    # at 0, 1 and 2 are skipped and the next one is due at t=3, with hog's.
+    scheduler.step()
+    report = scheduler.report()
+    assert report["fast"]["skipped"] == 3 and report["fast"]["runs"] == 0
+    assert report["hog"]["misses"] == 2
+    assert runs == ["hog", "hog"]
+
+
+def test_overdue_periodic_tasks_behind_a_late_run_once_task_are_skipped():
+    clock, runs = Clock(), []
+    scheduler = DeadlineScheduler([PollTask("identity", ONCE, busy(clock, runs, "identity", 0.1), deadline=1.0),
+                                   PollTask("fast", 2.0, busy(clock, runs, "fast", 0.1))], clock=clock)
+    clock.now = 5.0
+    scheduler.step()
+    report = scheduler.report()
+    assert runs == ["identity"]
+    assert report["fast"]["skipped"] == 2 and report["fast"]["runs"] == 0
+    assert report["identity"]["misses"] == 1 and report["identity"]["skipped"] == 0
+
+
+def test_low_priority_tasks_are_stretched_under_overload():
+    clock, runs = Clock(), []
+    scheduler = DeadlineScheduler([PollTask("fast", 1.0, busy(clock, runs, "fast", 0.5), priority=1),
+                                   PollTask("slow", 1.0, busy(clock, runs, "slow", 0.5))],
+                                  max_utilisation=0.8, clock=clock)
+    for _ in range(20):
+        wait = scheduler.step()
+        clock.now += wait
+    report = scheduler.report()
+    assert report["fast"]["stretch"] == 1.0
+    assert report["slow"]["stretch"] > 1.0
+    assert scheduler.utilisation() > 0.8
+
+# End of file: testing/utils/test_poll_scheduler.py
@@ -0,0 +1,68 @@
+#
+# This module is used to test publishing into and reading from the shared memory process image.
+#
+
+import math
+import os
+import threading
+
+import pytest
+
+from utils.process_image import ProcessImage, ProcessImageReader
+
+REGISTER_MAP = [(0, 2, "float32", "power"), (2, 1, "uint16", "status"), (3, 4, "string", "serial_number"),
+                (7, 2, None, "raw")]
+
+
+@pytest.fixture
+def image():
+    with ProcessImage(f"uiot_test_{os.getpid()}_{threading.get_ident()}", ["unit1", "unit2"], REGISTER_MAP) as image:
+        yield image
+
+
+def test_reader_sees_published_values(image):
+    with ProcessImageReader(image.name) as reader:
+        timestamp, _ = reader.read("unit1")
+        assert math.isnan(timestamp) and reader.generation("unit1") == 0
+        image.publish("unit1", {"power": 1.5, "status": 3, "serial_number": "AB12", "raw": [1, 2], "other": 9}, 10.0)
+        assert reader.generation("unit1") == 2
+        assert reader.read("unit1")[0] == 10.0
+        assert reader.read_dict("unit1") == {"power": 1.5, "status": 3, "serial_number": b"AB12", "raw": [1, 2]}
+        assert reader.column("status").tolist() == [3, 0]
+
+
+def test_values_that_do_not_fit_are_skipped(image):
+    with ProcessImageReader(image.name) as reader:
+        image.publish("unit1", {"power": [1, 2, 3], "status": 1 << 20, "serial_number": "AB", "raw": "x"}, 5.0)
+        assert image.rejected == 3
+        assert reader.read_dict("unit1")["serial_number"] == b"AB"
+        assert reader.generation("unit1") == 2
+        image.publish("unit1", {"power": "2.5", "status": 7.0}, 6.0)
+        assert reader.read_dict("unit1")["power"] == 2.5 and reader.read_dict("unit1")["status"] == 7
+
+
+def test_concurrent_reads_are_never_torn(image):
+    stop = threading.Event()
+
+    def publish():
+        i = 0
+        while not stop.is_set():
+            i += 1
+            image.publish("unit2", {"power": float(i), "status": i & 0xFFFF, "raw": [i & 0xFFFF] * 2}, float(i))
+
+    writer = threading.Thread(target=publish)
+    writer.start()
+    try:
+        with ProcessImageReader(image.name) as reader:
+            for _ in range(2000):
+                timestamp, values = reader.read("unit2")
+                if not math.isnan(timestamp):
+                    assert values["power"] == timestamp
+                    assert values["status"] == int(timestamp) & 0xFFFF == values["raw"][0]
+    finally:
+        stop.set()
+        writer.join()
+    with pytest.raises(KeyError):
+        image.publish("unit9", {})
+
+# End of file: testing/utils/test_process_image.py
@@ -0,0 +1,82 @@
+#
+# This module is used to test the read-through register cache and its change events.
+#
+
+from utils.register_cache import CachedReader, CachePolicy, RegisterCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_only_values_past_the_deadband_are_reported():
+    cache = RegisterCache(policies={"power": CachePolicy(deadband=5), "voltage": CachePolicy(deadband_percent=1)})
+    events = []
+    cache.subscribe(events.append)
+    assert cache.put("inverter", "power", 100).previous is None
+    assert cache.put("inverter", "power", 104) is None
+    # The deadband is measured from the last reported value, so slow drift is reported eventually.
+    assert cache.put("inverter", "power", 106).previous == 100
+    assert cache.put("inverter", "voltage", 230.0) is not None
+    assert cache.put("inverter", "voltage", 232.0) is None
+    assert cache.put("inverter", "voltage", 232.4) is not None
+    assert cache.update("inverter", {"power": 107, "status": "ok"}) == {"status": "ok"}
+    assert [(event.key, event.value) for event in events] == [
+        ("power", 100), ("power", 106), ("voltage", 230.0), ("voltage", 232.4), ("status", "ok")]
+    assert cache.changes("inverter", {"power": 120, "status": "ok", "alarm": 0}) == {"power": 120, "alarm": 0}
+    assert cache.get("inverter", "alarm", max_age=10) is None
+
+
+def test_values_expire_after_max_age_and_on_invalidate():
+    clock = Clock()
+    cache = RegisterCache(default_policy=CachePolicy(max_age=1.0), clock=clock)
+    reads = []
+
+    def reader():
+        reads.append(clock.now)
+        return len(reads)
+
+    assert cache.read_through("unit", 10, reader) == 1
+    clock.now = 0.5
+    assert cache.read_through("unit", 10, reader) == 1
+    assert cache.fresh("unit", [10])
+    clock.now = 1.6
+    assert cache.read_through("unit", 10, reader) == 2
+    cache.invalidate("unit")
+    assert not cache.fresh("unit", [10])
+    assert cache.read_through("unit", 10, reader) == 3
+    assert (cache.hits, reads) == (1, [0.0, 1.6, 1.6])
+
+
+def test_least_recently_used_values_are_evicted():
+    cache = RegisterCache(max_entries=2, default_policy=CachePolicy(max_age=60))
+    cache.put("a", 1, 1)
+    cache.put("b", 1, 2)
+    assert cache.get("a", 1) == 1
+    cache.put("c", 1, 3)
+    assert (len(cache), cache.evictions) == (2, 1)
+    assert cache.get("b", 1) is None and cache.get("a", 1) == 1
+
+
+def test_cached_reader_serves_reads_and_drops_them_on_write():
+    class Device:
+        calls = 0
+
+        def read_int16(self, address, count):
+            Device.calls += 1
+            return [Device.calls] * count
+
+        def write_int16(self, address, values):
+            return True
+
+    reader = CachedReader(Device(), RegisterCache(policies={100: CachePolicy(max_age=60)}), "gw/1")
+    assert reader.read_int16(100, 2) == reader.read_int16(100, 2) == [1, 1]
+    assert reader.read_int16(200, 1) == [2]
+    assert reader.write_int16(100, [5])
+    assert reader.read_int16(100, 2) == [3, 3]
+
+# End of file: testing/utils/test_register_cache.py
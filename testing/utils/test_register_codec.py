@@ -0,0 +1,77 @@
+#
+# This module is used to test the struct register codecs against the NumPy decoder.
+#
+
+import itertools
+
+import pytest
+
+from utils.register_codec import compile_register_map, get_codec
+from utils.register_decoder import BatchDecoder, DecodeEntry, decode_array
+
+ORDERS = list(itertools.product(("big", "little"), repeat=2))
+
+# type: values that survive a round trip exactly.
+SAMPLES = {
+    "uint16": [0, 1, 0xABCD, 0xFFFF],
+    "int16": [-32768, -1, 0, 12345],
+    "uint32": [0, 0x12345678, 0xFFFFFFFF],
+    "int32": [-2 ** 31, -2, 0x01020304],
+    "uint64": [0, 0x0102030405060708, 2 ** 64 - 1],
+    "int64": [-2 ** 63, -3, 2 ** 40 + 7],
+    "float16": [0.0, -1.5, 0.25],
+    "float32": [0.0, -2.5, 1234.125],
+    "float64": [0.0, -1e300, 3.141592653589793],
+    "int8": [-128, -1, 0, 127],
+    "uint8": [0, 200, 255],
+}
+
+
+@pytest.mark.parametrize("byteorder, wordorder", ORDERS)
+@pytest.mark.parametrize("kind", sorted(SAMPLES))
+def test_values_round_trip_through_codec_and_decoder(kind, byteorder, wordorder):
+    codec = get_codec(kind, byteorder=byteorder, wordorder=wordorder)
+    registers = codec.encode_values(SAMPLES[kind])
+    assert len(registers) == codec.count * len(SAMPLES[kind])
+    assert [codec.decode(registers, offset) for offset in range(0, len(registers), codec.count)] == SAMPLES[kind]
+    wire = b"".join(register.to_bytes(2, "big") for register in registers)
+    assert [codec.decode_bytes(wire, 2 * offset) for offset in range(0, len(registers), codec.count)] == SAMPLES[kind]
+    assert decode_array(registers, kind, byteorder, wordorder).tolist() == SAMPLES[kind]
+
+
+def test_orders_move_bytes_and_words():
+    value = 0x01020304
+    assert get_codec("uint32").encode(value) == [0x0102, 0x0304]
+    assert get_codec("uint32", wordorder="little").encode(value) == [0x0304, 0x0102]
+    assert get_codec("uint32", byteorder="little").encode(value) == [0x0201, 0x0403]
+    assert get_codec("uint32", byteorder="<", wordorder="<").encode(value) == [0x0403, 0x0201]
+    assert get_codec("decode_32bit_uint") is get_codec("decode_32bit_uint")
+    assert get_codec("u32").encode(value) == get_codec("decode_32bit_uint").encode(value)
+
+
+def test_strings_and_bits():
+    text = get_codec("string", count=3)
+    assert text.decode(text.encode("SIM")) == "SIM"
+    assert text.encode("TOO LONG") == text.encode("TOO LON")
+    bits = get_codec("bits")
+    flags = [True, False, True] + [False] * 5
+    assert bits.decode(bits.encode(flags)) == flags
+
+
+def test_batch_decoder_matches_the_compiled_register_map():
+    register_map = [(0, 2, "decode_32bit_float", "power"), (2, 1, "decode_16bit_int", "status"),
+                    (3, 2, "string", "name"), (5, 1, None, "raw")]
+    codecs = compile_register_map(register_map, "little", "little")
+    assert compile_register_map(register_map, "little", "little") is codecs
+    values = {"power": 2.5, "status": -7, "name": "AB"}
+    registers = [register for name in ("power", "status", "name") for register in codecs[name].encode(values[name])]
+    registers.append(99)
+    decoder = BatchDecoder([DecodeEntry(name, address, kind, count) for address, count, kind, name in register_map],
+                           "little", "little")
+    assert decoder.decode(registers) == {**values, "raw": [99]}
+    rows = decoder.decode([registers, registers])
+    assert rows["status"].tolist() == [-7, -7] and rows["name"] == ["AB", "AB"]
+    with pytest.raises(ValueError):
+        decoder.decode(registers[:3])
+
+# End of file: testing/utils/test_register_codec.py
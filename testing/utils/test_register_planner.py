@@ -0,0 +1,54 @@
+#
+# This module is used to test the coalescing register read planner.
+#
+
+import pytest
+
+from utils.register_planner import (MAX_READ_REGISTERS, READ_HOLDING_REGISTERS, RegisterRead, plan_reads,
+                                    planned_register_count)
+
+REGISTER_MAP = [
+    (30, 2, "decode_32bit_float", "power"),
+    (10, 1, "decode_16bit_int", "status"),
+    (11, 1, "decode_16bit_int", "alarm"),
+    (15, 2, "decode_32bit_uint", "energy"),
+]
+
+
+def test_adjacent_entries_share_a_block_in_address_order():
+    plan = plan_reads(REGISTER_MAP)
+    assert [(block.address, block.count) for block in plan] == [(10, 2), (15, 2), (30, 2)]
+    assert [entry.name for entry in plan[0].entries] == ["status", "alarm"]
+
+
+def test_gaps_up_to_max_gap_are_read_through():
+    plan = plan_reads(REGISTER_MAP, max_gap=3, function_code=READ_HOLDING_REGISTERS)
+    assert [(block.address, block.count) for block in plan] == [(10, 7), (30, 2)]
+    assert {block.function_code for block in plan} == {READ_HOLDING_REGISTERS}
+    assert planned_register_count(plan) == 9
+    assert plan[0].split(list(range(7))) == {"status": [0], "alarm": [1], "energy": [5, 6]}
+    assert len(plan_reads(REGISTER_MAP, max_gap=13)) == 1
+
+
+def test_blocks_stop_at_the_request_limit():
+    register_map = [(address, 2, "decode_32bit_float", f"value_{address}") for address in range(0, 300, 2)]
+    plan = plan_reads(register_map)
+    assert [block.count for block in plan] == [124, 124, 52]
+    assert all(block.count <= MAX_READ_REGISTERS for block in plan)
+    assert sum(len(block.entries) for block in plan) == len(register_map)
+    assert [block.count for block in plan_reads(register_map, max_count=100)] == [100, 100, 100]
+
+
+def test_invalid_entries_and_limits_are_rejected():
+    with pytest.raises(ValueError):
+        plan_reads([RegisterRead(0, MAX_READ_REGISTERS + 1, None, "too_long")])
+    with pytest.raises(ValueError):
+        plan_reads([(0, 0, None, "empty")])
+    with pytest.raises(ValueError):
+        plan_reads(REGISTER_MAP, max_count=MAX_READ_REGISTERS + 1)
+    with pytest.raises(ValueError):
+        plan_reads(REGISTER_MAP, max_gap=-1)
+    with pytest.raises(ValueError):
+        plan_reads(REGISTER_MAP)[0].split([1])
+
+# End of file: testing/utils/test_register_planner.py
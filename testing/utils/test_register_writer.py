@@ -0,0 +1,68 @@
+#
+# This module is used to test batched setpoint writes and their read-back.
+#
+
+import pytest
+
+from utils.register_writer import MAX_WRITE_REGISTERS, WritePoint, encode_setpoints, execute_writes, plan_writes
+
+WRITE_MAP = [
+    (100, 2, "decode_32bit_float", "power_limit"),
+    (102, 1, "decode_16bit_int", "mode"),
+    (110, 1, None, "reset"),
+]
+
+
+def points(addresses, count=1):
+    return [WritePoint(f"p{address}", address, 0, (address,) * count) for address in addresses]
+
+
+def test_setpoints_are_encoded_with_the_map_types():
+    encoded = {point.name: point for point in encode_setpoints(WRITE_MAP, {"power_limit": 1.5, "mode": -2, "reset": 1})}
+    assert encoded["power_limit"].registers == (0x3FC0, 0)
+    assert encoded["mode"].registers == (0xFFFE,)
+    assert encoded["reset"].registers == (1,)
+    with pytest.raises(KeyError):
+        encode_setpoints(WRITE_MAP, {"missing": 1})
+    with pytest.raises(ValueError):
+        encode_setpoints(WRITE_MAP, {"reset": [1, 2]})
+
+
+def test_only_back_to_back_points_share_a_request():
+    plan = plan_writes(encode_setpoints(WRITE_MAP, {"reset": 1, "mode": 3, "power_limit": 2.0}))
+    assert [(block.address, block.count) for block in plan] == [(100, 3), (110, 1)]
+    with pytest.raises(ValueError):
+        plan_writes(points([0, 0]))
+
+
+def test_requests_split_at_123_registers():
+    plan = plan_writes(points(range(0, 250, 2), count=2))
+    assert [block.count for block in plan] == [122, 122, 6]
+    assert all(block.count <= MAX_WRITE_REGISTERS for block in plan)
+    assert [block.count for block in plan_writes(points(range(250)))] == [123, 123, 4]
+    with pytest.raises(ValueError):
+        plan_writes(points([0]), max_count=MAX_WRITE_REGISTERS + 1)
+
+
+def test_writes_are_read_back_and_compared():
+    device = {}
+
+    def write(address, registers):
+        if address == 110:
+            return False
+        for offset, register in enumerate(registers):
+            # The device clamps the mode register.
+            device[address + offset] = min(register, 5) if address + offset == 102 else register
+        return True
+
+    def read(address, count):
+        return [device.get(address + offset, 0) for offset in range(count)]
+
+    plan = plan_writes(encode_setpoints(WRITE_MAP, {"power_limit": 2.0, "mode": 9, "reset": 1}))
+    results = execute_writes(plan, write, read)
+    assert {name: (result.written, result.verified, result.ok) for name, result in results.items()} == {
+        "power_limit": (True, True, True), "mode": (True, False, False), "reset": (False, None, False)}
+    assert results["mode"].read_back == [5]
+    assert all(result.verified is None for result in execute_writes(plan, write).values())
+
+# End of file: testing/utils/test_register_writer.py
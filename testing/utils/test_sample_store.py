@@ -0,0 +1,51 @@
+#
+# This module is used to test the memory-mapped sample store.
+#
+
+import json
+import math
+
+from utils.sample_store import FLAG_ERROR, HEADER, SEGMENT_UNSORTED, SampleReader, SampleWriter
+
+
+def test_scan_returns_one_register_in_a_time_range(tmp_path):
+    with SampleWriter(str(tmp_path), segment_records=4) as writer:
+        for i in range(10):
+            writer.append_values("unit1", {"power": float(i), "status": i, "name": "skipped"}, timestamp=100.0 + i)
+        writer.append("unit2", "power", None, timestamp=120.0)
+    reader = SampleReader(str(tmp_path))
+    assert reader.names() == (["unit1", "unit2"], ["power", "status"])
+    columns = reader.scan("power", "unit1", start=103.0, end=107.0)
+    assert columns.t.tolist() == [103.0, 104.0, 105.0, 106.0]
+    assert columns.value.tolist() == [3.0, 4.0, 5.0, 6.0]
+    error = reader.scan("power", "unit2")
+    assert math.isnan(error.value[0]) and error.flags.tolist() == [FLAG_ERROR]
+    assert len(reader.scan("missing").t) == 0
+
+
+def test_new_names_are_saved_on_flush_not_per_name(tmp_path):
+    writer = SampleWriter(str(tmp_path))
+    try:
+        writer.append_values("unit1", {f"register_{i}": i for i in range(50)}, timestamp=1.0)
+        assert not (tmp_path / "index.json").exists()
+        writer.flush()
+        assert len(json.loads((tmp_path / "index.json").read_text())["registers"]) == 50
+        writer.append("unit2", "register_0", 1, timestamp=2.0)
+    finally:
+        writer.close()
+    assert SampleReader(str(tmp_path)).names()[0] == ["unit1", "unit2"]
+
+
+def test_samples_appended_out_of_order_are_still_found(tmp_path):
+    times = [10.0, 11.0, 12.0, 5.0, 6.0, 13.0]
+    with SampleWriter(str(tmp_path)) as writer:
+        for i, timestamp in enumerate(times):
+            writer.append("unit1", "power", i, timestamp=timestamp)
+    segment = next(tmp_path.glob("segment_*.dat"))
+    _, _, flags, count, first, last = HEADER.unpack(segment.read_bytes()[:HEADER.size])
+    assert (flags & SEGMENT_UNSORTED, count, first, last) == (SEGMENT_UNSORTED, 6, 5.0, 13.0)
+    reader = SampleReader(str(tmp_path))
+    assert reader.scan("power", start=5.5, end=12.0).t.tolist() == [10.0, 11.0, 6.0]
+    assert reader.scan("power", end=6.0).value.tolist() == [3.0]
+
+# End of file: testing/utils/test_sample_store.py
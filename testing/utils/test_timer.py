@@ -0,0 +1,67 @@
+#
+# This module is used to test the latency histograms and poll metrics.
+#
+
+import asyncio
+
+import pytest
+
+from utils.timer import EXCEPTION, RETRY, TIMEOUT, LatencyHistogram, PollMetrics, block_label
+
+
+def test_histogram_percentiles_come_from_bucket_bounds():
+    histogram = LatencyHistogram((0.001, 0.01, 0.1))
+    for seconds in [0.0005] * 90 + [0.005] * 9 + [0.05]:
+        histogram.observe(seconds)
+    snapshot = histogram.snapshot()
+    assert (snapshot["count"], snapshot["min"], snapshot["max"]) == (100, 0.0005, 0.05)
+    assert (snapshot["p50"], snapshot["p95"], snapshot["p99"]) == (0.001, 0.01, 0.01)
+    assert snapshot["buckets"] == {"0.001": 90, "0.01": 9, "0.1": 1, "+Inf": 0}
+    assert LatencyHistogram().percentile(99) == 0.0
+
+
+def test_measurements_record_latency_and_failures():
+    metrics = PollMetrics()
+    with metrics.time("gw/1", 3, block_label(100, 10)):
+        pass
+    with pytest.raises(TimeoutError):
+        with metrics.time("gw/1", 3, "100-109"):
+            raise TimeoutError
+    with pytest.raises(ValueError):
+        with metrics.time("gw/2", 4, "0-0"):
+            raise ValueError
+    metrics.count("gw/1", RETRY, 2)
+    snapshot = metrics.snapshot()
+    assert [(entry["device"], entry["function_code"], entry["block"], entry["count"])
+            for entry in snapshot["latency"]] == [("gw/1", 3, "100-109", 2), ("gw/2", 4, "0-0", 1)]
+    assert {(entry["device"], entry["event"]): entry["count"] for entry in snapshot["counters"]} == \
+        {("gw/1", RETRY): 2, ("gw/1", TIMEOUT): 1, ("gw/2", EXCEPTION): 1}
+    metrics.reset()
+    assert metrics.snapshot()["latency"] == []
+
+
+def test_measurements_decorate_sync_and_async_functions():
+    metrics = PollMetrics()
+
+    @metrics.time("gw/1", 3, "0-1")
+    def read():
+        return [1, 2]
+
+    @metrics.time("gw/1", 3, "0-1")
+    async def read_async():
+        return [3]
+
+    assert read() == [1, 2] and asyncio.run(read_async()) == [3]
+    assert metrics.snapshot()["latency"][0]["count"] == 2
+
+
+def test_prometheus_output_escapes_labels():
+    metrics = PollMetrics((0.1,))
+    metrics.observe(('COM6/"1"', 3, "0-1"), 0.05)
+    metrics.count("COM6/1", TIMEOUT)
+    text = metrics.to_prometheus()
+    assert 'modbus_request_seconds_bucket{device="COM6/\\"1\\"",function_code="3",block="0-1",le="0.1"} 1' in text
+    assert 'modbus_request_seconds_bucket{device="COM6/\\"1\\"",function_code="3",block="0-1",le="+Inf"} 1' in text
+    assert 'modbus_events_total{device="COM6/1",event="timeout"} 1' in text
+
+# End of file: testing/utils/test_timer.py
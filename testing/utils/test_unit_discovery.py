@@ -0,0 +1,43 @@
+#
+# This module is used to test unit id discovery against the Modbus TCP simulator.
+#
+
+from pymodbus.client import ModbusTcpClient
+
+from testing.benchmark.modbus_simulator import DataBank, ModbusTcpSimulator
+from utils.unit_discovery import AdaptiveTimeout, UnitDiscovery, get_timeout
+
+
+def test_timeout_follows_the_slowest_answer_within_its_bounds():
+    timeout = AdaptiveTimeout(initial=0.1, min_timeout=0.02, max_timeout=1.0, factor=3.0)
+    timeout.observe(0.01)
+    assert timeout.value == 0.1
+    timeout.observe(0.05)
+    assert abs(timeout.value - 0.15) < 1e-9
+    timeout.observe(0.01)
+    timeout.observe(2.0)
+    assert timeout.value == 1.0
+
+
+def test_scan_finds_the_live_units_and_saves_them(tmp_path):
+    path = str(tmp_path / "discovery.json")
+    with ModbusTcpSimulator(DataBank(), units=[2, 4]) as simulator:
+        client = ModbusTcpClient(simulator.host, port=simulator.port, timeout=2.0)
+        assert client.connect()
+        saved = get_timeout(client)
+        try:
+            discovery = UnitDiscovery(path, candidates=range(1, 6), initial_timeout=0.05, max_timeout=0.2)
+            assert sorted(discovery.scan("gw", client)) == [2, 4]
+            # Probing with short timeouts leaves the client's configured timeout alone.
+            assert get_timeout(client)[0] == saved[0] == 2.0
+            assert discovery.missing("gw") == [1, 3, 5]
+            simulator.units.add(3)
+            assert discovery.reprobe("gw", client, count=1) == []
+            assert discovery.reprobe("gw", client, count=1) == [3]
+        finally:
+            client.close()
+    reloaded = UnitDiscovery(path, candidates=range(1, 6))
+    assert reloaded.known("gw") == [2, 3, 4]
+    assert reloaded.known("other") == []
+
+# End of file: testing/utils/test_unit_discovery.py
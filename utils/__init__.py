@@ -0,0 +1,57 @@
+#
+# Shared helpers used by the protocol and device tests.
+#
+# Names are imported on first use, so `from utils import Logger` does not pull in
+# NumPy, asyncio or shared memory for a script that only needs the logger.
+#
+
+import importlib
+
+# Exported name: module it lives in.
+_EXPORTS = {
+    "Logger": "utils.logger",
+    "METRICS": "utils.timer",
+    "LatencyHistogram": "utils.timer",
+    "PollMetrics": "utils.timer",
+    "Timer": "utils.timer",
+    "MAX_READ_REGISTERS": "utils.register_planner",
+    "ReadBlock": "utils.register_planner",
+    "RegisterRead": "utils.register_planner",
+    "plan_reads": "utils.register_planner",
+    "RegisterCodec": "utils.register_codec",
+    "compile_register_map": "utils.register_codec",
+    "get_codec": "utils.register_codec",
+    "RegisterMap": "utils.config_loader",
+    "load_config": "utils.config_loader",
+    "load_register_map": "utils.config_loader",
+    "CachePolicy": "utils.register_cache",
+    "CachedReader": "utils.register_cache",
+    "RegisterCache": "utils.register_cache",
+    "SampleReader": "utils.sample_store",
+    "SampleWriter": "utils.sample_store",
+    "UnitDiscovery": "utils.unit_discovery",
+    "WriteResult": "utils.register_writer",
+    "encode_setpoints": "utils.register_writer",
+    "execute_writes": "utils.register_writer",
+    "plan_writes": "utils.register_writer",
+    "ONCE": "utils.poll_scheduler",
+    "DeadlineScheduler": "utils.poll_scheduler",
+    "PollTask": "utils.poll_scheduler",
+    "ProcessImage": "utils.process_image",
+    "ProcessImageReader": "utils.process_image",
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
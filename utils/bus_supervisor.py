@@ -0,0 +1,282 @@
+#
+# This module is used to poll each physical bus from its own worker process.
+#
+
+import importlib
+import logging
+import multiprocessing
+import time
+from multiprocessing.connection import Connection, wait
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+from utils.register_planner import READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS
+
+log = logging.getLogger(__name__)
+
+# Cycles in a row that may fail before a worker exits so it is restarted with a fresh connection.
+MAX_FAILED_CYCLES = 5
+
+
+# One physical bus and what to poll on it.
+# factory is 'module:function'; the function takes the BusSpec inside the worker
+# and returns a poll() callable yielding (unit, values, errors) for one cycle,
+# errors being the text of the unit's reads that failed.
+# options are passed to the factory (serial or TCP client settings).
+# writes is a setpoint write plan (register_writer.WriteBlock list) sent to every
+# unit after its reads, read back and compared when verify is set.
+class BusSpec(NamedTuple):
+    name: str
+    factory: str
+    options: Mapping[str, Any]
+    units: Sequence[int]
+    register_map: Sequence[Sequence]
+    period: float = 1.0
+    max_gap: int = 0
+    function_code: int = READ_INPUT_REGISTERS
+    byteorder: str = "big"
+    wordorder: str = "big"
+    writes: Sequence[Any] = ()
+    verify: bool = False
+
+
+# Results a worker sends back in one message.
+# samples holds (unit, unix timestamp, values) tuples; errors holds text of failed reads and cycles.
+class PollBatch(NamedTuple):
+    bus: str
+    samples: List[Tuple[int, float, Dict[str, object]]]
+    errors: List[str]
+
+
+def _resolve(factory: str) -> Callable[[BusSpec], Callable[[], Iterable[Tuple[int, Dict[str, object], List[str]]]]]:
+    module, _, name = factory.partition(":")
+    return getattr(importlib.import_module(module), name)
+
+
+# Send the spec's setpoint writes to a unit; returns the text of every write that failed.
+def _write_setpoints(spec: BusSpec, unit: int, write: Callable[[int, int, List[int]], bool],
+                     read: Callable[[int, Any], Optional[Sequence[int]]]) -> List[str]:
+    from utils.register_planner import ReadBlock
+    from utils.register_writer import execute_writes
+
+    def read_back(address, count):
+        return read(unit, ReadBlock(address, count, READ_HOLDING_REGISTERS, ()))
+
+    results = execute_writes(spec.writes, lambda address, registers: write(unit, address, registers),
+                             read_back if spec.verify else None)
+    return [f"unit {unit}: {'writing' if not result.written else 'verifying'} {result.name} failed"
+            for result in results.values() if not result.ok]
+
+
+# Decode a read plan block by block through a read(unit, block) callable returning registers or None,
+# then send the spec's writes through write(unit, address, registers), which returns whether it succeeded.
+def _poll_plan(spec: BusSpec, read: Callable[[int, Any], Optional[Sequence[int]]],
+               write: Optional[Callable[[int, int, List[int]], bool]] = None):
+    from utils.config_loader import RegisterMap
+    from utils.register_decoder import block_decoder
+
+    plan = RegisterMap(spec.register_map).plan(spec.max_gap, function_code=spec.function_code)
+
+    def poll():
+        for unit in spec.units:
+            values = {}
+            errors = []
+            for block in plan:
+                registers = read(unit, block)
+                if registers is None:
+                    errors.append(f"unit {unit}: reading {block.count} registers at {block.address} failed")
+                else:
+                    values.update(block_decoder(block, spec.byteorder, spec.wordorder).decode(registers))
+            if spec.writes and write is not None:
+                errors.extend(_write_setpoints(spec, unit, write, read))
+            yield unit, values, errors
+    return poll
+
+
+def _registers(response) -> Optional[List[int]]:
+    return None if response.isError() else response.registers
+
+
+# read(unit, block) and write(unit, address, registers) callables over a pymodbus client.
+def _client_io(client):
+    def read(unit, block):
+        if block.function_code == READ_HOLDING_REGISTERS:
+            return _registers(client.read_holding_registers(block.address, block.count, slave=unit))
+        return _registers(client.read_input_registers(block.address, block.count, slave=unit))
+
+    def write(unit, address, registers):
+        return not client.write_registers(address, registers, slave=unit).isError()
+    return read, write
+
+
+# Poll factory for a Modbus RTU port; options are ModbusSerialClient arguments.
+def rtu_bus(spec: BusSpec):
+    from pymodbus.client import ModbusSerialClient
+    from protocols.modbusRTU.rtu_bus_scheduler import RtuBusScheduler, inter_frame_gap
+
+    options = dict(spec.options)
+    client = ModbusSerialClient(**options)
+    scheduler = RtuBusScheduler(client, inter_frame_gap(options.get("baudrate", 19200), options.get("bytesize", 8),
+                                                        options.get("parity", "N"), options.get("stopbits", 1)))
+    if not scheduler.open():
+        raise ConnectionError(f"Failed to open serial port {options.get('port')}")
+    return _poll_plan(spec, *_client_io(client))
+
+
+# Poll factory for a Modbus TCP gateway; options are ModbusTcpClient arguments.
+def tcp_bus(spec: BusSpec):
+    from pymodbus.client import ModbusTcpClient
+
+    client = ModbusTcpClient(**spec.options)
+    if not client.connect():
+        raise ConnectionError(f"Failed to connect to {spec.options.get('host')}:{spec.options.get('port', 502)}")
+    return _poll_plan(spec, *_client_io(client))
+
+
+# Run one poll cycle, adding its samples and errors to the batch being built.
+def _cycle(spec: BusSpec, poll, samples: List[Tuple[int, float, Dict[str, object]]], errors: List[str]):
+    answered = unanswered = 0
+    for unit, values, unit_errors in poll():
+        errors.extend(unit_errors)
+        unanswered += len(unit_errors)
+        if values:
+            samples.append((unit, time.time(), values))
+            answered += 1
+    if unanswered and not answered:
+        # Not one read of the cycle succeeded: as good as a lost connection.
+        raise ConnectionError(f"no unit on {spec.name} answered")
+
+
+# Worker process: run the bus's poll loop and send results back in batches.
+def _worker(spec: BusSpec, connection: Connection, stop, batch_interval: float, batch_size: int):
+    poll = _resolve(spec.factory)(spec)
+    samples: List[Tuple[int, float, Dict[str, object]]] = []
+    errors: List[str] = []
+    failed = 0
+    last_send = time.monotonic()
+    try:
+        while not stop.is_set():
+            start = time.monotonic()
+            try:
+                _cycle(spec, poll, samples, errors)
+                failed = 0
+            except Exception as e:
+                failed += 1
+                errors.append(f"{type(e).__name__}: {e}")
+                if failed >= MAX_FAILED_CYCLES:
+                    raise
+            if len(samples) >= batch_size or time.monotonic() - last_send >= batch_interval:
+                connection.send(PollBatch(spec.name, samples, errors))
+                samples, errors = [], []
+                last_send = time.monotonic()
+            remaining = spec.period - (time.monotonic() - start)
+            if remaining > 0:
+                stop.wait(remaining)
+    finally:
+        if samples or errors:
+            connection.send(PollBatch(spec.name, samples, errors))
+        connection.close()
+
+
+# This class is used to run one worker process per bus and restart crashed workers.
+# Each bus (an RTU port or a TCP gateway) gets its own process and poll loop,
+# so buses no longer share one GIL. Workers stream PollBatch messages over a
+# pipe; batches() yields them in the parent as they arrive.
+class BusSupervisor:
+    def __init__(self, buses: Iterable[BusSpec], batch_interval: float = 0.2, batch_size: int = 500,
+                 restart_delay: float = 1.0, max_restart_delay: float = 30.0, start_method: str = "spawn"):
+        self.buses = {bus.name: bus for bus in buses}
+        self.batch_interval = batch_interval
+        self.batch_size = batch_size
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.restarts: Dict[str, int] = {name: 0 for name in self.buses}
+        self._context = multiprocessing.get_context(start_method)
+        self._stop = self._context.Event()
+        self._workers: Dict[str, Tuple[Any, Connection]] = {}
+        # bus name: monotonic time the worker may be started again.
+        self._pending: Dict[str, float] = {}
+        # bus name: (crashes in a row, monotonic start time of the current worker).
+        self._crashes: Dict[str, Tuple[int, float]] = {}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _spawn(self, name: str):
+        receiver, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(target=_worker, name=f"bus-{name}", daemon=True,
+                                        args=(self.buses[name], sender, self._stop, self.batch_interval,
+                                              self.batch_size))
+        process.start()
+        sender.close()
+        self._workers[name] = (process, receiver)
+        self._crashes[name] = (self._crashes.get(name, (0, 0.0))[0], time.monotonic())
+
+    def start(self):
+        self._stop.clear()
+        for name in self.buses:
+            self._spawn(name)
+
+    # Restart workers that died, waiting longer after each crash of the same bus.
+    def _supervise(self):
+        now = time.monotonic()
+        for name, (process, receiver) in list(self._workers.items()):
+            if process.is_alive():
+                continue
+            receiver.close()
+            del self._workers[name]
+            self.restarts[name] += 1
+            crashes, started = self._crashes[name]
+            # A worker that ran for a while starts the backoff over.
+            crashes = 1 if now - started > self.max_restart_delay else crashes + 1
+            self._crashes[name] = (crashes, started)
+            delay = min(self.restart_delay * 2 ** (crashes - 1), self.max_restart_delay)
+            log.error("Worker for bus %s exited with code %s, restarting in %.1fs", name, process.exitcode, delay)
+            self._pending[name] = now + delay
+        for name, due in list(self._pending.items()):
+            if now >= due:
+                del self._pending[name]
+                self._spawn(name)
+
+    # Yield batches as workers send them, until stop() or timeout seconds have passed.
+    def batches(self, timeout: Optional[float] = None) -> Iterator[PollBatch]:
+        end = None if timeout is None else time.monotonic() + timeout
+        while not self._stop.is_set():
+            if end is not None and time.monotonic() >= end:
+                return
+            receivers = [receiver for _, receiver in self._workers.values()]
+            if not receivers:
+                time.sleep(0.1)
+            for receiver in wait(receivers, timeout=0.1) if receivers else ():
+                try:
+                    yield receiver.recv()
+                except (EOFError, OSError):
+                    # The worker is gone; _supervise() restarts it.
+                    pass
+            self._supervise()
+
+    # Stop every worker and return the last batches they sent.
+    def stop(self, timeout: float = 5.0) -> List[PollBatch]:
+        self._stop.set()
+        remaining = []
+        end = time.monotonic() + timeout
+        for process, receiver in self._workers.values():
+            # Keep draining the pipe so a worker blocked on send can finish.
+            while time.monotonic() < end and (process.is_alive() or receiver.poll()):
+                if receiver.poll(0.05):
+                    try:
+                        remaining.append(receiver.recv())
+                    except (EOFError, OSError):
+                        break
+            if process.is_alive():
+                process.terminate()
+            process.join()
+            receiver.close()
+        self._workers.clear()
+        self._pending.clear()
+        return remaining
+
+# End of file: utils/bus_supervisor.py
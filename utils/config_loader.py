@@ -0,0 +1,177 @@
+#
+# This module is used to load device configs and their register maps.
+#
+
+import json
+import os
+from bisect import bisect_left, bisect_right
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+from utils.register_cache import CachePolicy
+from utils.register_planner import (MAX_READ_REGISTERS, READ_INPUT_REGISTERS, ReadBlock, RegisterRead, as_register_reads,
+                                    plan_reads)
+from utils.register_types import register_type
+
+# path: ((mtime_ns, size), parsed config)
+_CONFIG_CACHE: Dict[str, Tuple[Tuple[int, int], Any]] = {}
+# (path, keys): ((mtime_ns, size), register map)
+_MAP_CACHE: Dict[Tuple[str, Tuple[str, ...]], Tuple[Tuple[int, int], "RegisterMap"]] = {}
+
+
+# This class is an immutable register map indexed by name and by address.
+# Entries are kept sorted by address, so the map can be planned or searched
+# for the entry covering an address without scanning it.
+class RegisterMap:
+    __slots__ = ("entries", "by_name", "by_address", "_starts", "_plans")
+
+    def __init__(self, register_map: Iterable[Sequence] = ()):
+        entries = tuple(sorted(as_register_reads(register_map), key=lambda entry: (entry.address, entry.count)))
+        by_name: Dict[str, RegisterRead] = {}
+        by_address: Dict[int, RegisterRead] = {}
+        for entry in entries:
+            if entry.name in by_name:
+                raise ValueError(f"Register name {entry.name} is defined twice")
+            by_name[entry.name] = entry
+            by_address.setdefault(entry.address, entry)
+        self.entries = entries
+        self.by_name = MappingProxyType(by_name)
+        self.by_address = MappingProxyType(by_address)
+        self._starts = tuple(entry.address for entry in entries)
+        self._plans: Dict[Tuple[int, int, int], Tuple[ReadBlock, ...]] = {}
+
+    def __repr__(self):
+        return f"RegisterMap({len(self.entries)} registers)"
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self) -> Iterator[RegisterRead]:
+        return iter(self.entries)
+
+    def __contains__(self, name) -> bool:
+        return name in self.by_name
+
+    def __getitem__(self, name: str) -> RegisterRead:
+        return self.by_name[name]
+
+    # Entry for a register name, or None.
+    def get(self, name: str) -> Optional[RegisterRead]:
+        return self.by_name.get(name)
+
+    # Entry starting at an address, or None.
+    def at(self, address: int) -> Optional[RegisterRead]:
+        return self.by_address.get(address)
+
+    # Entry whose registers include address, or None.
+    def covering(self, address: int) -> Optional[RegisterRead]:
+        index = bisect_right(self._starts, address)
+        # Entries may overlap, so walk back over the ones starting at or before address.
+        while index:
+            index -= 1
+            entry = self.entries[index]
+            if entry.end > address:
+                return entry
+            if address - entry.address >= MAX_READ_REGISTERS:
+                break
+        return None
+
+    # Entries whose registers fall inside [start, end).
+    def between(self, start: int, end: int) -> Tuple[RegisterRead, ...]:
+        entries = self.entries[bisect_left(self._starts, start):bisect_left(self._starts, end)]
+        return tuple(entry for entry in entries if entry.end <= end)
+
+    # Coalesced read plan for the map; plans are built once per setting.
+    def plan(self, max_gap: int = 0, max_count: int = MAX_READ_REGISTERS,
+             function_code: int = READ_INPUT_REGISTERS) -> Tuple[ReadBlock, ...]:
+        key = (max_gap, max_count, function_code)
+        plan = self._plans.get(key)
+        if plan is None:
+            plan = self._plans[key] = tuple(plan_reads(self.entries, max_gap, max_count, function_code))
+        return plan
+
+
+# Modification stamp used to tell whether a file changed since it was parsed.
+def _stamp(path: str) -> Tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+# Load a JSON config file. The parsed result is cached until the file changes,
+# so it must be treated as read-only.
+def load_config(path: str) -> Any:
+    path = os.path.abspath(path)
+    stamp = _stamp(path)
+    cached = _CONFIG_CACHE.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    with open(path, "r", encoding="utf-8") as file:
+        config = json.load(file)
+    _CONFIG_CACHE[path] = (stamp, config)
+    return config
+
+
+# The section of a parsed config selected by keys, for example ('huawei', 'sacu').
+def _section(config: Any, keys: Sequence[str], path: str) -> Any:
+    section = config
+    for key in keys:
+        try:
+            section = section[key]
+        except (KeyError, TypeError):
+            raise KeyError(f"{path} has no section {'.'.join(keys)}") from None
+    return section
+
+
+# Turn a 'registers' section into register map entries.
+# Each register is {"name", "type", "address", "length"}; a missing name falls
+# back to the register key and an empty type means raw registers.
+def parse_registers(registers: Mapping[str, Mapping[str, Any]]) -> List[RegisterRead]:
+    entries = []
+    for key, register in registers.items():
+        kind = register.get("type") or None
+        try:
+            address = int(register["address"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"Register {key} has no valid address") from None
+        if kind is not None:
+            register_type(kind)
+        entries.append(RegisterRead(address, int(register.get("length") or 1), kind, register.get("name") or key))
+    return entries
+
+
+# Load the register map of a device from a JSON config.
+# keys select the device section, for example ('huawei', 'sacu').
+def load_register_map(path: str, *keys: str) -> RegisterMap:
+    path = os.path.abspath(path)
+    stamp = _stamp(path)
+    cached = _MAP_CACHE.get((path, keys))
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    section = _section(load_config(path), keys, path)
+    register_map = RegisterMap(parse_registers(section.get("registers", {})))
+    _MAP_CACHE[(path, keys)] = (stamp, register_map)
+    return register_map
+
+
+# Load the cache policies of a device's registers from a JSON config.
+# Registers may set "max_age" (seconds), "deadband" and "deadband_percent";
+# registers setting none of them are left to the cache's default policy.
+def load_cache_policies(path: str, *keys: str) -> Dict[str, CachePolicy]:
+    section = _section(load_config(path), keys, path)
+    policies = {}
+    for key, register in section.get("registers", {}).items():
+        if any(field in register for field in CachePolicy._fields):
+            fields = (float(register.get(field, 0)) for field in CachePolicy._fields)
+            policies[register.get("name") or key] = CachePolicy(*fields)
+    return policies
+
+
+# Load the poll intervals of a device's registers from a JSON config.
+# Registers may set "poll_interval" in seconds (0: read once at startup);
+# registers without one are left to the caller's default interval.
+def load_poll_intervals(path: str, *keys: str) -> Dict[str, float]:
+    section = _section(load_config(path), keys, path)
+    return {register.get("name") or key: float(register["poll_interval"])
+            for key, register in section.get("registers", {}).items() if "poll_interval" in register}
+
+# End of file: utils/config_loader.py
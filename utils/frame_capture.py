@@ -0,0 +1,296 @@
+#
+# This module is used to capture raw Modbus frames to a binary file and replay them.
+#
+
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from utils.config_loader import RegisterMap
+from utils.register_decoder import block_decoder
+from utils.register_planner import READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS, ReadBlock
+
+# Capture header: magic, link type, wall clock time of the first frame.
+HEADER = struct.Struct("<8sHxxxxxxd")
+MAGIC = b"UIOTCAP1"
+
+# One frame record: nanoseconds since the first frame, direction, payload length; the payload follows.
+RECORD = struct.Struct("<QBI")
+
+# Link types: how the payloads are framed.
+TCP = 1
+RTU = 2
+
+# Frame directions.
+REQUEST = 0
+RESPONSE = 1
+
+MBAP = struct.Struct(">HHHB")
+
+
+# One captured frame: seconds since the first frame, direction and the raw bytes.
+class Frame(NamedTuple):
+    t: float
+    direction: int
+    data: bytes
+
+
+# A request and its response taken from a capture (response None when unanswered).
+# Times are seconds since the first frame; pdus exclude the MBAP header or RTU address and CRC.
+class Transaction(NamedTuple):
+    t: float
+    response_t: Optional[float]
+    unit: int
+    request: bytes
+    response: Optional[bytes]
+
+    @property
+    def latency(self) -> Optional[float]:
+        return None if self.response_t is None else self.response_t - self.t
+
+
+# This class is used to stream raw frames into a capture file.
+# Every request sent is one frame; response bytes are gathered until the next
+# request, so a response read in several pieces is stored as one frame stamped
+# with the monotonic time its first byte was seen.
+class CaptureWriter:
+    def __init__(self, path: str, link: int):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.link = link
+        self.frames = 0
+        self._file = open(path, "wb", buffering=1 << 16)
+        self._start: Optional[int] = None
+        self._pending = bytearray()
+        self._pending_direction = REQUEST
+        self._pending_time = 0
+        self._lock = threading.Lock()
+        self._file.write(HEADER.pack(MAGIC, link, 0.0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def record(self, direction: int, data: bytes):
+        if not data:
+            return
+        now = time.monotonic_ns()
+        with self._lock:
+            if self._file is None:
+                return
+            if self._start is None:
+                self._start = now
+                self._file.seek(0)
+                self._file.write(HEADER.pack(MAGIC, self.link, time.time()))
+                self._file.seek(0, os.SEEK_END)
+            if self._pending and (direction == REQUEST or direction != self._pending_direction):
+                self._write_pending()
+            if not self._pending:
+                self._pending_direction = direction
+                self._pending_time = now - self._start
+            self._pending += data
+
+    def _write_pending(self):
+        self._file.write(RECORD.pack(self._pending_time, self._pending_direction, len(self._pending)))
+        self._file.write(self._pending)
+        self._pending.clear()
+        self.frames += 1
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                if self._pending:
+                    self._write_pending()
+                self._file.flush()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# Record every byte a pymodbus sync client (TCP or serial) sends and receives into writer.
+# The client's send/recv are wrapped on the instance, so the framing and
+# retries of the client are captured as they happen on the wire.
+def capture_client(client, writer: CaptureWriter):
+    send, recv = client.send, client.recv
+
+    def captured_send(request):
+        writer.record(REQUEST, bytes(request))
+        return send(request)
+
+    def captured_recv(size):
+        data = recv(size)
+        writer.record(RESPONSE, bytes(data))
+        return data
+
+    client.send = captured_send
+    client.recv = captured_recv
+    client.capture = writer
+    return client
+
+
+# This class is used to read a capture file. Frames are sliced out of a
+# read-only memory map, so even large captures load without copying.
+class CaptureReader:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(file.fileno()).st_size \
+                else b""
+        if len(self._map) < HEADER.size:
+            raise ValueError(f"{path} is not a frame capture")
+        magic, self.link, self.start_time = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a frame capture")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self) -> Iterator[Frame]:
+        data = memoryview(self._map)
+        offset = HEADER.size
+        try:
+            while offset + RECORD.size <= len(data):
+                nanoseconds, direction, length = RECORD.unpack_from(data, offset)
+                offset += RECORD.size
+                if offset + length > len(data):
+                    # Truncated last frame (capture cut off mid-write).
+                    break
+                yield Frame(nanoseconds / 1e9, direction, bytes(data[offset:offset + length]))
+                offset += length
+        finally:
+            data.release()
+
+    def frames(self) -> List[Frame]:
+        return list(self)
+
+    # Request/response pairs of the capture.
+    def transactions(self) -> List[Transaction]:
+        if self.link == TCP:
+            return _tcp_transactions(self)
+        return _rtu_transactions(self)
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+
+def _tcp_transactions(frames: Iterable[Frame]) -> List[Transaction]:
+    # Frames can hold several pipelined ADUs, or part of one; split both directions by the MBAP length.
+    buffers = {REQUEST: b"", RESPONSE: b""}
+    pending: Dict[Tuple[int, int], Tuple[float, bytes]] = {}
+    transactions: List[Transaction] = []
+    for frame in frames:
+        buffer = buffers[frame.direction] + frame.data
+        while len(buffer) >= MBAP.size:
+            transaction_id, _, length, unit = MBAP.unpack_from(buffer)
+            end = MBAP.size - 1 + length
+            if len(buffer) < end:
+                break
+            pdu, buffer = buffer[MBAP.size:end], buffer[end:]
+            if frame.direction == REQUEST:
+                pending[(transaction_id, unit)] = (frame.t, pdu)
+            else:
+                request = pending.pop((transaction_id, unit), None)
+                if request is not None:
+                    transactions.append(Transaction(request[0], frame.t, unit, request[1], pdu))
+        buffers[frame.direction] = buffer
+    transactions.extend(Transaction(t, None, unit, pdu, None) for (_, unit), (t, pdu) in pending.items())
+    transactions.sort(key=lambda transaction: transaction.t)
+    return transactions
+
+
+def _rtu_transactions(frames: Iterable[Frame]) -> List[Transaction]:
+    # Half duplex: each request frame is answered by the response frame after it, if any.
+    transactions: List[Transaction] = []
+    request: Optional[Frame] = None
+    for frame in frames:
+        if frame.direction == REQUEST:
+            if request is not None:
+                transactions.append(Transaction(request.t, None, request.data[0], request.data[1:-2], None))
+            request = frame if len(frame.data) >= 4 else None
+        elif request is not None:
+            response = frame.data[1:-2] if len(frame.data) >= 4 else None
+            transactions.append(Transaction(request.t, frame.t if response else None, request.data[0],
+                                            request.data[1:-2], response))
+            request = None
+    if request is not None:
+        transactions.append(Transaction(request.t, None, request.data[0], request.data[1:-2], None))
+    return transactions
+
+
+# Yield items as their times come, at speed times the captured rate (0: as fast as possible).
+def paced(items: Iterable, speed: float = 1.0, time_of: Callable = lambda item: item.t,
+          sleep: Callable[[float], None] = time.sleep) -> Iterator:
+    start = None
+    first = 0.0
+    for item in items:
+        if speed > 0:
+            if start is None:
+                start, first = time.monotonic(), time_of(item)
+            delay = (time_of(item) - first) / speed - (time.monotonic() - start)
+            if delay > 0:
+                sleep(delay)
+        yield item
+
+
+# This class is used to run captured register reads back through the decode pipeline.
+# Each answered FC3/FC4 read becomes a ReadBlock over the register map entries it
+# covers and is decoded by that block's cached BatchDecoder, as a live poll
+# would be; decode() yields (unix timestamp, unit, values) for a sink such as
+# SampleWriter, MqttBridge or ProcessImage.
+class ReplayDecoder:
+    def __init__(self, register_map: Iterable, byteorder="big", wordorder="big"):
+        self.register_map = register_map if isinstance(register_map, RegisterMap) else RegisterMap(register_map)
+        self.byteorder = byteorder
+        self.wordorder = wordorder
+        self.decoded = 0
+        self.skipped = 0
+        self._blocks: Dict[Tuple[int, int, int], Optional[ReadBlock]] = {}
+
+    def _block(self, function_code: int, address: int, count: int) -> Optional[ReadBlock]:
+        key = (function_code, address, count)
+        if key not in self._blocks:
+            entries = self.register_map.between(address, address + count)
+            self._blocks[key] = ReadBlock(address, count, function_code, entries) if entries else None
+        return self._blocks[key]
+
+    # Decoded values of one transaction, or None if it was not an answered read of mapped registers.
+    def decode_transaction(self, transaction: Transaction) -> Optional[Dict[str, object]]:
+        request, response = transaction.request, transaction.response
+        if response is None or len(request) < 5 or request[0] not in (READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS) \
+                or response[0] != request[0]:
+            self.skipped += 1
+            return None
+        address, count = struct.unpack_from(">HH", request, 1)
+        block = self._block(request[0], address, count)
+        if block is None or len(response) < 2 + 2 * count:
+            self.skipped += 1
+            return None
+        registers = np.frombuffer(response, ">u2", count, 2)
+        self.decoded += 1
+        return block_decoder(block, self.byteorder, self.wordorder).decode(registers)
+
+    # Decode transactions, paced at speed times the captured rate (0: as fast as possible).
+    def decode(self, transactions: Iterable[Transaction], start_time: float = 0.0,
+               speed: float = 0.0) -> Iterator[Tuple[float, int, Dict[str, object]]]:
+        for transaction in paced(transactions, speed):
+            values = self.decode_transaction(transaction)
+            if values is not None:
+                yield start_time + transaction.response_t, transaction.unit, values
+
+# End of file: utils/frame_capture.py
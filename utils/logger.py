@@ -2,25 +2,202 @@
 # This module is used for anthing logging related.
 #
 
+import atexit
+import json
 import logging
 import os
+import queue
 import sys
-from logging.handlers import TimedRotatingFileHandler
+import time
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+from typing import Iterable, Mapping, Optional
+
+DEFAULT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Records waiting for the listener thread before new ones are dropped.
+QUEUE_SIZE = 10000
+
+
+# This class is a queue handler that leaves formatting to the listener thread.
+# QueueHandler formats every record in the caller; here the record goes on the
+# queue untouched (it never leaves the process) and a full queue drops the
+# record instead of blocking the poll loop.
+class LazyQueueHandler(QueueHandler):
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# This class is a rotating file handler that flushes in batches.
+# The stream is flushed every batch_size records or when flush_interval seconds
+# have passed since the last flush, instead of after every record; under a
+# FlushingQueueListener the rest of a batch is flushed once logging goes quiet.
+class BatchingFileHandler(TimedRotatingFileHandler):
+    def __init__(self, filename, batch_size=64, flush_interval=1.0, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    # Called by StreamHandler.emit after each record.
+    def flush(self):
+        self._pending += 1
+        if self._pending >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush_now()
+
+    def flush_now(self):
+        super().flush()
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    # Flush records still held back; the listener calls this when its queue goes quiet.
+    def flush_pending(self):
+        with self.lock:
+            if self._pending:
+                self.flush_now()
+
+    def close(self):
+        self.flush_now()
+        super().close()
+
+
+# This class is a formatter for compact structured sample records.
+# Records logged with log_sample() become one JSON line:
+# {"t": unix time, "d": device, "v": {name: value}}; other records use fmt.
+class SampleFormatter(logging.Formatter):
+    def format(self, record):
+        sample = getattr(record, "sample", None)
+        if sample is None:
+            return super().format(record)
+        device, values = sample
+        return json.dumps({"t": round(record.created, 3), "d": device, "v": values}, separators=(",", ":"),
+                          default=_json_value)
+
+
+def _json_value(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode("utf-8", errors="replace").strip("\x00")
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return str(value)
+
+
+# Log one poll result as a structured sample record.
+# Nothing is built when the level is disabled; with a SampleFormatter the
+# values are only serialised by the listener thread.
+def log_sample(logger: logging.Logger, device, values: Mapping[str, object], level=logging.INFO):
+    if logger.isEnabledFor(level):
+        logger.log(level, "%s %s", device, values, extra={"sample": (str(device), dict(values))})
+
+
+# This class is a queue listener that flushes batching handlers while idle.
+# Waiting for the next record times out after the shortest flush_interval of its
+# BatchingFileHandlers, so the last records of a burst reach the file within
+# that time even when nothing else is logged. stop() may be called more than once.
+class FlushingQueueListener(QueueListener):
+    def __init__(self, log_queue: queue.Queue, *handlers: logging.Handler, respect_handler_level: bool = False):
+        super().__init__(log_queue, *handlers, respect_handler_level=respect_handler_level)
+        self.batching = [handler for handler in handlers if isinstance(handler, BatchingFileHandler)]
+        self.idle_timeout = min((handler.flush_interval for handler in self.batching), default=None)
+        self.running = False
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, self.idle_timeout)
+            except queue.Empty:
+                if not block:
+                    raise
+                for handler in self.batching:
+                    handler.flush_pending()
+
+    def start(self):
+        super().start()
+        self.running = True
+
+    # Drain the queue, then write out what the batching handlers still hold.
+    def stop(self):
+        if self.running:
+            self.running = False
+            super().stop()
+            for handler in self.batching:
+                handler.flush_pending()
+
+
+# Move a logger's output onto a background queue listener.
+# The logger gets a LazyQueueHandler; handlers run in the listener thread.
+def start_queue_logging(logger: logging.Logger, handlers: Iterable[logging.Handler],
+                        queue_size: int = QUEUE_SIZE) -> FlushingQueueListener:
+    log_queue: queue.Queue = queue.Queue(queue_size)
+    listener = FlushingQueueListener(log_queue, *handlers, respect_handler_level=True)
+    logger.addHandler(LazyQueueHandler(log_queue))
+    listener.start()
+    # Drain the queue and flush the files when the process exits.
+    atexit.register(stop_queue_logging, listener)
+    return listener
+
+
+# Stop a queue listener, writing out every record still queued.
+def stop_queue_logging(listener: FlushingQueueListener):
+    listener.stop()
+
+
+# Configure the root logger for a poll script.
+# queued=True keeps console and file I/O off the calling thread; log_file adds
+# a batching rotating file handler.
+def configure_logging(level=logging.INFO, fmt: str = DEFAULT_FORMAT, log_file: Optional[str] = None,
+                      queued: bool = True, stream=sys.stdout) -> Optional[FlushingQueueListener]:
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    formatter = SampleFormatter(fmt)
+    handlers = [logging.StreamHandler(stream)]
+    if log_file:
+        handlers.append(BatchingFileHandler(log_file, when='midnight', interval=1, backupCount=7) if queued
+                        else TimedRotatingFileHandler(log_file, when='midnight', interval=1, backupCount=7))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    if queued:
+        return start_queue_logging(root, handlers)
+    for handler in handlers:
+        root.addHandler(handler)
+    return None
+
 
 class Logger:
-    def __init__(self, log_name, log_path, log_level):
+    # queued=True writes through a background listener with batched file flushes.
+    def __init__(self, log_name, log_path, log_level, queued=False):
         self.log_name = log_name
         self.log_path = log_path
         self.log_level = log_level
         self.logger = logging.getLogger(self.log_name)
         self.logger.setLevel(self.log_level)
-        self.formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        self.file_handler = TimedRotatingFileHandler(os.path.join(self.log_path, self.log_name + '.log'), when='midnight', interval=1, backupCount=7)
+        self.formatter = SampleFormatter(DEFAULT_FORMAT)
+        log_file = os.path.join(self.log_path, self.log_name + '.log')
+        if queued:
+            self.file_handler = BatchingFileHandler(log_file, when='midnight', interval=1, backupCount=7)
+        else:
+            self.file_handler = TimedRotatingFileHandler(log_file, when='midnight', interval=1, backupCount=7)
         self.file_handler.setFormatter(self.formatter)
-        self.logger.addHandler(self.file_handler)
         self.stream_handler = logging.StreamHandler(sys.stdout)
         self.stream_handler.setFormatter(self.formatter)
-        self.logger.addHandler(self.stream_handler)
+        self.listener = None
+        if queued:
+            self.listener = start_queue_logging(self.logger, [self.file_handler, self.stream_handler])
+        else:
+            self.logger.addHandler(self.file_handler)
+            self.logger.addHandler(self.stream_handler)
 
     def log(self, message):
         self.logger.info(message)
@@ -38,4 +215,16 @@ class Logger:
         self.logger.critical(message)
 
     def log_exception(self, message):
-        self.logger.exception(message)
\ No newline at end of file
+        self.logger.exception(message)
+
+    # Log one poll result as a compact structured record.
+    def log_sample(self, device, values):
+        log_sample(self.logger, device, values)
+
+    # Stop the listener, writing out everything still queued.
+    def close(self):
+        if self.listener is not None:
+            stop_queue_logging(self.listener)
+            self.listener = None
+
+# End of file: utils/logger.py
@@ -0,0 +1,238 @@
+#
+# This module is used to run poll groups at their own rates on one bus by earliest deadline.
+#
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional
+
+from utils.timer import LatencyHistogram
+
+log = logging.getLogger(__name__)
+
+# Interval of a task that runs once, at startup.
+ONCE = 0.0
+
+# Deadline of a run-once task, in seconds after the scheduler starts.
+ONCE_DEADLINE = 10.0
+
+# Shed tasks run at most this many times slower than their interval.
+MAX_STRETCH = 10.0
+
+# Weight of the newest run in a task's average duration.
+DURATION_WEIGHT = 0.2
+
+
+# One poll group on a bus: run() is called every interval seconds (ONCE: a single
+# time at startup) and should finish within deadline seconds of its release
+# (the interval by default). When the bus is overloaded, tasks are shed lowest
+# priority first by stretching their interval.
+class PollTask(NamedTuple):
+    name: str
+    interval: float
+    run: Callable[[], Any]
+    priority: int = 0
+    deadline: Optional[float] = None
+
+
+# This class is used to keep the timing record of one task.
+# jitter is how late a run started after its release, lateness how far past
+# its deadline a missed run finished; skipped counts releases dropped because
+# their deadline had already passed, stretch the current shedding factor.
+class TaskStats:
+    __slots__ = ("runs", "misses", "skipped", "errors", "stretch", "jitter", "duration", "lateness")
+
+    def __init__(self):
+        self.runs = 0
+        self.misses = 0
+        self.skipped = 0
+        self.errors = 0
+        self.stretch = 1.0
+        self.jitter = LatencyHistogram()
+        self.duration = LatencyHistogram()
+        self.lateness = LatencyHistogram()
+
+    def snapshot(self) -> Dict[str, object]:
+        return {
+            "runs": self.runs,
+            "misses": self.misses,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "stretch": self.stretch,
+            "jitter": self.jitter.snapshot(),
+            "duration": self.duration.snapshot(),
+            "lateness": self.lateness.snapshot(),
+        }
+
+
+class _Entry:
+    __slots__ = ("task", "deadline", "release", "stats", "average")
+
+    def __init__(self, task: PollTask, release: float):
+        self.task = task
+        if task.deadline is not None:
+            self.deadline = task.deadline
+        else:
+            self.deadline = task.interval if task.interval > ONCE else ONCE_DEADLINE
+        self.release = release
+        self.stats = TaskStats()
+        self.average = 0.0
+
+    @property
+    def period(self) -> float:
+        return self.task.interval * self.stats.stretch
+
+    @property
+    def utilisation(self) -> float:
+        return self.average / self.task.interval if self.task.interval > ONCE else 0.0
+
+
+# This class is a non-preemptive earliest-deadline-first scheduler for one bus.
+# Released tasks wait in a heap ordered by absolute deadline (higher priority
+# first on ties) and the bus runs them back to back; the only idle time is
+# until the next release. A release whose deadline passes before the task can
+# start is skipped (counted in TaskStats.skipped) rather than run late, so an
+# overrun never turns into a catch-up burst. When the measured load of the
+# periodic tasks exceeds max_utilisation, the lowest priority tasks have their
+# interval stretched (up to MAX_STRETCH times) until the rest fit again;
+# stretching is undone when the load drops. report() gives jitter, duration and deadline misses per task.
+class DeadlineScheduler:
+    def __init__(self, tasks: Iterable[PollTask] = (), name: str = "bus", max_utilisation: float = 0.9,
+                 clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.max_utilisation = max_utilisation
+        self.clock = clock
+        self.entries: Dict[str, _Entry] = {}
+        self._waiting: List = []
+        self._ready: List = []
+        self._order = itertools.count()
+        self._completed = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        for task in tasks:
+            self.add(task)
+
+    # Add a task, released now.
+    def add(self, task: PollTask):
+        if task.name in self.entries:
+            raise ValueError(f"Task {task.name} is already scheduled on {self.name}")
+        if task.interval < ONCE:
+            raise ValueError(f"Task {task.name} has a negative interval")
+        entry = self.entries[task.name] = _Entry(task, self.clock())
+        heapq.heappush(self._waiting, (entry.release, next(self._order), entry))
+
+    def _release(self, now: float):
+        while self._waiting and self._waiting[0][0] <= now:
+            _, order, entry = heapq.heappop(self._waiting)
+            heapq.heappush(self._ready, (entry.release + entry.deadline, -entry.task.priority, order, entry))
+
+    # Run the released task with the earliest deadline. Returns the seconds until
+    # the next release when nothing is ready (None when no task is left).
+    def step(self) -> Optional[float]:
+        now = self.clock()
+        self._release(now)
+        # Releases whose deadline passed while other tasks held the bus are skipped
+        # (a run-once task still runs, late, so it is set aside and put back).
+        late = []
+        while self._ready and self._ready[0][0] <= now:
+            item = heapq.heappop(self._ready)
+            entry = item[3]
+            if entry.task.interval > ONCE:
+                entry.stats.skipped += 1
+                self._reschedule(entry, now)
+            else:
+                late.append(item)
+        for item in late:
+            heapq.heappush(self._ready, item)
+        if not self._ready:
+            return self._waiting[0][0] - now if self._waiting else None
+        deadline, _, _, entry = heapq.heappop(self._ready)
+        stats = entry.stats
+        start = self.clock()
+        try:
+            entry.task.run()
+        except Exception as e:
+            stats.errors += 1
+            log.error("Poll task %s on %s failed: %s", entry.task.name, self.name, e)
+        end = self.clock()
+        duration = end - start
+        stats.runs += 1
+        stats.jitter.observe(max(0.0, start - entry.release))
+        stats.duration.observe(duration)
+        if end > deadline:
+            stats.misses += 1
+            stats.lateness.observe(end - deadline)
+        entry.average += DURATION_WEIGHT * (duration - entry.average) if stats.runs > 1 else duration
+        if entry.task.interval > ONCE:
+            self._reschedule(entry, end)
+        self._completed += 1
+        if self._completed % len(self.entries) == 0:
+            self._shed()
+        return 0.0
+
+    def _reschedule(self, entry: _Entry, now: float):
+        period = entry.period
+        entry.release += period
+        while entry.release + entry.deadline <= now:
+            entry.release += period
+            entry.stats.skipped += 1
+        heapq.heappush(self._waiting, (entry.release, next(self._order), entry))
+
+    # Stretch the lowest priority periodic tasks while the load is over max_utilisation.
+    def _shed(self):
+        periodic = [entry for entry in self.entries.values() if entry.task.interval > ONCE]
+        excess = sum(entry.utilisation for entry in periodic) - self.max_utilisation
+        levels = sorted({entry.task.priority for entry in periodic})
+        # The highest priority level is never shed.
+        for priority in levels[:-1]:
+            members = [entry for entry in periodic if entry.task.priority == priority]
+            load = sum(entry.utilisation for entry in members)
+            stretch = 1.0
+            if excess > 0 and load > 0:
+                stretch = min(MAX_STRETCH, load / max(load - excess, load / MAX_STRETCH))
+                excess -= load - load / stretch
+            for entry in members:
+                if entry.stats.stretch != stretch:
+                    log.info("Poll task %s on %s now runs every %.3fs", entry.task.name, self.name,
+                             entry.task.interval * stretch)
+                    entry.stats.stretch = stretch
+
+    # Measured share of the bus the periodic tasks need at their own intervals.
+    def utilisation(self) -> float:
+        return sum(entry.utilisation for entry in self.entries.values())
+
+    # Run tasks until stop() is called or duration seconds have passed.
+    def run(self, duration: Optional[float] = None):
+        end = None if duration is None else self.clock() + duration
+        while not self._stop.is_set():
+            wait = self.step()
+            if wait is None:
+                break
+            if end is not None:
+                remaining = end - self.clock()
+                if remaining <= 0:
+                    break
+                wait = min(wait, remaining)
+            if wait > 0:
+                self._stop.wait(wait)
+
+    # Run the bus in a background thread.
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name=f"scheduler-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # Timing record of every task: {name: TaskStats.snapshot()}.
+    def report(self) -> Dict[str, Dict[str, object]]:
+        return {name: entry.stats.snapshot() for name, entry in self.entries.items()}
+
+# End of file: utils/poll_scheduler.py
@@ -0,0 +1,241 @@
+#
+# This module is used to share the latest polled values of every device through shared memory.
+#
+
+import json
+import logging
+import struct
+import time
+from multiprocessing import parent_process, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+
+from utils.config_loader import RegisterMap
+from utils.register_types import BITS, STRING, register_type, type_layout
+
+log = logging.getLogger(__name__)
+
+# Segment header: magic, slot size, slot count, layout length, data offset.
+HEADER = struct.Struct("<8sIIII")
+HEADER_SIZE = 64
+MAGIC = b"UIOTIMG1"
+
+# Slots start on their own cache line so a write to one device never shares a line with another.
+SLOT_ALIGN = 64
+
+# Reads give up after this many torn attempts in a row (the writer is stuck mid-update).
+MAX_READ_RETRIES = 1000
+
+
+# Names of the images this process created.
+_CREATED = set()
+
+
+def _align(size: int, alignment: int = SLOT_ALIGN) -> int:
+    return (size + alignment - 1) // alignment * alignment
+
+
+# NumPy field of one register map entry, in native little-endian order:
+# numbers as their type, strings as bytes, bits as 8 flags and raw registers as uint16s.
+def _field(entry) -> Tuple[str, str, Tuple[int, ...]]:
+    kind = register_type(entry.decode)
+    if kind is None:
+        return entry.name, "<u2", (entry.count,)
+    if kind == STRING:
+        return entry.name, f"S{2 * entry.count}", ()
+    if kind == BITS:
+        return entry.name, "?", (8,)
+    return entry.name, "<" + type_layout(kind)[0], ()
+
+
+def _slot_dtype(fields: Sequence[Tuple[str, str, Sequence[int]]]) -> np.dtype:
+    values = np.dtype([(name, dtype, tuple(shape)) for name, dtype, shape in fields])
+    header = np.dtype([("generation", "<u8"), ("timestamp", "<f8")])
+    return np.dtype({"names": ["generation", "timestamp", "values"],
+                     "formats": ["<u8", "<f8", values],
+                     "offsets": [0, 8, header.itemsize],
+                     "itemsize": _align(header.itemsize + values.itemsize)})
+
+
+# Attach to an existing segment without leaving it to this process's resource
+# tracker, which would otherwise destroy it when a reader exits. Processes
+# started through multiprocessing share their parent's tracker, so there the
+# registration is left alone, as it is for images created by this process.
+def _attach(name: str) -> SharedMemory:
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        memory = SharedMemory(name=name)
+        if parent_process() is None and memory.name not in _CREATED:
+            resource_tracker.unregister(memory._name, "shared_memory")
+        return memory
+
+
+# This class is used to map a process image segment as NumPy arrays.
+# The segment holds a header, a JSON layout (device names and the register
+# fields, taken from the register map) and one cache-line aligned slot per
+# device: a generation counter, the poll timestamp and the values record.
+class _Segment:
+    def __init__(self, memory: SharedMemory):
+        self.memory = memory
+        magic, slot_size, slot_count, layout_length, offset = HEADER.unpack_from(memory.buf)
+        if magic != MAGIC:
+            raise ValueError(f"Shared memory {memory.name} is not a process image")
+        layout = json.loads(bytes(memory.buf[HEADER_SIZE:HEADER_SIZE + layout_length]).decode("utf-8"))
+        self.devices: List[str] = layout["devices"]
+        self.index: Dict[str, int] = {device: i for i, device in enumerate(self.devices)}
+        self.dtype = _slot_dtype(layout["fields"])
+        if self.dtype.itemsize != slot_size:
+            raise ValueError(f"Process image {memory.name} has a slot size of {slot_size}, its layout needs "
+                             f"{self.dtype.itemsize}")
+        self.slots = np.ndarray((slot_count,), self.dtype, memory.buf, offset)
+        self.generations = self.slots["generation"]
+        self.timestamps = self.slots["timestamp"]
+        self.values = self.slots["values"]
+        self.fields: Tuple[str, ...] = self.values.dtype.names
+
+    def slot(self, device: str) -> int:
+        try:
+            return self.index[device]
+        except KeyError:
+            raise KeyError(f"Device {device} is not in process image {self.memory.name}") from None
+
+    def release(self):
+        # Views must go before the buffer they point into can be closed.
+        self.slots = self.generations = self.timestamps = self.values = None
+        self.memory.close()
+
+
+# This class is the writer of a process image: the poller publishes each device's
+# latest values into it and any local process can map them with ProcessImageReader.
+# Every publish is a seqlock update of the device's slot: the generation goes odd,
+# the values and timestamp are stored in place, then the generation goes even
+# again, so readers never block the poller and detect a torn read themselves.
+# Only one process may publish into an image.
+class ProcessImage:
+    def __init__(self, name: str, devices: Iterable[str], register_map: Iterable[Sequence]):
+        register_map = register_map if isinstance(register_map, RegisterMap) else RegisterMap(register_map)
+        devices = [str(device) for device in devices]
+        fields = [_field(entry) for entry in register_map]
+        layout = json.dumps({"devices": devices, "fields": fields}).encode("utf-8")
+        dtype = _slot_dtype(fields)
+        device_count = len(devices)
+        offset = _align(HEADER_SIZE + len(layout))
+        self.memory = SharedMemory(name=name, create=True, size=offset + dtype.itemsize * max(1, device_count))
+        _CREATED.add(self.memory.name)
+        HEADER.pack_into(self.memory.buf, 0, MAGIC, dtype.itemsize, device_count, len(layout), offset)
+        self.memory.buf[HEADER_SIZE:HEADER_SIZE + len(layout)] = layout
+        self._segment = _Segment(self.memory)
+        self._segment.timestamps[:] = np.nan
+        self._columns = {name: self._segment.values[name] for name in self._segment.fields}
+        self.name = self.memory.name
+        self.devices = self._segment.devices
+        self.rejected = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Store a device's values (names outside the register map are ignored).
+    # A value that does not fit its field (a list for a number, text for a float,
+    # an integer out of range) is logged and left out; the rest are still stored.
+    def publish(self, device: str, values: Mapping[str, object], timestamp: Optional[float] = None):
+        segment = self._segment
+        slot = segment.slot(device)
+        generation = int(segment.generations[slot])
+        segment.generations[slot] = generation + 1
+        try:
+            for name, value in values.items():
+                column = self._columns.get(name)
+                if column is None or value is None:
+                    continue
+                try:
+                    column[slot] = value.encode("utf-8") if isinstance(value, str) else value
+                except (TypeError, ValueError, OverflowError) as e:
+                    self.rejected += 1
+                    log.warning("Not publishing %s of %s as %s: %s", name, device, column.dtype, e)
+            segment.timestamps[slot] = time.time() if timestamp is None else timestamp
+        finally:
+            segment.generations[slot] = generation + 2
+
+    # Unmap the segment and remove it; readers still attached keep their mapping.
+    def close(self):
+        if self._segment is not None:
+            self._segment.release()
+            self._segment = self._columns = None
+            self.memory.unlink()
+            _CREATED.discard(self.name)
+
+
+# This class is used to read a process image from another process.
+# view() and column() are zero-copy NumPy views into the segment that follow the
+# poller live; read() gives a consistent copy of one device by retrying while
+# its generation is odd or changed during the read, without any lock. Views
+# must be dropped before close().
+class ProcessImageReader:
+    def __init__(self, name: str):
+        self._segment = _Segment(_attach(name))
+        self.name = name
+        self.devices = self._segment.devices
+        self.fields = self._segment.fields
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Live structured view of a device's values.
+    def view(self, device: str) -> np.void:
+        return self._segment.values[self._segment.slot(device)]
+
+    # Live view of one register across every device, in the order of .devices.
+    def column(self, name: str) -> np.ndarray:
+        return self._segment.values[name]
+
+    # Publish count of a device; it changes every time the poller stores new values.
+    def generation(self, device: str) -> int:
+        return int(self._segment.generations[self._segment.slot(device)])
+
+    # Consistent copy of a device's values and their poll timestamp (NaN before the first poll).
+    def read(self, device: str) -> Tuple[float, np.void]:
+        segment = self._segment
+        slot = segment.slot(device)
+        generations = segment.generations
+        for _ in range(MAX_READ_RETRIES):
+            before = generations[slot]
+            if before & 1:
+                time.sleep(0)
+                continue
+            values = segment.values[slot].copy()
+            timestamp = float(segment.timestamps[slot])
+            if generations[slot] == before:
+                return timestamp, values
+        raise TimeoutError(f"Device {device} in process image {self.name} is being written continuously")
+
+    # Consistent values of a device as a plain dict.
+    def read_dict(self, device: str) -> Dict[str, object]:
+        _, values = self.read(device)
+        return {name: values[name].tolist() for name in self.fields}
+
+    # Wait until a device is published past generation; returns the new generation, or None on timeout.
+    def wait(self, device: str, generation: int, timeout: float = 1.0, poll: float = 0.001) -> Optional[int]:
+        deadline = time.monotonic() + timeout
+        while True:
+            current = self.generation(device)
+            if current > generation and not current & 1:
+                return current
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(poll)
+
+    def close(self):
+        if self._segment is not None:
+            self._segment.release()
+            self._segment = None
+
+# End of file: utils/process_image.py
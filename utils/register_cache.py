@@ -0,0 +1,225 @@
+#
+# This module is used to cache register values and detect real value changes.
+#
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Mapping, NamedTuple, Optional, Tuple
+
+
+# How long a value may be served from memory and how far it must move to count as a change.
+# max_age is in seconds (0 always goes to the bus); deadband is absolute and
+# deadband_percent is relative to the last reported value. With both at 0 any
+# different value is a change.
+class CachePolicy(NamedTuple):
+    max_age: float = 0.0
+    deadband: float = 0.0
+    deadband_percent: float = 0.0
+
+
+# A value that moved past its deadband. previous is the last reported value
+# (None the first time the register is seen).
+class ChangeEvent(NamedTuple):
+    device: str
+    key: Hashable
+    value: Any
+    previous: Any
+    timestamp: float
+
+
+class _Entry:
+    __slots__ = ("value", "read_at", "reported")
+
+    def __init__(self, value, read_at, reported):
+        self.value = value
+        self.read_at = read_at
+        self.reported = reported
+
+
+_UNSET = object()
+
+
+# Whether value moved past the policy's deadband since previous.
+def exceeds_deadband(policy: CachePolicy, previous, value) -> bool:
+    if previous is _UNSET:
+        return True
+    if isinstance(value, (int, float)) and isinstance(previous, (int, float)) \
+            and not isinstance(value, bool) and (policy.deadband or policy.deadband_percent):
+        delta = abs(value - previous)
+        if policy.deadband and delta > policy.deadband:
+            return True
+        return bool(policy.deadband_percent) and delta > abs(previous) * policy.deadband_percent / 100
+    return value != previous
+
+
+# This class is a read-through register cache shared by every device.
+# Values are keyed by (device, register name or address); entries older than
+# their policy's max_age go back to the bus, and at most max_entries values are
+# kept, evicting the least recently used across all devices. put() reports a
+# ChangeEvent (to the caller and every subscriber) only when a value moves past
+# its deadband.
+class RegisterCache:
+    def __init__(self, max_entries: int = 10000, default_policy: CachePolicy = CachePolicy(),
+                 policies: Optional[Mapping[Hashable, CachePolicy]] = None, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.default_policy = default_policy
+        self.policies: Dict[Hashable, CachePolicy] = dict(policies or {})
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Tuple[str, Hashable], _Entry]" = OrderedDict()
+        self._subscribers: List[Callable[[ChangeEvent], None]] = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Policy of a register name or address.
+    def policy(self, key: Hashable) -> CachePolicy:
+        return self.policies.get(key, self.default_policy)
+
+    # Call callback with every ChangeEvent from now on.
+    def subscribe(self, callback: Callable[[ChangeEvent], None]):
+        self._subscribers.append(callback)
+
+    # Cached value if it is younger than max_age (the policy's by default), else None.
+    def get(self, device, key: Hashable, max_age: Optional[float] = None):
+        max_age = self.policy(key).max_age if max_age is None else max_age
+        with self._lock:
+            entry = self._entries.get((str(device), key))
+            if entry is None or entry.value is _UNSET or max_age <= 0 or self.clock() - entry.read_at > max_age:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((str(device), key))
+            self.hits += 1
+            return entry.value
+
+    # Store a value read from the bus; returns a ChangeEvent if it moved past the deadband.
+    def put(self, device, key: Hashable, value) -> Optional[ChangeEvent]:
+        device = str(device)
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get((device, key))
+            previous = _UNSET if entry is None else entry.reported
+            changed = exceeds_deadband(self.policy(key), previous, value)
+            if entry is None:
+                entry = self._entries[(device, key)] = _Entry(value, now, value)
+                if len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+            else:
+                entry.value = value
+                entry.read_at = now
+                if changed:
+                    entry.reported = value
+                self._entries.move_to_end((device, key))
+        if not changed:
+            return None
+        event = ChangeEvent(device, key, value, None if previous is _UNSET else previous, time.time())
+        for callback in self._subscribers:
+            callback(event)
+        return event
+
+    # Values of a device that put() would report as changed, without storing anything.
+    def changes(self, device, values: Mapping[Hashable, Any]) -> Dict[Hashable, Any]:
+        device = str(device)
+        with self._lock:
+            entries = self._entries
+            return {key: value for key, value in values.items()
+                    if exceeds_deadband(self.policy(key), entries[(device, key)].reported
+                                        if (device, key) in entries else _UNSET, value)}
+
+    # Store several values of one device; returns the values that changed.
+    def update(self, device, values: Mapping[Hashable, Any]) -> Dict[Hashable, Any]:
+        changes = {}
+        for key, value in values.items():
+            if self.put(device, key, value) is not None:
+                changes[key] = value
+        return changes
+
+    # Serve a value from memory when fresh, else call reader() and cache its result.
+    # reader returning None (a failed read) is passed through and not cached.
+    def read_through(self, device, key: Hashable, reader: Callable[[], Any], max_age: Optional[float] = None):
+        value = self.get(device, key, max_age)
+        if value is not None:
+            return value
+        value = reader()
+        if value is not None:
+            self.put(device, key, value)
+        return value
+
+    # Async form of read_through(); reader is a coroutine function.
+    async def read_through_async(self, device, key: Hashable, reader: Callable[[], Any],
+                                 max_age: Optional[float] = None):
+        value = self.get(device, key, max_age)
+        if value is not None:
+            return value
+        value = await reader()
+        if value is not None:
+            self.put(device, key, value)
+        return value
+
+    # Whether every key of a device can be served from memory.
+    def fresh(self, device, keys: Iterable[Hashable]) -> bool:
+        device = str(device)
+        now = self.clock()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get((device, key))
+                max_age = self.policy(key).max_age
+                if entry is None or entry.value is _UNSET or max_age <= 0 or now - entry.read_at > max_age:
+                    return False
+        return True
+
+    # Drop cached values (one key, one device, or everything) so the next read goes
+    # to the bus. The last reported values are kept, so a value read back unchanged
+    # after a write is not reported as a change.
+    def invalidate(self, device=None, key: Optional[Hashable] = None):
+        with self._lock:
+            if device is None:
+                entries = self._entries.values()
+            elif key is not None:
+                entries = [entry for entry in (self._entries.get((str(device), key)),) if entry is not None]
+            else:
+                entries = [entry for cached, entry in self._entries.items() if cached[0] == str(device)]
+            for entry in entries:
+                entry.value = _UNSET
+
+
+# This class is used to put a RegisterCache in front of an object with read_* methods,
+# such as ModbusTcpTest. Calls are keyed by method name and arguments and the
+# policy is looked up by the first argument (the register address). write_*
+# calls go straight through and drop the device's cached values.
+class CachedReader:
+    def __init__(self, target, cache: RegisterCache, device):
+        self.target = target
+        self.cache = cache
+        self.device = str(device)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.target, name)
+        if not callable(attribute):
+            return attribute
+        if name.startswith("write_"):
+            def write(*args, **kwargs):
+                try:
+                    return attribute(*args, **kwargs)
+                finally:
+                    self.invalidate()
+            return write
+        if not name.startswith("read_"):
+            return attribute
+
+        def cached_read(*args, **kwargs):
+            key = (name,) + args + tuple(sorted(kwargs.items()))
+            max_age = self.cache.policy(args[0] if args else name).max_age
+            return self.cache.read_through(self.device, key, lambda: attribute(*args, **kwargs), max_age)
+        return cached_read
+
+    # Values written through the target make cached reads of the device stale.
+    def invalidate(self):
+        self.cache.invalidate(self.device)
+
+# End of file: utils/register_cache.py
@@ -0,0 +1,140 @@
+#
+# This module is used to encode and decode register values with precompiled structs.
+#
+
+from functools import lru_cache
+from struct import Struct
+from types import MappingProxyType
+from typing import Iterable, List, Mapping, Optional, Sequence, Tuple, Union
+
+from utils.register_types import BITS, STRING, byte_order, register_type, type_layout
+
+Value = Union[int, float, str, List[bool]]
+
+
+# This class is used to convert one value type to and from registers.
+# All structs and slices are built once in __init__, so decode/encode only
+# run precompiled struct calls; instances are shared through get_codec().
+class RegisterCodec:
+    __slots__ = ("kind", "count", "byteorder", "wordorder", "_words", "_wire", "_value", "_direct")
+
+    def __init__(self, kind: str, count: int = 1, byteorder="big", wordorder="big"):
+        self.kind = kind
+        self.byteorder = byte_order(byteorder)
+        self.wordorder = byte_order(wordorder)
+        if kind in (STRING, BITS):
+            self.count = count
+            self._wire = Struct(f">{count}H")
+            self._words = self._value = self._direct = None
+            return
+        char, width = type_layout(kind)
+        self.count = width
+        # Raw registers as they arrive from pymodbus / go out on the wire.
+        self._wire = Struct(f">{width}H")
+        if width == 1 and char in "bB":
+            # 8-bit values live in the high byte of their register.
+            self._words = Struct(">H")
+            self._value = Struct(f">{char}x")
+            self._direct = self._value
+            return
+        # Registers packed with the device byte order give the value bytes in big-endian order.
+        self._words = Struct(("<" if self.byteorder == "little" else ">") + "H" * width)
+        self._value = Struct(">" + char)
+        # Same orders for bytes and words means the value can be read straight from wire bytes.
+        if self.byteorder == self.wordorder or width == 1 and self.byteorder == "big":
+            self._direct = Struct(("<" if self.byteorder == "little" else ">") + char)
+        else:
+            self._direct = None
+
+    def __repr__(self):
+        return f"RegisterCodec({self.kind!r}, count={self.count}, byteorder={self.byteorder!r}, wordorder={self.wordorder!r})"
+
+    # Registers in value (most significant first) order.
+    def _ordered(self, registers: Sequence[int], offset: int) -> Sequence[int]:
+        words = registers[offset:offset + self.count]
+        if self.wordorder == "little" and self.count > 1:
+            return words[::-1]
+        return words
+
+    # Decode the value starting at offset in a register list.
+    def decode(self, registers: Sequence[int], offset: int = 0) -> Value:
+        if self.kind == STRING:
+            return self._wire.pack(*registers[offset:offset + self.count]).decode("utf-8", errors="replace").strip("\x00")
+        if self.kind == BITS:
+            return _unpack_bits(self._wire.pack(*registers[offset:offset + self.count])[:1])
+        return self._value.unpack(self._words.pack(*self._ordered(registers, offset)))[0]
+
+    # Decode the value starting at byte offset in raw response bytes.
+    def decode_bytes(self, data: Union[bytes, bytearray, memoryview], offset: int = 0) -> Value:
+        if self._direct is not None:
+            return self._direct.unpack_from(data, offset)[0]
+        return self.decode(self._wire.unpack_from(data, offset))
+
+    # Encode a value into the registers to write.
+    def encode(self, value: Value) -> List[int]:
+        if self.kind == STRING:
+            data = value.encode("utf-8") if isinstance(value, str) else bytes(value)
+            return list(self._wire.unpack(data[:self.count * 2].ljust(self.count * 2, b"\x00")))
+        if self.kind == BITS:
+            return list(self._wire.unpack(_pack_bits(value).ljust(self.count * 2, b"\x00")))
+        if self._words.size != self._value.size:
+            # 8-bit value: the padding byte of the struct becomes the low byte.
+            return list(self._words.unpack(self._value.pack(value)))
+        words = self._words.unpack(self._value.pack(value))
+        if self.wordorder == "little" and self.count > 1:
+            words = words[::-1]
+        return list(words)
+
+    # Encode a value straight into a request buffer at byte offset.
+    def encode_into(self, buffer: bytearray, offset: int, value: Value):
+        self._wire.pack_into(buffer, offset, *self.encode(value))
+
+    # Encode several values of this type back to back.
+    def encode_values(self, values: Iterable[Value]) -> List[int]:
+        registers: List[int] = []
+        for value in values:
+            registers.extend(self.encode(value))
+        return registers
+
+
+# Bits are packed least significant first, as pymodbus does.
+def _pack_bits(bits: Sequence[bool]) -> bytes:
+    data = bytearray((len(bits) + 7) // 8)
+    for i, bit in enumerate(bits):
+        if bit:
+            data[i // 8] |= 1 << (i % 8)
+    return bytes(data)
+
+
+def _unpack_bits(data: bytes) -> List[bool]:
+    return [bool(byte >> i & 1) for byte in data for i in range(8)]
+
+
+# Return the shared codec for a type key such as 'decode_32bit_float' or 'build_16bit_uint'.
+# count only matters for strings and bits; numeric types take their width from the type.
+@lru_cache(maxsize=None)
+def get_codec(key: str, count: int = 1, byteorder="big", wordorder="big") -> RegisterCodec:
+    kind = register_type(key)
+    if kind is None:
+        raise ValueError("A codec needs a register type")
+    return RegisterCodec(kind, count, byte_order(byteorder), byte_order(wordorder))
+
+
+# Compile a register map (address, count, type key, name, ...) once into name: codec.
+# Entries without a type key map to None (raw registers). The result is cached
+# and immutable, so every unit sharing a map shares the same compiled codecs.
+def compile_register_map(register_map: Iterable[Sequence], byteorder="big",
+                         wordorder="big") -> Mapping[str, Optional[RegisterCodec]]:
+    return _compile_register_map(tuple((entry[0], entry[1], entry[2], entry[3]) for entry in register_map),
+                                 byte_order(byteorder), byte_order(wordorder))
+
+
+@lru_cache(maxsize=64)
+def _compile_register_map(entries: Tuple[Tuple[int, int, Optional[str], str], ...], byteorder: str,
+                          wordorder: str) -> Mapping[str, Optional[RegisterCodec]]:
+    return MappingProxyType({
+        name: get_codec(key, count, byteorder, wordorder) if key else None
+        for _, count, key, name in entries
+    })
+
+# End of file: utils/register_codec.py
@@ -0,0 +1,141 @@
+#
+# This module is used to decode whole register arrays into typed values with NumPy.
+#
+
+from functools import lru_cache
+from typing import Dict, Iterable, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from utils.register_types import BITS, STRING, byte_order, register_type, type_layout
+
+
+# One value of a mixed register map: where it starts inside the register
+# array, its type, how many registers it spans and an optional scale factor.
+class DecodeEntry(NamedTuple):
+    name: str
+    offset: int
+    kind: Optional[str]
+    count: int = 1
+    scale: Optional[float] = None
+
+
+# Turn a register list (or array) into a uint16 array without copying arrays.
+def as_register_array(registers) -> np.ndarray:
+    return np.asarray(registers, dtype=np.uint16)
+
+
+# Big-endian dtype of one value of a numeric type.
+@lru_cache(maxsize=None)
+def _value_dtype(kind: str) -> np.dtype:
+    return np.dtype(">" + type_layout(kind)[0])
+
+
+# Gather the values starting at offsets and view their bytes as the value type.
+# registers may be 1-D (one device) or 2-D (one row per device with the same map).
+def _gather(registers: np.ndarray, offsets: np.ndarray, kind: str, byteorder: str, wordorder: str) -> np.ndarray:
+    char, width = type_layout(kind)
+    if width == 1 and char in "bB":
+        # 8-bit values are the high byte of their register.
+        return (registers[..., offsets] >> 8).astype(np.uint8).view(np.dtype(char))
+    index = offsets[:, None] + np.arange(width)
+    if wordorder == "little":
+        index = index[:, ::-1]
+    words = registers[..., index].astype(">u2" if byteorder == "big" else "<u2")
+    return np.ascontiguousarray(words).view(_value_dtype(kind))[..., 0]
+
+
+# Decode consecutive values of one type from a register array in one step.
+# count defaults to as many values as fit in the registers.
+def decode_array(registers, kind: str, byteorder="big", wordorder="big", count: Optional[int] = None,
+                 scale: Optional[float] = None) -> np.ndarray:
+    kind = register_type(kind)
+    registers = as_register_array(registers)
+    width = type_layout(kind)[1]
+    if count is None:
+        count = registers.shape[-1] // width
+    if count * width > registers.shape[-1]:
+        raise ValueError(f"{count} {kind} values need {count * width} registers, got {registers.shape[-1]}")
+    values = _gather(registers, np.arange(count) * width, kind, byte_order(byteorder), byte_order(wordorder))
+    return values * scale if scale is not None else values
+
+
+# Raw bytes of a register array in wire (big-endian) order.
+def registers_to_bytes(registers) -> bytes:
+    return as_register_array(registers).astype(">u2").tobytes()
+
+
+def _register_string(registers) -> str:
+    return registers_to_bytes(registers).decode("utf-8", errors="replace").strip("\x00")
+
+
+# This class is used to decode a mixed-type register map in one vectorised pass.
+# Entries of the same type are grouped at compile time so each call costs one
+# gather and one dtype view per type, however many values the map holds.
+class BatchDecoder:
+    def __init__(self, entries: Iterable[Sequence], byteorder="big", wordorder="big"):
+        self.entries = tuple(entry if isinstance(entry, DecodeEntry) else DecodeEntry(*entry) for entry in entries)
+        self.byteorder = byte_order(byteorder)
+        self.wordorder = byte_order(wordorder)
+        self.size = max((entry.offset + entry.count for entry in self.entries), default=0)
+        groups: Dict[str, list] = {}
+        self._others = []
+        for entry in self.entries:
+            kind = register_type(entry.kind)
+            if kind is None or kind in (STRING, BITS):
+                self._others.append((entry, kind))
+            else:
+                groups.setdefault(kind, []).append(entry)
+        self._groups = []
+        for kind, members in groups.items():
+            offsets = np.array([entry.offset for entry in members], dtype=np.intp)
+            scales = np.array([1.0 if entry.scale is None else entry.scale for entry in members])
+            scaled = any(entry.scale is not None for entry in members)
+            self._groups.append((kind, tuple(entry.name for entry in members), offsets, scales if scaled else None))
+
+    # Decode every group into arrays: a value per entry, or a column per entry for 2-D input.
+    def decode_arrays(self, registers) -> Dict[str, Tuple[Tuple[str, ...], np.ndarray]]:
+        registers = as_register_array(registers)
+        if registers.shape[-1] < self.size:
+            raise ValueError(f"Register map needs {self.size} registers, got {registers.shape[-1]}")
+        arrays = {}
+        for kind, names, offsets, scales in self._groups:
+            values = _gather(registers, offsets, kind, self.byteorder, self.wordorder)
+            if scales is not None:
+                values = values * scales
+            arrays[kind] = (names, values)
+        return arrays
+
+    # Decode a register array into named values.
+    # 1-D input gives Python scalars, 2-D input gives one array per name.
+    def decode(self, registers) -> Dict[str, object]:
+        registers = as_register_array(registers)
+        values: Dict[str, object] = {}
+        for names, decoded in self.decode_arrays(registers).values():
+            if registers.ndim == 1:
+                values.update(zip(names, decoded.tolist()))
+            else:
+                values.update(zip(names, np.moveaxis(decoded, -1, 0)))
+        for entry, kind in self._others:
+            block = registers[..., entry.offset:entry.offset + entry.count]
+            if kind is None:
+                values[entry.name] = block.tolist() if registers.ndim == 1 else block
+            elif kind == STRING:
+                # As RegisterCodec: UTF-8 text without the NUL padding, one string per row for 2-D input.
+                if registers.ndim == 1:
+                    values[entry.name] = _register_string(block)
+                else:
+                    values[entry.name] = [_register_string(row) for row in block.reshape(-1, entry.count)]
+            else:
+                high_byte = (block[..., :1] >> 8).astype(np.uint8)
+                values[entry.name] = np.unpackbits(high_byte, axis=-1, bitorder="little").astype(bool).tolist()
+        return values
+
+
+# Compile (once) the decoder for a coalesced read block from utils.register_planner.
+@lru_cache(maxsize=1024)
+def block_decoder(block, byteorder="big", wordorder="big") -> BatchDecoder:
+    return BatchDecoder([DecodeEntry(entry.name, entry.address - block.address, entry.decode, entry.count)
+                         for entry in block.entries], byteorder, wordorder)
+
+# End of file: utils/register_decoder.py
@@ -0,0 +1,99 @@
+#
+# This module is used to plan coalesced Modbus register reads.
+#
+
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+# A single read request (FC3/FC4) may return at most 125 registers.
+MAX_READ_REGISTERS = 125
+
+# Modbus function codes a read plan can be issued with.
+READ_HOLDING_REGISTERS = 3
+READ_INPUT_REGISTERS = 4
+
+
+# One named entry of a register map.
+# The field order mirrors the REGISTER_ADDRESSES_READ tuples:
+# register_address, register_count, decode, register_name.
+class RegisterRead(NamedTuple):
+    address: int
+    count: int
+    decode: Optional[str]
+    name: str
+
+    @property
+    def end(self) -> int:
+        return self.address + self.count
+
+
+# One coalesced request covering several register map entries.
+class ReadBlock(NamedTuple):
+    address: int
+    count: int
+    function_code: int
+    entries: Tuple[RegisterRead, ...]
+
+    # Offset of an entry inside the block, in registers.
+    def offset(self, entry: RegisterRead) -> int:
+        return entry.address - self.address
+
+    # Split the registers returned for this block back into named values.
+    def split(self, registers: Sequence[int]) -> Dict[str, List[int]]:
+        if len(registers) < self.count:
+            raise ValueError(f"Block at {self.address} expects {self.count} registers, got {len(registers)}")
+        values = {}
+        for entry in self.entries:
+            start = entry.address - self.address
+            values[entry.name] = list(registers[start:start + entry.count])
+        return values
+
+
+# Normalise register map entries to RegisterRead tuples.
+def as_register_reads(register_map: Iterable[Sequence]) -> List[RegisterRead]:
+    entries = []
+    for entry in register_map:
+        entry = entry if isinstance(entry, RegisterRead) else RegisterRead(*entry[:4])
+        if entry.count < 1:
+            raise ValueError(f"Register {entry.name} has an invalid count {entry.count}")
+        if entry.count > MAX_READ_REGISTERS:
+            raise ValueError(f"Register {entry.name} spans {entry.count} registers, "
+                             f"more than the {MAX_READ_REGISTERS} allowed per request")
+        entries.append(entry)
+    return entries
+
+
+# Merge a register map into the fewest read requests.
+# Entries are sorted by address and greedily packed into a block as long as
+# the hole before them is at most max_gap registers and the block stays within
+# max_count registers. Holes are read and discarded, so max_gap should only be
+# raised on devices that answer reads of unmapped addresses.
+def plan_reads(register_map: Iterable[Sequence], max_gap: int = 0, max_count: int = MAX_READ_REGISTERS,
+               function_code: int = READ_INPUT_REGISTERS) -> List[ReadBlock]:
+    if not 1 <= max_count <= MAX_READ_REGISTERS:
+        raise ValueError(f"max_count must be between 1 and {MAX_READ_REGISTERS}")
+    if max_gap < 0:
+        raise ValueError("max_gap must not be negative")
+    entries = sorted(as_register_reads(register_map), key=lambda entry: (entry.address, entry.count))
+    blocks = []
+    start = end = 0
+    members: List[RegisterRead] = []
+    for entry in entries:
+        if entry.count > max_count:
+            raise ValueError(f"Register {entry.name} spans {entry.count} registers, more than max_count {max_count}")
+        if members and entry.address - end <= max_gap and max(end, entry.end) - start <= max_count:
+            end = max(end, entry.end)
+            members.append(entry)
+            continue
+        if members:
+            blocks.append(ReadBlock(start, end - start, function_code, tuple(members)))
+        start, end, members = entry.address, entry.end, [entry]
+    if members:
+        blocks.append(ReadBlock(start, end - start, function_code, tuple(members)))
+    return blocks
+
+
+# Total number of registers (mapped and gap) a plan transfers.
+def planned_register_count(plan: Iterable[ReadBlock]) -> int:
+    return sum(block.count for block in plan)
+
+# End of file: utils/register_planner.py
@@ -0,0 +1,71 @@
+#
+# This module is used to name the value types stored in Modbus registers.
+#
+
+from typing import Optional, Tuple
+
+# type name: (struct format character, registers per value)
+REGISTER_TYPES = {
+    "uint8": ("B", 1),
+    "int8": ("b", 1),
+    "uint16": ("H", 1),
+    "int16": ("h", 1),
+    "uint32": ("I", 2),
+    "int32": ("i", 2),
+    "uint64": ("Q", 4),
+    "int64": ("q", 4),
+    "float16": ("e", 1),
+    "float32": ("f", 2),
+    "float64": ("d", 4),
+}
+
+# Types that are not a single number: their register count comes from the map.
+STRING = "string"
+BITS = "bits"
+
+# Short names used in vendor register lists and device config files.
+ALIASES = {
+    "u8": "uint8", "s8": "int8", "i8": "int8",
+    "u16": "uint16", "s16": "int16", "i16": "int16",
+    "u32": "uint32", "s32": "int32", "i32": "int32",
+    "u64": "uint64", "s64": "int64", "i64": "int64",
+    "f16": "float16", "f32": "float32", "f64": "float64",
+    "float": "float32", "double": "float64",
+    "str": STRING, "string_list": STRING,
+}
+
+
+# Normalise a decoder/builder key or config type name to a type name.
+# 'decode_32bit_float', 'build_32bit_float', '32bit_float', 'F32' and 'float32'
+# all give 'float32'; None stays None (raw registers).
+def register_type(key: Optional[str]) -> Optional[str]:
+    if key is None:
+        return None
+    name = key.lower()
+    for prefix in ("decode_", "build_"):
+        if name.startswith(prefix):
+            name = name[len(prefix):]
+    if "bit_" in name:
+        size, kind = name.split("bit_", 1)
+        name = kind + size
+    name = ALIASES.get(name, name)
+    if name in REGISTER_TYPES or name in (STRING, BITS):
+        return name
+    raise ValueError(f"Unknown register type {key}")
+
+
+# Struct format character and registers per value of a numeric type.
+def type_layout(kind: str) -> Tuple[str, int]:
+    return REGISTER_TYPES[kind]
+
+
+# Normalise a byte/word order given as 'big'/'little', '>'/'<' or a pymodbus Endian.
+def byte_order(order) -> str:
+    order = getattr(order, "value", order)
+    if order in (">", "!", "big"):
+        return "big"
+    if order in ("<", "little"):
+        return "little"
+    raise ValueError(f"Unknown byte order {order}")
+
+# End of file: utils/register_types.py
@@ -0,0 +1,145 @@
+#
+# This module is used to plan and run batched Modbus register writes.
+#
+
+from typing import Callable, Dict, Iterable, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+from utils.config_loader import RegisterMap
+from utils.register_codec import compile_register_map
+from utils.register_planner import RegisterRead, plan_reads
+
+# A single write multiple registers request (FC16) may carry at most 123 registers.
+MAX_WRITE_REGISTERS = 123
+
+
+# One named setpoint encoded into the registers to write.
+class WritePoint(NamedTuple):
+    name: str
+    address: int
+    value: object
+    registers: Tuple[int, ...]
+
+    @property
+    def count(self) -> int:
+        return len(self.registers)
+
+    @property
+    def end(self) -> int:
+        return self.address + len(self.registers)
+
+
+# One FC16 request covering several contiguous setpoints.
+class WriteBlock(NamedTuple):
+    address: int
+    points: Tuple[WritePoint, ...]
+
+    @property
+    def count(self) -> int:
+        return sum(point.count for point in self.points)
+
+    # Registers of every point, back to back.
+    @property
+    def registers(self) -> List[int]:
+        registers: List[int] = []
+        for point in self.points:
+            registers.extend(point.registers)
+        return registers
+
+
+# Outcome of one setpoint. verified is None when there was no read-back (not asked
+# for, or the write or read-back failed); read_back holds the registers read back.
+class WriteResult(NamedTuple):
+    name: str
+    address: int
+    value: object
+    written: bool
+    verified: Optional[bool] = None
+    read_back: Optional[List[int]] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.written and self.verified is not False
+
+
+# Encode named setpoints with the types of a register map.
+# Entries without a type take a register list, or an int written as one raw register.
+def encode_setpoints(register_map, setpoints: Mapping[str, object], byteorder="big",
+                     wordorder="big") -> List[WritePoint]:
+    register_map = register_map if isinstance(register_map, RegisterMap) else RegisterMap(register_map)
+    codecs = compile_register_map(register_map.entries, byteorder=byteorder, wordorder=wordorder)
+    points = []
+    for name, value in setpoints.items():
+        entry = register_map.get(name)
+        if entry is None:
+            raise KeyError(f"Register {name} is not in the write map")
+        codec = codecs[name]
+        if codec is not None:
+            registers = codec.encode(value)
+        elif isinstance(value, (list, tuple)):
+            registers = list(value)
+        elif isinstance(value, int):
+            registers = [value & 0xFFFF]
+        else:
+            raise ValueError(f"Register {name} has no type to encode {value!r} with")
+        if len(registers) != entry.count:
+            raise ValueError(f"Register {name} spans {entry.count} registers, got {len(registers)}")
+        points.append(WritePoint(name, entry.address, value, tuple(registers)))
+    return points
+
+
+# Merge setpoints into the fewest FC16 requests.
+# Only back-to-back points share a request (a write cannot skip addresses) and
+# a request stays within max_count registers. Overlapping points are rejected.
+def plan_writes(points: Iterable[WritePoint], max_count: int = MAX_WRITE_REGISTERS) -> List[WriteBlock]:
+    if not 1 <= max_count <= MAX_WRITE_REGISTERS:
+        raise ValueError(f"max_count must be between 1 and {MAX_WRITE_REGISTERS}")
+    blocks = []
+    members: List[WritePoint] = []
+    end = 0
+    for point in sorted(points, key=lambda point: point.address):
+        if point.count > max_count:
+            raise ValueError(f"Register {point.name} spans {point.count} registers, more than max_count {max_count}")
+        if members and point.address < end:
+            raise ValueError(f"Registers {members[-1].name} and {point.name} overlap")
+        if members and point.address == end and end + point.count - members[0].address <= max_count:
+            members.append(point)
+            end = point.end
+            continue
+        if members:
+            blocks.append(WriteBlock(members[0].address, tuple(members)))
+        members, end = [point], point.end
+    if members:
+        blocks.append(WriteBlock(members[0].address, tuple(members)))
+    return blocks
+
+
+# Run a write plan and report every setpoint.
+# write(address, registers) returns whether the request succeeded. With read,
+# a (address, count) callable returning registers or None, the written points
+# are read back with coalesced requests (max_gap as for plan_reads) and
+# compared with what was sent.
+def execute_writes(blocks: Sequence[WriteBlock], write: Callable[[int, List[int]], bool],
+                   read: Optional[Callable[[int, int], Optional[Sequence[int]]]] = None,
+                   max_gap: int = 0) -> Dict[str, WriteResult]:
+    results: Dict[str, WriteResult] = {}
+    written: List[WritePoint] = []
+    for block in blocks:
+        ok = write(block.address, block.registers)
+        for point in block.points:
+            results[point.name] = WriteResult(point.name, point.address, point.value, ok)
+        if ok:
+            written.extend(block.points)
+    if read is None or not written:
+        return results
+    points = {point.name: point for point in written}
+    for read_block in plan_reads([RegisterRead(point.address, point.count, None, point.name) for point in written],
+                                 max_gap=max_gap):
+        registers = read(read_block.address, read_block.count)
+        if registers is None:
+            continue
+        for name, read_back in read_block.split(registers).items():
+            results[name] = results[name]._replace(verified=tuple(read_back) == points[name].registers,
+                                                   read_back=read_back)
+    return results
+
+# End of file: utils/register_writer.py
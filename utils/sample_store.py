@@ -0,0 +1,273 @@
+#
+# This module is used to store polled samples in memory-mapped binary segment files.
+#
+
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+# Default store location, under the repository's logs directory.
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "logs", "samples")
+
+# One sample: timestamp (unix seconds), device id, register id, flags, value.
+RECORD = struct.Struct("<dHHId")
+RECORD_DTYPE = np.dtype([("t", "<f8"), ("device", "<u2"), ("register", "<u2"), ("flags", "<u4"), ("value", "<f8")])
+
+# Segment header: magic, record size, segment flags, record count, lowest and highest timestamp.
+HEADER = struct.Struct("<8sIIQdd")
+HEADER_SIZE = 64
+MAGIC = b"UIOTSMP1"
+
+# Set in the segment flags once a sample was appended with an earlier timestamp
+# than one already in the segment; such segments are scanned linearly.
+SEGMENT_UNSORTED = 1
+
+# Set in flags when the value could not be read (value is NaN).
+FLAG_ERROR = 1
+
+INDEX_FILE = "index.json"
+
+
+# Samples of one register scanned from the store, as columns.
+class SampleColumns(NamedTuple):
+    t: np.ndarray
+    value: np.ndarray
+    flags: np.ndarray
+
+
+def _segment_name(sequence: int) -> str:
+    return f"segment_{sequence:08d}.dat"
+
+
+def _segment_files(directory: str) -> List[str]:
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name for name in os.listdir(directory) if name.startswith("segment_") and name.endswith(".dat"))
+
+
+# Name <-> id tables for devices and registers, kept in index.json next to the segments.
+# New names are saved by save_pending(), which the writer calls on flush, rotation and close.
+class _NameIndex:
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, INDEX_FILE)
+        self.devices: Dict[str, int] = {}
+        self.registers: Dict[str, int] = {}
+        self.pending = False
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as file:
+                index = json.load(file)
+            self.devices = {name: i for i, name in enumerate(index["devices"])}
+            self.registers = {name: i for i, name in enumerate(index["registers"])}
+
+    def _id(self, table: Dict[str, int], name: str) -> int:
+        key = table.get(name)
+        if key is None:
+            if len(table) > 0xFFFF:
+                raise ValueError("The sample store holds at most 65536 device and register names")
+            key = table[name] = len(table)
+            self.pending = True
+        return key
+
+    def device_id(self, name) -> int:
+        return self._id(self.devices, str(name))
+
+    def register_id(self, name) -> int:
+        return self._id(self.registers, str(name))
+
+    def save(self):
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump({"devices": list(self.devices), "registers": list(self.registers)}, file)
+        os.replace(temporary, self.path)
+        self.pending = False
+
+    def save_pending(self):
+        if self.pending:
+            self.save()
+
+
+# This class is used to append samples to memory-mapped segment files.
+# Each segment is preallocated for segment_records fixed-width records; when it
+# is full the writer moves on to a new one and deletes the oldest segments
+# beyond max_segments. Only numeric values are stored (bools as 0/1); None is
+# stored as NaN with FLAG_ERROR and other types are skipped. Names first seen
+# since the last flush() are written to index.json on flush() and close().
+class SampleWriter:
+    def __init__(self, directory: str = SAMPLE_DIR, segment_records: int = 1 << 20,
+                 max_segments: Optional[int] = 100):
+        self.directory = directory
+        self.segment_records = segment_records
+        self.max_segments = max_segments
+        os.makedirs(directory, exist_ok=True)
+        self.index = _NameIndex(directory)
+        self._lock = threading.Lock()
+        self._file = None
+        self._map: Optional[mmap.mmap] = None
+        self._count = 0
+        self._capacity = 0
+        self._flags = 0
+        self._first = self._last = 0.0
+        self._sequence = 0
+        segments = _segment_files(directory)
+        if segments:
+            self._sequence = int(segments[-1][8:16])
+            self._open(self._sequence)
+        else:
+            self._open(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _open(self, sequence: int):
+        path = os.path.join(self.directory, _segment_name(sequence))
+        size = HEADER_SIZE + self.segment_records * RECORD.size
+        existing = os.path.exists(path)
+        self._file = open(path, "r+b" if existing else "w+b")
+        if not existing or os.path.getsize(path) < HEADER_SIZE:
+            self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._sequence = sequence
+        self._capacity = (len(self._map) - HEADER_SIZE) // RECORD.size
+        magic, record_size, flags, count, first, last = HEADER.unpack_from(self._map, 0)
+        if magic == MAGIC and record_size == RECORD.size:
+            self._flags, self._count, self._first, self._last = flags, count, first, last
+        else:
+            self._flags, self._count, self._first, self._last = 0, 0, 0.0, 0.0
+            self._write_header()
+
+    def _write_header(self):
+        HEADER.pack_into(self._map, 0, MAGIC, RECORD.size, self._flags, self._count, self._first, self._last)
+
+    def _rotate(self):
+        self.index.save_pending()
+        self._close_segment()
+        self._open(self._sequence + 1)
+        if self.max_segments:
+            for name in _segment_files(self.directory)[:-self.max_segments]:
+                os.remove(os.path.join(self.directory, name))
+
+    def _close_segment(self):
+        if self._map is not None:
+            self._write_header()
+            self._map.flush()
+            self._map.close()
+            self._file.close()
+            self._map = self._file = None
+
+    # Append one sample; returns False when the value is not numeric and was skipped.
+    def append(self, device, register, value, timestamp: Optional[float] = None, flags: int = 0) -> bool:
+        if value is None:
+            value, flags = float("nan"), flags | FLAG_ERROR
+        elif not isinstance(value, (int, float)):
+            return False
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            device_id = self.index.device_id(device)
+            register_id = self.index.register_id(register)
+            if self._count >= self._capacity:
+                self._rotate()
+            RECORD.pack_into(self._map, HEADER_SIZE + self._count * RECORD.size,
+                             timestamp, device_id, register_id, flags, value)
+            if not self._count:
+                self._first = self._last = timestamp
+            elif timestamp < self._last:
+                # The wall clock stepped back: keep the time range, stop binary searching.
+                self._flags |= SEGMENT_UNSORTED
+                self._first = min(self._first, timestamp)
+            else:
+                self._last = timestamp
+            self._count += 1
+            struct.pack_into("<IQdd", self._map, 12, self._flags, self._count, self._first, self._last)
+        return True
+
+    # Append every numeric value of one poll of a device with a shared timestamp.
+    # Returns the number of samples stored.
+    def append_values(self, device, values: Mapping[str, object], timestamp: Optional[float] = None) -> int:
+        timestamp = time.time() if timestamp is None else timestamp
+        return sum(self.append(device, name, value, timestamp) for name, value in values.items())
+
+    # Write the mapped pages and any new names out to the files.
+    def flush(self):
+        with self._lock:
+            self.index.save_pending()
+            if self._map is not None:
+                self._map.flush()
+
+    def close(self):
+        with self._lock:
+            self.index.save_pending()
+            self._close_segment()
+
+
+# This class is used to scan stored samples by register and time range.
+# Segments are memory-mapped read-only as NumPy record arrays; segments whose
+# header time range misses the query are skipped and the time column is
+# binary-searched, so a scan only touches the pages it returns. Segments written
+# while the clock stepped back are flagged unsorted and filtered linearly instead.
+class SampleReader:
+    def __init__(self, directory: str = SAMPLE_DIR):
+        self.directory = directory
+
+    def _index(self) -> _NameIndex:
+        return _NameIndex(self.directory)
+
+    # Device and register names known to the store.
+    def names(self) -> Tuple[List[str], List[str]]:
+        index = self._index()
+        return list(index.devices), list(index.registers)
+
+    # (records, sorted) of every segment whose time range overlaps [start, end).
+    def _segments(self, start: Optional[float], end: Optional[float]) -> Iterable[Tuple[np.ndarray, bool]]:
+        for name in _segment_files(self.directory):
+            path = os.path.join(self.directory, name)
+            with open(path, "rb") as file:
+                magic, record_size, flags, count, first, last = HEADER.unpack(file.read(HEADER.size))
+            if magic != MAGIC or record_size != RECORD.size or not count:
+                continue
+            if start is not None and last < start or end is not None and first >= end:
+                continue
+            records = np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=HEADER_SIZE, shape=(count,))
+            yield records, not flags & SEGMENT_UNSORTED
+
+    # Records of a segment in [start, end).
+    @staticmethod
+    def _window(records: np.ndarray, in_order: bool, start: Optional[float], end: Optional[float]) -> np.ndarray:
+        times = records["t"]
+        if not in_order:
+            mask = np.ones(len(records), dtype=bool)
+            if start is not None:
+                mask &= times >= start
+            if end is not None:
+                mask &= times < end
+            return records[mask]
+        low = 0 if start is None else int(np.searchsorted(times, start, side="left"))
+        high = len(records) if end is None else int(np.searchsorted(times, end, side="left"))
+        return records[low:high]
+
+    # Samples of one register in [start, end), optionally from one device only, in append order.
+    def scan(self, register, device=None, start: Optional[float] = None, end: Optional[float] = None) -> SampleColumns:
+        index = self._index()
+        register_id = index.registers.get(str(register))
+        device_id = None if device is None else index.devices.get(str(device))
+        if register_id is None or device is not None and device_id is None:
+            return SampleColumns(np.empty(0), np.empty(0), np.empty(0, dtype=np.uint32))
+        parts = []
+        for records, in_order in self._segments(start, end):
+            window = self._window(records, in_order, start, end)
+            mask = window["register"] == register_id
+            if device_id is not None:
+                mask &= window["device"] == device_id
+            parts.append(np.array(window[mask]))
+        selected = np.concatenate(parts) if parts else np.empty(0, dtype=RECORD_DTYPE)
+        return SampleColumns(selected["t"], selected["value"], selected["flags"])
+
+# End of file: utils/sample_store.py
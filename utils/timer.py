@@ -2,18 +2,209 @@
 # This module is used for anything timing related.
 #
 
+import asyncio
+import functools
+import json
+import threading
 import time
-from time import sleep
-import datetime
-import random
-import string
+from bisect import bisect_left
+from typing import Dict, Sequence, Tuple
 
 
 class Timer:
     def __init__(self):
         self.start_time = 0
         self.end_time = 0
-        self.elapsed_time = 0
+        self.elapsed = 0.0
 
     def start(self):
-        self.start_time = time.time()
\ No newline at end of file
+        self.start_time = time.perf_counter()
+
+    def stop(self):
+        self.end_time = time.perf_counter()
+        self.elapsed += self.end_time - self.start_time
+        return self.elapsed
+
+    def reset(self):
+        self.start_time = self.end_time = 0
+        self.elapsed = 0.0
+
+    # Seconds measured between start() and stop() since the last reset.
+    def elapsed_time(self):
+        return self.elapsed
+
+
+# Histogram bucket upper bounds in seconds: 1-2.5-5 steps from 100 us to 10 s.
+LATENCY_BUCKETS = tuple(round(base * 10.0 ** exponent, 7) for exponent in range(-4, 1) for base in (1, 2.5, 5)) + (10.0,)
+
+# Counter names recorded by PollMetrics.
+TIMEOUT = "timeout"
+RETRY = "retry"
+EXCEPTION = "exception"
+ERROR_RESPONSE = "error_response"
+
+
+# This class is a fixed-memory latency histogram.
+# Samples only bump a bucket count, so memory does not grow with the number of
+# observations; percentiles are estimated from the bucket bounds.
+class LatencyHistogram:
+    __slots__ = ("bounds", "buckets", "count", "sum", "min", "max")
+
+    def __init__(self, bounds: Sequence[float] = LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.buckets[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # Estimated latency at percentile p: the upper bound of the bucket holding it.
+    def percentile(self, p: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self) -> Dict[str, object]:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else 0.0,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "buckets": dict(zip([*map(str, self.bounds), "+Inf"], self.buckets)),
+        }
+
+
+# This class is used to time one request and record it into PollMetrics.
+# It works as a context manager and as a decorator for sync and async functions.
+class Measurement:
+    __slots__ = ("metrics", "key", "start")
+
+    def __init__(self, metrics: "PollMetrics", key: Tuple[str, int, str]):
+        self.metrics = metrics
+        self.key = key
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.metrics.observe(self.key, time.perf_counter() - self.start)
+        if exc_type is not None:
+            timeout = issubclass(exc_type, (TimeoutError, asyncio.TimeoutError))
+            self.metrics.count(self.key[0], TIMEOUT if timeout else EXCEPTION)
+        return False
+
+    def __call__(self, function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def timed_async(*args, **kwargs):
+                with Measurement(self.metrics, self.key):
+                    return await function(*args, **kwargs)
+            return timed_async
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            with Measurement(self.metrics, self.key):
+                return function(*args, **kwargs)
+        return timed
+
+
+# This class is used to collect poll latency and error counts.
+# Latency goes into one LatencyHistogram per (device, function code, register block)
+# and timeouts, retries, exceptions and error responses are counted per device.
+# Recording costs a perf_counter() pair, a dict lookup and a bisect, so it can stay on.
+class PollMetrics:
+    def __init__(self, bounds: Sequence[float] = LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.histograms: Dict[Tuple[str, int, str], LatencyHistogram] = {}
+        self.counters: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+
+    # Time a request: 'with metrics.time(device, 3, block):' or '@metrics.time(device, 3, block)'.
+    def time(self, device, function_code: int, block) -> Measurement:
+        return Measurement(self, (str(device), int(function_code), str(block)))
+
+    def observe(self, key: Tuple[str, int, str], seconds: float):
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram(self.bounds)
+            histogram.observe(seconds)
+
+    # Count an event (TIMEOUT, RETRY, EXCEPTION, ERROR_RESPONSE) for a device.
+    def count(self, device, event: str, n: int = 1):
+        key = (str(device), event)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    # Plain-data copy of every histogram and counter.
+    def snapshot(self) -> Dict[str, object]:
+        with self._lock:
+            latency = [{"device": device, "function_code": function_code, "block": block, **histogram.snapshot()}
+                       for (device, function_code, block), histogram in sorted(self.histograms.items())]
+            counters = [{"device": device, "event": event, "count": count}
+                        for (device, event), count in sorted(self.counters.items())]
+        return {"timestamp": time.time(), "latency": latency, "counters": counters}
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.snapshot(), **kwargs)
+
+    # Metrics in the Prometheus text exposition format.
+    def to_prometheus(self, prefix: str = "modbus") -> str:
+        snapshot = self.snapshot()
+        lines = [f"# HELP {prefix}_request_seconds Modbus request latency.",
+                 f"# TYPE {prefix}_request_seconds histogram"]
+        for entry in snapshot["latency"]:
+            labels = (f'device="{_escape(entry["device"])}",function_code="{entry["function_code"]}",'
+                      f'block="{_escape(entry["block"])}"')
+            cumulative = 0
+            for bound, count in entry["buckets"].items():
+                cumulative += count
+                lines.append(f'{prefix}_request_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{prefix}_request_seconds_sum{{{labels}}} {entry['sum']}")
+            lines.append(f"{prefix}_request_seconds_count{{{labels}}} {entry['count']}")
+        lines += [f"# HELP {prefix}_events_total Modbus timeouts, retries, exceptions and error responses.",
+                  f"# TYPE {prefix}_events_total counter"]
+        for entry in snapshot["counters"]:
+            lines.append(f'{prefix}_events_total{{device="{_escape(entry["device"])}",event="{entry["event"]}"}} '
+                         f'{entry["count"]}')
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Process-wide metrics used by the Modbus read and write paths.
+METRICS = PollMetrics()
+
+
+# Label of a register block for metrics, e.g. '40101-40110'.
+def block_label(address: int, count: int) -> str:
+    return f"{address}-{address + count - 1}"
+
+# End of file: utils/timer.py
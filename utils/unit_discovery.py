@@ -0,0 +1,207 @@
+#
+# This module is used to find the live Modbus unit ids on each bus and remember them.
+#
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+# Where discovery results are kept between runs.
+DISCOVERY_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "logs", "unit_discovery.json")
+
+# Every unit id a Modbus device may use.
+UNIT_RANGE = range(1, 248)
+
+
+# Set the response timeout of a pymodbus sync client (serial or TCP) in place.
+def set_timeout(client, timeout: float):
+    params = getattr(client, "comm_params", None)
+    if params is not None:
+        params.timeout_connect = timeout
+    sock = getattr(client, "socket", None)
+    if sock is None:
+        return
+    if hasattr(sock, "settimeout"):
+        sock.settimeout(timeout)
+    else:
+        # pyserial port
+        sock.timeout = timeout
+
+
+# Response timeouts of a client as (comm_params.timeout_connect, open port or socket timeout), for restore_timeout().
+def get_timeout(client) -> Tuple[Optional[float], Optional[float]]:
+    params = getattr(client, "comm_params", None)
+    sock = getattr(client, "socket", None)
+    if sock is None:
+        current = None
+    elif hasattr(sock, "gettimeout"):
+        current = sock.gettimeout()
+    else:
+        # pyserial port
+        current = sock.timeout
+    return getattr(params, "timeout_connect", None), current
+
+
+# Put back the timeouts saved by get_timeout().
+def restore_timeout(client, saved: Tuple[Optional[float], Optional[float]]):
+    configured, current = saved
+    params = getattr(client, "comm_params", None)
+    if params is not None and configured is not None:
+        params.timeout_connect = configured
+    sock = getattr(client, "socket", None)
+    if sock is None:
+        return
+    # A port opened during the probes takes the configured timeout, like one opened normally.
+    current = configured if current is None else current
+    if hasattr(sock, "settimeout"):
+        sock.settimeout(current)
+    else:
+        sock.timeout = current
+
+
+# Probe one unit with a one-register read; returns the response time or None if nothing answered.
+# A Modbus exception response still proves the unit is there.
+def probe_unit(client, unit: int, address: int = 0, function_code: int = 3) -> Optional[float]:
+    from pymodbus.exceptions import ModbusIOException
+
+    start = time.perf_counter()
+    try:
+        if function_code == 3:
+            response = client.read_holding_registers(address, 1, slave=unit)
+        else:
+            response = client.read_input_registers(address, 1, slave=unit)
+    except Exception:
+        return None
+    if isinstance(response, ModbusIOException):
+        return None
+    return time.perf_counter() - start
+
+
+# This class is a probe timeout that follows the latency of the units found so far:
+# factor times the slowest answer, kept between min_timeout and max_timeout.
+class AdaptiveTimeout:
+    def __init__(self, initial: float = 0.1, min_timeout: float = 0.02, max_timeout: float = 1.0, factor: float = 3.0):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.factor = factor
+        self.slowest = 0.0
+        self.value = min(max(initial, min_timeout), max_timeout)
+
+    def observe(self, latency: float):
+        if latency > self.slowest:
+            self.slowest = latency
+            self.value = min(max(self.factor * latency, self.min_timeout, self.value), self.max_timeout)
+
+
+# This class is used to discover live unit ids per bus and persist them.
+# scan() probes every candidate on one bus; scan_all() runs one scan per bus in
+# parallel threads (probes on one bus stay sequential). Results are saved to
+# path as {bus: {"units": {unit: latency}, "updated": time}} so later runs can
+# poll known() units only and call reprobe() between sweeps to pick up the
+# missing ones a few at a time.
+class UnitDiscovery:
+    def __init__(self, path: str = DISCOVERY_FILE, candidates: Iterable[int] = UNIT_RANGE, initial_timeout: float = 0.1,
+                 min_timeout: float = 0.02, max_timeout: float = 1.0, address: int = 0, function_code: int = 3):
+        self.path = path
+        self.candidates = list(candidates)
+        self.initial_timeout = initial_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.address = address
+        self.function_code = function_code
+        self.results: Dict[str, Dict[str, Any]] = {}
+        self._next_missing: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as file:
+                self.results = json.load(file)
+
+    def save(self):
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temporary = self.path + ".tmp"
+            with open(temporary, "w", encoding="utf-8") as file:
+                json.dump(self.results, file, indent=2, sort_keys=True)
+            os.replace(temporary, self.path)
+
+    # Live units of a bus from the last scan, with their response times in seconds.
+    def latencies(self, bus: str) -> Dict[int, float]:
+        return {int(unit): latency for unit, latency in self.results.get(bus, {}).get("units", {}).items()}
+
+    # Live unit ids of a bus, in id order.
+    def known(self, bus: str) -> List[int]:
+        return sorted(self.latencies(bus))
+
+    # Candidates that did not answer on a bus.
+    def missing(self, bus: str) -> List[int]:
+        live = set(self.latencies(bus))
+        return [unit for unit in self.candidates if unit not in live]
+
+    def _timeout(self, bus: str) -> AdaptiveTimeout:
+        timeout = AdaptiveTimeout(self.initial_timeout, self.min_timeout, self.max_timeout)
+        for latency in self.latencies(bus).values():
+            timeout.observe(latency)
+        return timeout
+
+    def _record(self, bus: str, unit: int, latency: Optional[float]):
+        with self._lock:
+            entry = self.results.setdefault(bus, {"units": {}})
+            if latency is None:
+                entry["units"].pop(str(unit), None)
+            else:
+                entry["units"][str(unit)] = round(latency, 6)
+            entry["updated"] = time.time()
+
+    # Probe units (all candidates by default) on one bus and save the result.
+    def scan(self, bus: str, client, units: Optional[Iterable[int]] = None) -> Dict[int, float]:
+        timeout = self._timeout(bus)
+        # One probe per unit even with retry_on_empty; the adaptive timeout already bounds the wait.
+        transaction = getattr(client, "transaction", None)
+        retries = getattr(transaction, "retries", None)
+        if retries is not None:
+            transaction.retries = 0
+        # The probe timeout is only for probing: the client goes back to its own timeout for polling.
+        saved = get_timeout(client)
+        try:
+            for unit in self.candidates if units is None else units:
+                set_timeout(client, timeout.value)
+                latency = probe_unit(client, unit, self.address, self.function_code)
+                if latency is not None:
+                    timeout.observe(latency)
+                self._record(bus, unit, latency)
+        finally:
+            restore_timeout(client, saved)
+            if retries is not None:
+                transaction.retries = retries
+        self.save()
+        return self.latencies(bus)
+
+    # Scan several buses at once; clients maps bus name to an open client.
+    def scan_all(self, clients: Mapping[str, Any]) -> Dict[str, Dict[int, float]]:
+        if not clients:
+            return {}
+        with ThreadPoolExecutor(max_workers=len(clients)) as pool:
+            futures = {bus: pool.submit(self.scan, bus, client) for bus, client in clients.items()}
+        return {bus: future.result() for bus, future in futures.items()}
+
+    # Probe the next count missing units of a bus, round robin; returns the ones that answered.
+    # Meant to run between poll sweeps so missing units are picked up without a full scan.
+    def reprobe(self, bus: str, client, count: int = 1) -> List[int]:
+        missing = self.missing(bus)
+        if not missing:
+            return []
+        start = self._next_missing.get(bus, 0) % len(missing)
+        units = (missing[start:] + missing[:start])[:count]
+        self._next_missing[bus] = start + len(units)
+        before = set(self.latencies(bus))
+        return sorted(set(self.scan(bus, client, units)) - before)
+
+# End of file: utils/unit_discovery.py